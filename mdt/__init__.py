@@ -25,7 +25,7 @@ from mdt.component_templates.library_functions import LibraryFunctionTemplate
 from mdt.model_fitting import get_batch_fitting_function
 from mdt.user_script_info import easy_save_user_script_info
 from mdt.utils import estimate_noise_std, get_cl_devices, load_input_data,\
-    create_blank_mask, create_index_matrix, \
+    create_blank_mask, create_index_matrix, MaskIndex, get_mask_index, \
     volume_index_to_roi_index, roi_index_to_volume_index, load_brain_mask, init_user_settings, restore_volumes, \
     apply_mask, create_roi, volume_merge, protocol_merge, create_median_otsu_brain_mask, load_samples, load_sample, \
     load_nifti, write_slice_roi, apply_mask_to_file, extract_volumes, \
@@ -33,7 +33,8 @@ from mdt.utils import estimate_noise_std, get_cl_devices, load_input_data,\
     get_temporary_results_dir, get_example_data, SimpleInitializationData, InitializationData, load_volume_maps,\
     covariance_to_correlation, check_user_components
 from mdt.sorting import sort_orientations, create_sort_matrix, sort_volumes_per_voxel
-from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise
+from mdt.simulations import (create_signal_estimates, iter_signal_estimates, simulate_signals, iter_simulate_signals,
+                             add_noise, add_gaussian_noise, add_rician_noise, run_recovery_study)
 from mdt.batch_utils import run_function_on_batch_fit_output, batch_apply, \
     batch_profile_factory, get_subject_selection
 from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, write_protocol, write_bvec_bval
@@ -54,7 +55,7 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 def fit_model(model, input_data, output_folder, optimizer=None,
               recalculate=False, only_recalculate_last=False, cascade_subdir=False,
               cl_device_ind=None, double_precision=False, tmp_results_dir=True, save_user_script_info=True,
-              initialization_data=None, post_processing=None):
+              initialization_data=None, post_processing=None, incremental=False, shard=None, mixed_precision=None):
     """Run the optimizer on the given model.
 
     Args:
@@ -64,7 +65,9 @@ def fit_model(model, input_data, output_folder, optimizer=None,
         input_data (:class:`~mdt.utils.MRIInputData`): the input data object containing all
             the info needed for the model fitting.
         output_folder (string): The path to the folder where to place the output, we will make a subdir with the
-            model name in it.
+            model name in it. If set to None, we keep all results in memory and do not write anything to disk. The
+            returned maps can later be saved using :func:`write_volume_maps`. Results that would be written to a
+            subdirectory, like the bootstrap maps, are then returned as nested dictionaries.
         optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): The optimization routine to use.
             If the optimizer is specified and the cl_device_ind is specified, we will overwrite the cl environments
             in the optimizer with the devices specified by the cl_device_ind.
@@ -102,6 +105,17 @@ def fit_model(model, input_data, output_folder, optimizer=None,
             For valid elements, please see the configuration file settings for ``optimization``
             under ``post_processing``. Valid input for this parameter is for example: {'covariance': False}
             to disable automatic calculation of the covariance from the Hessian.
+        incremental (boolean): if the existing results in the output folder do not match the current mask,
+            input data or initialization, only refit the voxels that are new or changed and merge these with the
+            existing results. This only applies if the model, protocol and optimizer did not change, else all voxels
+            are refit. This is useful after slightly changing the brain mask or fixing a few bad voxels.
+        shard (str or :class:`~mdt.sharding.Shard`): if given, only fit this shard of the voxels, for example '1/4'
+            for the first of four shards. The shards are fitted by independent processes started with the same
+            arguments, the shard finishing last merges the results of all the shards. See :mod:`mdt.sharding`
+            for details.
+        mixed_precision (boolean): if we fit in single precision, if we optimize the poorly converged voxels again in
+            double precision, starting from their single precision results. If None, we use the ``mixed_precision``
+            setting of the ``optimization`` configuration. This has no effect if double_precision is set.
 
     Returns:
         dict: The result maps for the given composite model or the last model in the cascade.
@@ -109,6 +123,7 @@ def fit_model(model, input_data, output_folder, optimizer=None,
     """
     import mdt.utils
     from mdt.model_fitting import ModelFit
+    from mdt.sharding import Shard
 
     if not mdt.utils.check_user_components():
         init_user_settings(pass_if_exists=True)
@@ -116,6 +131,9 @@ def fit_model(model, input_data, output_folder, optimizer=None,
     if not isinstance(initialization_data, InitializationData) and initialization_data is not None:
         initialization_data = SimpleInitializationData(**initialization_data)
 
+    if isinstance(shard, string_types):
+        shard = Shard.from_string(shard)
+
     if cl_device_ind is not None and not isinstance(cl_device_ind, collections.Iterable):
         cl_device_ind = [cl_device_ind]
 
@@ -124,11 +142,13 @@ def fit_model(model, input_data, output_folder, optimizer=None,
                          cascade_subdir=cascade_subdir,
                          cl_device_ind=cl_device_ind, double_precision=double_precision,
                          tmp_results_dir=tmp_results_dir, initialization_data=initialization_data,
-                         post_processing=post_processing)
+                         post_processing=post_processing, incremental=incremental, shard=shard,
+                         mixed_precision=mixed_precision)
 
     results = model_fit.run()
-    easy_save_user_script_info(save_user_script_info, output_folder + '/used_scripts.py',
-                               stack()[1][0].f_globals.get('__file__'))
+    if output_folder is not None:
+        easy_save_user_script_info(save_user_script_info, output_folder + '/used_scripts.py',
+                                   stack()[1][0].f_globals.get('__file__'))
     return results
 
 
@@ -191,9 +211,9 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
            doi:10.1198/jcgs.2009.06134.
     """
     import mdt.utils
-    from mot.load_balance_strategies import EvenDistribution
     from mdt.model_sampling import sample_composite_model
     from mdt.models.cascade import DMRICascadeModelInterface
+    from mdt.load_balancing import ThroughputDistribution
     import mot.configuration
 
     settings = mdt.configuration.get_general_sampling_settings()
@@ -222,13 +242,15 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
     if cl_device_ind is not None and not isinstance(cl_device_ind, collections.Iterable):
         cl_device_ind = [cl_device_ind]
 
+    load_balancer = None
     if cl_device_ind is None:
         cl_context_action = mot.configuration.VoidConfigurationAction()
     else:
         cl_envs = [get_cl_devices()[ind] for ind in cl_device_ind]
+        load_balancer = mdt.configuration.get_load_balancer(cache_key=model.name)
         cl_context_action = mot.configuration.RuntimeConfigurationAction(
             cl_environments=cl_envs,
-            load_balancer=EvenDistribution(),
+            load_balancer=load_balancer,
             double_precision=double_precision)
 
     with mot.configuration.config_context(cl_context_action):
@@ -251,6 +273,9 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                                          sample_items_to_save=sample_items_to_save,
                                          initialization_data=initialization_data)
 
+        if isinstance(load_balancer, ThroughputDistribution):
+            load_balancer.save_throughputs()
+
         easy_save_user_script_info(save_user_script_info, os.path.join(base_dir, 'used_scripts.py'),
                                    stack()[1][0].f_globals.get('__file__'))
         return results
@@ -524,27 +549,31 @@ def make_path_joiner(*args, make_dirs=False):
     return PathJoiner(*args, make_dirs=make_dirs)
 
 
-def sort_maps(input_maps, reversed_sort=False, sort_index_matrix=None):
+def sort_maps(input_maps, reversed_sort=False, sort_index_matrix=None, mask=None):
     """Sort the values of the given maps voxel by voxel.
 
     This first creates a sort matrix to index the maps in sorted order per voxel. Next, it creates the output
     maps for the maps we sort on.
 
+    Maps given as filenames are read in slabs during sorting, such that they are never all loaded at once.
+
     Args:
-        input_maps (:class:`list`): a list of string (filenames) or ndarrays we will sort
+        input_maps (:class:`list`): a list of string (filenames), volumes or ROI arrays we will sort
         reversed_sort (boolean): if we want to sort from large to small instead of small to large.
             This is not used if a sort index matrix is provided.
-        sort_index_matrix (ndarray): if given we use this sort index map instead of generating one by sorting the
-            maps_to_sort_on. Supposed to be a integer matrix.
+        sort_index_matrix (ndarray or str): if given we use this sort index map instead of generating one by sorting
+            the maps_to_sort_on. Supposed to be a integer matrix, can also be the filename of a nifti file.
+        mask (str or ndarray or mdt.utils.MaskIndex): if given, we only sort the voxels in this mask.
+            The sorted volumes are zero outside of the mask.
 
     Returns:
-        list: the list of sorted volumes
+        list: the list of sorted volumes (as 4d volumes) or ROI arrays
     """
     if sort_index_matrix is None:
-        sort_index_matrix = create_sort_matrix(input_maps, reversed_sort=reversed_sort)
+        sort_index_matrix = create_sort_matrix(input_maps, reversed_sort=reversed_sort, mask=mask)
     elif isinstance(sort_index_matrix, string_types):
-        sort_index_matrix = np.round(load_nifti(sort_index_matrix).get_data()).astype(np.int64)
-    return sort_volumes_per_voxel(input_maps, sort_index_matrix)
+        sort_index_matrix = load_nifti(sort_index_matrix).dataobj
+    return sort_volumes_per_voxel(input_maps, sort_index_matrix, mask=mask)
 
 
 def get_volume_names(directory):
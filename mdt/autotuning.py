@@ -0,0 +1,197 @@
+"""Autotuning of the OpenCL kernel launches of MDT.
+
+The throughput of a kernel can differ by a factor of two or more between work group sizes and kernel variants, and
+the best choice depends on the device, the model and the shape of the problem. With autotuning enabled, the first
+launch of a tunable routine for a given device and problem benchmarks a small set of candidate settings, selects the
+fastest and stores it in a cache file in the MDT configuration directory (see :func:`get_autotuning_cache_file`). The
+cached settings are applied automatically in subsequent launches, also in later sessions.
+
+The devices are identified by their description in :func:`mdt.utils.get_cl_devices` together with their driver
+version, such that a driver update triggers a new benchmark.
+
+Autotuning is configured in the ``autotuning`` section of the configuration.
+"""
+import logging
+import os
+import tempfile
+import timeit
+import yaml
+
+from mdt.configuration import get_config_dir
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-28'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+#: the name of the cache file with the autotuned settings, in the MDT configuration directory
+AUTOTUNING_CACHE_FILENAME = 'autotuning.yml'
+
+
+def get_autotuning_cache_file():
+    """Get the path to the file with the cached autotuning results.
+
+    Returns:
+        str: the path to the cache file in the MDT configuration directory
+    """
+    return os.path.join(get_config_dir(), AUTOTUNING_CACHE_FILENAME)
+
+
+def get_device_key(cl_environment):
+    """Get the key identifying a device in the autotuning cache.
+
+    Args:
+        cl_environment (mot.cl_environments.CLEnvironment): the environment of the device
+
+    Returns:
+        str: the description of the device with its driver version
+    """
+    return '{} [{}]'.format(cl_environment, cl_environment.device.driver_version)
+
+
+def load_autotuning_cache(cache_file=None):
+    """Load the cached autotuning results.
+
+    Args:
+        cache_file (str): the cache file, defaults to :func:`get_autotuning_cache_file`
+
+    Returns:
+        dict: per device key a dictionary with the cached results, empty if the cache file does not exist or can not
+            be read
+    """
+    cache_file = cache_file or get_autotuning_cache_file()
+    if not os.path.isfile(cache_file):
+        return {}
+
+    try:
+        with open(cache_file, 'r') as f:
+            cache = yaml.safe_load(f)
+    except (IOError, OSError, yaml.YAMLError) as exc:
+        logging.getLogger(__name__).warning('Could not read the autotuning cache {}, ignoring it: {}'.format(
+            cache_file, exc))
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+    return {device_key: results for device_key, results in cache.items() if isinstance(results, dict)}
+
+
+def update_autotuning_cache(device_key, key, value, cache_file=None):
+    """Store a result in the autotuning cache.
+
+    Args:
+        device_key (str): the key of the device, see :func:`get_device_key`
+        key (str): the key of the result
+        value (object): the result to store, this should be serializable to YAML
+        cache_file (str): the cache file, defaults to :func:`get_autotuning_cache_file`
+    """
+    update_autotuning_cache_entries({device_key: {key: value}}, cache_file=cache_file)
+
+
+def update_autotuning_cache_entries(entries, cache_file=None):
+    """Store multiple results in the autotuning cache, in one write.
+
+    Args:
+        entries (dict): per device key a dictionary with the results to store, these should be serializable to YAML
+        cache_file (str): the cache file, defaults to :func:`get_autotuning_cache_file`
+    """
+    cache_file = cache_file or get_autotuning_cache_file()
+
+    cache = load_autotuning_cache(cache_file)
+    for device_key, results in entries.items():
+        cache.setdefault(device_key, {}).update(results)
+    _write_autotuning_cache(cache, cache_file)
+
+
+def _write_autotuning_cache(cache, cache_file):
+    """Write the autotuning cache atomically.
+
+    We write to a temporary file in the same directory and then rename it over the cache file, such that concurrent
+    readers never see a partially written cache.
+
+    Args:
+        cache (dict): the complete cache to write
+        cache_file (str): the cache file
+    """
+    directory = os.path.dirname(cache_file)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    handle, tmp_file = tempfile.mkstemp(prefix='.' + os.path.basename(cache_file), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as f:
+            yaml.safe_dump(cache, f, default_flow_style=False)
+        getattr(os, 'replace', os.rename)(tmp_file, cache_file)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+class KernelAutotuner(object):
+
+    def __init__(self, cache_file=None, nmr_repeats=3, nmr_benchmark_voxels=10000):
+        """Selects the fastest settings of a kernel launch by benchmarking, and caches the results per device.
+
+        Args:
+            cache_file (str): the file with the cached results, defaults to :func:`get_autotuning_cache_file`
+            nmr_repeats (int): the number of timed runs per candidate, we use the fastest of these runs
+            nmr_benchmark_voxels (int): the maximum number of voxels the routines should use for benchmarking
+        """
+        self.cache_file = cache_file or get_autotuning_cache_file()
+        self.nmr_repeats = nmr_repeats
+        self.nmr_benchmark_voxels = nmr_benchmark_voxels
+        self._logger = logging.getLogger(__name__)
+
+    def get_settings(self, cl_environment, routine_key, candidates, prepare_benchmark):
+        """Get the fastest of the candidate settings for a routine on the given device.
+
+        If the cache contains settings for this device and routine, and these are in the candidates, we return these.
+        Otherwise we benchmark all the candidates and store the fastest in the cache.
+
+        Args:
+            cl_environment (mot.cl_environments.CLEnvironment): the environment of the device
+            routine_key (str): identifies the routine and the problem, for example by the model and the problem size
+            candidates (list of dict): the candidate settings, these should be serializable to YAML
+            prepare_benchmark (Callable[[dict], Callable[[], None]]): prepares the benchmark of a candidate, for
+                example by compiling the kernel, and returns a function which runs the workload once and returns
+                when it is done.
+
+        Returns:
+            dict: the fastest candidate settings, or the first candidate if none of the candidates could be run
+        """
+        device_key = get_device_key(cl_environment)
+
+        cached = load_autotuning_cache(self.cache_file).get(device_key, {}).get(routine_key)
+        if cached in candidates:
+            return cached
+
+        self._logger.info('Autotuning {} on {}.'.format(routine_key, cl_environment))
+
+        timings = [self._benchmark(candidate, prepare_benchmark) for candidate in candidates]
+        best_timing, best_candidate = min(zip(timings, range(len(candidates))))
+        if best_timing == float('inf'):
+            return candidates[0]
+
+        settings = candidates[best_candidate]
+        self._logger.info('Selected {} ({:.3g} seconds, the slowest candidate took {:.3g} seconds).'.format(
+            settings, best_timing, max(t for t in timings if t != float('inf'))))
+
+        update_autotuning_cache(device_key, routine_key, settings, cache_file=self.cache_file)
+        return settings
+
+    def clear_cache(self):
+        """Remove all the cached autotuning results."""
+        if os.path.isfile(self.cache_file):
+            os.remove(self.cache_file)
+
+    def _benchmark(self, candidate, prepare_benchmark):
+        """Get the fastest run time of the given candidate, or infinity if the candidate can not be run."""
+        try:
+            run = prepare_benchmark(candidate)
+            run()
+            return min(timeit.repeat(run, number=1, repeat=self.nmr_repeats))
+        except Exception as exc:
+            self._logger.debug('Autotuning candidate {} failed: {}'.format(candidate, exc))
+            return float('inf')
@@ -0,0 +1,118 @@
+"""Residual bootstrap estimates of the uncertainty of optimization results.
+
+Next to the standard deviations from the Hessian (the ``covariance`` post-processing) and full MCMC sampling (see
+:func:`mdt.sample_model`), the uncertainty of the fitted parameters can be estimated using a residual bootstrap.
+For every voxel we compute the residuals of the fitted model, generate a number of replicate signals by adding
+randomly resampled (with replacement) residuals to the model estimate and optimize the model again on every
+replicate, starting from the original optimum. The spread of the replicate results estimates the uncertainty of the
+fitted parameters.
+
+All voxel and replicate combinations are optimized together, as one set of problems per batch of voxels, instead of
+fitting the model once per replicate.
+
+The bootstrap is enabled with the ``bootstrap`` flag in the ``optimization`` section of ``active_post_processing``
+and is configured in the ``optimization`` section of the configuration, under ``bootstrap``. The results are stored
+in the ``bootstrap`` subdirectory of the model output, with per free parameter a ``<param>.std`` map and for every
+configured percentile a ``<param>.percentile_<percentile>`` map.
+"""
+import numpy as np
+
+from mdt.cl_routines.mapping.calculate_model_estimates import CalculateModelEstimates
+from mdt.model_building.utils import ParameterTransformedModel
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-26'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+#: the name of the output subdirectory holding the bootstrap maps
+BOOTSTRAP_MAPS_DIR = 'bootstrap'
+
+
+class ResidualBootstrap(object):
+
+    def __init__(self, nmr_replicates=100, percentiles=(2.5, 97.5), seed=None, max_batch_problems=100000):
+        """Estimates the uncertainty of optimization results using a residual bootstrap.
+
+        Args:
+            nmr_replicates (int): the number of bootstrap replicates per voxel
+            percentiles (list of float): the percentiles (between 0 and 100) of the replicate results to report
+            seed (int): the seed for the resampling of the residuals. If given, the results are reproducible for
+                the same processing chunks.
+            max_batch_problems (int): the maximum number of voxel and replicate combinations we optimize at once,
+                limits the memory usage
+        """
+        self.nmr_replicates = nmr_replicates
+        self.percentiles = list(percentiles or [])
+        self.seed = seed
+        self.max_batch_problems = max_batch_problems
+
+    def get_settings(self):
+        """Get the settings of this bootstrap.
+
+        Returns:
+            dict: the bootstrap settings, used for the provenance of the results
+        """
+        return {'nmr_replicates': self.nmr_replicates,
+                'percentiles': self.percentiles,
+                'seed': self.seed}
+
+    def compute(self, model, optimizer, roi_indices, parameters):
+        """Compute the bootstrap maps for the given voxels.
+
+        The replicates are computed on the parameters as optimized, that is, before the post-optimization modifiers
+        of the model (like the sorting of the Tensor eigenvalues) are applied.
+
+        Args:
+            model (mdt.models.composite.DMRICompositeModel): the fitted model, with its input data set
+            optimizer: the optimization routine to use for the replicates
+            roi_indices (ndarray): the ROI indices of the voxels
+            parameters (ndarray): the (v, p) matrix with the optimized free parameters of these voxels
+
+        Returns:
+            dict: per free parameter the standard deviation and the percentiles over the replicates, with one
+                row per voxel
+        """
+        param_names = model.get_free_param_names()
+        observations = model.get_input_data().observations
+        random_state = np.random.RandomState(None if self.seed is None else [self.seed, int(roi_indices[0])])
+
+        replicates = np.zeros((len(roi_indices), self.nmr_replicates, len(param_names)))
+        batch_size = max(self.max_batch_problems // self.nmr_replicates, 1)
+
+        for start in range(0, len(roi_indices), batch_size):
+            batch = slice(start, min(start + batch_size, len(roi_indices)))
+            replicates[batch] = self._optimize_replicates(model, optimizer, roi_indices[batch], parameters[batch],
+                                                          np.asarray(observations[roi_indices[batch]]), random_state)
+
+        results = {}
+        for ind, name in enumerate(param_names):
+            results[name + '.std'] = np.std(replicates[..., ind], axis=1, ddof=1)
+            for percentile in self.percentiles:
+                results['{}.percentile_{:g}'.format(name, percentile)] = np.percentile(
+                    replicates[..., ind], percentile, axis=1)
+        return results
+
+    def _optimize_replicates(self, model, optimizer, roi_indices, parameters, observations, random_state):
+        """Generate the replicate signals of the given voxels and optimize the model on all of them at once.
+
+        Returns:
+            ndarray: a (v, r, p) matrix with the optimized parameters per voxel and replicate
+        """
+        nmr_voxels, nmr_observations = observations.shape
+
+        estimates = CalculateModelEstimates().calculate(model.build(roi_indices), parameters).astype(np.float64)
+        residuals = observations - estimates
+
+        resampling = random_state.randint(nmr_observations, size=(nmr_voxels, self.nmr_replicates, nmr_observations))
+        replicate_signals = estimates[:, None, :] + residuals[np.arange(nmr_voxels)[:, None, None], resampling]
+
+        build_model = model.build(np.repeat(roi_indices, self.nmr_replicates),
+                                  observations=np.reshape(replicate_signals, (-1, nmr_observations)))
+        codec_model = ParameterTransformedModel(build_model, model.get_parameter_codec())
+        starting_positions = codec_model.encode_parameters(np.repeat(parameters, self.nmr_replicates, axis=0))
+
+        results = optimizer.minimize(codec_model, starting_positions).get_optimization_result()
+        return np.reshape(results, (nmr_voxels, self.nmr_replicates, -1))
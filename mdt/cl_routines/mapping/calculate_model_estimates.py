@@ -3,6 +3,7 @@ import numpy as np
 from mot.utils import get_float_type_def, KernelDataManager
 from mot.cl_routines.base import CLRoutine
 from mot.load_balance_strategies import Worker
+from mdt.configuration import get_kernel_autotuner
 
 
 __author__ = 'Robbert Harms'
@@ -12,8 +13,41 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
+PARALLELIZATIONS = ('voxels', 'observations')
+"""The available kernel layouts, either one work item per voxel or one work item per voxel and observation."""
+
+MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION = 16384
+"""Up to this number of voxels, the automatic layout uses one work item per voxel and observation."""
+
+AUTOTUNING_LOCAL_SIZES = (16, 32, 64, 128, 256)
+"""The work group sizes tried by the autotuner, next to letting the OpenCL implementation choose."""
+
+
 class CalculateModelEstimates(CLRoutine):
 
+    def __init__(self, parallelization=None, cl_runtime_info=None):
+        """Evaluate the model, and derived quantities, for every problem and every observation.
+
+        The evaluations can be computed with one of two kernel layouts. With the ``voxels`` layout, we launch one work
+        item per voxel which loops over all observations. With the ``observations`` layout we launch a two dimensional
+        range with one work item per voxel and observation, which saturates wide devices with fewer voxels (for
+        example in ROI fits and simulations) and gives contiguous writes, at the cost of preparing the parameters of a
+        voxel in every work item.
+
+        If the layout is not given and autotuning is enabled (see :mod:`mdt.autotuning`), the layout and the work group
+        size are autotuned per device, model and problem size. Otherwise the layout is chosen by the number of voxels.
+
+        Args:
+            parallelization (str): one of :data:`PARALLELIZATIONS`, if not set we autotune the layout or use the
+                ``observations`` layout up to :data:`MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION` voxels and the
+                ``voxels`` layout otherwise.
+            cl_runtime_info (mot.cl_runtime_info.CLRuntimeInfo): the runtime information
+        """
+        super(CalculateModelEstimates, self).__init__(cl_runtime_info=cl_runtime_info)
+        if parallelization is not None and parallelization not in PARALLELIZATIONS:
+            raise ValueError('The parallelization "{}" is not one of {}.'.format(parallelization, PARALLELIZATIONS))
+        self._parallelization = parallelization
+
     def calculate(self, model, parameters):
         """Evaluate the model for every problem and every observation and return the estimates.
 
@@ -26,6 +60,33 @@ class CalculateModelEstimates(CLRoutine):
         Returns:
             ndarray: Return per problem instance the evaluation per data point.
         """
+        return self._evaluate(model, parameters, 'estimates')
+
+    def calculate_residuals(self, model, parameters):
+        """Calculate the residuals, the observations minus the model estimates, for every problem and observation.
+
+        Args:
+            model (AbstractModel): The model to evaluate, its kernel data needs to contain the observations.
+            parameters (ndarray): The parameters to use in the evaluation of the model
+
+        Returns:
+            ndarray: Return per problem instance the residual per data point.
+        """
+        return self._evaluate(model, parameters, 'residuals')
+
+    def calculate_log_likelihoods(self, model, parameters):
+        """Calculate the log likelihood of every observation, for every problem.
+
+        Args:
+            model (SampleModelInterface): The model to evaluate.
+            parameters (ndarray): The parameters to use in the evaluation of the model
+
+        Returns:
+            ndarray: Return per problem instance the log likelihood per data point.
+        """
+        return self._evaluate(model, parameters, 'log_likelihoods')
+
+    def _evaluate(self, model, parameters, evaluation):
         nmr_observations = model.get_nmr_observations()
 
         parameters = np.require(parameters, self._cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O'])
@@ -34,18 +95,79 @@ class CalculateModelEstimates(CLRoutine):
         evaluations = np.zeros((nmr_problems, nmr_observations),
                                dtype=self._cl_runtime_info.mot_float_dtype, order='C')
 
-        workers = self._create_workers(lambda cl_environment: _EvaluateModelWorker(
-            cl_environment, self._cl_runtime_info.get_compile_flags(), model, parameters, evaluations,
-            self._cl_runtime_info.mot_float_dtype, self._cl_runtime_info.double_precision))
+        def create_worker(cl_environment, worker_parameters, worker_evaluations, settings):
+            return _EvaluateModelWorker(
+                cl_environment, self._cl_runtime_info.get_compile_flags(), model, worker_parameters,
+                worker_evaluations, self._cl_runtime_info.mot_float_dtype, self._cl_runtime_info.double_precision,
+                evaluation, settings['parallelization'], settings['local_size'])
+
+        def get_worker(cl_environment):
+            settings = self._get_launch_settings(cl_environment, model, parameters, evaluation, create_worker)
+            return create_worker(cl_environment, parameters, evaluations, settings)
+
+        workers = self._create_workers(get_worker)
         self._cl_runtime_info.load_balancer.process(workers, nmr_problems)
 
         return evaluations
 
+    def _get_launch_settings(self, cl_environment, model, parameters, evaluation, create_worker):
+        """Get the kernel layout and work group size to use on the given device.
+
+        Returns:
+            dict: with the elements ``parallelization`` and ``local_size``
+        """
+        nmr_problems = parameters.shape[0]
+
+        if self._parallelization is not None:
+            return {'parallelization': self._parallelization, 'local_size': None}
+
+        autotuner = get_kernel_autotuner()
+        if autotuner is None or nmr_problems == 0:
+            return {'parallelization': ('observations' if nmr_problems <= MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION
+                                        else 'voxels'),
+                    'local_size': None}
+
+        max_local_size = cl_environment.device.max_work_group_size
+        candidates = [{'parallelization': parallelization, 'local_size': local_size}
+                      for parallelization in PARALLELIZATIONS
+                      for local_size in (None,) + AUTOTUNING_LOCAL_SIZES
+                      if local_size is None or local_size <= max_local_size]
+
+        nmr_benchmark_problems = min(nmr_problems, autotuner.nmr_benchmark_voxels)
+        benchmark_parameters = np.require(parameters[:nmr_benchmark_problems], requirements=['C', 'A', 'O'])
+
+        # the kernel only depends on the layout, so we compile one worker per layout and only vary the local size
+        benchmark_workers = {}
+
+        def prepare_benchmark(settings):
+            parallelization = settings['parallelization']
+            if parallelization not in benchmark_workers:
+                benchmark_workers[parallelization] = create_worker(
+                    cl_environment, benchmark_parameters,
+                    np.zeros((nmr_benchmark_problems, model.get_nmr_observations()),
+                             dtype=self._cl_runtime_info.mot_float_dtype, order='C'),
+                    settings)
+            worker = benchmark_workers[parallelization]
+            worker.set_local_size(settings['local_size'])
+
+            def run():
+                worker.calculate(0, nmr_benchmark_problems)
+                for queue in worker.get_used_queues():
+                    queue.finish()
+            return run
+
+        routine_key = '{}/{}/{}/{} observations/{} voxels/{} precision'.format(
+            type(self).__name__, getattr(model, 'name', type(model).__name__), evaluation,
+            model.get_nmr_observations(), 2 ** int(np.ceil(np.log2(nmr_problems))),
+            'double' if self._cl_runtime_info.double_precision else 'single')
+
+        return autotuner.get_settings(cl_environment, routine_key, candidates, prepare_benchmark)
+
 
 class _EvaluateModelWorker(Worker):
 
     def __init__(self, cl_environment, compile_flags, model, parameters, evaluations, mot_float_dtype,
-                 double_precision):
+                 double_precision, evaluation, parallelization, local_size=None):
         super(_EvaluateModelWorker, self).__init__(cl_environment)
 
         self._model = model
@@ -54,23 +176,48 @@ class _EvaluateModelWorker(Worker):
         self._double_precision = double_precision
         self._evaluations = evaluations
         self._parameters = parameters
+        self._evaluation = evaluation
+        self._parallelization = parallelization
+        self._local_size = local_size
 
         self._all_buffers, self._evaluations_buffer = self._create_buffers()
         self._kernel = self._build_kernel(self._get_kernel_source(), compile_flags)
 
+    def set_local_size(self, local_size):
+        """Set the work group size of the next kernel launches.
+
+        Args:
+            local_size (int or None): the work group size, None to let the OpenCL driver choose
+        """
+        self._local_size = local_size
+
     def calculate(self, range_start, range_end):
         nmr_problems = range_end - range_start
 
         kernel_func = self._kernel.get_estimates
 
-        scalar_args = [None, None]
+        scalar_args = [None, None, np.uint64]
         scalar_args.extend(self._data_struct_manager.get_scalar_arg_dtypes())
         kernel_func.set_scalar_arg_dtypes(scalar_args)
 
-        kernel_func(self._cl_queue, (int(nmr_problems), ), None,
-                    *self._all_buffers, global_offset=(int(range_start),))
+        buffers = self._all_buffers[:2] + [np.uint64(range_end)] + self._all_buffers[2:]
+
+        if self._parallelization == 'observations':
+            global_size = (self._round_up(self._model.get_nmr_observations()), int(nmr_problems))
+            local_size = None if self._local_size is None else (int(self._local_size), 1)
+            kernel_func(self._cl_queue, global_size, local_size, *buffers, global_offset=(0, int(range_start)))
+        else:
+            global_size = (self._round_up(nmr_problems), )
+            local_size = None if self._local_size is None else (int(self._local_size), )
+            kernel_func(self._cl_queue, global_size, local_size, *buffers, global_offset=(int(range_start),))
         self._enqueue_readout(self._evaluations_buffer, self._evaluations, range_start, range_end)
 
+    def _round_up(self, global_size):
+        """Round the given global size up to a multiple of the work group size, if set."""
+        if self._local_size is None:
+            return int(global_size)
+        return int(np.ceil(global_size / float(self._local_size)) * self._local_size)
+
     def _create_buffers(self):
         evaluations_buffer = cl.Buffer(self._cl_context,
                                        cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR,
@@ -84,15 +231,50 @@ class _EvaluateModelWorker(Worker):
         return all_buffers, evaluations_buffer
 
     def _get_kernel_source(self):
-        eval_function_info = self._model.get_model_eval_function()
         param_modifier = self._model.get_pre_eval_parameter_modifier()
 
+        if self._evaluation == 'log_likelihoods':
+            eval_function_info = self._model.get_log_likelihood_per_observation_function()
+        else:
+            eval_function_info = self._model.get_model_eval_function()
+
+        evaluation = eval_function_info.get_cl_function_name() + '(&data, x, i)'
+        if self._evaluation == 'residuals':
+            evaluation = 'data.observations[i] - ' + evaluation
+
         nmr_params = self._parameters.shape[1]
 
         kernel_param_names = ['global mot_float_type* restrict params',
-                              'global mot_float_type* restrict estimates']
+                              'global mot_float_type* restrict estimates',
+                              'ulong range_end']
         kernel_param_names.extend(self._data_struct_manager.get_kernel_arguments())
 
+        if self._parallelization == 'observations':
+            kernel_ids = '''
+                    ulong gid = get_global_id(1);
+                    uint i = (uint)get_global_id(0);
+                    if(i >= NMR_OBSERVATIONS){
+                        return;
+                    }
+            '''
+            evaluation_loop = '''
+                    estimates[gid * NMR_OBSERVATIONS + i] = ''' + evaluation + ''';
+            '''
+        else:
+            kernel_ids = '''
+                    ulong gid = get_global_id(0);
+                    if(gid >= range_end){
+                        return;
+                    }
+            '''
+            evaluation_loop = '''
+                    global mot_float_type* result = estimates + gid * NMR_OBSERVATIONS;
+
+                    for(uint i = 0; i < NMR_OBSERVATIONS; i++){
+                        result[i] = ''' + evaluation + ''';
+                    }
+            '''
+
         kernel_source = '''
             #define NMR_OBSERVATIONS ''' + str(self._model.get_nmr_observations()) + '''
         '''
@@ -104,21 +286,17 @@ class _EvaluateModelWorker(Worker):
             __kernel void get_estimates(
                 ''' + ",\n".join(kernel_param_names) + '''
                 ){
-                    ulong gid = get_global_id(0);
+                    ''' + kernel_ids + '''
                     mot_data_struct data = ''' + self._data_struct_manager.get_struct_init_string('gid') + ''';
 
                     mot_float_type x[''' + str(nmr_params) + '''];
-                    for(uint i = 0; i < ''' + str(nmr_params) + '''; i++){
-                        x[i] = params[gid * ''' + str(nmr_params) + ''' + i];
+                    for(uint j = 0; j < ''' + str(nmr_params) + '''; j++){
+                        x[j] = params[gid * ''' + str(nmr_params) + ''' + j];
                     }
 
-                    global mot_float_type* result = estimates + gid * NMR_OBSERVATIONS;
-                    
                     ''' + param_modifier.get_cl_function_name() + '''(&data, x);
-                    
-                    for(uint i = 0; i < NMR_OBSERVATIONS; i++){
-                        result[i] = ''' + eval_function_info.get_cl_function_name() + '''(&data, x, i);
-                    }
+
+                    ''' + evaluation_loop + '''
             }
         '''
         return kernel_source
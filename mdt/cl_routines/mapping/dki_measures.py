@@ -1,8 +1,23 @@
+"""Computation of the Kurtosis measures Mean Kurtosis (MK), Axial Kurtosis (AK) and Radial Kurtosis (RK).
+
+The measures can be computed numerically, by averaging the apparent kurtosis over a set of directions, or
+analytically, using the closed form expressions of Tabesh et al. (2011). The numerical method is configurable in the
+number of directions used for the MK and RK, trading accuracy for speed. The direction sets are precomputed, cached
+and compiled as constant tables into the OpenCL program, such that they are transferred to a device only once per
+program build.
+
+The default settings are taken from the ``dki_measures`` section of the configuration.
+
+References:
+    Tabesh A, Jensen JH, Ardekani BA, Helpern JA. Estimation of tensors and tensor-derived measures in diffusional
+    kurtosis imaging. Magn Reson Med. 2011;65(3):823-836.
+"""
 import numpy as np
 from mot.cl_routines.mapping.run_procedure import RunProcedure
-from mot.kernel_data import KernelArray, KernelAllocatedArray, KernelScalar
+from mot.kernel_data import KernelArray
 from mot.cl_routines.base import CLRoutine
 from mdt.components import get_component
+from mdt.configuration import get_dki_measures_settings
 from mot.utils import NameFunctionTuple
 
 __author__ = 'Robbert Harms'
@@ -12,8 +27,41 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
+DKI_METHODS = ('numerical', 'analytic')
+"""The available methods for computing the Kurtosis measures."""
+
+DEFAULT_NMR_DIRECTIONS = 256
+"""The size of the default direction set, taken from "dki_parameters.m" by Jelle Veraart."""
+
+MAX_CONSTANT_TABLE_SIZE = 64 * 1024
+"""The maximum size in bytes of the compiled direction table, the constant memory size guaranteed by OpenCL."""
+
+_direction_sets = {}
+_compute_functions = {}
+
+
 class DKIMeasures(CLRoutine):
 
+    def __init__(self, method=None, nmr_directions=None, nmr_radial_directions=None, cl_runtime_info=None):
+        """Calculate DKI statistics like the mean, axial and radial kurtosis.
+
+        All settings default to the values in the ``dki_measures`` section of the configuration, at the moment
+        of calculation.
+
+        Args:
+            method (str): either 'numerical' for averaging the apparent kurtosis over a set of directions or
+                'analytic' for using the closed form expressions of Tabesh et al. (2011).
+            nmr_directions (int): the number of directions on the sphere used for the numerical MK,
+                see :func:`get_spherical_directions`.
+            nmr_radial_directions (int): the number of directions on the circle around the principal eigenvector
+                used for the numerical RK.
+            cl_runtime_info (mot.cl_runtime_info.CLRuntimeInfo): the runtime information
+        """
+        super(DKIMeasures, self).__init__(cl_runtime_info=cl_runtime_info)
+        self._method = method
+        self._nmr_directions = nmr_directions
+        self._nmr_radial_directions = nmr_radial_directions
+
     def calculate(self, parameters_dict):
         """Calculate DKI statistics like the mean, axial and radial kurtosis.
 
@@ -23,6 +71,10 @@ class DKIMeasures(CLRoutine):
         Finally, the Radial Kurtosis (RK) is calculated by averaging the Kurtosis over a circle of directions around
         the first eigenvec.
 
+        With the analytic method the MK and RK averages are computed in closed form (Tabesh et al. 2011), with the
+        kurtosis tensor rotated to the eigensystem of the diffusion tensor. Voxels with a non-positive eigenvalue have
+        a zero MK and RK in this case.
+
         Args:
             parameters_dict (dict): the fitted Kurtosis parameters, this requires a dictionary with at least
                 the elements:
@@ -41,34 +93,91 @@ class DKIMeasures(CLRoutine):
                                 self._cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O'])
 
         nmr_voxels = parameters.shape[0]
+
+        # the outputs are allocated here, such that all devices write their voxels to the same arrays
+        outputs = {name: np.zeros((nmr_voxels, 1), dtype=self._cl_runtime_info.mot_float_dtype, order='C')
+                   for name in ['mks', 'aks', 'rks']}
+
         kernel_data = {'parameters': KernelArray(parameters, ctype='mot_float_type',
-                                                 is_readable=True, is_writable=False),
-                       'directions': KernelArray(self._get_spherical_samples(), ctype='mot_float_type4',
-                                                 is_readable=True, is_writable=False, offset_str='0'),
-                       'nmr_directions': KernelScalar(self._get_spherical_samples().shape[0]),
-                       'nmr_radial_directions': KernelScalar(256),
-                       'mks': KernelAllocatedArray((nmr_voxels, 1), ctype='mot_float_type'),
-                       'aks': KernelAllocatedArray((nmr_voxels, 1), ctype='mot_float_type'),
-                       'rks': KernelAllocatedArray((nmr_voxels, 1), ctype='mot_float_type')}
+                                                 is_readable=True, is_writable=False)}
+        kernel_data.update({name: KernelArray(output, ctype='mot_float_type', is_readable=False, is_writable=True)
+                            for name, output in outputs.items()})
 
         runner = RunProcedure(self._cl_runtime_info)
-        runner.run_procedure(self._get_compute_function(param_names), kernel_data, nmr_voxels)
+        runner.run_procedure(self._get_compute_function(param_names, *self._get_settings()), kernel_data, nmr_voxels)
+
+        return {'MK': outputs['mks'], 'AK': outputs['aks'], 'RK': outputs['rks']}
+
+    def get_settings(self):
+        """Get the settings used for the calculation, with the configuration applied to the settings not given.
+
+        Returns:
+            dict: with the keys 'method', 'nmr_directions' and 'nmr_radial_directions'
+        """
+        return dict(zip(('method', 'nmr_directions', 'nmr_radial_directions'), self._get_settings()))
+
+    def _get_settings(self):
+        """Get the method and the number of directions, using the configuration for the settings not given.
 
-        return {'MK': kernel_data['mks'].get_data(),
-                'AK': kernel_data['aks'].get_data(),
-                'RK': kernel_data['rks'].get_data()}
+        Returns:
+            tuple: the method, the number of directions and the number of radial directions
+        """
+        settings = get_dki_measures_settings()
+
+        method = self._method or settings.get('method', 'numerical')
+        if method not in DKI_METHODS:
+            raise ValueError('The DKI method "{}" is not one of {}.'.format(method, DKI_METHODS))
+
+        nmr_directions = int(self._nmr_directions or settings.get('nmr_directions', DEFAULT_NMR_DIRECTIONS))
+        nmr_radial_directions = int(self._nmr_radial_directions or settings.get('nmr_radial_directions', 256))
+
+        if method == 'numerical':
+            float_size = np.dtype(self._cl_runtime_info.mot_float_dtype).itemsize
+            max_nmr_directions = MAX_CONSTANT_TABLE_SIZE // (3 * float_size)
+            if not 0 < nmr_directions <= max_nmr_directions:
+                raise ValueError('The number of DKI directions should be between 1 and {} with the current precision, '
+                                 '{} given.'.format(max_nmr_directions, nmr_directions))
+            if nmr_radial_directions < 1:
+                raise ValueError('The number of radial DKI directions should be positive, '
+                                 '{} given.'.format(nmr_radial_directions))
+
+        return method, nmr_directions, nmr_radial_directions
 
-    def _get_compute_function(self, param_names):
+    def _get_compute_function(self, param_names, method, nmr_directions, nmr_radial_directions):
+        """Get the (cached) CL function for the given settings.
+
+        The kernel source is only generated once per setting, such that the source, and hence the compiled program,
+        is identical over calls.
+        """
+        key = (tuple(param_names), method, nmr_directions, nmr_radial_directions)
+        if key not in _compute_functions:
+            if method == 'analytic':
+                measures_source = self._get_analytic_measures_source()
+            else:
+                measures_source = self._get_numerical_measures_source(nmr_directions, nmr_radial_directions)
+            _compute_functions[key] = NameFunctionTuple(
+                'calculate_measures', self._get_common_source(param_names) + measures_source)
+        return _compute_functions[key]
+
+    def _get_common_source(self, param_names):
         def get_param_cl_ref(param_name):
-            return 'data->parameters[{}]'.format(param_names.index(param_name))
+            return 'params[{}]'.format(param_names.index(param_name))
 
-        param_expansions = ['mot_float_type {} = params[{}];'.format(name, ind) for ind, name in enumerate(param_names)]
+        weight_names = ['W_0000', 'W_1111', 'W_2222', 'W_1000', 'W_2000', 'W_1110', 'W_2220', 'W_2111', 'W_2221',
+                        'W_1100', 'W_2200', 'W_2211', 'W_2100', 'W_2110', 'W_2210']
 
         kernel_source = ''
         kernel_source += get_component('library_functions', 'TensorApparentDiffusion')().get_cl_code()
         kernel_source += get_component('library_functions', 'RotateOrthogonalVector')().get_cl_code()
         kernel_source += get_component('library_functions', 'KurtosisMultiplication')().get_cl_code()
         kernel_source += '''
+            /**
+             * Evaluate the Kurtosis tensor with the given vector, the sum of n_i * n_j * n_k * n_l * W_ijkl.
+             */
+            double dki_kurtosis_product(global mot_float_type* params, mot_float_type4 n){
+                return KurtosisMultiplication(''' + ', '.join(get_param_cl_ref(n) for n in weight_names) + ''', n);
+            }
+
             double apparent_kurtosis(
                     global mot_float_type* params,
                     mot_float_type4 direction,
@@ -76,7 +185,9 @@ class DKIMeasures(CLRoutine):
                     mot_float_type4 vec1,
                     mot_float_type4 vec2){
 
-                ''' + '\n'.join(param_expansions) + '''
+                mot_float_type d = ''' + get_param_cl_ref('d') + ''';
+                mot_float_type dperp0 = ''' + get_param_cl_ref('dperp0') + ''';
+                mot_float_type dperp1 = ''' + get_param_cl_ref('dperp1') + ''';
 
                 mot_float_type adc = d *      pown(dot(vec0, direction), 2) +
                                      dperp0 * pown(dot(vec1, direction), 2) +
@@ -84,346 +195,561 @@ class DKIMeasures(CLRoutine):
 
                 mot_float_type tensor_md = (d + dperp0 + dperp1) / 3.0;
 
-                double kurtosis_sum = KurtosisMultiplication(
-                    W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
-                    W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
-                    W_2100, W_2110, W_2210, direction);
-
-                return pown(tensor_md / adc, 2) * kurtosis_sum;
+                return pown(tensor_md / adc, 2) * dki_kurtosis_product(params, direction);
             }
 
-            void get_principal_and_perpendicular_eigenvector(
-                    mot_float_type d,
-                    mot_float_type dperp0,
-                    mot_float_type dperp1,
-                    mot_float_type4* vec0,
-                    mot_float_type4* vec1,
-                    mot_float_type4* vec2,
-                    mot_float_type4** principal_vec,
-                    mot_float_type4** perpendicular_vec){
-
-                if(d >= dperp0 && d >= dperp1){
-                    *principal_vec = vec0;
-                    *perpendicular_vec = vec1;
-                }
-                if(dperp0 >= d && dperp0 >= dperp1){
-                    *principal_vec = vec1;
-                    *perpendicular_vec = vec0;
-                }
-                *principal_vec = vec2;
-                *perpendicular_vec = vec0;
-            }
+            /**
+             * Get the eigenvalues and eigenvectors of the diffusion tensor, sorted by decreasing eigenvalue.
+             */
+            void dki_sorted_eigensystem(
+                    global mot_float_type* params,
+                    double* eigenvalues,
+                    mot_float_type4* eigenvectors){
 
-            void calculate_measures(mot_data_struct* data){
-                int i, j;
+                uint i, j, tmp_ind;
+                double tmp_val;
+                uint order[3] = {0, 1, 2};
 
-                mot_float_type4 vec0, vec1, vec2;
+                eigenvalues[0] = ''' + get_param_cl_ref('d') + ''';
+                eigenvalues[1] = ''' + get_param_cl_ref('dperp0') + ''';
+                eigenvalues[2] = ''' + get_param_cl_ref('dperp1') + ''';
+
+                mot_float_type4 vecs[3];
                 TensorSphericalToCartesian(
                     ''' + get_param_cl_ref('theta') + ''',
                     ''' + get_param_cl_ref('phi') + ''',
                     ''' + get_param_cl_ref('psi') + ''',
-                    &vec0, &vec1, &vec2);
+                    &vecs[0], &vecs[1], &vecs[2]);
+
+                for(i = 0; i < 2; i++){
+                    for(j = 0; j < 2 - i; j++){
+                        if(eigenvalues[order[j]] < eigenvalues[order[j + 1]]){
+                            tmp_ind = order[j];
+                            order[j] = order[j + 1];
+                            order[j + 1] = tmp_ind;
+                        }
+                    }
+                }
+
+                double unsorted[3] = {eigenvalues[0], eigenvalues[1], eigenvalues[2]};
+                for(i = 0; i < 3; i++){
+                    eigenvalues[i] = unsorted[order[i]];
+                    eigenvectors[i] = vecs[order[i]];
+                }
+            }
+        '''
+        return kernel_source
 
-                mot_float_type4* principal_vec;
-                mot_float_type4* perpendicular_vec;
-                get_principal_and_perpendicular_eigenvector(
-                    ''' + get_param_cl_ref('d') + ''',
-                    ''' + get_param_cl_ref('dperp0') + ''',
-                    ''' + get_param_cl_ref('dperp1') + ''',
-                    &vec0, &vec1, &vec2,
-                    &principal_vec, &perpendicular_vec);
+    def _get_numerical_measures_source(self, nmr_directions, nmr_radial_directions):
+        directions = get_spherical_directions(nmr_directions)
+        return '''
+            __constant mot_float_type dki_directions[''' + str(directions.size) + '''] = {
+                ''' + ',\n                '.join(', '.join(repr(float(v)) for v in direction)
+                                              for direction in directions) + '''
+            };
 
+            void calculate_measures(mot_data_struct* data){
+                int i;
+
+                double eigenvalues[3];
+                mot_float_type4 vecs[3];
+                dki_sorted_eigensystem(data->parameters, eigenvalues, vecs);
+
+                mot_float_type4 vec0, vec1, vec2;
+                TensorSphericalToCartesian(
+                    data->parameters[3], data->parameters[4], data->parameters[5], &vec0, &vec1, &vec2);
 
                 // Mean Kurtosis integrated over a set of directions
                 double mean = 0;
-                for(i = 0; i < data->nmr_directions; i++){
-                    mean += (apparent_kurtosis(data->parameters, data->directions[i], vec0, vec1, vec2) - mean) 
-                                / (i + 1);
+                mot_float_type4 direction;
+                for(i = 0; i < ''' + str(directions.shape[0]) + '''; i++){
+                    direction = (mot_float_type4)(dki_directions[i * 3],
+                                                  dki_directions[i * 3 + 1],
+                                                  dki_directions[i * 3 + 2], 0);
+                    mean += (apparent_kurtosis(data->parameters, direction, vec0, vec1, vec2) - mean) / (i + 1);
                 }
                 *(data->mks) = clamp(mean, (double)0, (double)3);
 
-
                 // Axial Kurtosis over the principal direction of diffusion
-                *(data->aks) = clamp(apparent_kurtosis(data->parameters, *principal_vec, vec0, vec1, vec2), 
-                                   (double)0, (double)10);
-
+                *(data->aks) = clamp(apparent_kurtosis(data->parameters, vecs[0], vec0, vec1, vec2),
+                                     (double)0, (double)10);
 
                 // Radial Kurtosis integrated over a unit circle around the principal eigenvector.
                 mean = 0;
                 mot_float_type4 rotated_vec;
-                for(i = 0; i < data->nmr_radial_directions; i++){
-                    rotated_vec = RotateOrthogonalVector(*principal_vec, *perpendicular_vec,
-                                                         i * (2 * M_PI_F) / data->nmr_radial_directions);
+                for(i = 0; i < ''' + str(nmr_radial_directions) + '''; i++){
+                    rotated_vec = RotateOrthogonalVector(vecs[0], vecs[1],
+                                                         i * (2 * M_PI_F) / ''' + str(nmr_radial_directions) + ''');
 
                     mean += (apparent_kurtosis(data->parameters, rotated_vec, vec0, vec1, vec2) - mean) / (i + 1);
                 }
                 *(data->rks) = max(mean, (double)0);
             }
         '''
-        return NameFunctionTuple('calculate_measures', kernel_source)
 
-    def _get_spherical_samples(self):
-        """Get a number of 3d coordinates mapping an unit sphere.
+    def _get_analytic_measures_source(self):
+        return '''
+            #define DKI_SINGULARITY_TOLERANCE 2.5e-2
+
+            /** Carlson's incomplete elliptic integral of the first kind, R_F(x, y, z). */
+            double dki_carlson_rf(double x, double y, double z){
+                double sqrtx, sqrty, sqrtz, alamb, ave, delx, dely, delz, e2, e3;
+                int i;
+                for(i = 0; i < 100; i++){
+                    sqrtx = sqrt(x);
+                    sqrty = sqrt(y);
+                    sqrtz = sqrt(z);
+                    alamb = sqrtx * (sqrty + sqrtz) + sqrty * sqrtz;
+                    x = 0.25 * (x + alamb);
+                    y = 0.25 * (y + alamb);
+                    z = 0.25 * (z + alamb);
+                    ave = (x + y + z) / 3.0;
+                    delx = (ave - x) / ave;
+                    dely = (ave - y) / ave;
+                    delz = (ave - z) / ave;
+                    if(max(max(fabs(delx), fabs(dely)), fabs(delz)) <= 0.0025){
+                        break;
+                    }
+                }
+                e2 = delx * dely - delz * delz;
+                e3 = delx * dely * delz;
+                return (1.0 + (e2 / 24.0 - 0.1 - 3.0 / 44.0 * e3) * e2 + e3 / 14.0) / sqrt(ave);
+            }
 
-        List taken from "dki_parameters.m" by Jelle Veraart
-        (https://github.com/NYU-DiffusionMRI/Diffusion-Kurtosis-Imaging/blob/master/dki_parameters.m).
+            /** Carlson's incomplete elliptic integral of the second kind, R_D(x, y, z). */
+            double dki_carlson_rd(double x, double y, double z){
+                double sqrtx, sqrty, sqrtz, alamb, ave, delx, dely, delz, ea, eb, ec, ed, ee;
+                double sum = 0;
+                double fac = 1;
+                int i;
+                for(i = 0; i < 100; i++){
+                    sqrtx = sqrt(x);
+                    sqrty = sqrt(y);
+                    sqrtz = sqrt(z);
+                    alamb = sqrtx * (sqrty + sqrtz) + sqrty * sqrtz;
+                    sum += fac / (sqrtz * (z + alamb));
+                    fac = 0.25 * fac;
+                    x = 0.25 * (x + alamb);
+                    y = 0.25 * (y + alamb);
+                    z = 0.25 * (z + alamb);
+                    ave = 0.2 * (x + y + 3.0 * z);
+                    delx = (ave - x) / ave;
+                    dely = (ave - y) / ave;
+                    delz = (ave - z) / ave;
+                    if(max(max(fabs(delx), fabs(dely)), fabs(delz)) <= 0.0015){
+                        break;
+                    }
+                }
+                ea = delx * dely;
+                eb = delz * delz;
+                ec = ea - eb;
+                ed = ea - 6.0 * eb;
+                ee = ed + ec + ec;
+                return 3.0 * sum + fac * (1.0 + ed * (-3.0 / 14.0 + 0.25 * 9.0 / 22.0 * ed
+                                                      - 1.5 * 3.0 / 26.0 * delz * ee)
+                                          + delz * (ee / 6.0 + delz * (-9.0 / 22.0 * ec + delz * 3.0 / 26.0 * ea)))
+                                    / (ave * sqrt(ave));
+            }
 
-        Returns:
-            ndarray: a list of 3d coordinates mapping an unit sphere.
-        """
-        return np.array([[0, 0, 1.0000],
-                         [0.5924, 0, 0.8056],
-                         [-0.7191, -0.1575, -0.6768],
-                         [-0.9151, -0.3479, 0.2040],
-                         [0.5535, 0.2437, 0.7964],
-                         [-0.0844, 0.9609, -0.2636],
-                         [0.9512, -0.3015, 0.0651],
-                         [-0.4225, 0.8984, 0.1202],
-                         [0.5916, -0.6396, 0.4909],
-                         [0.3172, 0.8818, -0.3489],
-                         [-0.1988, -0.6687, 0.7164],
-                         [-0.2735, 0.3047, -0.9123],
-                         [0.9714, -0.1171, 0.2066],
-                         [-0.5215, -0.4013, 0.7530],
-                         [-0.3978, -0.9131, -0.0897],
-                         [0.2680, 0.8196, 0.5063],
-                         [-0.6824, -0.6532, -0.3281],
-                         [0.4748, -0.7261, -0.4973],
-                         [0.4504, -0.4036, 0.7964],
-                         [-0.5551, -0.8034, -0.2153],
-                         [0.0455, -0.2169, 0.9751],
-                         [0.0483, 0.5845, 0.8099],
-                         [-0.1909, -0.1544, -0.9694],
-                         [0.8383, 0.5084, 0.1969],
-                         [-0.2464, 0.1148, 0.9623],
-                         [-0.7458, 0.6318, 0.2114],
-                         [-0.0080, -0.9831, -0.1828],
-                         [-0.2630, 0.5386, -0.8005],
-                         [-0.0507, 0.6425, -0.7646],
-                         [0.4476, -0.8877, 0.1081],
-                         [-0.5627, 0.7710, 0.2982],
-                         [-0.3790, 0.7774, -0.5020],
-                         [-0.6217, 0.4586, -0.6350],
-                         [-0.1506, 0.8688, -0.4718],
-                         [-0.4579, 0.2131, 0.8631],
-                         [-0.8349, -0.2124, 0.5077],
-                         [0.7682, -0.1732, -0.6163],
-                         [0.0997, -0.7168, -0.6901],
-                         [0.0386, -0.2146, -0.9759],
-                         [0.9312, 0.1655, -0.3249],
-                         [0.9151, 0.3053, 0.2634],
-                         [0.8081, 0.5289, -0.2593],
-                         [-0.3632, -0.9225, 0.1305],
-                         [0.2709, -0.3327, -0.9033],
-                         [-0.1942, -0.9790, -0.0623],
-                         [0.6302, -0.7641, 0.1377],
-                         [-0.6948, -0.3137, 0.6471],
-                         [-0.6596, -0.6452, 0.3854],
-                         [-0.9454, 0.2713, 0.1805],
-                         [-0.2586, -0.7957, 0.5477],
-                         [-0.3576, 0.6511, 0.6695],
-                         [-0.8490, -0.5275, 0.0328],
-                         [0.3830, 0.2499, -0.8893],
-                         [0.8804, -0.2392, -0.4095],
-                         [0.4321, -0.4475, -0.7829],
-                         [-0.5821, -0.1656, 0.7961],
-                         [0.3963, 0.6637, 0.6344],
-                         [-0.7222, -0.6855, -0.0929],
-                         [0.2130, -0.9650, -0.1527],
-                         [0.4737, 0.7367, -0.4825],
-                         [-0.9956, 0.0891, 0.0278],
-                         [-0.5178, 0.7899, -0.3287],
-                         [-0.8906, 0.1431, -0.4317],
-                         [0.2431, -0.9670, 0.0764],
-                         [-0.6812, -0.3807, -0.6254],
-                         [-0.1091, -0.5141, 0.8507],
-                         [-0.2206, 0.7274, -0.6498],
-                         [0.8359, 0.2674, 0.4794],
-                         [0.9873, 0.1103, 0.1147],
-                         [0.7471, 0.0659, -0.6615],
-                         [0.6119, -0.2508, 0.7502],
-                         [-0.6191, 0.0776, 0.7815],
-                         [0.7663, -0.4739, 0.4339],
-                         [-0.5699, 0.5369, 0.6220],
-                         [0.0232, -0.9989, 0.0401],
-                         [0.0671, -0.4207, -0.9047],
-                         [-0.2145, 0.5538, 0.8045],
-                         [0.8554, -0.4894, 0.1698],
-                         [-0.7912, -0.4194, 0.4450],
-                         [-0.2341, 0.0754, -0.9693],
-                         [-0.7725, 0.6346, -0.0216],
-                         [0.0228, 0.7946, -0.6067],
-                         [0.7461, -0.3966, -0.5348],
-                         [-0.4045, -0.0837, -0.9107],
-                         [-0.4364, 0.6084, -0.6629],
-                         [0.6177, -0.3175, -0.7195],
-                         [-0.4301, -0.0198, 0.9026],
-                         [-0.1489, -0.9706, 0.1892],
-                         [0.0879, 0.9070, -0.4117],
-                         [-0.7764, -0.4707, -0.4190],
-                         [0.9850, 0.1352, -0.1073],
-                         [-0.1581, -0.3154, 0.9357],
-                         [0.8938, -0.3246, 0.3096],
-                         [0.8358, -0.4464, -0.3197],
-                         [0.4943, 0.4679, 0.7327],
-                         [-0.3095, 0.9015, -0.3024],
-                         [-0.3363, -0.8942, -0.2956],
-                         [-0.1271, -0.9274, -0.3519],
-                         [0.3523, -0.8717, -0.3407],
-                         [0.7188, -0.6321, 0.2895],
-                         [-0.7447, 0.0924, -0.6610],
-                         [0.1622, 0.7186, 0.6762],
-                         [-0.9406, -0.0829, -0.3293],
-                         [-0.1229, 0.9204, 0.3712],
-                         [-0.8802, 0.4668, 0.0856],
-                         [-0.2062, -0.1035, 0.9730],
-                         [-0.4861, -0.7586, -0.4338],
-                         [-0.6138, 0.7851, 0.0827],
-                         [0.8476, 0.0504, 0.5282],
-                         [0.3236, 0.4698, -0.8213],
-                         [-0.7053, -0.6935, 0.1473],
-                         [0.1511, 0.3778, 0.9135],
-                         [0.6011, 0.5847, 0.5448],
-                         [0.3610, 0.3183, 0.8766],
-                         [0.9432, 0.3304, 0.0341],
-                         [0.2423, -0.8079, -0.5372],
-                         [0.4431, -0.1578, 0.8825],
-                         [0.6204, 0.5320, -0.5763],
-                         [-0.2806, -0.5376, -0.7952],
-                         [-0.5279, -0.8071, 0.2646],
-                         [-0.4214, -0.6159, 0.6656],
-                         [0.6759, -0.5995, -0.4288],
-                         [0.5670, 0.8232, -0.0295],
-                         [-0.0874, 0.4284, -0.8994],
-                         [0.8780, -0.0192, -0.4782],
-                         [0.0166, 0.8421, 0.5391],
-                         [-0.7741, 0.2931, -0.5610],
-                         [0.9636, -0.0579, -0.2611],
-                         [0, 0, -1.0000],
-                         [-0.5924, 0, -0.8056],
-                         [0.7191, 0.1575, 0.6768],
-                         [0.9151, 0.3479, -0.2040],
-                         [-0.5535, -0.2437, -0.7964],
-                         [0.0844, -0.9609, 0.2636],
-                         [-0.9512, 0.3015, -0.0651],
-                         [0.4225, -0.8984, -0.1202],
-                         [-0.5916, 0.6396, -0.4909],
-                         [-0.3172, -0.8818, 0.3489],
-                         [0.1988, 0.6687, -0.7164],
-                         [0.2735, -0.3047, 0.9123],
-                         [-0.9714, 0.1171, -0.2066],
-                         [0.5215, 0.4013, -0.7530],
-                         [0.3978, 0.9131, 0.0897],
-                         [-0.2680, -0.8196, -0.5063],
-                         [0.6824, 0.6532, 0.3281],
-                         [-0.4748, 0.7261, 0.4973],
-                         [-0.4504, 0.4036, -0.7964],
-                         [0.5551, 0.8034, 0.2153],
-                         [-0.0455, 0.2169, -0.9751],
-                         [-0.0483, -0.5845, -0.8099],
-                         [0.1909, 0.1544, 0.9694],
-                         [-0.8383, -0.5084, -0.1969],
-                         [0.2464, -0.1148, -0.9623],
-                         [0.7458, -0.6318, -0.2114],
-                         [0.0080, 0.9831, 0.1828],
-                         [0.2630, -0.5386, 0.8005],
-                         [0.0507, -0.6425, 0.7646],
-                         [-0.4476, 0.8877, -0.1081],
-                         [0.5627, -0.7710, -0.2982],
-                         [0.3790, -0.7774, 0.5020],
-                         [0.6217, -0.4586, 0.6350],
-                         [0.1506, -0.8688, 0.4718],
-                         [0.4579, -0.2131, -0.8631],
-                         [0.8349, 0.2124, -0.5077],
-                         [-0.7682, 0.1732, 0.6163],
-                         [-0.0997, 0.7168, 0.6901],
-                         [-0.0386, 0.2146, 0.9759],
-                         [-0.9312, -0.1655, 0.3249],
-                         [-0.9151, -0.3053, -0.2634],
-                         [-0.8081, -0.5289, 0.2593],
-                         [0.3632, 0.9225, -0.1305],
-                         [-0.2709, 0.3327, 0.9033],
-                         [0.1942, 0.9790, 0.0623],
-                         [-0.6302, 0.7641, -0.1377],
-                         [0.6948, 0.3137, -0.6471],
-                         [0.6596, 0.6452, -0.3854],
-                         [0.9454, -0.2713, -0.1805],
-                         [0.2586, 0.7957, -0.5477],
-                         [0.3576, -0.6511, -0.6695],
-                         [0.8490, 0.5275, -0.0328],
-                         [-0.3830, -0.2499, 0.8893],
-                         [-0.8804, 0.2392, 0.4095],
-                         [-0.4321, 0.4475, 0.7829],
-                         [0.5821, 0.1656, -0.7961],
-                         [-0.3963, -0.6637, -0.6344],
-                         [0.7222, 0.6855, 0.0929],
-                         [-0.2130, 0.9650, 0.1527],
-                         [-0.4737, -0.7367, 0.4825],
-                         [0.9956, -0.0891, -0.0278],
-                         [0.5178, -0.7899, 0.3287],
-                         [0.8906, -0.1431, 0.4317],
-                         [-0.2431, 0.9670, -0.0764],
-                         [0.6812, 0.3807, 0.6254],
-                         [0.1091, 0.5141, -0.8507],
-                         [0.2206, -0.7274, 0.6498],
-                         [-0.8359, -0.2674, -0.4794],
-                         [-0.9873, -0.1103, -0.1147],
-                         [-0.7471, -0.0659, 0.6615],
-                         [-0.6119, 0.2508, -0.7502],
-                         [0.6191, -0.0776, -0.7815],
-                         [-0.7663, 0.4739, -0.4339],
-                         [0.5699, -0.5369, -0.6220],
-                         [-0.0232, 0.9989, -0.0401],
-                         [-0.0671, 0.4207, 0.9047],
-                         [0.2145, -0.5538, -0.8045],
-                         [-0.8554, 0.4894, -0.1698],
-                         [0.7912, 0.4194, -0.4450],
-                         [0.2341, -0.0754, 0.9693],
-                         [0.7725, -0.6346, 0.0216],
-                         [-0.0228, -0.7946, 0.6067],
-                         [-0.7461, 0.3966, 0.5348],
-                         [0.4045, 0.0837, 0.9107],
-                         [0.4364, -0.6084, 0.6629],
-                         [-0.6177, 0.3175, 0.7195],
-                         [0.4301, 0.0198, -0.9026],
-                         [0.1489, 0.9706, -0.1892],
-                         [-0.0879, -0.9070, 0.4117],
-                         [0.7764, 0.4707, 0.4190],
-                         [-0.9850, -0.1352, 0.1073],
-                         [0.1581, 0.3154, -0.9357],
-                         [-0.8938, 0.3246, -0.3096],
-                         [-0.8358, 0.4464, 0.3197],
-                         [-0.4943, -0.4679, -0.7327],
-                         [0.3095, -0.9015, 0.3024],
-                         [0.3363, 0.8942, 0.2956],
-                         [0.1271, 0.9274, 0.3519],
-                         [-0.3523, 0.8717, 0.3407],
-                         [-0.7188, 0.6321, -0.2895],
-                         [0.7447, -0.0924, 0.6610],
-                         [-0.1622, -0.7186, -0.6762],
-                         [0.9406, 0.0829, 0.3293],
-                         [0.1229, -0.9204, -0.3712],
-                         [0.8802, -0.4668, -0.0856],
-                         [0.2062, 0.1035, -0.9730],
-                         [0.4861, 0.7586, 0.4338],
-                         [0.6138, -0.7851, -0.0827],
-                         [-0.8476, -0.0504, -0.5282],
-                         [-0.3236, -0.4698, 0.8213],
-                         [0.7053, 0.6935, -0.1473],
-                         [-0.1511, -0.3778, -0.9135],
-                         [-0.6011, -0.5847, -0.5448],
-                         [-0.3610, -0.3183, -0.8766],
-                         [-0.9432, -0.3304, -0.0341],
-                         [-0.2423, 0.8079, 0.5372],
-                         [-0.4431, 0.1578, -0.8825],
-                         [-0.6204, -0.5320, 0.5763],
-                         [0.2806, 0.5376, 0.7952],
-                         [0.5279, 0.8071, -0.2646],
-                         [0.4214, 0.6159, -0.6656],
-                         [-0.6759, 0.5995, 0.4288],
-                         [-0.5670, -0.8232, 0.0295],
-                         [0.0874, -0.4284, 0.8994],
-                         [-0.8780, 0.0192, 0.4782],
-                         [-0.0166, -0.8421, -0.5391],
-                         [0.7741, -0.2931, 0.5610],
-                         [-0.9636, 0.0579, 0.2611]])
+            bool dki_is_close(double a, double b, double reference){
+                return fabs(a - b) < reference * DKI_SINGULARITY_TOLERANCE;
+            }
+
+            /** Equation 39 of Tabesh et al. (2011), with the singularity b == c resolved using equation 46. */
+            double dki_F2(double a, double b, double c){
+                if(dki_is_close(b, c, b)){
+                    if(dki_is_close(a, b, b)){
+                        return 6 / 15.0;
+                    }
+                    double l3 = (b + c) / 2.0;
+                    double x = 1 - a / l3;
+                    double alpha;
+                    if(x > 0){
+                        alpha = atanh(sqrt(x)) / sqrt(x);
+                    }
+                    else{
+                        alpha = atan(sqrt(-x)) / sqrt(-x);
+                    }
+                    return 6 * pown(a + 2 * l3, 2) / (144 * l3 * l3 * pown(a - l3, 2))
+                            * (l3 * (a + 2 * l3) + a * (a - 4 * l3) * alpha);
+                }
+                return pown(a + b + c, 2) / (3 * pown(b - c, 2))
+                        * ((b + c) / sqrt(b * c) * dki_carlson_rf(a / b, a / c, 1)
+                           + (2 * a - b - c) / (3 * sqrt(b * c)) * dki_carlson_rd(a / b, a / c, 1) - 2);
+            }
+
+            /** Equation 38 of Tabesh et al. (2011), with the singularities a == b and a == c resolved. */
+            double dki_F1(double a, double b, double c){
+                if(dki_is_close(a, b, a) && dki_is_close(a, c, a)){
+                    return 1 / 5.0;
+                }
+                if(dki_is_close(a, b, a)){
+                    return dki_F2(c, (a + b) / 2.0, (a + b) / 2.0) / 2.0;
+                }
+                if(dki_is_close(a, c, a)){
+                    return dki_F2(b, (a + c) / 2.0, (a + c) / 2.0) / 2.0;
+                }
+                return pown(a + b + c, 2) / (18 * (a - b) * (a - c))
+                        * (sqrt(b * c) / a * dki_carlson_rf(a / b, a / c, 1)
+                           + (3 * a * a - a * b - a * c - b * c) / (3 * a * sqrt(b * c))
+                             * dki_carlson_rd(a / b, a / c, 1) - 1);
+            }
+
+            /** Equation 44 of Tabesh et al. (2011), with the singularity b == c resolved. */
+            double dki_G1(double a, double b, double c){
+                if(dki_is_close(b, c, b)){
+                    return pown(a + 2 * b, 2) / (24 * b * b);
+                }
+                return pown(a + b + c, 2) / (18 * b * pown(b - c, 2)) * (2 * b + (c * c - 3 * b * c) / sqrt(b * c));
+            }
+
+            /** Equation 45 of Tabesh et al. (2011), with the singularity b == c resolved. */
+            double dki_G2(double a, double b, double c){
+                if(dki_is_close(b, c, b)){
+                    return pown(a + 2 * b, 2) / (12 * b * b);
+                }
+                return pown(a + b + c, 2) / (3 * pown(b - c, 2)) * ((b + c) / sqrt(b * c) - 2);
+            }
+
+            /**
+             * Get the element W(u, u, v, v) of the Kurtosis tensor, using the polarization identity.
+             */
+            double dki_mixed_kurtosis_product(global mot_float_type* params, mot_float_type4 u, mot_float_type4 v){
+                return (dki_kurtosis_product(params, u + v) + dki_kurtosis_product(params, u - v)
+                        - 2 * dki_kurtosis_product(params, u) - 2 * dki_kurtosis_product(params, v)) / 12.0;
+            }
+
+            void calculate_measures(mot_data_struct* data){
+                double l[3];
+                mot_float_type4 e[3];
+                dki_sorted_eigensystem(data->parameters, l, e);
+
+                mot_float_type4 vec0, vec1, vec2;
+                TensorSphericalToCartesian(
+                    data->parameters[3], data->parameters[4], data->parameters[5], &vec0, &vec1, &vec2);
+
+                // Axial Kurtosis over the principal direction of diffusion
+                *(data->aks) = clamp(apparent_kurtosis(data->parameters, e[0], vec0, vec1, vec2),
+                                     (double)0, (double)10);
+
+                if(l[0] <= 0 || l[1] <= 0 || l[2] <= 0){
+                    *(data->mks) = 0;
+                    *(data->rks) = 0;
+                    return;
+                }
+
+                // the Kurtosis tensor elements rotated to the eigensystem of the diffusion tensor
+                double w_1111 = dki_kurtosis_product(data->parameters, e[0]);
+                double w_2222 = dki_kurtosis_product(data->parameters, e[1]);
+                double w_3333 = dki_kurtosis_product(data->parameters, e[2]);
+                double w_1122 = dki_mixed_kurtosis_product(data->parameters, e[0], e[1]);
+                double w_1133 = dki_mixed_kurtosis_product(data->parameters, e[0], e[2]);
+                double w_2233 = dki_mixed_kurtosis_product(data->parameters, e[1], e[2]);
+
+                double mean = dki_F1(l[0], l[1], l[2]) * w_1111
+                              + dki_F1(l[1], l[0], l[2]) * w_2222
+                              + dki_F1(l[2], l[1], l[0]) * w_3333
+                              + dki_F2(l[0], l[1], l[2]) * w_2233
+                              + dki_F2(l[1], l[0], l[2]) * w_1133
+                              + dki_F2(l[2], l[1], l[0]) * w_1122;
+                *(data->mks) = clamp(mean, (double)0, (double)3);
+
+                double radial = dki_G1(l[0], l[1], l[2]) * w_2222
+                                + dki_G1(l[0], l[2], l[1]) * w_3333
+                                + dki_G2(l[0], l[1], l[2]) * w_2233;
+                *(data->rks) = max(radial, (double)0);
+            }
+        '''
+
+
+def get_spherical_directions(nmr_directions=DEFAULT_NMR_DIRECTIONS):
+    """Get a (cached) set of unit vectors covering the sphere.
+
+    For the default size this returns the directions from "dki_parameters.m" by Jelle Veraart, for all other sizes
+    this returns the points of a Fibonacci lattice on the sphere.
+
+    Args:
+        nmr_directions (int): the number of directions
+
+    Returns:
+        ndarray: a (n, 3) array with the directions, should not be altered
+    """
+    if nmr_directions not in _direction_sets:
+        if nmr_directions == DEFAULT_NMR_DIRECTIONS:
+            directions = _get_default_directions()
+        else:
+            indices = np.arange(nmr_directions) + 0.5
+            z = 1 - 2 * indices / nmr_directions
+            radius = np.sqrt(1 - z ** 2)
+            azimuth = np.pi * (1 + np.sqrt(5)) * indices
+            directions = np.column_stack([radius * np.cos(azimuth), radius * np.sin(azimuth), z])
+        directions.setflags(write=False)
+        _direction_sets[nmr_directions] = directions
+    return _direction_sets[nmr_directions]
+
+
+def _get_default_directions():
+    """Get a number of 3d coordinates mapping an unit sphere.
+
+    List taken from "dki_parameters.m" by Jelle Veraart
+    (https://github.com/NYU-DiffusionMRI/Diffusion-Kurtosis-Imaging/blob/master/dki_parameters.m).
+
+    Returns:
+        ndarray: a list of 3d coordinates mapping an unit sphere.
+    """
+    return np.array([[0, 0, 1.0000],
+                     [0.5924, 0, 0.8056],
+                     [-0.7191, -0.1575, -0.6768],
+                     [-0.9151, -0.3479, 0.2040],
+                     [0.5535, 0.2437, 0.7964],
+                     [-0.0844, 0.9609, -0.2636],
+                     [0.9512, -0.3015, 0.0651],
+                     [-0.4225, 0.8984, 0.1202],
+                     [0.5916, -0.6396, 0.4909],
+                     [0.3172, 0.8818, -0.3489],
+                     [-0.1988, -0.6687, 0.7164],
+                     [-0.2735, 0.3047, -0.9123],
+                     [0.9714, -0.1171, 0.2066],
+                     [-0.5215, -0.4013, 0.7530],
+                     [-0.3978, -0.9131, -0.0897],
+                     [0.2680, 0.8196, 0.5063],
+                     [-0.6824, -0.6532, -0.3281],
+                     [0.4748, -0.7261, -0.4973],
+                     [0.4504, -0.4036, 0.7964],
+                     [-0.5551, -0.8034, -0.2153],
+                     [0.0455, -0.2169, 0.9751],
+                     [0.0483, 0.5845, 0.8099],
+                     [-0.1909, -0.1544, -0.9694],
+                     [0.8383, 0.5084, 0.1969],
+                     [-0.2464, 0.1148, 0.9623],
+                     [-0.7458, 0.6318, 0.2114],
+                     [-0.0080, -0.9831, -0.1828],
+                     [-0.2630, 0.5386, -0.8005],
+                     [-0.0507, 0.6425, -0.7646],
+                     [0.4476, -0.8877, 0.1081],
+                     [-0.5627, 0.7710, 0.2982],
+                     [-0.3790, 0.7774, -0.5020],
+                     [-0.6217, 0.4586, -0.6350],
+                     [-0.1506, 0.8688, -0.4718],
+                     [-0.4579, 0.2131, 0.8631],
+                     [-0.8349, -0.2124, 0.5077],
+                     [0.7682, -0.1732, -0.6163],
+                     [0.0997, -0.7168, -0.6901],
+                     [0.0386, -0.2146, -0.9759],
+                     [0.9312, 0.1655, -0.3249],
+                     [0.9151, 0.3053, 0.2634],
+                     [0.8081, 0.5289, -0.2593],
+                     [-0.3632, -0.9225, 0.1305],
+                     [0.2709, -0.3327, -0.9033],
+                     [-0.1942, -0.9790, -0.0623],
+                     [0.6302, -0.7641, 0.1377],
+                     [-0.6948, -0.3137, 0.6471],
+                     [-0.6596, -0.6452, 0.3854],
+                     [-0.9454, 0.2713, 0.1805],
+                     [-0.2586, -0.7957, 0.5477],
+                     [-0.3576, 0.6511, 0.6695],
+                     [-0.8490, -0.5275, 0.0328],
+                     [0.3830, 0.2499, -0.8893],
+                     [0.8804, -0.2392, -0.4095],
+                     [0.4321, -0.4475, -0.7829],
+                     [-0.5821, -0.1656, 0.7961],
+                     [0.3963, 0.6637, 0.6344],
+                     [-0.7222, -0.6855, -0.0929],
+                     [0.2130, -0.9650, -0.1527],
+                     [0.4737, 0.7367, -0.4825],
+                     [-0.9956, 0.0891, 0.0278],
+                     [-0.5178, 0.7899, -0.3287],
+                     [-0.8906, 0.1431, -0.4317],
+                     [0.2431, -0.9670, 0.0764],
+                     [-0.6812, -0.3807, -0.6254],
+                     [-0.1091, -0.5141, 0.8507],
+                     [-0.2206, 0.7274, -0.6498],
+                     [0.8359, 0.2674, 0.4794],
+                     [0.9873, 0.1103, 0.1147],
+                     [0.7471, 0.0659, -0.6615],
+                     [0.6119, -0.2508, 0.7502],
+                     [-0.6191, 0.0776, 0.7815],
+                     [0.7663, -0.4739, 0.4339],
+                     [-0.5699, 0.5369, 0.6220],
+                     [0.0232, -0.9989, 0.0401],
+                     [0.0671, -0.4207, -0.9047],
+                     [-0.2145, 0.5538, 0.8045],
+                     [0.8554, -0.4894, 0.1698],
+                     [-0.7912, -0.4194, 0.4450],
+                     [-0.2341, 0.0754, -0.9693],
+                     [-0.7725, 0.6346, -0.0216],
+                     [0.0228, 0.7946, -0.6067],
+                     [0.7461, -0.3966, -0.5348],
+                     [-0.4045, -0.0837, -0.9107],
+                     [-0.4364, 0.6084, -0.6629],
+                     [0.6177, -0.3175, -0.7195],
+                     [-0.4301, -0.0198, 0.9026],
+                     [-0.1489, -0.9706, 0.1892],
+                     [0.0879, 0.9070, -0.4117],
+                     [-0.7764, -0.4707, -0.4190],
+                     [0.9850, 0.1352, -0.1073],
+                     [-0.1581, -0.3154, 0.9357],
+                     [0.8938, -0.3246, 0.3096],
+                     [0.8358, -0.4464, -0.3197],
+                     [0.4943, 0.4679, 0.7327],
+                     [-0.3095, 0.9015, -0.3024],
+                     [-0.3363, -0.8942, -0.2956],
+                     [-0.1271, -0.9274, -0.3519],
+                     [0.3523, -0.8717, -0.3407],
+                     [0.7188, -0.6321, 0.2895],
+                     [-0.7447, 0.0924, -0.6610],
+                     [0.1622, 0.7186, 0.6762],
+                     [-0.9406, -0.0829, -0.3293],
+                     [-0.1229, 0.9204, 0.3712],
+                     [-0.8802, 0.4668, 0.0856],
+                     [-0.2062, -0.1035, 0.9730],
+                     [-0.4861, -0.7586, -0.4338],
+                     [-0.6138, 0.7851, 0.0827],
+                     [0.8476, 0.0504, 0.5282],
+                     [0.3236, 0.4698, -0.8213],
+                     [-0.7053, -0.6935, 0.1473],
+                     [0.1511, 0.3778, 0.9135],
+                     [0.6011, 0.5847, 0.5448],
+                     [0.3610, 0.3183, 0.8766],
+                     [0.9432, 0.3304, 0.0341],
+                     [0.2423, -0.8079, -0.5372],
+                     [0.4431, -0.1578, 0.8825],
+                     [0.6204, 0.5320, -0.5763],
+                     [-0.2806, -0.5376, -0.7952],
+                     [-0.5279, -0.8071, 0.2646],
+                     [-0.4214, -0.6159, 0.6656],
+                     [0.6759, -0.5995, -0.4288],
+                     [0.5670, 0.8232, -0.0295],
+                     [-0.0874, 0.4284, -0.8994],
+                     [0.8780, -0.0192, -0.4782],
+                     [0.0166, 0.8421, 0.5391],
+                     [-0.7741, 0.2931, -0.5610],
+                     [0.9636, -0.0579, -0.2611],
+                     [0, 0, -1.0000],
+                     [-0.5924, 0, -0.8056],
+                     [0.7191, 0.1575, 0.6768],
+                     [0.9151, 0.3479, -0.2040],
+                     [-0.5535, -0.2437, -0.7964],
+                     [0.0844, -0.9609, 0.2636],
+                     [-0.9512, 0.3015, -0.0651],
+                     [0.4225, -0.8984, -0.1202],
+                     [-0.5916, 0.6396, -0.4909],
+                     [-0.3172, -0.8818, 0.3489],
+                     [0.1988, 0.6687, -0.7164],
+                     [0.2735, -0.3047, 0.9123],
+                     [-0.9714, 0.1171, -0.2066],
+                     [0.5215, 0.4013, -0.7530],
+                     [0.3978, 0.9131, 0.0897],
+                     [-0.2680, -0.8196, -0.5063],
+                     [0.6824, 0.6532, 0.3281],
+                     [-0.4748, 0.7261, 0.4973],
+                     [-0.4504, 0.4036, -0.7964],
+                     [0.5551, 0.8034, 0.2153],
+                     [-0.0455, 0.2169, -0.9751],
+                     [-0.0483, -0.5845, -0.8099],
+                     [0.1909, 0.1544, 0.9694],
+                     [-0.8383, -0.5084, -0.1969],
+                     [0.2464, -0.1148, -0.9623],
+                     [0.7458, -0.6318, -0.2114],
+                     [0.0080, 0.9831, 0.1828],
+                     [0.2630, -0.5386, 0.8005],
+                     [0.0507, -0.6425, 0.7646],
+                     [-0.4476, 0.8877, -0.1081],
+                     [0.5627, -0.7710, -0.2982],
+                     [0.3790, -0.7774, 0.5020],
+                     [0.6217, -0.4586, 0.6350],
+                     [0.1506, -0.8688, 0.4718],
+                     [0.4579, -0.2131, -0.8631],
+                     [0.8349, 0.2124, -0.5077],
+                     [-0.7682, 0.1732, 0.6163],
+                     [-0.0997, 0.7168, 0.6901],
+                     [-0.0386, 0.2146, 0.9759],
+                     [-0.9312, -0.1655, 0.3249],
+                     [-0.9151, -0.3053, -0.2634],
+                     [-0.8081, -0.5289, 0.2593],
+                     [0.3632, 0.9225, -0.1305],
+                     [-0.2709, 0.3327, 0.9033],
+                     [0.1942, 0.9790, 0.0623],
+                     [-0.6302, 0.7641, -0.1377],
+                     [0.6948, 0.3137, -0.6471],
+                     [0.6596, 0.6452, -0.3854],
+                     [0.9454, -0.2713, -0.1805],
+                     [0.2586, 0.7957, -0.5477],
+                     [0.3576, -0.6511, -0.6695],
+                     [0.8490, 0.5275, -0.0328],
+                     [-0.3830, -0.2499, 0.8893],
+                     [-0.8804, 0.2392, 0.4095],
+                     [-0.4321, 0.4475, 0.7829],
+                     [0.5821, 0.1656, -0.7961],
+                     [-0.3963, -0.6637, -0.6344],
+                     [0.7222, 0.6855, 0.0929],
+                     [-0.2130, 0.9650, 0.1527],
+                     [-0.4737, -0.7367, 0.4825],
+                     [0.9956, -0.0891, -0.0278],
+                     [0.5178, -0.7899, 0.3287],
+                     [0.8906, -0.1431, 0.4317],
+                     [-0.2431, 0.9670, -0.0764],
+                     [0.6812, 0.3807, 0.6254],
+                     [0.1091, 0.5141, -0.8507],
+                     [0.2206, -0.7274, 0.6498],
+                     [-0.8359, -0.2674, -0.4794],
+                     [-0.9873, -0.1103, -0.1147],
+                     [-0.7471, -0.0659, 0.6615],
+                     [-0.6119, 0.2508, -0.7502],
+                     [0.6191, -0.0776, -0.7815],
+                     [-0.7663, 0.4739, -0.4339],
+                     [0.5699, -0.5369, -0.6220],
+                     [-0.0232, 0.9989, -0.0401],
+                     [-0.0671, 0.4207, 0.9047],
+                     [0.2145, -0.5538, -0.8045],
+                     [-0.8554, 0.4894, -0.1698],
+                     [0.7912, 0.4194, -0.4450],
+                     [0.2341, -0.0754, 0.9693],
+                     [0.7725, -0.6346, 0.0216],
+                     [-0.0228, -0.7946, 0.6067],
+                     [-0.7461, 0.3966, 0.5348],
+                     [0.4045, 0.0837, 0.9107],
+                     [0.4364, -0.6084, 0.6629],
+                     [-0.6177, 0.3175, 0.7195],
+                     [0.4301, 0.0198, -0.9026],
+                     [0.1489, 0.9706, -0.1892],
+                     [-0.0879, -0.9070, 0.4117],
+                     [0.7764, 0.4707, 0.4190],
+                     [-0.9850, -0.1352, 0.1073],
+                     [0.1581, 0.3154, -0.9357],
+                     [-0.8938, 0.3246, -0.3096],
+                     [-0.8358, 0.4464, 0.3197],
+                     [-0.4943, -0.4679, -0.7327],
+                     [0.3095, -0.9015, 0.3024],
+                     [0.3363, 0.8942, 0.2956],
+                     [0.1271, 0.9274, 0.3519],
+                     [-0.3523, 0.8717, 0.3407],
+                     [-0.7188, 0.6321, -0.2895],
+                     [0.7447, -0.0924, 0.6610],
+                     [-0.1622, -0.7186, -0.6762],
+                     [0.9406, 0.0829, 0.3293],
+                     [0.1229, -0.9204, -0.3712],
+                     [0.8802, -0.4668, -0.0856],
+                     [0.2062, 0.1035, -0.9730],
+                     [0.4861, 0.7586, 0.4338],
+                     [0.6138, -0.7851, -0.0827],
+                     [-0.8476, -0.0504, -0.5282],
+                     [-0.3236, -0.4698, 0.8213],
+                     [0.7053, 0.6935, -0.1473],
+                     [-0.1511, -0.3778, -0.9135],
+                     [-0.6011, -0.5847, -0.5448],
+                     [-0.3610, -0.3183, -0.8766],
+                     [-0.9432, -0.3304, -0.0341],
+                     [-0.2423, 0.8079, 0.5372],
+                     [-0.4431, 0.1578, -0.8825],
+                     [-0.6204, -0.5320, 0.5763],
+                     [0.2806, 0.5376, 0.7952],
+                     [0.5279, 0.8071, -0.2646],
+                     [0.4214, 0.6159, -0.6656],
+                     [-0.6759, 0.5995, 0.4288],
+                     [-0.5670, -0.8232, 0.0295],
+                     [0.0874, -0.4284, 0.8994],
+                     [-0.8780, 0.0192, 0.4782],
+                     [-0.0166, -0.8421, -0.5391],
+                     [0.7741, -0.2931, 0.5610],
+                     [-0.9636, 0.0579, 0.2611]])
@@ -0,0 +1,178 @@
+"""Goodness-of-fit statistics of optimized models.
+
+These statistics are computed on the device, in one kernel per batch of voxels, from the observations and the
+optimized parameters of the fitted model. They do not require the signal estimates to be stored.
+
+Per voxel we compute the sum of squared errors (SSE), the coefficient of determination (R2), the root mean squared
+error normalized by the mean observed signal (NRMSE) and the number of outlier volumes, being the volumes whose
+absolute residual exceeds the configured number of times the root mean squared error. Per group of volumes (shell) we
+compute the mean and the standard deviation of the residuals.
+
+The default settings are taken from the ``goodness_of_fit`` section of the ``optimization`` configuration.
+"""
+import numpy as np
+from mot.cl_routines.mapping.run_procedure import RunProcedure
+from mot.kernel_data import KernelArray
+from mot.cl_routines.base import CLRoutine
+from mdt.configuration import get_goodness_of_fit_settings
+from mot.utils import NameFunctionTuple
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-27"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+#: the prefix of the names of the goodness-of-fit output maps
+GOODNESS_OF_FIT_MAPS_PREFIX = 'GoodnessOfFit'
+
+
+class GoodnessOfFit(CLRoutine):
+
+    def __init__(self, outlier_threshold=None, cl_runtime_info=None):
+        """Calculate goodness-of-fit statistics of optimized models.
+
+        Args:
+            outlier_threshold (float): volumes whose absolute residual is larger than this value times the root mean
+                squared error of the voxel are counted as outliers. Defaults to the value in the configuration, at
+                the moment of calculation.
+            cl_runtime_info (mot.cl_runtime_info.CLRuntimeInfo): the runtime information
+        """
+        super(GoodnessOfFit, self).__init__(cl_runtime_info=cl_runtime_info)
+        self._outlier_threshold = outlier_threshold
+
+    def get_settings(self):
+        """Get the settings used for the calculation, with the configuration applied to the settings not given.
+
+        Returns:
+            dict: with the key 'outlier_threshold'
+        """
+        outlier_threshold = self._outlier_threshold
+        if outlier_threshold is None:
+            outlier_threshold = get_goodness_of_fit_settings().get('outlier_threshold', 3.0)
+        return {'outlier_threshold': float(outlier_threshold)}
+
+    def calculate(self, model, parameters, shells):
+        """Calculate the goodness-of-fit statistics.
+
+        Args:
+            model (mot.model_interfaces.SampleModelInterface): the build model, its kernel data needs to contain the
+                observations
+            parameters (ndarray): the (v, p) matrix with the optimized parameters
+            shells (list of tuple): the groups of volumes for which we compute the residual statistics, as tuples of
+                the name of a group and the indices of its volumes. Every volume may be in at most one group.
+
+        Returns:
+            dict: the maps ``GoodnessOfFit.SSE``, ``GoodnessOfFit.R2``, ``GoodnessOfFit.NRMSE``,
+                ``GoodnessOfFit.OutlierVolumes`` and per shell the maps ``GoodnessOfFit.ResidualMean.<shell>`` and
+                ``GoodnessOfFit.ResidualStd.<shell>``.
+        """
+        outlier_threshold = self.get_settings()['outlier_threshold']
+
+        parameters = np.require(parameters, self._cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O'])
+        nmr_voxels = parameters.shape[0]
+        nmr_shells = max(len(shells), 1)
+
+        # the outputs are allocated here, such that all devices write their voxels to the same arrays
+        measures = np.zeros((nmr_voxels, 4), dtype=self._cl_runtime_info.mot_float_dtype, order='C')
+        shell_stats = np.zeros((nmr_voxels, nmr_shells, 2), dtype=self._cl_runtime_info.mot_float_dtype, order='C')
+
+        kernel_data = dict(model.get_kernel_data())
+        kernel_data.update({
+            'gof_parameters': KernelArray(parameters, ctype='mot_float_type', is_readable=True, is_writable=False),
+            'gof_measures': KernelArray(measures, ctype='mot_float_type', is_readable=False, is_writable=True),
+            'gof_shell_stats': KernelArray(shell_stats, ctype='mot_float_type', is_readable=False, is_writable=True)})
+
+        runner = RunProcedure(self._cl_runtime_info)
+        runner.run_procedure(self._get_compute_function(model, parameters.shape[1], shells, outlier_threshold),
+                             kernel_data, nmr_voxels)
+
+
+        results = {GOODNESS_OF_FIT_MAPS_PREFIX + '.SSE': measures[:, 0],
+                   GOODNESS_OF_FIT_MAPS_PREFIX + '.R2': measures[:, 1],
+                   GOODNESS_OF_FIT_MAPS_PREFIX + '.NRMSE': measures[:, 2],
+                   GOODNESS_OF_FIT_MAPS_PREFIX + '.OutlierVolumes': np.round(measures[:, 3]).astype(np.uint32)}
+
+        for ind, (name, _) in enumerate(shells):
+            results['{}.ResidualMean.{}'.format(GOODNESS_OF_FIT_MAPS_PREFIX, name)] = shell_stats[:, ind, 0]
+            results['{}.ResidualStd.{}'.format(GOODNESS_OF_FIT_MAPS_PREFIX, name)] = shell_stats[:, ind, 1]
+        return results
+
+    def _get_compute_function(self, model, nmr_parameters, shells, outlier_threshold):
+        nmr_observations = model.get_nmr_observations()
+        nmr_shells = max(len(shells), 1)
+
+        volume_shells = np.full(nmr_observations, nmr_shells, dtype=np.uint32)
+        for ind, (_, indices) in enumerate(shells):
+            volume_shells[indices] = ind
+
+        eval_function = model.get_model_eval_function()
+        param_modifier = model.get_pre_eval_parameter_modifier()
+
+        kernel_source = ''
+        kernel_source += eval_function.get_cl_code()
+        kernel_source += param_modifier.get_cl_code()
+        kernel_source += '''
+            __constant uint gof_volume_shells[''' + str(nmr_observations) + '''] = {
+                ''' + ', '.join(map(str, volume_shells)) + '''
+            };
+
+            void calculate_goodness_of_fit(mot_data_struct* data){
+                uint i;
+                double residual;
+
+                mot_float_type x[''' + str(nmr_parameters) + '''];
+                for(i = 0; i < ''' + str(nmr_parameters) + '''; i++){
+                    x[i] = data->gof_parameters[i];
+                }
+                ''' + param_modifier.get_cl_function_name() + '''(data, x);
+
+                double sse = 0;
+                double observations_sum = 0;
+                double observations_sum_squares = 0;
+
+                double shell_sums[''' + str(nmr_shells + 1) + '''] = {0};
+                double shell_sums_squares[''' + str(nmr_shells + 1) + '''] = {0};
+                uint shell_counts[''' + str(nmr_shells + 1) + '''] = {0};
+
+                for(i = 0; i < ''' + str(nmr_observations) + '''; i++){
+                    residual = data->observations[i] - ''' + eval_function.get_cl_function_name() + '''(data, x, i);
+
+                    sse += residual * residual;
+                    observations_sum += data->observations[i];
+                    observations_sum_squares += data->observations[i] * data->observations[i];
+
+                    shell_sums[gof_volume_shells[i]] += residual;
+                    shell_sums_squares[gof_volume_shells[i]] += residual * residual;
+                    shell_counts[gof_volume_shells[i]]++;
+                }
+
+                double observations_mean = observations_sum / ''' + str(nmr_observations) + ''';
+                double total_sum_squares = observations_sum_squares - observations_sum * observations_mean;
+                double rmse = sqrt(sse / ''' + str(nmr_observations) + ''');
+
+                // the outliers are counted in a second pass, we re-evaluate the model to avoid storing the residuals
+                uint nmr_outliers = 0;
+                for(i = 0; i < ''' + str(nmr_observations) + '''; i++){
+                    residual = data->observations[i] - ''' + eval_function.get_cl_function_name() + '''(data, x, i);
+                    if(fabs(residual) > ''' + repr(float(outlier_threshold)) + ''' * rmse){
+                        nmr_outliers++;
+                    }
+                }
+
+                data->gof_measures[0] = sse;
+                data->gof_measures[1] = total_sum_squares > 0 ? 1 - sse / total_sum_squares : 0;
+                data->gof_measures[2] = observations_mean != 0 ? rmse / observations_mean : 0;
+                data->gof_measures[3] = nmr_outliers;
+
+                double mean;
+                for(i = 0; i < ''' + str(nmr_shells) + '''; i++){
+                    mean = shell_counts[i] > 0 ? shell_sums[i] / shell_counts[i] : 0;
+                    data->gof_shell_stats[i * 2] = mean;
+                    data->gof_shell_stats[i * 2 + 1] = shell_counts[i] > 0 ?
+                        sqrt(max(shell_sums_squares[i] / shell_counts[i] - mean * mean, (double)0)) : 0;
+                }
+            }
+        '''
+        return NameFunctionTuple('calculate_goodness_of_fit', kernel_source)
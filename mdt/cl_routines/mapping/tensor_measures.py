@@ -0,0 +1,178 @@
+import numpy as np
+from mot.cl_routines.mapping.run_procedure import RunProcedure
+from mot.kernel_data import KernelArray
+from mot.cl_routines.base import CLRoutine
+from mdt.components import get_component
+from mot.utils import NameFunctionTuple
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-25"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class TensorMeasures(CLRoutine):
+
+    def calculate(self, parameters_dict):
+        """Calculate the sorted eigensystem and the scalar DTI measures of the Tensor.
+
+        This sorts the eigenvalues of the Tensor in decreasing order, permutes the eigenvectors accordingly and
+        recomputes the angles theta, phi and psi matching the rotated system (see
+        :func:`mdt.utils.tensor_cartesian_to_spherical`). From the sorted eigenvalues it computes the Fractional
+        Anisotropy (FA), Mean Diffusivity (MD), Axial Diffusivity (AD) and Radial Diffusivity (RD). If the standard
+        deviations of the diffusivities are given, it also computes the standard deviations of these measures using
+        error propagation.
+
+        Args:
+            parameters_dict (dict): the fitted Tensor parameters, this requires a dictionary with at least
+                the elements 'd', 'dperp0', 'dperp1', 'theta', 'phi' and 'psi'. The standard deviations are used if
+                'd.std', 'dperp0.std' and 'dperp1.std' are all present.
+
+        Returns:
+            dict: the sorted eigenvalues ('d', 'dperp0', 'dperp1'), the matching angles ('theta', 'phi', 'psi'),
+                the sorted eigenvectors ('vec0', 'vec1', 'vec2'), the maps 'FA', 'MD', 'AD' and 'RD' and, if the
+                standard deviations were given, the maps 'FA.std', 'MD.std', 'AD.std' and 'RD.std'.
+        """
+        param_names = ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi']
+        std_names = ['d.std', 'dperp0.std', 'dperp1.std']
+        with_stds = all(name in parameters_dict for name in std_names)
+        if with_stds:
+            param_names += std_names
+
+        parameters = np.require(np.column_stack([parameters_dict[n] for n in param_names]),
+                                self._cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O'])
+
+        nmr_voxels = parameters.shape[0]
+        kernel_data = {'parameters': KernelArray(parameters, ctype='mot_float_type',
+                                                 is_readable=True, is_writable=False),
+                       'eigenvalues': self._get_output_array((nmr_voxels, 3)),
+                       'eigenvectors': self._get_output_array((nmr_voxels, 3, 3)),
+                       'angles': self._get_output_array((nmr_voxels, 3)),
+                       'measures': self._get_output_array((nmr_voxels, 4))}
+        if with_stds:
+            kernel_data['measure_stds'] = self._get_output_array((nmr_voxels, 4))
+
+        runner = RunProcedure(self._cl_runtime_info)
+        runner.run_procedure(self._get_compute_function(with_stds), kernel_data, nmr_voxels)
+
+        eigenvalues = kernel_data['eigenvalues'].get_data()
+        eigenvectors = kernel_data['eigenvectors'].get_data()
+        angles = kernel_data['angles'].get_data()
+        measures = kernel_data['measures'].get_data()
+
+        results = {'d': eigenvalues[:, 0], 'dperp0': eigenvalues[:, 1], 'dperp1': eigenvalues[:, 2],
+                   'theta': angles[:, 0], 'phi': angles[:, 1], 'psi': angles[:, 2],
+                   'vec0': eigenvectors[:, 0], 'vec1': eigenvectors[:, 1], 'vec2': eigenvectors[:, 2],
+                   'FA': measures[:, 0], 'MD': measures[:, 1], 'AD': measures[:, 2], 'RD': measures[:, 3]}
+
+        if with_stds:
+            measure_stds = kernel_data['measure_stds'].get_data()
+            results.update({'FA.std': measure_stds[:, 0], 'MD.std': measure_stds[:, 1],
+                            'AD.std': measure_stds[:, 2], 'RD.std': measure_stds[:, 3]})
+        return results
+
+    def _get_output_array(self, shape):
+        """Get a kernel output array, preallocated such that all devices write to the same host array."""
+        return KernelArray(np.zeros(shape, dtype=self._cl_runtime_info.mot_float_dtype), ctype='mot_float_type',
+                           is_readable=False, is_writable=True)
+
+    def _get_compute_function(self, with_stds):
+        kernel_source = ''
+        kernel_source += get_component('library_functions', 'TensorSphericalToCartesian')().get_cl_code()
+        kernel_source += '''
+            /**
+             * Check if the eigenvalue at index a comes before the eigenvalue at index b in the sorted order.
+             *
+             * This sorts from large to small and places equal eigenvalues in reversed order, the same as a reversed
+             * stable sort.
+             */
+            bool tensor_eigenvalue_comes_before(mot_float_type* eigenvalues, uint a, uint b){
+                return eigenvalues[a] > eigenvalues[b] || (eigenvalues[a] == eigenvalues[b] && a > b);
+            }
+
+            void calculate_tensor_measures(mot_data_struct* data){
+                uint i, j, tmp;
+
+                mot_float_type eigenvalues[3] = {data->parameters[0], data->parameters[1], data->parameters[2]};
+
+                mot_float_type4 vecs[3];
+                TensorSphericalToCartesian(data->parameters[3], data->parameters[4], data->parameters[5],
+                                           &vecs[0], &vecs[1], &vecs[2]);
+
+                uint ranking[3] = {0, 1, 2};
+                for(i = 0; i < 2; i++){
+                    for(j = 0; j < 2 - i; j++){
+                        if(!tensor_eigenvalue_comes_before(eigenvalues, ranking[j], ranking[j + 1])){
+                            tmp = ranking[j];
+                            ranking[j] = ranking[j + 1];
+                            ranking[j + 1] = tmp;
+                        }
+                    }
+                }
+
+                // Reflect the eigenvectors such that the angles are within the bounds of the Tensor model
+                mot_float_type4 e0 = vecs[ranking[0]];
+                mot_float_type4 e1 = vecs[ranking[1]];
+                if(e0.y < 0){
+                    e0 *= -1;
+                }
+
+                mot_float_type denom = sqrt(e0.x * e0.x + e0.y * e0.y);
+                mot_float_type4 orthogonal_vec = (mot_float_type4)(0, 0, 1, 0);
+                if(denom > 1e-8){
+                    orthogonal_vec = (mot_float_type4)(e0.z * e0.x / denom,
+                                                       e0.z * e0.y / denom,
+                                                       -sqrt(max(1 - e0.z * e0.z, (mot_float_type)0)),
+                                                       0);
+                }
+
+                if(dot(cross(e0, orthogonal_vec), e1) < 0){
+                    e1 *= -1;
+                }
+                mot_float_type4 e2 = cross(e0, e1);
+
+                data->angles[0] = acos(clamp(e0.z / length(e0), (mot_float_type)-1, (mot_float_type)1));
+                data->angles[1] = atan2(e0.y, e0.x);
+                data->angles[2] = acos(clamp(dot(orthogonal_vec, e1), (mot_float_type)-1, (mot_float_type)1));
+
+                mot_float_type4 sorted_vecs[3] = {e0, e1, e2};
+                for(i = 0; i < 3; i++){
+                    data->eigenvalues[i] = eigenvalues[ranking[i]];
+                    data->eigenvectors[i * 3 + 0] = sorted_vecs[i].x;
+                    data->eigenvectors[i * 3 + 1] = sorted_vecs[i].y;
+                    data->eigenvectors[i * 3 + 2] = sorted_vecs[i].z;
+                }
+
+                double d = eigenvalues[ranking[0]];
+                double dperp0 = eigenvalues[ranking[1]];
+                double dperp1 = eigenvalues[ranking[2]];
+
+                data->measures[0] = sqrt(0.5) * sqrt((pown(d - dperp0, 2) + pown(dperp0 - dperp1, 2)
+                                                      + pown(dperp1 - d, 2))
+                                                     / (d * d + dperp0 * dperp0 + dperp1 * dperp1));
+                data->measures[1] = (d + dperp0 + dperp1) / 3.0;
+                data->measures[2] = d;
+                data->measures[3] = (dperp0 + dperp1) / 2.0;
+        '''
+        if with_stds:
+            kernel_source += '''
+                double d_std = data->parameters[6 + ranking[0]];
+                double dperp0_std = data->parameters[6 + ranking[1]];
+                double dperp1_std = data->parameters[6 + ranking[2]];
+
+                data->measure_stds[0] = 0.5 * sqrt(
+                    pown(d + dperp0 + dperp1, 2) * (
+                        pown(d_std, 2) * pown(-d * (dperp0 + dperp1) + dperp0 * dperp0 + dperp1 * dperp1, 2) +
+                        pown(dperp0_std, 2) * pown(d * d - d * dperp0 + dperp1 * (dperp1 - dperp0), 2) +
+                        pown(dperp1_std, 2) * pown(d * d - d * dperp1 + dperp0 * (dperp0 - dperp1), 2))
+                    / (pown(d * d + dperp0 * dperp0 + dperp1 * dperp1, 3) *
+                       (d * d - d * (dperp0 + dperp1) + dperp0 * dperp0 - dperp0 * dperp1 + dperp1 * dperp1)));
+                data->measure_stds[1] = sqrt(d_std + dperp0_std + dperp1_std) / 3.0;
+                data->measure_stds[2] = d_std;
+                data->measure_stds[3] = (dperp0_std + dperp1_std) / 2.0;
+            '''
+        kernel_source += '''
+            }
+        '''
+        return NameFunctionTuple('calculate_tensor_measures', kernel_source)
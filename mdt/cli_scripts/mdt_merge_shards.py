@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Merge the results of a sharded model fit.
+
+When fitting with the --shard option of mdt-model-fit, the shard finishing last merges the results of all the shards.
+If this shard was interrupted during merging, this command can merge the results of the finished shards afterwards.
+Please provide the same mask and temporary results directory as used during fitting, and the output folder of
+the model, that is, the output folder of mdt-model-fit appended with the model name.
+"""
+import argparse
+import os
+from argcomplete.completers import FilesCompleter
+import textwrap
+
+from mdt.configuration import gzip_optimization_results
+from mdt.nifti import load_nifti
+from mdt.processing_strategies import get_full_tmp_results_path
+from mdt.shell_utils import BasicShellApplication, get_argparse_extension_checker
+from mdt.sharding import get_sharding_dirs, merge_shards
+from mdt.utils import get_temporary_results_dir
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-30"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class MergeShards(BasicShellApplication):
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-merge-shards mask.nii.gz output/mask/NODDI
+            mdt-merge-shards mask.nii.gz output/mask/NODDI --tmp-results-dir /shared/tmp
+           ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+
+        parser.add_argument('mask', action=get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+                            help='the (brain) mask used for fitting').completer = \
+            FilesCompleter(['nii', 'gz', 'hdr', 'img'], directories=False)
+
+        parser.add_argument('output_folder', help='the output folder of the model').completer = FilesCompleter()
+
+        parser.add_argument('--tmp-results-dir', dest='tmp_results_dir', default='True', type=str,
+                            help='The directory for the temporary results. The default ("True") uses the config file '
+                                 'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
+
+        return parser
+
+    def run(self, args, extra_args):
+        tmp_results_dir = args.tmp_results_dir
+        for match, to_set in [('true', True), ('false', False), ('none', None)]:
+            if tmp_results_dir.lower() == match:
+                tmp_results_dir = to_set
+                break
+
+        tmp_dir = get_full_tmp_results_path(args.output_folder, get_temporary_results_dir(tmp_results_dir))
+
+        sharding_dirs = get_sharding_dirs(tmp_dir)
+        if not sharding_dirs:
+            print('No shards to merge found in {}.'.format(tmp_dir))
+            return
+
+        mask = load_nifti(os.path.realpath(args.mask))
+        for sharding_dir in sharding_dirs:
+            merge_shards(sharding_dir, args.output_folder, mask.get_data(), mask.get_header(),
+                         gzip=gzip_optimization_results())
+            print('Merged the shards in {}.'.format(sharding_dir))
+
+
+def get_doc_arg_parser():
+    return MergeShards().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    MergeShards().start()
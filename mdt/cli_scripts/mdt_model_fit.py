@@ -37,6 +37,8 @@ class ModelFit(BasicShellApplication):
             mdt-model-fit ... --cl-device-ind 1
             mdt-model-fit ... --cl-device-ind {0, 1}
             mdt-model-fit ... --protocol-maps T1=T1_map.nii.gz T2=T2_map.nii.gz
+            mdt-model-fit ... --shard 1/4 --tmp-results-dir /shared/tmp
+            mdt-model-fit ... --mixed
            ''')
         epilog = self._format_examples(doc_parser, examples)
 
@@ -79,6 +81,11 @@ class ModelFit(BasicShellApplication):
                             help="Do not recalculate the model(s) if the output exists.")
         parser.set_defaults(recalculate=True)
 
+        parser.add_argument('--incremental', dest='incremental', action='store_true',
+                            help="If the output exists, only refit the voxels that are new in the mask or whose "
+                                 "input changed. Implies --no-recalculate.")
+        parser.set_defaults(incremental=False)
+
         parser.add_argument('--only-recalculate-last', dest='only_recalculate_last', action='store_true',
                             help="Only recalculate the last model in a cascade. (default)")
         parser.add_argument('--recalculate-all', dest='only_recalculate_last', action='store_false',
@@ -89,7 +96,10 @@ class ModelFit(BasicShellApplication):
                             help="Calculate in double precision.")
         parser.add_argument('--float', dest='double_precision', action='store_false',
                             help="Calculate in single precision. (default)")
-        parser.set_defaults(double_precision=False)
+        parser.add_argument('--mixed', dest='mixed_precision', action='store_true',
+                            help="Calculate in single precision and optimize the poorly converged voxels again in "
+                                 "double precision. The default uses the config file setting.")
+        parser.set_defaults(double_precision=False, mixed_precision=None)
 
         parser.add_argument('--use-cascade-subdir', dest='cascade_subdir', action='store_true',
                             help="Set if you want to create a subdirectory for the given cascade model"
@@ -107,6 +117,11 @@ class ModelFit(BasicShellApplication):
         parser.add_argument('--protocol-maps', dest='protocol_maps', type=str, nargs='+',
                             help='The protocol maps, provide as <key>=<value> pairs')
 
+        parser.add_argument('--shard', dest='shard', type=str,
+                            help='Only fit this shard of the voxels, as "i/N" for shard i of N. Run one process '
+                                 'per shard with the same arguments, the shard finishing last merges the results. '
+                                 'The temporary results directory should be on a filesystem shared by all shards.')
+
         return parser
 
     def run(self, args, extra_args):
@@ -133,12 +148,15 @@ class ModelFit(BasicShellApplication):
                                               gradient_deviations=args.gradient_deviations,
                                               noise_std=noise_std,
                                               protocol_maps=get_protocol_maps(args.protocol_maps, os.path.realpath(''))),
-                          output_folder, recalculate=args.recalculate,
+                          output_folder, recalculate=args.recalculate and not args.incremental,
                           only_recalculate_last=args.only_recalculate_last, cl_device_ind=args.cl_device_ind,
                           double_precision=args.double_precision,
                           cascade_subdir=args.cascade_subdir,
                           tmp_results_dir=tmp_results_dir,
-                          save_user_script_info=None)
+                          save_user_script_info=None,
+                          incremental=args.incremental,
+                          shard=args.shard,
+                          mixed_precision=args.mixed_precision)
 
         if args.config_context:
             with mdt.config_context(args.config_context):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Start a long running fitting server on a local Unix socket.
+
+The server keeps MDT loaded and the OpenCL devices and contexts alive between jobs, which removes the start-up
+overhead of a new process for every fit of many small datasets. Submit jobs with mdt-serve-submit or with the Python
+class mdt.server.ServerClient.
+"""
+import argparse
+import json
+import textwrap
+import mdt
+from argcomplete.completers import FilesCompleter
+from mdt.server import FittingServer, ServerClient
+from mdt.shell_utils import BasicShellApplication
+from mot import cl_environments
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-14"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class Serve(BasicShellApplication):
+
+    def __init__(self):
+        super(Serve, self).__init__()
+        self.available_devices = list((ind for ind, env in
+                                       enumerate(cl_environments.CLEnvironmentFactory.smart_device_selection())))
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-serve
+            mdt-serve --cl-device-ind 1
+            mdt-serve --socket /tmp/mdt.sock
+            mdt-serve --status
+            mdt-serve --stop
+           ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+
+        parser.add_argument('--socket', dest='socket_path', default=None,
+                            help='the path to the Unix socket, defaults to a socket '
+                                 'in the MDT configuration directory').completer = FilesCompleter()
+
+        parser.add_argument('--cl-device-ind', type=int, nargs='*', choices=self.available_devices,
+                            help="The index of the devices the server should use. This follows the indices "
+                                 "in mdt-list-devices and defaults to all devices.")
+
+        parser.add_argument('--double', dest='double_precision', action='store_true',
+                            help="Calculate in double precision by default.")
+        parser.add_argument('--float', dest='double_precision', action='store_false',
+                            help="Calculate in single precision by default. (default)")
+        parser.set_defaults(double_precision=False)
+
+        parser.add_argument('--status', action='store_true',
+                            help='print the status of a running server and exit')
+        parser.add_argument('--stop', action='store_true',
+                            help='stop a running server and exit')
+
+        return parser
+
+    def run(self, args, extra_args):
+        if args.status:
+            print(json.dumps(ServerClient(args.socket_path).status(), indent=4, sort_keys=True))
+        elif args.stop:
+            ServerClient(args.socket_path).shutdown()
+        else:
+            mdt.init_user_settings(pass_if_exists=True)
+            FittingServer(socket_path=args.socket_path, cl_device_ind=args.cl_device_ind,
+                          double_precision=args.double_precision).serve_forever()
+
+
+def get_doc_arg_parser():
+    return Serve().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    Serve().start()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Submit a fit or sample job to a running fitting server (see mdt-serve).
+
+The job is queued on the server and the progress is printed while the job runs. This command exits after the job
+has finished, with a non-zero exit code if the job failed.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import textwrap
+from argcomplete.completers import FilesCompleter
+from mdt.exceptions import ServerJobError
+from mdt.server import ServerClient
+from mdt.shell_utils import BasicShellApplication, get_argparse_extension_checker
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-14"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ServeSubmit(BasicShellApplication):
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-serve-submit "BallStick_r1 (Cascade)" data.nii.gz data.prtcl roi_mask_0_50.nii.gz
+            mdt-serve-submit "BallStick_r1 (Cascade)" data.nii.gz data.prtcl data_mask.nii.gz --no-recalculate
+            mdt-serve-submit NODDI data.nii.gz data.prtcl data_mask.nii.gz --sample --nmr-samples 2000
+           ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+        parser.add_argument('model', metavar='model', help='model name, see mdt-list-models')
+        parser.add_argument('dwi', action=get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+                            help='the diffusion weighted image').completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'],
+                                                                                            directories=False)
+        parser.add_argument(
+            'protocol', action=get_argparse_extension_checker(['.prtcl']),
+            help='the protocol file, see mdt-generate-protocol').completer = FilesCompleter(['prtcl'],
+                                                                                            directories=False)
+        parser.add_argument('mask', action=get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+                            help='the (brain) mask to use').completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'],
+                                                                                       directories=False)
+        parser.add_argument('-o', '--output_folder',
+                            help='the directory for the output, defaults to "output/<mask_name>" '
+                                 'in the same directory as the dwi volume').completer = FilesCompleter()
+
+        parser.add_argument('--socket', dest='socket_path', default=None,
+                            help='the path to the Unix socket of the server, defaults to a socket '
+                                 'in the MDT configuration directory').completer = FilesCompleter()
+
+        parser.add_argument('--sample', dest='sample', action='store_true',
+                            help='sample the model instead of fitting it')
+        parser.add_argument('--nmr-samples', dest='nmr_samples', type=int,
+                            help='the number of samples to take, only used when sampling')
+
+        parser.add_argument('-n', '--noise-std', default=None,
+                            help='the noise std, defaults to None for automatic noise estimation.'
+                                 'Either set this to a value, or to a filename.')
+
+        parser.add_argument('--cl-device-ind', type=int, nargs='*',
+                            help="The indices of the server devices to use for this job, "
+                                 "defaults to all devices of the server.")
+
+        parser.add_argument('--recalculate', dest='recalculate', action='store_true',
+                            help="Recalculate the model(s) if the output exists. (default)")
+        parser.add_argument('--no-recalculate', dest='recalculate', action='store_false',
+                            help="Do not recalculate the model(s) if the output exists.")
+        parser.set_defaults(recalculate=True)
+
+        parser.add_argument('--double', dest='double_precision', action='store_true', default=None,
+                            help="Calculate in double precision.")
+        parser.add_argument('--float', dest='double_precision', action='store_false',
+                            help="Calculate in single precision.")
+
+        parser.add_argument('--config-context', dest='config_context', type=str,
+                            help='The configuration context to use during fitting the model. '
+                                 'Same syntax as config files')
+
+        parser.add_argument('-q', '--quiet', action='store_true', help='do not print the progress')
+
+        return parser
+
+    def run(self, args, extra_args):
+        mask_name = os.path.splitext(os.path.basename(os.path.realpath(args.mask)))[0]
+        mask_name = mask_name.replace('.nii', '')
+        output_folder = args.output_folder or os.path.join(os.path.dirname(args.dwi), 'output', mask_name)
+
+        noise_std = args.noise_std
+        if noise_std is not None:
+            if os.path.isfile(os.path.realpath(noise_std)):
+                noise_std = os.path.realpath(noise_std)
+            else:
+                noise_std = float(noise_std)
+
+        options = {'noise_std': noise_std,
+                   'recalculate': args.recalculate,
+                   'cl_device_ind': args.cl_device_ind,
+                   'config_context': args.config_context}
+        if args.double_precision is not None:
+            options['double_precision'] = args.double_precision
+
+        def print_progress(event):
+            if not args.quiet:
+                if event['type'] == 'log':
+                    print(event['message'])
+                elif event['type'] == 'queued':
+                    print('Job {} queued at position {}.'.format(event['job_id'], event['position']))
+
+        client = ServerClient(args.socket_path)
+        try:
+            if args.sample:
+                result = client.sample_model(args.model, args.dwi, args.protocol, args.mask, output_folder,
+                                             progress_callback=print_progress, nmr_samples=args.nmr_samples,
+                                             **options)
+            else:
+                result = client.fit_model(args.model, args.dwi, args.protocol, args.mask, output_folder,
+                                          progress_callback=print_progress, **options)
+        except ServerJobError as exc:
+            print(str(exc), file=sys.stderr)
+            if exc.server_traceback:
+                print(exc.server_traceback, file=sys.stderr)
+            sys.exit(1)
+
+        if not args.quiet:
+            print('Results written to {}'.format(result['output_folder']))
+
+
+def get_doc_arg_parser():
+    return ServeSubmit().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    ServeSubmit().start()
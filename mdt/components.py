@@ -338,8 +338,9 @@ def get_model(model_name):
         model_name (str): One of the models from the cascade models or composite models
 
     Returns:
-        class: Either a cascade model or a composite model. In any case, a model that can be given to the ``fit_model``
-            function.
+        class: Either a cascade model, a composite model, a linear estimator (see :mod:`mdt.linear_estimators`)
+            or a dictionary matcher (see :mod:`mdt.dictionary_matching`). In any case, a model that can be given to
+            the ``fit_model`` function.
     """
     try:
         return component_library.get_component('cascade_models', model_name)
@@ -347,7 +348,18 @@ def get_model(model_name):
         try:
             return component_library.get_component('composite_models', model_name)
         except ValueError:
-            raise ValueError('The model with the name "{}" could not be found.'.format(model_name))
+            from mdt.linear_estimators import get_linear_estimator
+            from mdt.dictionary_matching import get_dictionary_matcher, DICTIONARY_MODEL_SUFFIX
+
+            target_model = model_name[:-len(DICTIONARY_MODEL_SUFFIX)]
+            if model_name.endswith(DICTIONARY_MODEL_SUFFIX) and component_library.has_component(
+                    'composite_models', target_model):
+                return get_dictionary_matcher(target_model)
+
+            try:
+                return get_linear_estimator(model_name)
+            except ValueError:
+                raise ValueError('The model with the name "{}" could not be found.'.format(model_name))
 
 
 def list_composite_models():
@@ -458,7 +470,8 @@ def _load_automatic_cascades():
     - CI: Cascade Initialized: initalizes the volume fractions and orientations
     - CF: Cascade Fixed: initializes the volume fractions, fixes the orientations
     """
-    from mdt.configuration import use_automatic_generated_cascades, get_automatic_generated_cascades_excluded
+    from mdt.configuration import use_automatic_generated_cascades, get_automatic_generated_cascades_excluded, \
+        use_linear_s0_in_automatic_cascades
 
     def get_missing_s0_cascades(models, cascades):
         missing_cascades = []
@@ -474,7 +487,7 @@ def _load_automatic_cascades():
             class Template(CascadeTemplate):
                 cascade_name_modifier = 'S0'
                 description = 'Automatically generated cascade.'
-                models = ('S0',
+                models = ('S0 (Linear)' if use_linear_s0_in_automatic_cascades() else 'S0',
                           cascaded_name[0:-len('(Cascade|S0)')].strip())
 
     if use_automatic_generated_cascades():
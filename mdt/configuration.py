@@ -262,6 +262,11 @@ class OutputFormatLoader(ConfigSectionLoader):
             if 'gzip' in options:
                 _config_insert(['output_format', item, 'gzip'], bool(options['gzip']))
 
+        if 'dtypes' in value:
+            ensure_exists(['output_format', 'dtypes'])
+            for key, sub_value in value['dtypes'].items():
+                _config_insert(['output_format', 'dtypes', key], sub_value)
+
 
 class LoggingLoader(ConfigSectionLoader):
     """Loader for the top level key logging. """
@@ -291,6 +296,26 @@ class OptimizationSettingsLoader(ConfigSectionLoader):
             for key, sub_value in value['model_specific'].items():
                 _config_insert(['optimization', 'model_specific', key], sub_value)
 
+        if 'refinement' in value:
+            ensure_exists(['optimization', 'refinement'])
+            for key, sub_value in value['refinement'].items():
+                _config_insert(['optimization', 'refinement', key], sub_value)
+
+        if 'mixed_precision' in value:
+            ensure_exists(['optimization', 'mixed_precision'])
+            for key, sub_value in value['mixed_precision'].items():
+                _config_insert(['optimization', 'mixed_precision', key], sub_value)
+
+        if 'bootstrap' in value:
+            ensure_exists(['optimization', 'bootstrap'])
+            for key, sub_value in value['bootstrap'].items():
+                _config_insert(['optimization', 'bootstrap', key], sub_value)
+
+        if 'goodness_of_fit' in value:
+            ensure_exists(['optimization', 'goodness_of_fit'])
+            for key, sub_value in value['goodness_of_fit'].items():
+                _config_insert(['optimization', 'goodness_of_fit', key], sub_value)
+
 
 class SampleSettingsLoader(ConfigSectionLoader):
     """Loads the sampling section"""
@@ -335,6 +360,8 @@ class ActivePostProcessingLoader(ConfigSectionLoader):
 
         optimization = value.get('optimization', {})
         optimization['covariance'] = optimization.get('covariance', True)
+        optimization['bootstrap'] = optimization.get('bootstrap', False)
+        optimization['goodness_of_fit'] = optimization.get('goodness_of_fit', False)
 
         _config_insert(['active_post_processing', 'optimization'], optimization)
         _config_insert(['active_post_processing', 'sampling'], sampling)
@@ -346,6 +373,52 @@ class AutomaticCascadeModels(ConfigSectionLoader):
     def load(self, value):
         _config_insert(['auto_generate_cascade_models', 'enabled'], value.get('enabled', True))
         _config_insert(['auto_generate_cascade_models', 'excluded'], value.get('excluded', []))
+        _config_insert(['auto_generate_cascade_models', 'linear_s0'], value.get('linear_s0', False))
+
+
+class VoxelTriageLoader(ConfigSectionLoader):
+    """Load the settings for the triage of degenerate voxels."""
+
+    def load(self, value):
+        ensure_exists(['voxel_triage'])
+        for key, sub_value in value.items():
+            _config_insert(['voxel_triage', key], sub_value)
+
+
+class DKIMeasuresLoader(ConfigSectionLoader):
+    """Load the settings for computing the Kurtosis measures."""
+
+    def load(self, value):
+        ensure_exists(['dki_measures'])
+        for key, sub_value in value.items():
+            _config_insert(['dki_measures', key], sub_value)
+
+
+class LoadBalancingLoader(ConfigSectionLoader):
+    """Load the settings for the distribution of the work over multiple devices."""
+
+    def load(self, value):
+        ensure_exists(['load_balancing'])
+        for key, sub_value in value.items():
+            _config_insert(['load_balancing', key], sub_value)
+
+
+class AutotuningLoader(ConfigSectionLoader):
+    """Load the settings for the autotuning of the kernel launches."""
+
+    def load(self, value):
+        ensure_exists(['autotuning'])
+        for key, sub_value in value.items():
+            _config_insert(['autotuning', key], sub_value)
+
+
+class ShardingLoader(ConfigSectionLoader):
+    """Load the settings for the sharded fitting over multiple processes."""
+
+    def load(self, value):
+        ensure_exists(['sharding'])
+        for key, sub_value in value.items():
+            _config_insert(['sharding', key], sub_value)
 
 
 class RuntimeSettingsLoader(ConfigSectionLoader):
@@ -364,7 +437,7 @@ class RuntimeSettingsLoader(ConfigSectionLoader):
 
                 if devices:
                     mot.configuration.set_cl_environments(devices)
-                    mot.configuration.set_load_balancer(EvenDistribution())
+                    mot.configuration.set_load_balancer(get_load_balancer())
 
     def update(self, config_dict, updates):
         if 'runtime_settings' not in config_dict:
@@ -408,6 +481,21 @@ def get_section_loader(section):
     if section == 'active_post_processing':
         return ActivePostProcessingLoader()
 
+    if section == 'voxel_triage':
+        return VoxelTriageLoader()
+
+    if section == 'dki_measures':
+        return DKIMeasuresLoader()
+
+    if section == 'autotuning':
+        return AutotuningLoader()
+
+    if section == 'load_balancing':
+        return LoadBalancingLoader()
+
+    if section == 'sharding':
+        return ShardingLoader()
+
     raise ValueError('Could not find a suitable configuration loader for the section {}.'.format(section))
 
 
@@ -429,6 +517,20 @@ def gzip_sampling_results():
     return _config['output_format']['sampling']['gzip']
 
 
+def get_output_dtype_policy():
+    """Get the policy for the data types of the temporary storage and the output maps.
+
+    Returns:
+        mdt.nifti.OutputDtypePolicy: the configured data type policy
+    """
+    from mdt.nifti import OutputDtypePolicy
+    settings = _config['output_format'].get('dtypes', {}) or {}
+    return OutputDtypePolicy(float_dtype=settings.get('float'),
+                             compact_integers=settings.get('compact_integers', True),
+                             integer_maps=settings.get('integer_maps'),
+                             scaled_int16_maps=settings.get('scaled_int16_maps'))
+
+
 def get_tmp_results_dir():
     """Get the default tmp results directory.
 
@@ -464,7 +566,7 @@ def get_processing_strategy(processing_type, *args, **kwargs):
         ModelProcessingStrategy: the processing strategy to use for this model
     """
     from mdt.processing_strategies import VoxelRange
-    options = _config['processing_strategies'].get(processing_type, {}) or {}
+    options = dict(_config['processing_strategies'].get(processing_type, {}) or {})
     options.update(kwargs)
     return VoxelRange(*args, **options)
 
@@ -511,6 +613,141 @@ def get_optimizer_for_model(model_names):
         return get_general_optimizer()
 
 
+def get_voxel_refinement():
+    """Get the adaptive refinement of poorly converged voxels, if enabled.
+
+    Returns:
+        mdt.refinement.VoxelRefinement: the configured voxel refinement, or None if refinement is disabled
+    """
+    from mdt.refinement import VoxelRefinement
+    settings = _config['optimization'].get('refinement', {}) or {}
+    if not settings.get('enabled', False):
+        return None
+
+    return VoxelRefinement(_resolve_optimizer(settings['optimizer']),
+                           return_codes=settings.get('return_codes', True),
+                           max_relative_residual=settings.get('max_relative_residual'),
+                           log_likelihood_outliers=settings.get('log_likelihood_outliers'),
+                           max_relative_gradient=settings.get('max_relative_gradient'))
+
+
+def use_mixed_precision():
+    """Check if we fit in mixed precision when fitting in single precision.
+
+    Returns:
+        boolean: if mixed precision fitting is enabled
+    """
+    return bool((_config['optimization'].get('mixed_precision', {}) or {}).get('enabled', False))
+
+
+def get_mixed_precision_refinement(model_names):
+    """Get the refinement in double precision of the voxels poorly converged in single precision.
+
+    This uses the same optimizer as the single precision fit (see :func:`get_optimizer_for_model`). The caller is
+    responsible for running this optimizer in double precision.
+
+    Args:
+        model_names (list of str): the list of model names, as for :func:`get_optimizer_for_model`
+
+    Returns:
+        mdt.refinement.VoxelRefinement: the refinement, with the configured criteria
+    """
+    from mdt.refinement import VoxelRefinement
+    settings = _config['optimization'].get('mixed_precision', {}) or {}
+    return VoxelRefinement(get_optimizer_for_model(model_names),
+                           return_codes=settings.get('return_codes', True),
+                           max_relative_gradient=settings.get('max_relative_gradient'),
+                           double_precision=True)
+
+
+def get_residual_bootstrap():
+    """Get the residual bootstrap, used if the ``bootstrap`` optimization post-processing is active.
+
+    Returns:
+        mdt.bootstrap.ResidualBootstrap: the configured residual bootstrap
+    """
+    from mdt.bootstrap import ResidualBootstrap
+    settings = _config['optimization'].get('bootstrap', {}) or {}
+    return ResidualBootstrap(nmr_replicates=settings.get('nmr_replicates', 100),
+                             percentiles=settings.get('percentiles', [2.5, 97.5]),
+                             seed=settings.get('seed'))
+
+
+def get_goodness_of_fit_settings():
+    """Get the settings for the goodness-of-fit maps, used if the ``goodness_of_fit`` post-processing is active.
+
+    Returns:
+        dict: the settings, with the key 'outlier_threshold'
+    """
+    return _config['optimization'].get('goodness_of_fit', {}) or {}
+
+
+def get_voxel_triage():
+    """Get the triage of degenerate voxels, if enabled.
+
+    Returns:
+        mdt.voxel_triage.VoxelTriage: the configured voxel triage, or None if triage is disabled
+    """
+    from mdt.voxel_triage import VoxelTriage
+    settings = _config.get('voxel_triage', {}) or {}
+    if not settings.get('enabled', False):
+        return None
+
+    return VoxelTriage(non_finite=settings.get('non_finite', True),
+                       all_zeros=settings.get('all_zeros', True),
+                       min_unweighted_snr=settings.get('min_unweighted_snr'))
+
+
+def get_load_balancer(cache_key=None):
+    """Get the load balancer for distributing the work over the devices.
+
+    Args:
+        cache_key (str): for the throughput strategy, the key under which we cache the measured throughputs, for
+            example the name of the model
+
+    Returns:
+        mot.load_balance_strategies.LoadBalanceStrategy: the configured load balancer
+    """
+    from mdt.load_balancing import ThroughputDistribution
+    settings = _config.get('load_balancing', {}) or {}
+    if settings.get('strategy', 'even') == 'throughput':
+        return ThroughputDistribution(smoothing=settings.get('smoothing', 0.5), cache_key=cache_key)
+    return EvenDistribution()
+
+
+def get_kernel_autotuner():
+    """Get the autotuner for the kernel launches, if enabled.
+
+    Returns:
+        mdt.autotuning.KernelAutotuner: the configured autotuner, or None if autotuning is disabled
+    """
+    from mdt.autotuning import KernelAutotuner
+    settings = _config.get('autotuning', {}) or {}
+    if not settings.get('enabled', False):
+        return None
+
+    return KernelAutotuner(nmr_repeats=settings.get('nmr_repeats', 3),
+                           nmr_benchmark_voxels=settings.get('nmr_benchmark_voxels', 10000))
+
+
+def get_sharding_settings():
+    """Get the settings for the sharded fitting over multiple processes, see :mod:`mdt.sharding`.
+
+    Returns:
+        dict: the settings, with the key 'poll_interval'
+    """
+    return _config.get('sharding', {}) or {}
+
+
+def get_dki_measures_settings():
+    """Get the settings for computing the Kurtosis measures (MK, AK and RK).
+
+    Returns:
+        dict: the settings, with the keys 'method', 'nmr_directions' and 'nmr_radial_directions'
+    """
+    return _config.get('dki_measures', {}) or {}
+
+
 def get_general_optimizer_name():
     """Get the name of the currently configured general optimizer
 
@@ -556,6 +793,16 @@ def get_automatic_generated_cascades_excluded():
     return _config['auto_generate_cascade_models']['excluded']
 
 
+def use_linear_s0_in_automatic_cascades():
+    """Check if the automatically generated S0 cascades should use the closed-form S0 estimate.
+
+    Returns:
+        boolean: if True, the automatic ``(Cascade|S0)`` cascades start with the linear estimator ``S0 (Linear)``
+            instead of a non-linear fit of the ``S0`` model.
+    """
+    return _config['auto_generate_cascade_models'].get('linear_s0', False)
+
+
 def get_model_config(model_names, config):
     """Get from the given dictionary the config for the given model.
 
@@ -670,8 +917,10 @@ def config_context(config_action):
         config_action = YamlStringAction(config_action)
 
     config_action.apply()
-    yield
-    config_action.unapply()
+    try:
+        yield
+    finally:
+        config_action.unapply()
 
 
 class ConfigAction(object):
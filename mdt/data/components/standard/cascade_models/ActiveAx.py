@@ -23,3 +23,11 @@ class ActiveAx(CascadeTemplate):
               'ActiveAx')
     inits = {'ActiveAx': {'CylinderGPD.theta': 'Stick0.theta',
                           'CylinderGPD.phi': 'Stick0.phi'}}
+
+
+class ActiveAx_Dictionary(CascadeTemplate):
+
+    cascade_name_modifier = 'Dictionary'
+    description = 'Cascade for ActiveAx initialized by dictionary matching.'
+    models = ('ActiveAx (Dictionary)',
+              'ActiveAx')
@@ -21,3 +21,11 @@ class Kurtosis(CascadeTemplate):
         'KurtosisTensor.dperp0': 'Tensor.dperp0',
         'KurtosisTensor.dperp1': 'Tensor.dperp1'}
     }
+
+
+class KurtosisLinear(CascadeTemplate):
+
+    cascade_name_modifier = 'Linear'
+    description = 'Initializes the tensor and kurtosis elements using a weighted linear least squares estimate.'
+    models = ('Kurtosis (Linear)',
+              'Kurtosis')
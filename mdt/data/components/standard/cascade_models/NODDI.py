@@ -29,3 +29,11 @@ class NODDI_Fixed(CascadeTemplate):
                        'w_csf.w': 'w_ball.w'}}
     fixes = {'NODDI': {'NODDI_IC.theta': 'Stick0.theta',
                        'NODDI_IC.phi': 'Stick0.phi'}}
+
+
+class NODDI_Dictionary(CascadeTemplate):
+
+    cascade_name_modifier = 'Dictionary'
+    description = 'Cascade for NODDI initialized by dictionary matching.'
+    models = ('NODDI (Dictionary)',
+              'NODDI')
@@ -23,3 +23,11 @@ class TensorFixed(CascadeTemplate):
               'Tensor')
     fixes = {'Tensor': {'Tensor.theta': 'Stick0.theta',
                         'Tensor.phi': 'Stick0.phi'}}
+
+
+class TensorLinear(CascadeTemplate):
+
+    cascade_name_modifier = 'Linear'
+    description = 'Cascade for Tensor initialized with a weighted linear least squares estimate.'
+    models = ('Tensor (Linear)',
+              'Tensor')
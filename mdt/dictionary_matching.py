@@ -0,0 +1,243 @@
+"""Dictionary matching initialization for multi-compartment models.
+
+Multi-compartment models like NODDI, CHARMED and ActiveAx are sensitive to their starting points. Instead of running
+long cascades or random restarts, we can pre-simulate the normalized signal of a model over a grid of parameter values
+(the dictionary) and initialize every voxel with the parameters of the dictionary entry closest to its normalized
+signal. Both the observations and the dictionary are normalized by their mean over the S0 volumes (see
+:func:`mdt.linear_estimators.get_s0_volume_indices`), matching is done with batched matrix products over chunks of
+voxels.
+
+Dictionaries are cached in memory per model definition, protocol and grid, such that fitting multiple subjects with
+the same protocol only simulates the dictionary once.
+
+The matchers are available as models with the name ``<model> (Dictionary)``, for example ``NODDI (Dictionary)``. These
+can be used as the first stage of a cascade, fitted on their own using :func:`mdt.fit_model` or used to provide
+initialization data, for example:
+
+.. code-block:: python
+
+    init_data = mdt.get_model('NODDI (Dictionary)')().get_initialization_data(input_data)
+    mdt.fit_model('NODDI', input_data, output_folder, initialization_data=init_data)
+"""
+import itertools
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from mdt.linear_estimators import get_s0_volume_indices
+from mdt.models.estimators import DMRIEstimator
+from mdt.provenance import get_model_digests, get_protocol_digest
+from mdt.simulations import simulate_signals
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-21'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+DICTIONARY_MODEL_SUFFIX = ' (Dictionary)'
+
+_dictionary_cache = OrderedDict()
+_DICTIONARY_CACHE_SIZE = 4
+
+_dictionary_matchers = {}
+
+
+def get_parameter_grid(model, max_size=20000, grid=None, min_points_per_parameter=4, seed=0):
+    """Get the parameter values for the entries of the dictionary of the given model.
+
+    The parameters given in ``grid`` take the given values. All other free parameters with finite bounds (except for
+    ``S0.s0``) are gridded between their bounds, at the midpoints of equally sized intervals. Parameters with infinite
+    bounds are kept at their initial value. If a regular grid with at least ``min_points_per_parameter`` points per
+    parameter would be larger than ``max_size``, we sample these parameters uniformly at random between their bounds
+    instead.
+
+    Combinations in which the estimable volume fractions sum to more than one are removed.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model to create the grid for
+        max_size (int): the maximum number of dictionary entries
+        grid (dict): optionally, for some of the parameters the values to use in the grid
+        min_points_per_parameter (int): the minimum number of grid points per automatically gridded parameter, if not
+            possible within the maximum size we use random sampling
+        seed (int): the seed for the random sampling
+
+    Returns:
+        dict: per varied parameter name an 1d array with the value of that parameter per dictionary entry
+    """
+    grid = grid or {}
+    given = OrderedDict((name, np.asarray(grid[name], dtype=np.float64)) for name in sorted(grid))
+
+    automatic = OrderedDict()
+    for name, lower, upper in zip(model.get_free_param_names(), model.get_lower_bounds(), model.get_upper_bounds()):
+        if name != 'S0.s0' and name not in given and np.isfinite(lower) and np.isfinite(upper):
+            automatic[name] = (lower, upper)
+
+    given_size = int(np.prod([len(values) for values in given.values()]))
+    nmr_points = int(np.floor((max_size / float(given_size)) ** (1.0 / max(len(automatic), 1))))
+
+    if not automatic or nmr_points >= min_points_per_parameter:
+        axes = list(given.values())
+        for lower, upper in automatic.values():
+            axes.append(lower + (np.arange(nmr_points) + 0.5) * (upper - lower) / nmr_points)
+        combinations = np.array(list(itertools.product(*axes)))
+        parameters = {name: combinations[:, ind] for ind, name in enumerate(list(given) + list(automatic))}
+    else:
+        random_state = np.random.RandomState(seed)
+        nmr_samples = max(max_size // given_size, 1)
+
+        combinations = np.array(list(itertools.product(*given.values()))) if given else np.zeros((1, 0))
+        combinations = np.repeat(combinations, nmr_samples, axis=0)
+        parameters = {name: combinations[:, ind] for ind, name in enumerate(given)}
+        for name, (lower, upper) in automatic.items():
+            parameters[name] = random_state.uniform(lower, upper, size=combinations.shape[0])
+
+    weights = [weight for weight in model.get_free_weight_names() if weight in parameters]
+    if len(weights) > 1:
+        feasible = np.sum([parameters[weight] for weight in weights], axis=0) <= 1
+        parameters = {name: values[feasible] for name, values in parameters.items()}
+
+    return parameters
+
+
+def create_dictionary(model, protocol, parameters):
+    """Simulate the dictionary of the given model.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model to simulate, should not do any volume selection
+        protocol (mdt.protocols.Protocol): the protocol to simulate
+        parameters (dict): per varied parameter the value per dictionary entry, as returned by
+            :func:`get_parameter_grid`. All other parameters are kept at their initial value, ``S0.s0`` is set to one.
+
+    Returns:
+        tuple: the parameters of the valid entries and the (d, n) matrix with the signals of these d entries,
+            normalized by their mean over the S0 volumes.
+    """
+    nmr_entries = len(next(iter(parameters.values()))) if parameters else 1
+
+    all_parameters = {}
+    for name, value in zip(model.get_free_param_names(), model.get_initial_parameters()):
+        all_parameters[name] = np.full(nmr_entries, value, dtype=np.float64)
+    all_parameters.update(parameters)
+    if 'S0.s0' in all_parameters:
+        all_parameters['S0.s0'][:] = 1
+
+    signals = simulate_signals(model, protocol, all_parameters)
+    signals = np.reshape(signals, (nmr_entries, len(protocol))).astype(np.float64)
+    reference = np.mean(signals[:, get_s0_volume_indices(protocol)], axis=1)
+
+    valid = np.all(np.isfinite(signals), axis=1) & (reference > 0)
+    signals = signals[valid] / reference[valid, None]
+    return {name: values[valid] for name, values in parameters.items()}, signals
+
+
+def match_dictionary(observations, dictionary, max_chunk_elements=2 ** 24):
+    """Find for every observation the dictionary entry with the smallest Euclidean distance.
+
+    Args:
+        observations (ndarray): the (v, n) matrix with the normalized observations
+        dictionary (ndarray): the (d, n) matrix with the normalized dictionary signals
+        max_chunk_elements (int): the maximum number of elements of the (chunk, d) score matrices, limits the memory
+            usage
+
+    Returns:
+        ndarray: for every observation the index of the closest dictionary entry
+    """
+    dictionary = np.asarray(dictionary, dtype=np.float32)
+    squared_norms = np.sum(dictionary.astype(np.float64) ** 2, axis=1).astype(np.float32)
+    chunk_size = max(max_chunk_elements // dictionary.shape[0], 1)
+
+    indices = np.zeros(observations.shape[0], dtype=np.int64)
+    for start in range(0, observations.shape[0], chunk_size):
+        chunk = slice(start, min(start + chunk_size, observations.shape[0]))
+        scores = squared_norms[None, :] - 2 * np.dot(np.asarray(observations[chunk], dtype=np.float32), dictionary.T)
+        indices[chunk] = np.argmin(scores, axis=1)
+    return indices
+
+
+class DictionaryMatcher(DMRIEstimator):
+    """Base class for initializing a composite model by matching the signal to a pre-simulated dictionary.
+
+    Attributes:
+        max_dictionary_size (int): the maximum number of entries in the dictionary
+        grid (dict): optionally, for some of the parameters the values to use in the grid, see
+            :func:`get_parameter_grid`.
+        max_chunk_elements (int): the maximum number of elements in the score matrix of a chunk of voxels
+    """
+    max_dictionary_size = 20000
+    grid = None
+    max_chunk_elements = 2 ** 24
+
+    def __init__(self):
+        super(DictionaryMatcher, self).__init__()
+        self._logger = logging.getLogger(__name__)
+
+    def _estimate(self, protocol, observations):
+        parameters, dictionary = self._get_dictionary(protocol)
+
+        observations = np.asarray(observations, dtype=np.float64)
+        reference = np.mean(observations[:, get_s0_volume_indices(protocol)], axis=1)
+        reference[~(reference > 0)] = 1
+
+        indices = match_dictionary(observations / reference[:, None], dictionary,
+                                   max_chunk_elements=self.max_chunk_elements)
+
+        results = {name: values[indices] for name, values in parameters.items()}
+        if 'S0.s0' in self.get_free_param_names():
+            results['S0.s0'] = reference
+        return results
+
+    def _get_dictionary(self, protocol):
+        """Get the (cached) dictionary of the target model for the given protocol.
+
+        Returns:
+            tuple: the parameters and the normalized signals of the dictionary entries
+        """
+        from mdt.components import get_model
+        model = get_model(self.target_model)()
+        model.volume_selection = False
+
+        grid_key = tuple((name, tuple(np.asarray(values).tolist()))
+                         for name, values in sorted((self.grid or {}).items()))
+        model_digests = get_model_digests(model)
+        key = (model_digests['model_definition'], model_digests['model_parameters'],
+               get_protocol_digest(protocol), grid_key, self.max_dictionary_size)
+
+        if key in _dictionary_cache:
+            _dictionary_cache[key] = _dictionary_cache.pop(key)
+            return _dictionary_cache[key]
+
+        parameters = get_parameter_grid(model, max_size=self.max_dictionary_size, grid=self.grid)
+        self._logger.info('Simulating a dictionary of {} entries for the {} model.'.format(
+            len(next(iter(parameters.values()))) if parameters else 1, self.target_model))
+        dictionary = create_dictionary(model, protocol, parameters)
+
+        _dictionary_cache[key] = dictionary
+        while len(_dictionary_cache) > _DICTIONARY_CACHE_SIZE:
+            _dictionary_cache.popitem(last=False)
+        return dictionary
+
+
+def get_dictionary_matcher(model_name):
+    """Get the dictionary matcher for the composite model with the given name.
+
+    Args:
+        model_name (str): the name of the composite model, for example 'NODDI'
+
+    Returns:
+        DictionaryMatcher: the class of the dictionary matcher, named ``<model_name> (Dictionary)``
+    """
+    if model_name not in _dictionary_matchers:
+        _dictionary_matchers[model_name] = type(
+            'DictionaryMatcher', (DictionaryMatcher,),
+            {'name': model_name + DICTIONARY_MODEL_SUFFIX,
+             'target_model': model_name,
+             'description': 'Dictionary matching initialization of the {} model.'.format(model_name)})
+    return _dictionary_matchers[model_name]
+
+
+def clear_dictionary_cache():
+    """Remove all the cached dictionaries from memory."""
+    _dictionary_cache.clear()
@@ -35,3 +35,16 @@ class NonUniqueComponent(Exception):
 
 class DoubleModelNameException(Exception):
     """Thrown when there are two models with the same name."""
+
+
+class ServerJobError(Exception):
+
+    def __init__(self, message, server_traceback=None):
+        """Raised by the fitting server client if a job failed on the server.
+
+        Args:
+            message (str): the error message
+            server_traceback (str): the traceback of the error on the server, if available
+        """
+        super(ServerJobError, self).__init__(message)
+        self.server_traceback = server_traceback
@@ -0,0 +1,393 @@
+"""Closed-form linear estimators for models with a log-linear signal equation.
+
+The S0, Tensor and Kurtosis models can be estimated without non-linear optimization. S0 follows from the mean of the
+unweighted volumes, and the diffusion tensor and the kurtosis tensor have well known (weighted) linear least squares
+solutions on the logarithm of the signal. These estimates are computed vectorized over all voxels and take seconds
+for a whole brain.
+
+The estimators are available as functions working on a protocol and an array of observations, and as
+:class:`LinearEstimator` objects which produce maps for the parameters of the corresponding composite model. The latter
+can be used directly as a stage in a cascade (for example ``models = ('Tensor (Linear)', 'Tensor')``), can be fitted
+on their own using :func:`mdt.fit_model` or can provide initialization data for another model fit.
+"""
+import itertools
+from math import factorial
+
+import numpy as np
+
+from mdt.models.base import MissingProtocolInput, InsufficientMeasurements
+from mdt.models.estimators import DMRIEstimator
+from mdt.utils import tensor_cartesian_to_spherical, tensor_spherical_to_cartesian
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-18'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+KURTOSIS_INDICES = [index for index in itertools.product(range(3), repeat=4)
+                    if index[0] >= index[1] >= index[2] >= index[3]]
+"""The indices of the unique elements of the kurtosis tensor, in the order of the ``W_ijkl`` parameters."""
+
+
+def estimate_s0(protocol, observations, unweighted_threshold=None):
+    """Estimate S0 as the mean of the unweighted volumes.
+
+    If the protocol does not contain unweighted volumes, we use the volumes with the lowest b-value instead.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol of the observations
+        observations (ndarray): the observations, a (v, n) array for v voxels and n volumes
+        unweighted_threshold (float): the threshold under which we call a volume unweighted
+
+    Returns:
+        ndarray: the S0 estimate per voxel
+    """
+    indices = get_s0_volume_indices(protocol, unweighted_threshold)
+    return np.mean(np.asarray(observations, dtype=np.float64)[:, indices], axis=1)
+
+
+def get_s0_volume_indices(protocol, unweighted_threshold=None):
+    """Get the indices of the volumes we use for estimating S0.
+
+    These are the unweighted volumes or, if the protocol does not contain unweighted volumes, the volumes with the
+    lowest b-value.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol
+        unweighted_threshold (float): the threshold under which we call a volume unweighted
+
+    Returns:
+        ndarray: the indices of the volumes to use for the S0 estimate
+    """
+    indices = protocol.get_unweighted_indices(unweighted_threshold)
+    if not len(indices):
+        b = np.squeeze(protocol.get_column('b'))
+        indices = np.where(np.isclose(b, np.min(b)))[0]
+    return np.array(indices)
+
+
+def estimate_tensor(protocol, observations, weighted=True, batch_size=10000):
+    """Estimate the diffusion tensor using (weighted) linear least squares on the log signal.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol of the observations, needs the columns ``g`` and ``b``
+        observations (ndarray): the observations, a (v, n) array for v voxels and n volumes
+        weighted (boolean): if we use weighted linear least squares, with the squared signal predicted by an
+            ordinary least squares fit as weights. If False we only use ordinary least squares.
+        batch_size (int): the number of voxels to process at once, limits the memory usage
+
+    Returns:
+        dict: the estimates per voxel of ``s0``, the eigenvalues ``d``, ``dperp0`` and ``dperp1`` (in descending
+            order) and the angles ``theta``, ``phi`` and ``psi`` of the eigenvectors.
+    """
+    design = np.column_stack([np.ones(len(protocol)), get_tensor_design_matrix(protocol)])
+    coefficients = _fit_log_linear(design, observations, weighted, batch_size)
+
+    results = {'s0': np.exp(coefficients[:, 0])}
+    results.update(_get_tensor_parameters(coefficients[:, 1:7]))
+    return results
+
+
+def estimate_kurtosis(protocol, observations, weighted=True, batch_size=10000):
+    """Estimate the diffusion and kurtosis tensor using (weighted) linear least squares on the log signal.
+
+    This requires at least two non-zero b-values. The kurtosis elements follow the parameterization of the
+    Kurtosis model, that is, they are scaled by the squared mean diffusivity of the tensor.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol of the observations, needs the columns ``g`` and ``b``
+        observations (ndarray): the observations, a (v, n) array for v voxels and n volumes
+        weighted (boolean): if we use weighted linear least squares, with the squared signal predicted by an
+            ordinary least squares fit as weights. If False we only use ordinary least squares.
+        batch_size (int): the number of voxels to process at once, limits the memory usage
+
+    Returns:
+        dict: the tensor estimates as returned by :func:`estimate_tensor`, and the kurtosis tensor elements
+            ``W_0000``, ``W_1000``, etc.
+    """
+    design = np.column_stack([np.ones(len(protocol)),
+                              get_tensor_design_matrix(protocol),
+                              get_kurtosis_design_matrix(protocol)])
+    coefficients = _fit_log_linear(design, observations, weighted, batch_size)
+
+    results = {'s0': np.exp(coefficients[:, 0])}
+    results.update(_get_tensor_parameters(coefficients[:, 1:7]))
+
+    mean_diffusivity = (results['d'] + results['dperp0'] + results['dperp1']) / 3.0
+    valid = mean_diffusivity > 0
+    for ind, index in enumerate(KURTOSIS_INDICES):
+        kurtosis = np.zeros(coefficients.shape[0])
+        kurtosis[valid] = coefficients[valid, 7 + ind] / mean_diffusivity[valid] ** 2
+        results['W_{}{}{}{}'.format(*index)] = kurtosis
+    return results
+
+
+def get_tensor_design_matrix(protocol):
+    """Get the design matrix for the linear estimation of the diffusion tensor.
+
+    The columns correspond to the tensor elements ``Dxx, Dyy, Dzz, Dxy, Dxz, Dyz`` such that the product of this
+    matrix with the tensor elements gives the log attenuation ``-b * g^T D g``.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol with the columns ``g`` and ``b``
+
+    Returns:
+        ndarray: a (n, 6) matrix for the n volumes in the protocol
+    """
+    g = protocol.get_column('g')
+    b = np.squeeze(protocol.get_column('b'))
+    return -b[:, None] * np.column_stack([g[:, 0] ** 2, g[:, 1] ** 2, g[:, 2] ** 2,
+                                          2 * g[:, 0] * g[:, 1], 2 * g[:, 0] * g[:, 2], 2 * g[:, 1] * g[:, 2]])
+
+
+def get_kurtosis_design_matrix(protocol):
+    """Get the design matrix for the linear estimation of the kurtosis tensor.
+
+    The columns correspond to the elements in :data:`KURTOSIS_INDICES`, multiplied by the squared mean
+    diffusivity. That is, the product of this matrix with these elements gives
+    ``b^2 / 6 * MD^2 * sum_ijkl(g_i g_j g_k g_l W_ijkl)``.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol with the columns ``g`` and ``b``
+
+    Returns:
+        ndarray: a (n, 15) matrix for the n volumes in the protocol
+    """
+    g = protocol.get_column('g')
+    b = np.squeeze(protocol.get_column('b'))
+
+    columns = []
+    for index in KURTOSIS_INDICES:
+        multiplicity = factorial(4)
+        for count in np.bincount(index):
+            multiplicity //= factorial(count)
+        columns.append(multiplicity * np.prod(g[:, index], axis=1))
+
+    return (b ** 2 / 6.0)[:, None] * np.column_stack(columns)
+
+
+class LinearEstimator(DMRIEstimator):
+    """Base class for the closed-form estimators of the parameters of a composite model.
+
+    Attributes:
+        required_protocol_names (tuple): the protocol columns needed by this estimator
+        nmr_unknowns (int): the number of unknowns in the linear system, the minimum number of volumes we need
+    """
+    required_protocol_names = ('b',)
+    nmr_unknowns = 1
+
+    def get_input_data_problems(self, input_data=None):
+        input_data = input_data or self._input_data
+
+        missing_columns = [name for name in self.required_protocol_names if not input_data.protocol.has_column(name)]
+        if missing_columns:
+            return [MissingProtocolInput(missing_columns)]
+
+        if len(input_data.protocol) < self.nmr_unknowns:
+            return [InsufficientMeasurements(self.nmr_unknowns, len(input_data.protocol))]
+        return []
+
+    def get_required_protocol_names(self):
+        return list(self.required_protocol_names)
+
+
+class S0LinearEstimator(LinearEstimator):
+
+    name = 'S0 (Linear)'
+    target_model = 'S0'
+    description = 'The mean of the unweighted volumes.'
+
+    def _estimate(self, protocol, observations):
+        return {'S0.s0': estimate_s0(protocol, observations)}
+
+
+class TensorLinearEstimator(LinearEstimator):
+
+    name = 'Tensor (Linear)'
+    target_model = 'Tensor'
+    required_protocol_names = ('g', 'b')
+    nmr_unknowns = 7
+    description = 'Weighted linear least squares estimate of the diffusion tensor.'
+
+    def _estimate(self, protocol, observations):
+        estimates = estimate_tensor(protocol, observations)
+        results = {'S0.s0': estimates.pop('s0')}
+        results.update({'Tensor.' + key: value for key, value in estimates.items()})
+        return results
+
+
+class KurtosisLinearEstimator(LinearEstimator):
+
+    name = 'Kurtosis (Linear)'
+    target_model = 'Kurtosis'
+    required_protocol_names = ('g', 'b')
+    nmr_unknowns = 22
+    description = 'Weighted linear least squares estimate of the diffusion and kurtosis tensor.'
+
+    def get_input_data_problems(self, input_data=None):
+        problems = super(KurtosisLinearEstimator, self).get_input_data_problems(input_data)
+        if not problems:
+            input_data = input_data or self._input_data
+            weighted_shells = [b for b in input_data.protocol.get_b_values_shells() if b > 0]
+            if len(weighted_shells) < 2:
+                problems.append(InsufficientMeasurements(2, len(weighted_shells), 'non-zero b-value shells'))
+        return problems
+
+    def _estimate(self, protocol, observations):
+        """Estimate the parameters and reset the kurtosis tensor of voxels with an infeasible estimate.
+
+        The Kurtosis model only accepts kurtosis tensors with a non-negative directional kurtosis not larger than
+        the bound where the signal would start to increase with b. Voxels violating this for any volume in the
+        protocol are initialized with a zero kurtosis tensor instead.
+        """
+        estimates = estimate_kurtosis(protocol, observations)
+
+        b = np.squeeze(protocol.get_column('b'))
+        weighted = b > 0
+
+        tensor = [estimates[name] for name in ('d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi')]
+        adc = -np.dot(_get_tensor_elements(*tensor), get_tensor_design_matrix(protocol)[weighted].T) / b[weighted]
+
+        kurtosis_names = ['W_{}{}{}{}'.format(*index) for index in KURTOSIS_INDICES]
+        kurtosis_sum = np.dot(np.column_stack([estimates[name] for name in kurtosis_names]),
+                              get_kurtosis_design_matrix(protocol)[weighted].T / (b[weighted] ** 2 / 6.0))
+
+        mean_diffusivity = (tensor[0] + tensor[1] + tensor[2]) / 3.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            upper_limit = (mean_diffusivity[:, None] ** 2 * b[weighted]) / adc * kurtosis_sum
+        infeasible = np.any((kurtosis_sum < 0) | ~(upper_limit <= 3.0), axis=1)
+
+        for name in kurtosis_names:
+            estimates[name][infeasible] = 0
+
+        results = {'S0.s0': estimates.pop('s0')}
+        results.update({'KurtosisTensor.' + key: value for key, value in estimates.items()})
+        return results
+
+
+def get_linear_estimator(name):
+    """Get the linear estimator with the given name.
+
+    Args:
+        name (str): the name of the estimator, for example 'Tensor (Linear)'
+
+    Returns:
+        LinearEstimator: the class of the linear estimator
+
+    Raises:
+        ValueError: if no linear estimator exists with the given name
+    """
+    for estimator in _LINEAR_ESTIMATORS:
+        if estimator.name == name:
+            return estimator
+    raise ValueError('The linear estimator with the name "{}" could not be found.'.format(name))
+
+
+def list_linear_estimators():
+    """Get the names of the available linear estimators.
+
+    Returns:
+        list of str: the names of the linear estimators
+    """
+    return [estimator.name for estimator in _LINEAR_ESTIMATORS]
+
+
+_LINEAR_ESTIMATORS = [S0LinearEstimator, TensorLinearEstimator, KurtosisLinearEstimator]
+
+
+def _fit_log_linear(design, observations, weighted, batch_size):
+    """Fit the given linear model to the logarithm of the observations.
+
+    Args:
+        design (ndarray): the (n, p) design matrix
+        observations (ndarray): the (v, n) observations
+        weighted (boolean): if we use weighted least squares after the initial ordinary least squares fit
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        ndarray: the (v, p) coefficients
+    """
+    pseudo_inverse = np.linalg.pinv(design)
+    design_products = np.reshape(design[:, :, None] * design[:, None, :], (design.shape[0], -1))
+
+    coefficients = np.zeros((observations.shape[0], design.shape[1]))
+    for start in range(0, observations.shape[0], batch_size):
+        batch = slice(start, min(start + batch_size, observations.shape[0]))
+        log_signal = _get_log_signal(observations[batch])
+
+        batch_coefficients = np.dot(log_signal, pseudo_inverse.T)
+
+        if weighted:
+            log_weights = 2 * np.dot(batch_coefficients, design.T)
+            log_weights -= np.max(log_weights, axis=1)[:, None]
+            weights = np.exp(log_weights)
+
+            lhs = np.reshape(np.dot(weights, design_products), (-1, design.shape[1], design.shape[1]))
+            rhs = np.dot(weights * log_signal, design)
+
+            try:
+                batch_coefficients = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                batch_coefficients = np.array([np.linalg.lstsq(a, b, rcond=-1)[0] for a, b in zip(lhs, rhs)])
+
+        coefficients[batch] = batch_coefficients
+    return coefficients
+
+
+def _get_log_signal(observations):
+    """Get the logarithm of the given observations, non-positive values are clipped to the smallest positive value.
+
+    Args:
+        observations (ndarray): the (v, n) observations
+
+    Returns:
+        ndarray: the log of the observations, as double precision
+    """
+    observations = np.asarray(observations, dtype=np.float64)
+    positive = np.where(observations > 0, observations, np.inf)
+    min_signal = np.min(positive, axis=1)
+    min_signal[~np.isfinite(min_signal)] = 1
+    return np.log(np.maximum(observations, min_signal[:, None]))
+
+
+def _get_tensor_parameters(tensor_elements):
+    """Get the Tensor model parameters from the tensor elements.
+
+    Args:
+        tensor_elements (ndarray): (v, 6) array with the elements ``Dxx, Dyy, Dzz, Dxy, Dxz, Dyz``
+
+    Returns:
+        dict: the eigenvalues ``d``, ``dperp0`` and ``dperp1`` in descending order and the angles ``theta``,
+            ``phi`` and ``psi``.
+    """
+    tensor_elements = np.nan_to_num(tensor_elements)
+    xx, yy, zz, xy, xz, yz = (tensor_elements[:, ind] for ind in range(6))
+    tensors = np.stack([np.stack([xx, xy, xz], axis=-1),
+                        np.stack([xy, yy, yz], axis=-1),
+                        np.stack([xz, yz, zz], axis=-1)], axis=-2)
+
+    eigen_values, eigen_vectors = np.linalg.eigh(tensors)
+    eigen_values = eigen_values[:, ::-1]
+    eigen_vectors = eigen_vectors[:, :, ::-1]
+
+    theta, phi, psi = tensor_cartesian_to_spherical(eigen_vectors[:, :, 0], eigen_vectors[:, :, 1])
+    return {'d': eigen_values[:, 0], 'dperp0': eigen_values[:, 1], 'dperp1': eigen_values[:, 2],
+            'theta': theta, 'phi': phi, 'psi': psi}
+
+
+def _get_tensor_elements(d, dperp0, dperp1, theta, phi, psi):
+    """Get the tensor elements ``Dxx, Dyy, Dzz, Dxy, Dxz, Dyz`` from the Tensor model parameters.
+
+    Returns:
+        ndarray: (v, 6) array with the tensor elements
+    """
+    vectors = tensor_spherical_to_cartesian(np.squeeze(theta), np.squeeze(phi), np.squeeze(psi))
+    eigen_values = [np.squeeze(d), np.squeeze(dperp0), np.squeeze(dperp1)]
+
+    def element(i, j):
+        return sum(value * vector[..., i] * vector[..., j] for value, vector in zip(eigen_values, vectors))
+
+    return np.column_stack([element(0, 0), element(1, 1), element(2, 2),
+                            element(0, 1), element(0, 2), element(1, 2)])
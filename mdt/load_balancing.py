@@ -0,0 +1,158 @@
+"""Distribution of the work over multiple OpenCL devices.
+
+With the default even distribution every device gets an equal share of every batch of voxels, such that with devices
+of a different speed (for example a GPU and a CPU, or two GPUs of different generations) the slowest device determines
+the run time. The :class:`ThroughputDistribution` measures the throughput (items per second) of every device and
+splits the work proportional to these throughputs, such that all devices finish at about the same time.
+
+The load balancing is configured in the ``load_balancing`` section of the configuration, the devices to use are set
+with ``cl_device_ind`` (or ``--cl-device-ind`` on the command line).
+"""
+import logging
+import timeit
+from multiprocessing.pool import ThreadPool
+
+from mot.load_balance_strategies import SimpleLoadBalanceStrategy
+
+from mdt.autotuning import get_device_key, load_autotuning_cache, update_autotuning_cache_entries
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-29'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class ThroughputDistribution(SimpleLoadBalanceStrategy):
+
+    def __init__(self, smoothing=0.5, cache_key=None, run_in_batches=True, single_batch_length=1e4):
+        """Distribute the work over the devices proportional to their measured throughput.
+
+        The throughput is measured per device and per type of work (the class of the worker, for example the
+        optimization or the computation of the model estimates), as the number of items processed per second. The
+        first time a type of work is seen it is split evenly, after which the work is split proportional to the
+        throughputs. After every call the throughputs are updated with the new measurements, using exponential
+        smoothing.
+
+        If a cache key is given (for example the name of the model), the throughputs can be stored in the autotuning
+        cache (see :mod:`mdt.autotuning`) using :meth:`save_throughputs`, and are used as initial throughputs in later
+        sessions.
+
+        Args:
+            smoothing (float): the weight of a new measurement in the exponential smoothing, between 0 and 1. A value
+                of 1 uses only the last measurement.
+            cache_key (str): if given, the key under which we cache the throughputs per device
+            run_in_batches (boolean): if we want to run the load per worker in batches or in one large run
+            single_batch_length (float): the length of a single batch, only used if run_in_batches is set to True
+        """
+        super(ThroughputDistribution, self).__init__(run_in_batches=run_in_batches,
+                                                     single_batch_length=single_batch_length)
+        self._logger = logging.getLogger(__name__)
+        self._smoothing = smoothing
+        self._cache_key = cache_key
+        self._throughputs = {}
+        self._unsaved_throughputs = {}
+
+    def process(self, workers, nmr_items, run_in_batches=None, single_batch_length=None):
+        if len(workers) == 1:
+            self._run_batches(workers, [self._create_batches(0, nmr_items, run_in_batches=run_in_batches,
+                                                             single_batch_length=single_batch_length)])
+            return
+
+        keys = [self._get_throughput_key(worker) for worker in workers]
+        throughputs = [self._get_throughput(worker, key) for worker, key in zip(workers, keys)]
+        if any(throughput is None for throughput in throughputs):
+            throughputs = [1] * len(workers)
+
+        ranges = self._split_range(nmr_items, throughputs)
+        batches = [self._create_batches(start, end, run_in_batches=run_in_batches,
+                                        single_batch_length=single_batch_length) for start, end in ranges]
+
+        pool = ThreadPool(len(workers))
+        try:
+            durations = pool.map(lambda args: self._run_worker(*args), zip(workers, batches))
+        finally:
+            pool.close()
+
+        for worker, key, (start, end), duration in zip(workers, keys, ranges, durations):
+            if end > start and duration > 0:
+                self._update_throughput(worker, key, (end - start) / duration)
+
+    def get_used_cl_environments(self, cl_environments):
+        return cl_environments
+
+    def save_throughputs(self):
+        """Store the throughputs measured since the last save in the autotuning cache.
+
+        This does nothing if no cache key was given or if no new throughputs were measured. Since this writes the
+        cache file, this should be called once at the end of a computation (for example a model fit), not after
+        every call to :meth:`process`.
+        """
+        if self._cache_key is None or not self._unsaved_throughputs:
+            return
+
+        entries = {}
+        for key, (device_key, routine_key) in self._unsaved_throughputs.items():
+            entries.setdefault(device_key, {})[routine_key] = float(self._throughputs[key])
+        update_autotuning_cache_entries(entries)
+        self._unsaved_throughputs = {}
+
+    def _run_worker(self, worker, batches):
+        """Run the given batches on a single worker, one after the other.
+
+        Returns:
+            float: the time it took to process all the batches
+        """
+        start_time = timeit.default_timer()
+        for range_start, range_end in batches:
+            worker.calculate(int(range_start), int(range_end))
+            for queue in worker.get_used_queues():
+                queue.finish()
+            worker.post_process(int(range_start), int(range_end))
+        return timeit.default_timer() - start_time
+
+    def _split_range(self, nmr_items, throughputs):
+        """Split the range of items in consecutive parts, proportional to the given throughputs.
+
+        Returns:
+            list of tuple: per worker the (start, end) of its part of the range
+        """
+        total = float(sum(throughputs))
+
+        ranges = []
+        start = 0
+        for ind, throughput in enumerate(throughputs):
+            if ind == len(throughputs) - 1:
+                end = nmr_items
+            else:
+                end = min(start + int(round(nmr_items * throughput / total)), nmr_items)
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def _get_throughput_key(self, worker):
+        return '{}/{}'.format(get_device_key(worker.cl_environment), type(worker).__name__)
+
+    def _get_throughput(self, worker, key):
+        """Get the current throughput of the given worker, or None if it is not yet known."""
+        if key not in self._throughputs and self._cache_key is not None:
+            cached = load_autotuning_cache().get(get_device_key(worker.cl_environment), {}).get(
+                self._get_cache_routine_key(worker))
+            if cached:
+                self._throughputs[key] = cached
+        return self._throughputs.get(key)
+
+    def _update_throughput(self, worker, key, throughput):
+        if key in self._throughputs:
+            throughput = self._smoothing * throughput + (1 - self._smoothing) * self._throughputs[key]
+        self._throughputs[key] = throughput
+
+        self._logger.debug('Throughput of {} on {}: {:.4g} items per second.'.format(
+            type(worker).__name__, worker.cl_environment, throughput))
+
+        if self._cache_key is not None:
+            self._unsaved_throughputs[key] = (get_device_key(worker.cl_environment),
+                                              self._get_cache_routine_key(worker))
+
+    def _get_cache_routine_key(self, worker):
+        return '{}/{}/{}'.format(type(self).__name__, self._cache_key, type(worker).__name__)
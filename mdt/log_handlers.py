@@ -5,6 +5,7 @@ They are typically configured in the MDT configuration file.
 """
 
 import codecs
+import errno
 from logging import StreamHandler
 import os
 import sys
@@ -47,7 +48,12 @@ class ModelOutputLogHandler(StreamHandler):
         self._output_file = output_file
         if self._output_file:
             if not os.path.isdir(os.path.dirname(self._output_file)):
-                os.makedirs(os.path.dirname(self._output_file))
+                try:
+                    os.makedirs(os.path.dirname(self._output_file))
+                except OSError as exc:
+                    # the directory may be created concurrently, for example by the other shards of a sharded fit
+                    if exc.errno != errno.EEXIST:
+                        raise
             self._open()
 
     def emit(self, record):
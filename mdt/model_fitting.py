@@ -1,23 +1,32 @@
 import collections
+import copy
+import errno
 import glob
 import logging
 import os
 import time
 import timeit
 from contextlib import contextmanager
+import numpy as np
 from six import string_types
 from mdt.__version__ import __version__
-from mdt.nifti import get_all_nifti_data
+from mdt.nifti import get_all_nifti_data, write_all_as_nifti
 from mdt.components import get_model
-from mdt.configuration import get_processing_strategy, get_optimizer_for_model
+from mdt.configuration import get_processing_strategy, get_optimizer_for_model, gzip_optimization_results, \
+    get_voxel_refinement, get_voxel_triage, get_residual_bootstrap, get_load_balancer, use_mixed_precision, \
+    get_mixed_precision_refinement, get_output_dtype_policy
 from mdt.models.cascade import DMRICascadeModelInterface
 from mdt.protocols import write_protocol
 from mdt.utils import create_roi, get_cl_devices, model_output_exists, \
-    per_model_logging_context, get_temporary_results_dir, SimpleInitializationData
-from mdt.processing_strategies import FittingProcessor, get_full_tmp_results_path
+    per_model_logging_context, get_temporary_results_dir, SimpleInitializationData, restore_volumes
+from mdt.processing_strategies import FittingProcessor, InMemoryFittingProcessor, get_full_tmp_results_path
 from mdt.exceptions import InsufficientProtocolError
+from mdt.load_balancing import ThroughputDistribution
+from mdt.sharding import ShardedFittingProcessor
+from mdt.models.estimators import DMRIEstimator
+from mdt.provenance import get_fit_provenance, get_provenance_changes, write_provenance, get_voxel_fingerprints, \
+    get_reusable_voxels, write_voxel_fingerprints
 from mot.cl_runtime_info import CLRuntimeInfo
-from mot.load_balance_strategies import EvenDistribution
 import mot.configuration
 from mot.configuration import RuntimeConfigurationAction
 
@@ -108,7 +117,7 @@ class ModelFit(object):
     def __init__(self, model, input_data, output_folder, optimizer=None,
                  recalculate=False, only_recalculate_last=False, cascade_subdir=False,
                  cl_device_ind=None, double_precision=False, tmp_results_dir=True, initialization_data=None,
-                 post_processing=None):
+                 post_processing=None, incremental=False, shard=None, mixed_precision=None):
         """Setup model fitting for the given input model and data.
 
         To actually fit the model call run().
@@ -118,7 +127,8 @@ class ModelFit(object):
                     the model we want to optimize.
             input_data (:class:`~mdt.utils.MRIInputData`): the input data object containing
                 all the info needed for the model fitting.
-            output_folder (string): The full path to the folder where to place the output
+            output_folder (string): The full path to the folder where to place the output. If None, nothing is
+                written to disk and all the results are kept in memory.
             optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): The optimization routine to use.
                 If None, we create one using the configuration files.
             recalculate (boolean): If we want to recalculate the results if they are already present.
@@ -143,22 +153,34 @@ class ModelFit(object):
                 For valid elements, please see the configuration file settings for ``optimization``
                 under ``post_processing``. Valid input for this parameter is for example: {'covariance': False}
                 to disable automatic calculation of the covariance from the Hessian.
-
+            incremental (boolean): if existing results no longer match the current input, only refit the voxels
+                that are new or changed instead of all voxels. See :class:`SingleModelFit` for details.
+            shard (:class:`~mdt.sharding.Shard`): if given, we only fit this shard of the voxels, see
+                :mod:`mdt.sharding`. This requires an output folder.
+            mixed_precision (boolean): if we fit in single precision, if we optimize the poorly converged voxels
+                again in double precision (see :mod:`mdt.refinement`). If None, we use the configuration setting.
+                This has no effect if double_precision is set.
         """
         if isinstance(model, string_types):
             model = get_model(model)()
 
+        if shard is not None and output_folder is None:
+            raise ValueError('Sharded fitting requires an output folder.')
+
         if post_processing:
             model.update_active_post_processing('optimization', post_processing)
 
         self._model = model
         self._input_data = input_data
         self._output_folder = output_folder
-        if cascade_subdir and isinstance(self._model, DMRICascadeModelInterface):
+        if cascade_subdir and output_folder is not None and isinstance(self._model, DMRICascadeModelInterface):
             self._output_folder += '/{}'.format(self._model.name)
         self._optimizer = optimizer
         self._recalculate = recalculate
         self._only_recalculate_last = only_recalculate_last
+        self._incremental = incremental
+        self._shard = shard
+        self._mixed_precision = use_mixed_precision() if mixed_precision is None else mixed_precision
         self._logger = logging.getLogger(__name__)
 
         self._model_names_list = []
@@ -173,7 +195,7 @@ class ModelFit(object):
             cl_environments = [get_cl_devices()[ind] for ind in cl_device_ind]
 
         self._cl_runtime_info = CLRuntimeInfo(cl_environments=cl_environments,
-                                              load_balancer=EvenDistribution(),
+                                              load_balancer=get_load_balancer(cache_key=model.name),
                                               double_precision=double_precision)
 
         if not model.is_input_data_sufficient(self._input_data):
@@ -189,6 +211,9 @@ class ModelFit(object):
                 This returns the results as 3d/4d volumes for every output map.
         """
         _, maps = self._run(self._model, self._recalculate, self._only_recalculate_last)
+
+        if isinstance(self._cl_runtime_info.load_balancer, ThroughputDistribution):
+            self._cl_runtime_info.load_balancer.save_throughputs()
         return maps
 
     def _run(self, model, recalculate, only_recalculate_last, _in_recursion=False):
@@ -233,6 +258,9 @@ class ModelFit(object):
             model.reset()
             return last_results
 
+        if isinstance(model, DMRIEstimator):
+            return self._run_estimator(model)
+
         return self._run_composite_model(model, recalculate, self._model_names_list,
                                          apply_user_provided_initialization=not _in_recursion)
 
@@ -246,11 +274,57 @@ class ModelFit(object):
             optimizer = self._optimizer or get_optimizer_for_model(model_names)
             optimizer.set_cl_runtime_info(self._cl_runtime_info)
 
+            refinement = get_voxel_refinement()
+            if refinement is not None:
+                refinement.optimizer.set_cl_runtime_info(self._cl_runtime_info)
+
+            precision_refinement = None
+            if self._mixed_precision and not self._cl_runtime_info.double_precision:
+                precision_refinement = get_mixed_precision_refinement(model_names)
+                if self._optimizer is not None:
+                    precision_refinement.optimizer = copy.copy(self._optimizer)
+                precision_refinement.optimizer.set_cl_runtime_info(CLRuntimeInfo(
+                    cl_environments=self._cl_runtime_info.cl_environments,
+                    load_balancer=self._cl_runtime_info.load_balancer, double_precision=True))
+
+            bootstrap = None
+            if model.get_active_post_processing()['optimization'].get('bootstrap', False):
+                bootstrap = get_residual_bootstrap()
+
             fitter = SingleModelFit(model, self._input_data, self._output_folder, optimizer,
-                                    self._tmp_results_dir, recalculate=recalculate, cascade_names=model_names)
+                                    self._tmp_results_dir, recalculate=recalculate, cascade_names=model_names,
+                                    double_precision=self._cl_runtime_info.double_precision,
+                                    incremental=self._incremental, refinement=refinement,
+                                    precision_refinement=precision_refinement, voxel_triage=get_voxel_triage(),
+                                    bootstrap=bootstrap, shard=self._shard)
             results = fitter.run()
 
-        map_results = get_all_nifti_data(os.path.join(self._output_folder, model.name))
+        if self._output_folder is None:
+            map_results = _restore_nested_volumes(results, self._input_data.mask_index)
+        else:
+            map_results = get_all_nifti_data(os.path.join(self._output_folder, model.name))
+        return results, map_results
+
+    def _run_estimator(self, estimator):
+        """Compute the estimates of the given estimator.
+
+        Since this is cheap, we always recompute the estimates instead of loading existing results.
+
+        Args:
+            estimator (mdt.models.estimators.DMRIEstimator): the estimator to run
+
+        Returns:
+            tuple: the ROI results and the reconstructed map results
+        """
+        self._logger.info('Computing the {} estimates'.format(estimator.name))
+        results = estimator.estimate(self._input_data)
+        map_results = restore_volumes(results, self._input_data.mask_index)
+
+        if self._output_folder is not None:
+            write_all_as_nifti(map_results, os.path.join(self._output_folder, estimator.name),
+                               nifti_header=self._input_data.nifti_header, gzip=gzip_optimization_results(),
+                               dtype_policy=get_output_dtype_policy())
+
         return results, map_results
 
     def _apply_user_provided_initialization_data(self, model):
@@ -265,15 +339,58 @@ class ModelFit(object):
         self._initialization_data.apply_to_model(model, self._input_data)
 
 
+def _restore_nested_volumes(results, mask_index):
+    """Restore the given ROI results to volumes, keeping nested results (like the bootstrap maps) as nested dicts.
+
+    Args:
+        results (dict): the ROI results, possibly nested
+        mask_index (mdt.utils.MaskIndex): the mask index of the input data
+
+    Returns:
+        dict: the same structure as the results, with every ROI array restored to a volume
+    """
+    volumes = restore_volumes({k: v for k, v in results.items() if not isinstance(v, collections.Mapping)}, mask_index)
+    volumes.update({k: _restore_nested_volumes(v, mask_index) for k, v in results.items()
+                    if isinstance(v, collections.Mapping)})
+    return volumes
+
+
 class SingleModelFit(object):
 
     def __init__(self, model, input_data, output_folder, optimizer, tmp_results_dir, recalculate=False,
-                 cascade_names=None):
+                 cascade_names=None, double_precision=False, incremental=False, refinement=None,
+                 precision_refinement=None, voxel_triage=None, bootstrap=None, shard=None):
         """Fits a composite model.
 
          This does not accept cascade models. Please use the more general ModelFit class for all models,
          composite and cascade.
 
+         Next to the output maps we store the provenance of the fit (see :mod:`mdt.provenance`). If recalculate
+         is False, existing results are only reused if their provenance matches the current model, input data and
+         optimizer. Results without stored provenance are reused as is.
+
+         In incremental mode, results that no longer match are not recomputed as a whole if only the voxel
+         dependent inputs changed (the mask, the signal, voxel wise protocol maps or noise std, or the parameter
+         initialization). Instead, we only fit the voxels which are new in the mask or whose inputs changed and
+         merge these with the existing results of the other voxels. In a cascade, the changed voxels propagate through
+         the initialization of the next model, such that every stage is updated incrementally.
+
+         With a refinement (see :mod:`mdt.refinement`), the voxels that did not converge well in the fit are
+         optimized again with the refinement optimizer, starting from their first results, and merged with the
+         results of the other voxels.
+
+         With a precision refinement, used for mixed precision fitting, the voxels that did not converge well in single
+         precision are optimized again in double precision, after the regular refinement.
+
+         With a voxel triage (see :mod:`mdt.voxel_triage`), the voxels without usable signal are not fitted. These
+         voxels are zero in all output maps and are marked in the ``SkippedVoxels`` map.
+
+         With a residual bootstrap (see :mod:`mdt.bootstrap`), we add bootstrap uncertainty maps of the fitted voxels
+         in the ``bootstrap`` subdirectory of the results.
+
+         With a shard (see :mod:`mdt.sharding`), we only fit (and refine) the voxels of this shard. The shard finishing
+         last merges the results of all the shards, the other shards wait for these results.
+
          Args:
              model (:class:`~mdt.models.composite.DMRICompositeModel`): An implementation of an composite model
                 that contains the model we want to optimize.
@@ -281,21 +398,41 @@ class SingleModelFit(object):
                 model.
              output_folder (string): The path to the folder where to place the output.
                 The resulting maps are placed in a subdirectory (named after the model name) in this output folder.
+                If None, we do not write anything to disk and return the results from memory.
              optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): The optimization routine to use.
              tmp_results_dir (str): the main directory to use for the temporary results
              recalculate (boolean): If we want to recalculate the results if they are already present.
              cascade_names (list): the list of cascade names, meant for logging
+             double_precision (boolean): if the computations are done in double precision, used for the provenance
+             incremental (boolean): if we only refit the new or changed voxels when existing results do not match
+             refinement (:class:`~mdt.refinement.VoxelRefinement`): if given, the refinement of the poorly
+                converged voxels after the fit
+             precision_refinement (:class:`~mdt.refinement.VoxelRefinement`): if given, the refinement of the
+                poorly converged voxels in double precision, applied after the other refinement
+             voxel_triage (:class:`~mdt.voxel_triage.VoxelTriage`): if given, used to select the voxels we skip
+             bootstrap (:class:`~mdt.bootstrap.ResidualBootstrap`): if given, used to compute the bootstrap maps
+             shard (:class:`~mdt.sharding.Shard`): if given, the shard of the voxels we fit
          """
         self.recalculate = recalculate
 
         self._model = model
         self._input_data = input_data
         self._output_folder = output_folder
-        self._output_path = os.path.join(self._output_folder, self._model.name)
+        self._output_path = None
+        if self._output_folder is not None:
+            self._output_path = os.path.join(self._output_folder, self._model.name)
         self._optimizer = optimizer
         self._logger = logging.getLogger(__name__)
         self._tmp_results_dir = tmp_results_dir
         self._cascade_names = cascade_names
+        self._double_precision = double_precision
+        self._incremental = incremental
+        self._refinement = refinement
+        self._precision_refinement = precision_refinement
+        self._voxel_triage = voxel_triage
+        self._bootstrap = bootstrap
+        self._shard = shard
+        self._skip_voxels = None
 
         if not self._model.is_input_data_sufficient(input_data):
             raise InsufficientProtocolError(
@@ -304,10 +441,34 @@ class SingleModelFit(object):
 
     def run(self):
         """Fits the composite model and returns the results as ROI lists per map."""
+        if self._output_folder is None:
+            return self._run_in_memory()
+
+        provenance = get_fit_provenance(self._model, self._input_data, self._optimizer,
+                                        double_precision=self._double_precision, refinement=self._refinement,
+                                        precision_refinement=self._precision_refinement,
+                                        voxel_triage=self._voxel_triage, bootstrap=self._bootstrap)
+        fingerprints = get_voxel_fingerprints(self._model, self._input_data)
+        reuse_voxels = None
+
         if not self.recalculate and model_output_exists(self._model, self._output_folder):
-            maps = get_all_nifti_data(self._output_path)
-            self._logger.info('Not recalculating {} model'.format(self._model.name))
-            return create_roi(maps, self._input_data.mask)
+            changes = get_provenance_changes(self._output_path, provenance)
+            if changes:
+                if self._incremental:
+                    reuse_voxels = get_reusable_voxels(self._output_path, provenance, fingerprints,
+                                                       self._input_data.mask)
+
+                if reuse_voxels is None:
+                    self._logger.info('Recalculating {} model, the existing results differ in: {}.'.format(
+                        self._model.name, ', '.join(changes)))
+                    self.recalculate = True
+                else:
+                    self._logger.info('Incrementally updating {} model, refitting {} of {} voxels.'.format(
+                        self._model.name, np.count_nonzero(~reuse_voxels), len(reuse_voxels)))
+            else:
+                maps = get_all_nifti_data(self._output_path)
+                self._logger.info('Not recalculating {} model'.format(self._model.name))
+                return create_roi(maps, self._input_data.mask_index)
 
         with per_model_logging_context(self._output_path):
             self._logger.info('Using MDT version {}'.format(__version__))
@@ -315,29 +476,172 @@ class SingleModelFit(object):
             self._logger.info('Current cascade: {0}'.format(self._cascade_names))
 
             self._model.set_input_data(self._input_data)
+            self._skip_voxels = self._get_voxels_to_skip()
 
             if self.recalculate:
                 if os.path.exists(self._output_path):
                     list(map(os.remove, glob.glob(os.path.join(self._output_path, '*.nii*'))))
 
             if not os.path.exists(self._output_path):
-                os.makedirs(self._output_path)
+                try:
+                    os.makedirs(self._output_path)
+                except OSError as exc:
+                    # with sharded fitting, the other shards may create the output directory concurrently
+                    if exc.errno != errno.EEXIST:
+                        raise
 
             with self._logging():
                 tmp_dir = get_full_tmp_results_path(self._output_path, self._tmp_results_dir)
                 self._logger.info('Saving temporary results in {}.'.format(tmp_dir))
 
-                worker = FittingProcessor(self._optimizer, self._model, self._input_data.mask,
-                                          self._input_data.nifti_header, self._output_path,
-                                          tmp_dir, self.recalculate)
+                worker = self._get_fitting_processor(self._optimizer, tmp_dir, 'optimization',
+                                                     self.recalculate or reuse_voxels is not None,
+                                                     reuse_voxels=reuse_voxels)
 
                 processing_strategy = get_processing_strategy('optimization')
                 results = processing_strategy.process(worker)
 
+                if self._refinement is not None:
+                    results = self._refine(self._refinement, results, tmp_dir=tmp_dir, sharding_subdir='refinement')
+
+                if self._precision_refinement is not None:
+                    results = self._refine(self._precision_refinement, results, tmp_dir=tmp_dir,
+                                           sharding_subdir='precision_refinement')
+
+                if self._shard is not None and os.path.isdir(tmp_dir) and not os.listdir(tmp_dir):
+                    try:
+                        os.rmdir(tmp_dir)
+                    except OSError:
+                        pass
+
                 self._write_protocol(self._model.get_input_data().protocol)
+                write_provenance(self._output_path, provenance)
+                write_voxel_fingerprints(self._output_path, fingerprints, self._input_data.mask)
 
         return results
 
+    def _run_in_memory(self):
+        """Fits the composite model without writing anything to disk.
+
+        Returns:
+            dict: the results as ROI lists per map
+        """
+        self._logger.info('Using MDT version {}'.format(__version__))
+        self._logger.info('Preparing for model {0}'.format(self._model.name))
+        self._logger.info('Current cascade: {0}'.format(self._cascade_names))
+
+        self._model.set_input_data(self._input_data)
+        self._skip_voxels = self._get_voxels_to_skip()
+
+        with self._logging():
+            worker = InMemoryFittingProcessor(self._optimizer, self._model, self._input_data.mask,
+                                              skip_voxels=self._skip_voxels, bootstrap=self._bootstrap)
+            processing_strategy = get_processing_strategy('optimization')
+            results = processing_strategy.process(worker)
+
+            if self._refinement is not None:
+                results = self._refine(self._refinement, results)
+
+            if self._precision_refinement is not None:
+                results = self._refine(self._precision_refinement, results)
+            return results
+
+    def _refine(self, refinement, results, tmp_dir=None, sharding_subdir=None):
+        """Optimize the poorly converged voxels again with the optimizer of the given refinement.
+
+        The selected voxels start from their current results. The results of all other voxels are kept as is.
+        Skipped voxels are never refined.
+
+        Args:
+            refinement (:class:`~mdt.refinement.VoxelRefinement`): the refinement to apply
+            results (dict): the ROI results of the previous pass
+            tmp_dir (str): the temporary results directory, if we are writing the results to disk
+            sharding_subdir (str): the subdirectory for the temporary results of this pass, when fitting a shard
+
+        Returns:
+            dict: the ROI results with the refined voxels updated
+        """
+        precision = ' in double precision' if refinement.double_precision else ''
+
+        refine_voxels = refinement.get_voxels_to_refine(self._model, results, skip_voxels=self._skip_voxels)
+        if not np.any(refine_voxels):
+            self._logger.info('All voxels of the {} model converged, no refinement{} needed.'.format(
+                self._model.name, precision))
+            return results
+
+        self._logger.info('Refining {} of {} voxels of the {} model{}.'.format(
+            np.count_nonzero(refine_voxels), len(refine_voxels), self._model.name, precision))
+
+        with self._starting_from(results):
+            if self._output_path is None:
+                worker = InMemoryFittingProcessor(refinement.optimizer, self._model, self._input_data.mask,
+                                                  existing_results=results, reuse_voxels=~refine_voxels,
+                                                  skip_voxels=self._skip_voxels, bootstrap=self._bootstrap)
+            else:
+                worker = self._get_fitting_processor(refinement.optimizer, tmp_dir, sharding_subdir, True,
+                                                     reuse_voxels=~refine_voxels)
+
+            processing_strategy = get_processing_strategy('optimization', warm_start=False)
+            return processing_strategy.process(worker)
+
+    @contextmanager
+    def _starting_from(self, results):
+        """Temporarily initialize the free parameters of the model with the given results.
+
+        The previous initial parameters are restored afterwards, such that later uses of the same model object do not
+        start from these (ROI length) results.
+
+        Args:
+            results (dict): the ROI results to start from
+        """
+        param_names = self._model.get_free_param_names()
+        previous = dict(zip(param_names, self._model.get_initial_parameters()))
+
+        self._model.set_initial_parameters({name: results[name] for name in param_names})
+        try:
+            yield
+        finally:
+            self._model.set_initial_parameters(previous)
+
+    def _get_fitting_processor(self, optimizer, tmp_dir, sharding_subdir, recalculate, reuse_voxels=None):
+        """Get the processor for fitting the model with the results written to disk.
+
+        Args:
+            optimizer: the optimization routine to use
+            tmp_dir (str): the temporary results directory
+            sharding_subdir (str): if we are fitting a shard, the subdirectory of the temporary results directory
+                shared by the shards, this differs per fitting pass.
+            recalculate (boolean): if we want to remove the existing temporary results
+            reuse_voxels (ndarray): the voxels whose existing results we reuse
+
+        Returns:
+            mdt.processing_strategies.FittingProcessor: the processor
+        """
+        if self._shard is not None:
+            return ShardedFittingProcessor(self._shard, os.path.join(tmp_dir, sharding_subdir), optimizer,
+                                           self._model, self._input_data.mask, self._input_data.nifti_header,
+                                           self._output_path, recalculate, reuse_voxels=reuse_voxels,
+                                           skip_voxels=self._skip_voxels, bootstrap=self._bootstrap)
+        return FittingProcessor(optimizer, self._model, self._input_data.mask, self._input_data.nifti_header,
+                                self._output_path, tmp_dir, recalculate, reuse_voxels=reuse_voxels,
+                                skip_voxels=self._skip_voxels, bootstrap=self._bootstrap)
+
+    def _get_voxels_to_skip(self):
+        """Get the voxels we do not fit, as selected by the voxel triage.
+
+        Returns:
+            ndarray or None: a boolean array with for every voxel in the mask if we skip it, or None if we fit
+                all voxels.
+        """
+        if self._voxel_triage is None:
+            return None
+
+        skip_voxels = self._voxel_triage.get_voxels_to_skip(self._input_data)
+        if np.any(skip_voxels):
+            self._logger.info('Skipping {} of {} voxels without usable signal.'.format(
+                np.count_nonzero(skip_voxels), len(skip_voxels)))
+        return skip_voxels
+
     def _write_protocol(self, protocol):
         if len(protocol):
             write_protocol(protocol, os.path.join(self._output_path, 'used_protocol.prtcl'))
@@ -3,8 +3,10 @@ import logging
 import os
 import timeit
 import time
+import numpy as np
 
 from mdt import get_processing_strategy
+from mdt.configuration import get_voxel_triage
 from mdt.utils import load_samples, per_model_logging_context
 from mdt.processing_strategies import SamplingProcessor, SaveAllSamples, \
     SaveNoSamples, get_full_tmp_results_path, SaveSpecificMaps
@@ -77,12 +79,20 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
             logger.info('Preparing the model with the user provided initialization data.')
             initialization_data.apply_to_model(model, input_data)
 
+        skip_voxels = None
+        voxel_triage = get_voxel_triage()
+        if voxel_triage is not None:
+            skip_voxels = voxel_triage.get_voxels_to_skip(input_data)
+            if np.any(skip_voxels):
+                logger.info('Skipping {} of {} voxels without usable signal.'.format(
+                    np.count_nonzero(skip_voxels), len(skip_voxels)))
+
         with _log_info(logger, model.name):
             worker = SamplingProcessor(
                 nmr_samples, thinning, burnin,
                 model, input_data.mask, input_data.nifti_header, output_folder,
                 get_full_tmp_results_path(output_folder, tmp_dir), recalculate,
-                samples_storage_strategy=samples_storage_strategy)
+                samples_storage_strategy=samples_storage_strategy, skip_voxels=skip_voxels)
 
             processing_strategy = get_processing_strategy('sampling')
             return processing_strategy.process(worker)
@@ -101,3 +101,23 @@ class NamedProtocolProblem(InputDataProblem):
 
     def __str__(self):
         return "{0}: {1}".format(self._model_name, self._model_protocol_problem)
+
+
+class InsufficientMeasurements(InputDataProblem):
+
+    def __init__(self, nmr_required, nmr_available, measurement_name='volumes'):
+        """Indicates that the input data does not contain enough measurements.
+
+        Args:
+            nmr_required (int): the minimum number of measurements needed
+            nmr_available (int): the number of measurements available
+            measurement_name (str): the name of the measurements, used for reporting
+        """
+        super(InsufficientMeasurements, self).__init__()
+        self.nmr_required = nmr_required
+        self.nmr_available = nmr_available
+        self.measurement_name = measurement_name
+
+    def __str__(self):
+        return 'At least {} {} are required, {} given'.format(self.nmr_required, self.measurement_name,
+                                                               self.nmr_available)
@@ -5,6 +5,7 @@ import collections
 import numpy as np
 from six import string_types
 
+from mdt.cl_routines.mapping.goodness_of_fit import GoodnessOfFit
 from mdt.configuration import get_active_post_processing
 from mdt.deferred_mappings import DeferredFunctionDict
 from mdt.exceptions import DoubleModelNameException
@@ -138,13 +139,24 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         return CompositeModelFunction(self._model_tree, signal_noise_model=self._signal_noise_model)
 
-    def build(self, problems_to_analyze=None):
+    def build(self, problems_to_analyze=None, observations=None):
+        """Build the model for the given problems.
+
+        Args:
+            problems_to_analyze (ndarray): the ROI indices of the problems to build the model for, the same index
+                can be given multiple times. If None, we build the model for all the voxels in the input data.
+            observations (ndarray): if given, the observations to use instead of those of the input data, with one
+                row per problem to analyze.
+
+        Returns:
+            BuildCompositeModel: the model ready for optimization and sampling
+        """
         if self._input_data is None:
             raise RuntimeError('Input data is not set, can not build the model.')
 
         return BuildCompositeModel(problems_to_analyze,
                                    self.name,
-                                   self._get_kernel_data(problems_to_analyze),
+                                   self._get_kernel_data(problems_to_analyze, observations=observations),
                                    self._get_nmr_problems(problems_to_analyze),
                                    self.get_nmr_observations(),
                                    self.get_nmr_parameters(),
@@ -173,7 +185,8 @@ class DMRICompositeModel(DMRIOptimizable):
                                    self._get_model_eval_function(problems_to_analyze),
                                    self._get_log_likelihood_per_observation_function(problems_to_analyze),
                                    self._get_log_prior_function_builder(),
-                                   self._get_finalize_proposal_function_builder())
+                                   self._get_finalize_proposal_function_builder(),
+                                   self._get_goodness_of_fit_shells())
 
     def update_active_post_processing(self, processing_type, settings):
         """Update the active post-processing semaphores.
@@ -396,6 +409,63 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         return self._input_data
 
+    def get_selected_input_data(self, input_data):
+        """Get the given input data limited to the volumes this model would use, without setting it.
+
+        Args:
+            input_data (mdt.utils.MRIInputData): the input data to select the volumes from
+
+        Returns:
+            mdt.utils.MRIInputData: either the same input data or a copy with a subset of the volumes
+        """
+        return self._prepare_input_data(input_data)
+
+    def get_provenance_data(self):
+        """Get the data that defines the results of optimizing this model, used for provenance tracking.
+
+        This contains the model definition (the CL code of the composite model and of the likelihood function),
+        the active post-processing options, the settings of the post-processing routines and the current
+        initialization, fixation and bounds of the free parameters.
+
+        Returns:
+            dict: with the elements ``definition``, ``post_processing``, ``post_processing_settings``
+                and ``parameters``.
+        """
+        parameters = {}
+        for m, p in self._model_functions_info.get_free_parameters_list():
+            param_name = '{}.{}'.format(m.name, p.name)
+            parameters[param_name] = {'fixed': self._model_functions_info.is_fixed(param_name),
+                                      'value': self._model_functions_info.get_parameter_value(param_name),
+                                      'lower_bound': self._lower_bounds[param_name],
+                                      'upper_bound': self._upper_bounds[param_name]}
+
+        return {'definition': [self.name,
+                               self.get_composite_model_function().get_cl_code(),
+                               self._likelihood_function.get_log_likelihood_function().get_cl_code()],
+                'post_processing': self._post_processing['optimization'],
+                'post_processing_settings': self._get_post_processing_settings(),
+                'parameters': parameters}
+
+    def _get_post_processing_settings(self):
+        """Get the settings of the post-processing routines that influence the output maps.
+
+        These are the settings of the goodness-of-fit maps, if active, and of the additional map routines of the
+        compartments that can report them, like the method and the number of directions of the DKI measures.
+
+        Returns:
+            dict: per post-processing routine the settings of that routine
+        """
+        settings = {}
+        if self._post_processing['optimization'].get('goodness_of_fit'):
+            settings['GoodnessOfFit'] = GoodnessOfFit().get_settings()
+
+        for compartment in self._model_functions_info.get_model_list():
+            for func in getattr(compartment, 'extra_optimization_maps_funcs', []):
+                routine = getattr(func, '__self__', None)
+                if hasattr(routine, 'get_settings'):
+                    settings['{}.{}'.format(compartment.name, type(routine).__name__)] = routine.get_settings()
+        return settings
+
     def get_nmr_observations(self):
         """See super class for details"""
         return self._input_data.nmr_observations
@@ -425,6 +495,10 @@ class DMRICompositeModel(DMRIOptimizable):
         """Get the names of the free parameters"""
         return ['{}.{}'.format(m.name, p.name) for m, p in self._model_functions_info.get_estimable_parameters_list()]
 
+    def get_free_weight_names(self):
+        """Get the names of the free compartment weights, these are constrained to sum to at most one."""
+        return ['{}.{}'.format(m.name, p.name) for m, p in self._model_functions_info.get_estimable_weights()]
+
     def get_required_protocol_names(self):
         """Get a list with the constant data names that are needed for this model to work.
 
@@ -486,7 +560,7 @@ class DMRICompositeModel(DMRIOptimizable):
                 of the problems_to_analyze setting).
         """
         if len(self._input_data.gradient_deviations.shape) > 2:
-            grad_dev = create_roi(self._input_data.gradient_deviations, self._input_data.mask)
+            grad_dev = create_roi(self._input_data.gradient_deviations, self._input_data.mask_index)
         else:
             grad_dev = np.copy(self._input_data.gradient_deviations)
 
@@ -653,6 +727,34 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         return list(range(input_data.nmr_observations))
 
+    def _get_goodness_of_fit_shells(self):
+        """Get the groups of volumes for which we compute the residual statistics in the goodness-of-fit maps.
+
+        The unweighted volumes form the group ``b0``, the weighted volumes are grouped per shell, with names of the
+        form ``b<b-value in s/mm^2>``. Since the b-values of a shell tend to vary slightly over the volumes, we group
+        the weighted volumes by their b-value rounded to the nearest 100 s/mm^2.
+
+        Returns:
+            list of tuple: per group the name and the indices of its volumes, empty if the protocol has no b-values
+        """
+        protocol = self._input_data.protocol
+        if not protocol.has_column('b'):
+            return []
+
+        shells = collections.OrderedDict()
+
+        unweighted = np.asarray(protocol.get_unweighted_indices(), dtype=np.int64)
+        if len(unweighted):
+            shells['b0'] = unweighted
+
+        weighted = np.asarray(protocol.get_weighted_indices(), dtype=np.int64)
+        rounded_b_values = np.round(protocol.get_column('b')[weighted, 0] / 1e8) * 100
+        for shell in np.unique(rounded_b_values):
+            name = 'b{:g}'.format(shell)
+            indices = weighted[rounded_b_values == shell]
+            shells[name] = np.concatenate([shells[name], indices]) if name in shells else indices
+        return list(shells.items())
+
     def _get_dependent_map_calculator(self):
         """Get the calculation function to compute the maps for the dependent parameters."""
         estimable_parameters = self._model_functions_info.get_estimable_parameters_list(exclude_priors=True)
@@ -821,15 +923,17 @@ class DMRICompositeModel(DMRIOptimizable):
                 value = self._input_data.get_input_data(parameter.name)
             return value
 
-    def _get_observations_data(self, problems_to_analyze):
+    def _get_observations_data(self, problems_to_analyze, observations=None):
         """Get the observations to use in the kernel.
 
-        Can return None if there are no observations.
+        Can return None if there are no observations. If observations are given, these are used instead of the
+        observations of the input data.
         """
-        observations = self._input_data.observations
-        if observations is not None:
-            if problems_to_analyze is not None:
+        if observations is None:
+            observations = self._input_data.observations
+            if observations is not None and problems_to_analyze is not None:
                 observations = observations[problems_to_analyze, ...]
+        if observations is not None:
             observations = self._transform_observations(observations)
             return {'observations': KernelArray(observations)}
         return {}
@@ -1310,9 +1414,9 @@ class DMRICompositeModel(DMRIOptimizable):
             return 0
         return len(problems_to_analyze)
 
-    def _get_kernel_data(self, problems_to_analyze):
+    def _get_kernel_data(self, problems_to_analyze, observations=None):
         data_items = {}
-        data_items.update(self._get_observations_data(problems_to_analyze))
+        data_items.update(self._get_observations_data(problems_to_analyze, observations=observations))
         data_items.update(self._get_fixed_parameters_as_var_data(problems_to_analyze))
         data_items.update(self._get_bounds_as_var_data(problems_to_analyze))
         data_items.update(self._get_protocol_data_as_var_data(problems_to_analyze))
@@ -1501,7 +1605,7 @@ class BuildCompositeModel(SampleModelInterface, NumericalDerivativeInterface):
                  free_param_names, parameter_codec, post_processing,
                  rwm_proposal_stds, eval_function,
                  ll_per_obs_func, log_prior_function_builder,
-                 finalize_proposal_function_builder):
+                 finalize_proposal_function_builder, goodness_of_fit_shells):
         self.used_problem_indices = used_problem_indices
         self.name = name
         self._kernel_data_info = kernel_data_info
@@ -1534,6 +1638,7 @@ class BuildCompositeModel(SampleModelInterface, NumericalDerivativeInterface):
         self._ll_per_obs_func = ll_per_obs_func
         self._log_prior_function_builder = log_prior_function_builder
         self._finalize_proposal_function_builder = finalize_proposal_function_builder
+        self._goodness_of_fit_shells = goodness_of_fit_shells
 
     def get_kernel_data(self):
         return self._kernel_data_info
@@ -1632,7 +1737,8 @@ class BuildCompositeModel(SampleModelInterface, NumericalDerivativeInterface):
             3) Apply each of the ``post_optimization_modifiers`` functions
             4) Add information criteria maps
             5) Calculate the covariance matrix according to the Fisher Information Matrix theory
-            6) Add the additional results from the ``additional_result_funcs``
+            6) Add the goodness-of-fit maps
+            7) Add the additional results from the ``additional_result_funcs``
 
         Args:
             results_dict (dict): A dictionary with as keys the names of the parameters and as values the 1d maps with
@@ -1664,6 +1770,9 @@ class BuildCompositeModel(SampleModelInterface, NumericalDerivativeInterface):
         if self._post_processing['optimization']['covariance']:
             results_dict.update(self._calculate_hessian_covariance(results_array))
 
+        if self._post_processing['optimization'].get('goodness_of_fit'):
+            results_dict.update(GoodnessOfFit().calculate(self, results_array, self._goodness_of_fit_shells))
+
         for routine in self._extra_optimization_maps:
             try:
                 results_dict.update(routine(results_dict))
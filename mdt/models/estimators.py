@@ -0,0 +1,107 @@
+import numpy as np
+
+from mdt.models.base import DMRIOptimizable
+from mdt.utils import restore_volumes, SimpleInitializationData
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-21'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class DMRIEstimator(DMRIOptimizable):
+    """Base class for models that estimate the parameters of a composite model without optimization.
+
+    An estimator produces estimates for the free parameters of the composite model with the name
+    :attr:`target_model`, clipped to the bounds of that model. It can be fitted using :func:`mdt.fit_model` and it can
+    be used as a model in a cascade, in which case its results initialize the next model in the cascade.
+
+    Attributes:
+        name (str): the name of this estimator, by convention ``<target model> (<estimation method>)``
+        target_model (str): the name of the composite model whose parameters we estimate
+        description (str): a description of this estimator
+    """
+    name = None
+    target_model = None
+    description = ''
+
+    def __init__(self):
+        super(DMRIEstimator, self).__init__()
+        self._model = None
+        self._input_data = None
+
+    def estimate(self, input_data=None):
+        """Estimate the parameters of the target model on all the voxels of the given input data.
+
+        This uses the same subset of the volumes as the target model would use for its fit.
+
+        Args:
+            input_data (mdt.utils.MRIInputData): the input data to use, if not set we use the input data set with
+                :meth:`set_input_data`.
+
+        Returns:
+            dict: per parameter name of the target model an array with the estimate per voxel in the ROI
+        """
+        model = self._get_target_model()
+        input_data = model.get_selected_input_data(input_data or self._input_data)
+        results = self._estimate(input_data.protocol, input_data.observations)
+
+        for name, lower, upper in zip(model.get_free_param_names(), model.get_lower_bounds(),
+                                      model.get_upper_bounds()):
+            if name in results:
+                results[name] = np.clip(np.nan_to_num(results[name]), lower, upper)
+        return results
+
+    def get_initialization_data(self, input_data):
+        """Get initialization data for fitting the target model (or another model with the same parameter names).
+
+        Args:
+            input_data (mdt.utils.MRIInputData): the input data to estimate the initialization values from
+
+        Returns:
+            mdt.utils.SimpleInitializationData: initialization data with the estimates as initial values
+        """
+        return SimpleInitializationData(inits=restore_volumes(self.estimate(input_data), input_data.mask_index,
+                                                              with_volume_dim=False))
+
+    def get_free_param_names(self):
+        """Get the names of the parameters we estimate, these are the free parameters of the target model."""
+        return self._get_target_model().get_free_param_names()
+
+    def has_parameter(self, model_param_name):
+        """Estimators can not be initialized, as such we report to have no parameters."""
+        return False
+
+    def set_input_data(self, input_data):
+        self._input_data = input_data
+
+    def is_input_data_sufficient(self, input_data=None):
+        return not self.get_input_data_problems(input_data)
+
+    def get_input_data_problems(self, input_data=None):
+        return self._get_target_model().get_input_data_problems(input_data or self._input_data)
+
+    def get_required_protocol_names(self):
+        return self._get_target_model().get_required_protocol_names()
+
+    def update_active_post_processing(self, processing_type, settings):
+        """Estimators have no post-processing, as such this does nothing."""
+
+    def _estimate(self, protocol, observations):
+        """Compute the estimates.
+
+        Args:
+            protocol (mdt.protocols.Protocol): the protocol of the observations
+            observations (ndarray): the (v, n) array of observations
+
+        Returns:
+            dict: per parameter name of the target model an array with the estimate per voxel
+        """
+        raise NotImplementedError()
+
+    def _get_target_model(self):
+        if self._model is None:
+            from mdt.components import get_model
+            self._model = get_model(self.target_model)()
+        return self._model
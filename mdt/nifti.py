@@ -1,3 +1,4 @@
+import fnmatch
 import glob
 import gzip
 import os
@@ -86,7 +87,7 @@ def get_all_nifti_data(directory, map_names=None, deferred=True):
         return {k: v.get_data() for k, v in proxies.items()}
 
 
-def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=True, **kwargs):
+def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=True, dtype=None, **kwargs):
     """Write data to a nifti file.
 
     This will write the output directory if it does not exist yet.
@@ -100,12 +101,18 @@ def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=Tru
         affine (ndarray): the affine transformation matrix
         use_data_dtype (boolean): if we want to use the dtype from the data instead of that from the header
             when saving the nifti.
+        dtype (np.dtype): if given, the dtype of the nifti file, overriding use_data_dtype. If this is an integer
+            type and the data is floating point, NiBabel scales the data to the integer range and stores the
+            scaling in the header.
         **kwargs: other arguments to Nifti2Image from NiBabel
     """
     if header is None:
         header = nib.nifti2.Nifti2Header()
 
-    if use_data_dtype:
+    if dtype is not None:
+        header = copy.deepcopy(header)
+        header.set_data_dtype(dtype)
+    elif use_data_dtype:
         header = copy.deepcopy(header)
         dtype = data.dtype
         if data.dtype == np.bool:
@@ -129,7 +136,8 @@ def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=Tru
     format(data, affine, header=header, **kwargs).to_filename(output_fname)
 
 
-def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=True, gzip=True):
+def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=True, gzip=True, bounding_box=None,
+                       dtype_policy=None):
     """Write a number of volume maps to the specific directory.
 
     Args:
@@ -139,6 +147,10 @@ def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=
         nifti_header: the nifti header to use for each of the volumes.
         overwrite_volumes (boolean): defaults to True, if we want to overwrite the volumes if they exists
         gzip (boolean): if True we write the files as .nii.gz, if False we write the files as .nii
+        bounding_box (mdt.utils.BoundingBox): if given, the volumes are cropped to this bounding box and are
+            padded to the full field of view (matching the nifti header) just before writing.
+        dtype_policy (OutputDtypePolicy): if given, the policy selecting the data type of every volume, if not
+            given we write every volume with the data type of its data.
     """
     for key, volume in volumes.items():
         extension = '.nii'
@@ -149,11 +161,97 @@ def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=
         full_filename = os.path.abspath(os.path.join(directory, filename))
 
         if os.path.exists(full_filename):
-            if overwrite_volumes:
-                os.remove(full_filename)
-                write_nifti(volume, full_filename, header=nifti_header)
-        else:
-            write_nifti(volume, full_filename, header=nifti_header)
+            if not overwrite_volumes:
+                continue
+            os.remove(full_filename)
+
+        dtype = None
+        if dtype_policy is not None:
+            volume, dtype = dtype_policy.prepare_nifti_data(key, volume)
+
+        if bounding_box is not None:
+            volume = bounding_box.pad(volume)
+        write_nifti(volume, full_filename, header=nifti_header, dtype=dtype)
+
+
+class OutputDtypePolicy(object):
+
+    def __init__(self, float_dtype=None, compact_integers=True, integer_maps=(), scaled_int16_maps=()):
+        """Selects compact data types for the temporary storage and the output maps of model fitting and sampling.
+
+        The maps are selected by name, using shell style wildcards (for example ``w_*.w``). In order of priority:
+
+        * maps matching ``scaled_int16_maps`` are written as int16 with a scaling factor and intercept in the nifti
+          header, computed from the range of the map. This is meant for bounded maps (like volume fractions or the
+          fractional anisotropy) where the precision of 1/65535 of the range suffices. Non finite values are
+          written as zero.
+        * boolean and integer maps, and the floating point maps matching ``integer_maps`` (after rounding), are
+          written with the smallest integer type holding all their values, if compact_integers is set.
+        * all other floating point maps are stored as float_dtype, if set.
+
+        The temporary storage only uses the float_dtype (if set), since the range of the values is not known in advance.
+
+        Args:
+            float_dtype (str or np.dtype): the data type for floating point maps, None to keep the data type of the maps
+            compact_integers (boolean): if we write integer and boolean maps with the smallest integer type
+            integer_maps (list of str): the (wildcard) names of floating point maps holding integer values
+            scaled_int16_maps (list of str): the (wildcard) names of floating point maps written as scaled int16
+        """
+        self.float_dtype = np.dtype(float_dtype) if float_dtype is not None else None
+        self.compact_integers = compact_integers
+        self.integer_maps = list(integer_maps or [])
+        self.scaled_int16_maps = list(scaled_int16_maps or [])
+
+    def get_storage_dtype(self, map_name, data):
+        """Get the data type for storing the given map in the temporary storage.
+
+        Args:
+            map_name (str): the name of the map
+            data (ndarray): (a part of) the data of the map
+
+        Returns:
+            np.dtype: the data type to use
+        """
+        if self.float_dtype is not None and np.issubdtype(data.dtype, np.floating):
+            return self.float_dtype
+        return data.dtype
+
+    def prepare_nifti_data(self, map_name, data):
+        """Prepare the given map for writing as a nifti file.
+
+        Args:
+            map_name (str): the name of the map
+            data (ndarray): the data of the map
+
+        Returns:
+            tuple: the (converted) data and the data type for the nifti file, this data type is None if the data type
+                of the returned data should be used.
+        """
+        is_float = np.issubdtype(data.dtype, np.floating)
+
+        if is_float and self._matches(map_name, self.scaled_int16_maps):
+            return np.nan_to_num(data), np.dtype(np.int16)
+
+        if self.compact_integers:
+            if is_float and self._matches(map_name, self.integer_maps):
+                data = np.round(np.nan_to_num(data))
+                return data.astype(_get_smallest_integer_dtype(data)), None
+            if data.dtype == np.bool or np.issubdtype(data.dtype, np.integer):
+                return data.astype(_get_smallest_integer_dtype(data)), None
+
+        if is_float and self.float_dtype is not None:
+            return data.astype(self.float_dtype, copy=False), None
+        return data, None
+
+    def _matches(self, map_name, patterns):
+        return any(fnmatch.fnmatchcase(map_name, pattern) for pattern in patterns)
+
+
+def _get_smallest_integer_dtype(data):
+    """Get the smallest integer data type which can hold all the values of the given data."""
+    if not data.size:
+        return np.dtype(np.uint8)
+    return np.promote_types(np.min_scalar_type(int(np.min(data))), np.min_scalar_type(int(np.max(data))))
 
 
 def nifti_filepath_resolution(file_path):
@@ -1,5 +1,6 @@
 """This module contains various standard post-processing routines for use after optimization or sampling."""
 import numpy as np
+from mdt.cl_routines.mapping.tensor_measures import TensorMeasures
 from mdt.utils import tensor_spherical_to_cartesian, tensor_cartesian_to_spherical
 from mot.utils import split_in_batches
 
@@ -12,18 +13,28 @@ __licence__ = 'LGPL v3'
 
 class DTIMeasures(object):
 
+    #: the maps needed for computing the Tensor measures using :class:`TensorMeasures`
+    cl_required_maps = ('d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi')
+
     @staticmethod
     def extra_optimization_maps(results):
         """Return some interesting measures like FA, MD, RD and AD.
 
+        If the angles are available, all maps are computed in one OpenCL kernel (see :class:`TensorMeasures`).
+        Else, the measures are computed from the diffusivities only.
+
         Args:
-            results (dict): Dictionary containing at least theta, phi, psi, d, dperp0 and dperp1
-                We will use this to generate some standard measures from the diffusion Tensor.
+            results (dict): Dictionary containing at least d, dperp0 and dperp1, and preferably also theta,
+                phi and psi. We will use this to generate some standard measures from the diffusion Tensor.
 
         Returns:
             dict: as keys typical elements like 'FA and 'MD' as interesting output and as per values the maps.
                 These maps are per voxel, and optionally per instance per voxel
         """
+        if DTIMeasures._use_cl_routine(results):
+            measures = TensorMeasures().calculate(results)
+            return {k: v for k, v in measures.items() if k not in DTIMeasures.cl_required_maps}
+
         output = {
             'FA': DTIMeasures.fractional_anisotropy(results['d'], results['dperp0'], results['dperp1']),
             'MD': (results['d'] + results['dperp0'] + results['dperp1']) / 3.,
@@ -89,17 +100,36 @@ class DTIMeasures(object):
         This is done primarily to be able to directly use the Tensor results in MCMC sampling. Since we often put a
         prior on the diffusivities to be in decreasing order, we need to make sure that the starting point is valid.
 
+        This uses the OpenCL routine :class:`TensorMeasures` if possible.
+
         Args:
             parameters_dict (dict): the results from optimization
 
         Returns:
             dict: same set of parameters but then possibly updated with a rotation.
         """
+        if DTIMeasures._use_cl_routine(parameters_dict):
+            measures = TensorMeasures().calculate(parameters_dict)
+            return {k: measures[k] for k in DTIMeasures.cl_required_maps}
+
         sorted_eigenvalues, sorted_eigenvectors, ranking = DTIMeasures.sort_eigensystem(parameters_dict)
         theta, phi, psi = tensor_cartesian_to_spherical(sorted_eigenvectors[0], sorted_eigenvectors[1])
         return {'d': sorted_eigenvalues[:, 0], 'dperp0': sorted_eigenvalues[:, 1], 'dperp1': sorted_eigenvalues[:, 2],
                 'theta': theta, 'phi': phi, 'psi': psi}
 
+    @staticmethod
+    def _use_cl_routine(results):
+        """Check if we can compute the Tensor measures of the given results using :class:`TensorMeasures`.
+
+        Returns:
+            boolean: if all the required maps are present and each has a single value per voxel
+        """
+        if not all(name in results for name in DTIMeasures.cl_required_maps):
+            return False
+        shapes = [np.shape(results[name]) for name in DTIMeasures.cl_required_maps]
+        return all(len(shape) in (1, 2) and shape[0] == shapes[0][0] > 0 and np.prod(shape[1:]) == 1
+                   for shape in shapes)
+
     @staticmethod
     def sort_eigensystem(parameters_dict):
         eigenvectors = np.stack(tensor_spherical_to_cartesian(np.squeeze(parameters_dict['theta']),
@@ -22,8 +22,10 @@ import gc
 from numpy.lib.format import open_memmap
 
 from mdt.nifti import write_all_as_nifti, get_all_nifti_data
-from mdt.configuration import gzip_optimization_results, gzip_sampling_results
-from mdt.utils import create_roi, load_samples
+from mdt.configuration import gzip_optimization_results, gzip_sampling_results, get_output_dtype_policy
+from mdt.utils import create_roi, load_samples, BoundingBox, MaskIndex, load_brain_mask
+from mdt.voxel_triage import SKIPPED_VOXELS_MAP_NAME
+from mdt.bootstrap import BOOTSTRAP_MAPS_DIR
 import collections
 
 from mot.cl_routines.sampling.amwg import AdaptiveMetropolisWithinGibbs
@@ -59,16 +61,32 @@ class ModelProcessingStrategy(object):
 class ChunksProcessingStrategy(ModelProcessingStrategy):
 
     def __init__(self, *args, **kwargs):
-        """This class is a base class for all model slice fitting strategies that fit the data in chunks/parts."""
+        """This class is a base class for all model slice fitting strategies that fit the data in chunks/parts.
+
+        Args:
+            voxel_ordering (str or VoxelOrdering): the order in which the voxels are processed, this determines which
+                voxels are grouped together in a chunk. Either a :class:`VoxelOrdering` or one of the names
+                'roi' (the order of the voxels in the ROI), 'slices' (slice by slice over the last spatial axis) or
+                'morton' (following a Z-order space filling curve).
+            warm_start (boolean): if set, we ask the processor to initialize the voxels of each chunk from the
+                results of their spatial neighbours processed in earlier chunks. This is most effective in
+                combination with a spatially coherent voxel ordering and chunks smaller than the dataset.
+        """
         super(ChunksProcessingStrategy, self).__init__()
         self._logger = logging.getLogger(__name__)
+        self._voxel_ordering = get_voxel_ordering(kwargs.pop('voxel_ordering', 'roi'))
+        self._warm_start = kwargs.pop('warm_start', False)
 
     def process(self, processor):
         """Compute all the slices using the implemented chunks generator"""
-        chunks = self._get_chunks(processor.get_voxels_to_compute())
+        if self._warm_start:
+            processor.enable_warm_start()
+
+        voxels_to_compute = self._voxel_ordering.order(processor.get_voxels_to_compute(), processor.get_mask())
+        chunks = self._get_chunks(voxels_to_compute)
         self._process_chunk(processor, chunks)
 
-        self._logger.info('Computed all voxels, now creating nifti\'s')
+        self._logger.info('Computed all voxels, now combining the results')
         return_data = processor.combine()
         processor.finalize()
 
@@ -171,6 +189,7 @@ class VoxelRange(ChunksProcessingStrategy):
 
         Args:
             max_nmr_voxels (int): the number of voxels per batch
+            **kwargs: see :class:`ChunksProcessingStrategy`
 
         Attributes:
             max_nmr_voxels (int): the number of voxels per chunk
@@ -222,6 +241,23 @@ class ModelProcessor(object):
         """
         raise NotImplementedError()
 
+    def get_mask(self):
+        """Get the mask defining the voxels of this processor.
+
+        The ROI indices used by this processor index the voxels of this mask.
+
+        Returns:
+            ndarray: the three dimensional mask
+        """
+        raise NotImplementedError()
+
+    def enable_warm_start(self):
+        """Initialize the voxels of each batch from the results of already processed spatial neighbours.
+
+        This is called by the processing strategy before processing. Processors which do not support warm starting
+        may ignore this.
+        """
+
     def combine(self):
         """Combine all the calculated parts.
 
@@ -237,32 +273,40 @@ class ModelProcessor(object):
 
 class SimpleModelProcessor(ModelProcessor):
 
-    def __init__(self, mask, nifti_header, output_dir, tmp_storage_dir, recalculate):
+    def __init__(self, mask, nifti_header, output_dir, tmp_storage_dir, recalculate, skip_voxels=None):
         """A default implementation of a processing worker.
 
         While the processing strategies determine how to split the work in batches, the workers
         implement the logic on how to process the model. For example, optimization and sampling both require
         different processing, while the batch sizes can be determined by a processing strategy.
 
+        The temporary results are stored on the grid of the bounding box of the mask and are only padded to the
+        full field of view when writing the final nifti files.
+
         Args:
-            mask (ndarray): the mask to use during processing
+            mask (ndarray or MaskIndex): the mask to use during processing
             nifti_header (nibabel nifti header): the nifti header to use for writing the output nifti files
             output_dir (str): the location for the final output files
             tmp_storage_dir (str): the location for the temporary output files
             recalculate (boolean): if we want to recalculate existing results if present
+            skip_voxels (ndarray): optional boolean array with for every voxel in the mask if we should not process
+                it, see :mod:`mdt.voxel_triage`.
         """
         super(SimpleModelProcessor, self).__init__()
         self._write_volumes_gzipped = True
+        self._dtype_policy = get_output_dtype_policy()
         self._used_mask_name = 'UsedMask'
-        self._mask = mask
+        self._mask = load_brain_mask(mask)
+        self._bounding_box = BoundingBox.from_mask(self._mask)
+        self._cropped_mask_index = MaskIndex(self._bounding_box.crop(self._mask))
         self._nifti_header = nifti_header
         self._output_dir = output_dir
         self._tmp_storage_dir = tmp_storage_dir
         self._prepare_tmp_storage(self._tmp_storage_dir, recalculate)
         self._processing_tmp_dir = os.path.join(self._tmp_storage_dir, 'processing_tmp')
-        self._roi_lookup_path = os.path.join(self._processing_tmp_dir, 'roi_voxel_lookup_table.npy')
-        self._volume_indices = self._create_roi_to_volume_index_lookup_table()
-        self._total_nmr_voxels = np.count_nonzero(self._mask)
+        self._volume_indices = self._cropped_mask_index.positions
+        self._total_nmr_voxels = self._cropped_mask_index.nmr_voxels
+        self._skip_voxels = skip_voxels
 
     def combine(self):
         pass
@@ -290,19 +334,26 @@ class SimpleModelProcessor(ModelProcessor):
         """By default this will return the indices of all the voxels we have not yet computed.
 
         In the case that recalculate is set to False and we have some intermediate results lying about, this
-        function will only return the indices of the voxels we have not yet processed.
+        function will only return the indices of the voxels we have not yet processed. Skipped voxels are never
+        returned.
         """
         roi_list = np.arange(0, self._total_nmr_voxels)
+        if self._skip_voxels is not None:
+            roi_list = roi_list[np.logical_not(self._skip_voxels)]
+
         processed_voxels_path = os.path.join(self._processing_tmp_dir, 'processed_voxels.npy')
         if os.path.exists(processed_voxels_path):
             return roi_list[np.logical_not(np.squeeze(create_roi(np.load(processed_voxels_path, mmap_mode='r'),
-                                                                 self._mask)[roi_list]))]
+                                                                 self._cropped_mask_index)[roi_list]))]
         return roi_list
 
     def get_total_nmr_voxels(self):
         """Returns the number of nonzero elements in the mask."""
         return self._total_nmr_voxels
 
+    def get_mask(self):
+        return self._mask
+
     def finalize(self):
         """Cleans the temporary storage directory."""
         del self._volume_indices
@@ -336,7 +387,8 @@ class SimpleModelProcessor(ModelProcessor):
     def _write_volume(self, data, volume_indices, filename):
         """Write the result of one map to the specified file.
 
-        This is meant to save map data to a temporary .npy file.
+        This is meant to save map data to a temporary .npy file, using the data type of the output dtype policy
+        (see :func:`~mdt.configuration.get_output_dtype_policy`).
 
         Args:
             data (ndarray): the voxel data to store
@@ -355,8 +407,9 @@ class SimpleModelProcessor(ModelProcessor):
         if os.path.isfile(filename):
             mode = 'r+'
 
-        tmp_matrix = open_memmap(filename, mode=mode, dtype=data.dtype,
-                                 shape=self._mask.shape[0:3] + extra_dims)
+        dtype = self._dtype_policy.get_storage_dtype(os.path.splitext(os.path.basename(filename))[0], data)
+        tmp_matrix = open_memmap(filename, mode=mode, dtype=dtype,
+                                 shape=self._cropped_mask_index.shape[0:3] + extra_dims)
         tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = data
 
     def _combine_volumes(self, output_dir, tmp_storage_dir, nifti_header, maps_subdir=''):
@@ -387,61 +440,50 @@ class SimpleModelProcessor(ModelProcessor):
         for map_name in map_names:
             data = np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r')
             write_all_as_nifti({map_name: data}, full_output_dir, nifti_header=nifti_header,
-                               gzip=self._write_volumes_gzipped)
-
-    def _create_roi_to_volume_index_lookup_table(self):
-        """Creates and returns a lookup table for roi index -> volume index.
-
-        This will create from the given mask a memory mapped lookup table mapping the ROI indices (single integer)
-        to the correct voxel location in 3d. To find a voxel index using the ROI index, just index this lookup
-        table using the ROI index as index.
-
-        For example, suppose we have the lookup table:
-
-            0: (0, 0, 0)
-            1: (0, 0, 1)
-            2: (0, 1, 0)
-            ...
-
-        We can get the position of a voxel in the 3d space by indexing this array as: ``lookup_table[roi_index]``
-        to get the correct 3d location.
-
-        Returns:
-            memmap ndarray: the memory mapped array which
-        """
-        if not os.path.exists(os.path.dirname(self._roi_lookup_path)):
-            os.mkdir(os.path.dirname(self._roi_lookup_path))
-        if os.path.isfile(self._roi_lookup_path):
-            os.remove(self._roi_lookup_path)
-        np.save(self._roi_lookup_path, np.argwhere(self._mask))
-        return np.load(self._roi_lookup_path, mmap_mode='r')
+                               gzip=self._write_volumes_gzipped, bounding_box=self._bounding_box,
+                               dtype_policy=self._dtype_policy)
 
 
 class FittingProcessor(SimpleModelProcessor):
 
-    def __init__(self, optimizer, model, mask, nifti_header, output_dir, tmp_storage_dir, recalculate):
+    def __init__(self, optimizer, model, mask, nifti_header, output_dir, tmp_storage_dir, recalculate,
+                 reuse_voxels=None, skip_voxels=None, bootstrap=None):
         """The processing worker for model fitting.
 
         Use this if you want to use the model processing strategy to do model fitting.
 
         Args:
             optimizer: the optimization routine to use
+            reuse_voxels (ndarray): optional boolean array with for every voxel in the mask if we can reuse the
+                results already present in the output directory. If given, we copy the existing results of these
+                voxels to the temporary storage and only fit the other voxels. The combined results are then written
+                over the existing results.
+            skip_voxels (ndarray): optional boolean array with for every voxel in the mask if we should not fit it.
+                These voxels are zero in all output maps and are marked in the ``SkippedVoxels`` map.
+            bootstrap (mdt.bootstrap.ResidualBootstrap): if given, we compute the bootstrap maps of every fitted
+                voxel, stored in the ``bootstrap`` subdirectory.
         """
-        super(FittingProcessor, self).__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
+        super(FittingProcessor, self).__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate,
+                                               skip_voxels=skip_voxels)
         self._model = model
         self._optimizer = optimizer
+        self._bootstrap = bootstrap
         self._write_volumes_gzipped = gzip_optimization_results()
         self._subdirs = set()
+        self._warm_start = None
 
-    def _process(self, roi_indices, next_indices=None):
-        build_model = self._model.build(roi_indices)
+        if reuse_voxels is not None and np.any(reuse_voxels):
+            self._load_existing_results(np.where(reuse_voxels)[0])
 
-        codec_model = ParameterTransformedModel(build_model, self._model.get_parameter_codec())
-        starting_positions = codec_model.encode_parameters(build_model.get_initial_parameters())
+        if skip_voxels is not None:
+            self._write_output_recursive({SKIPPED_VOXELS_MAP_NAME: skip_voxels}, np.arange(self._total_nmr_voxels))
 
-        optimization_results = self._optimizer.minimize(codec_model, starting_positions)
+    def enable_warm_start(self):
+        self._warm_start = NeighbourWarmStart(self._mask)
 
-        results = codec_model.get_post_optimization_output(optimization_results)
+    def _process(self, roi_indices, next_indices=None):
+        results = fit_roi_indices(self._model, self._optimizer, roi_indices, warm_start=self._warm_start,
+                                  bootstrap=self._bootstrap)
         results.update({self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)})
 
         self._write_output_recursive(results, roi_indices)
@@ -459,6 +501,38 @@ class FittingProcessor(SimpleModelProcessor):
         self._write_volumes(current_output, roi_indices, os.path.join(self._tmp_storage_dir, sub_dir))
         self._subdirs.add(sub_dir)
 
+    def _load_existing_results(self, roi_indices):
+        """Copy the existing results of the given voxels from the output directory to the temporary storage.
+
+        The copied voxels are marked as processed, such that they are skipped during processing.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels whose results we reuse
+        """
+        volume_indices = self._volume_indices[roi_indices, :] + self._bounding_box.offset
+        tmp_storage_dir = os.path.abspath(self._tmp_storage_dir)
+
+        for directory, _, _ in os.walk(self._output_dir):
+            if os.path.abspath(directory).startswith(tmp_storage_dir):
+                continue
+
+            sub_dir = os.path.relpath(directory, self._output_dir)
+            if sub_dir == '.':
+                sub_dir = ''
+
+            maps = get_all_nifti_data(directory)
+            if not len(maps):
+                continue
+
+            self._write_volumes({map_name: maps[map_name][volume_indices[:, 0],
+                                                          volume_indices[:, 1],
+                                                          volume_indices[:, 2]] for map_name in maps},
+                                roi_indices, os.path.join(self._tmp_storage_dir, sub_dir))
+            self._subdirs.add(sub_dir)
+
+        self._write_volumes({'processed_voxels': np.ones(roi_indices.shape[0], dtype=np.bool)},
+                            roi_indices, self._processing_tmp_dir)
+
     def combine(self):
         super(FittingProcessor, self).combine()
         for subdir in self._subdirs:
@@ -467,13 +541,105 @@ class FittingProcessor(SimpleModelProcessor):
         return create_roi(get_all_nifti_data(self._output_dir), self._mask)
 
 
+class InMemoryFittingProcessor(ModelProcessor):
+
+    def __init__(self, optimizer, model, mask, existing_results=None, reuse_voxels=None, skip_voxels=None,
+                 bootstrap=None):
+        """The processing worker for model fitting without any disk access.
+
+        In contrast to the :class:`FittingProcessor`, this processor does not write temporary results or nifti files.
+        The results of each chunk are stored in arrays with one row per voxel in the ROI, which are allocated
+        on the first chunk. This is meant for interactive use, where only the resulting arrays are needed.
+
+        Since nothing is stored on disk, interrupted computations can not be resumed.
+
+        Args:
+            optimizer: the optimization routine to use
+            model: the composite model to fit
+            mask (ndarray or MaskIndex): the mask to use during processing
+            existing_results (dict): optional ROI results of an earlier fit, used for the voxels in ``reuse_voxels``
+            reuse_voxels (ndarray): optional boolean array with for every voxel in the mask if we reuse its results
+                from ``existing_results`` instead of fitting it.
+            skip_voxels (ndarray): optional boolean array with for every voxel in the mask if we should not fit it.
+                These voxels are zero in all output maps and are marked in the ``SkippedVoxels`` map.
+            bootstrap (mdt.bootstrap.ResidualBootstrap): if given, we compute the bootstrap maps of every fitted
+                voxel, returned as the nested ``bootstrap`` results.
+        """
+        super(InMemoryFittingProcessor, self).__init__()
+        self._optimizer = optimizer
+        self._model = model
+        self._bootstrap = bootstrap
+        self._mask = load_brain_mask(mask)
+        self._used_mask_name = 'UsedMask'
+        self._total_nmr_voxels = np.count_nonzero(self._mask)
+        self._results = {}
+        self._warm_start = None
+        compute = np.ones(self._total_nmr_voxels, dtype=np.bool)
+
+        if reuse_voxels is not None and np.any(reuse_voxels):
+            reused = np.where(reuse_voxels)[0]
+            self._store_results(_select_rows(existing_results, reused), reused, self._results)
+            compute &= np.logical_not(reuse_voxels)
+
+        if skip_voxels is not None:
+            self._results[SKIPPED_VOXELS_MAP_NAME] = np.array(skip_voxels, dtype=np.bool)
+            compute &= np.logical_not(skip_voxels)
+
+        self._voxels_to_compute = np.where(compute)[0]
+
+    def process(self, roi_indices, next_indices=None):
+        results = fit_roi_indices(self._model, self._optimizer, roi_indices, warm_start=self._warm_start,
+                                  bootstrap=self._bootstrap)
+        results.update({self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)})
+        self._store_results(results, roi_indices, self._results)
+
+    def get_voxels_to_compute(self):
+        return self._voxels_to_compute
+
+    def get_total_nmr_voxels(self):
+        return self._total_nmr_voxels
+
+    def get_mask(self):
+        return self._mask
+
+    def enable_warm_start(self):
+        self._warm_start = NeighbourWarmStart(self._mask)
+
+    def combine(self):
+        """Get the results as a dictionary of ROI arrays.
+
+        Nested results (for example from subdirectories) are returned as nested dictionaries.
+        """
+        return self._results
+
+    def finalize(self):
+        pass
+
+    def _store_results(self, results, roi_indices, storage):
+        """Store the results of one chunk in the preallocated ROI arrays.
+
+        Args:
+            results (dict): the results of one chunk, possibly nested
+            roi_indices (ndarray): the ROI indices of the computed voxels
+            storage (dict): the dictionary holding the ROI arrays, updated in place
+        """
+        for key, value in results.items():
+            if isinstance(value, collections.Mapping):
+                self._store_results(value, roi_indices, storage.setdefault(key, {}))
+            else:
+                value = np.asarray(value)
+                if key not in storage:
+                    storage[key] = np.zeros((self._total_nmr_voxels,) + value.shape[1:], dtype=value.dtype)
+                storage[key][roi_indices] = value
+
+
 class SamplingProcessor(SimpleModelProcessor):
 
     class SampleChainNotStored(object):
         pass
 
     def __init__(self, nmr_samples, thinning, burnin, model, mask, nifti_header, output_dir, tmp_storage_dir,
-                 recalculate, samples_storage_strategy=None):
+                 recalculate, samples_storage_strategy=None, skip_voxels=None):
         """The processing worker for model sampling.
 
         Args:
@@ -485,8 +651,11 @@ class SamplingProcessor(SimpleModelProcessor):
                     stored is ``nmr_samples``. If set to one or lower we store every sample after the burn in.
             sampler (AbstractSampler): the optimization sampler to use
             samples_storage_strategy (SamplesStorageStrategy): indicates which samples to store
+            skip_voxels (ndarray): optional boolean array with for every voxel in the mask if we should not sample it.
+                These voxels are zero in all output maps and are marked in the ``SkippedVoxels`` map.
         """
-        super(SamplingProcessor, self).__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
+        super(SamplingProcessor, self).__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate,
+                                                skip_voxels=skip_voxels)
         self._nmr_samples = nmr_samples
         self._thinning = thinning
         self._burnin = burnin
@@ -497,6 +666,9 @@ class SamplingProcessor(SimpleModelProcessor):
         self._logger = logging.getLogger(__name__)
         self._samples_output_stored = []
 
+        if skip_voxels is not None:
+            self._write_output_recursive({SKIPPED_VOXELS_MAP_NAME: skip_voxels}, np.arange(self._total_nmr_voxels))
+
     def _process(self, roi_indices, next_indices=None):
         model = self._model.build(roi_indices)
 
@@ -712,6 +884,181 @@ class SaveSpecificSamples(SamplesStorageStrategy):
         return self._sample_indices
 
 
+def fit_roi_indices(model, optimizer, roi_indices, warm_start=None, bootstrap=None):
+    """Optimize the given model on the given voxels.
+
+    This builds the model for the given ROI indices, optimizes it from the initial parameters and applies the
+    post-optimization processing. If a bootstrap is given, we add its maps as the nested ``bootstrap`` results.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model to optimize
+        optimizer: the optimization routine to use
+        roi_indices (ndarray): the ROI indices of the voxels to optimize
+        warm_start (NeighbourWarmStart): if given, used to replace the initial parameters by the results of
+            already computed spatial neighbours. The results of these voxels are added to it afterwards.
+        bootstrap (mdt.bootstrap.ResidualBootstrap): if given, used to compute the bootstrap maps of these voxels
+
+    Returns:
+        dict: the post-optimization output of the model, with one row per given voxel
+    """
+    build_model = model.build(roi_indices)
+
+    initial_parameters = build_model.get_initial_parameters()
+    if warm_start is not None:
+        initial_parameters = warm_start.get_starting_points(roi_indices, initial_parameters)
+
+    codec_model = ParameterTransformedModel(build_model, model.get_parameter_codec())
+    starting_positions = codec_model.encode_parameters(initial_parameters)
+
+    optimization_results = optimizer.minimize(codec_model, starting_positions)
+    results = codec_model.get_post_optimization_output(optimization_results)
+
+    if bootstrap is not None:
+        results[BOOTSTRAP_MAPS_DIR] = bootstrap.compute(model, optimizer, roi_indices,
+                                                        optimization_results.get_optimization_result())
+
+    if warm_start is not None:
+        warm_start.add_results(roi_indices, np.column_stack([np.reshape(results[name], (-1,))
+                                                             for name in build_model.get_free_param_names()]))
+    return results
+
+
+class NeighbourWarmStart(object):
+
+    _neighbour_offsets = np.array([[-1, 0, 0], [1, 0, 0], [0, -1, 0], [0, 1, 0], [0, 0, -1], [0, 0, 1]])
+
+    def __init__(self, mask):
+        """Provides starting points for optimization from the results of already optimized neighbouring voxels.
+
+        For every voxel we look in its six connected neighbourhood for a voxel that has already been optimized and
+        use the optimized parameters of the first neighbour found as starting point. Voxels without an optimized
+        neighbour keep their initial parameters.
+
+        Args:
+            mask (ndarray): the three dimensional mask, the ROI indices index the voxels in this mask
+        """
+        mask_index = MaskIndex(BoundingBox.from_mask(mask).crop(load_brain_mask(mask)))
+        self._mask = mask_index.mask
+        self._positions = mask_index.positions
+        self._roi_lookup = mask_index.index_matrix
+        self._computed = np.zeros(self._positions.shape[0], dtype=np.bool)
+        self._parameters = None
+
+    def get_starting_points(self, roi_indices, initial_parameters):
+        """Get the starting points for the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels we are about to optimize
+            initial_parameters (ndarray): the default initial parameters for these voxels, (v, p) array
+
+        Returns:
+            ndarray: the starting points for these voxels, with the parameters of an optimized neighbour for all
+                voxels which have one.
+        """
+        if self._parameters is None:
+            return initial_parameters
+
+        starting_points = np.array(initial_parameters, copy=True)
+        positions = self._positions[roi_indices]
+        found = np.zeros(len(roi_indices), dtype=np.bool)
+
+        for offset in self._neighbour_offsets:
+            neighbours = positions + offset
+            candidates = ~found & np.all((neighbours >= 0) & (neighbours < self._mask.shape), axis=1)
+
+            neighbour_indices = self._roi_lookup[tuple(neighbours[candidates].T)]
+            usable = neighbour_indices >= 0
+            usable[usable] = self._computed[neighbour_indices[usable]]
+
+            voxels = np.where(candidates)[0][usable]
+            starting_points[voxels] = self._parameters[neighbour_indices[usable]]
+            found[voxels] = True
+
+        return starting_points
+
+    def add_results(self, roi_indices, parameters):
+        """Add the optimized parameters of the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the optimized voxels
+            parameters (ndarray): the optimized parameters, (v, p) array
+        """
+        if self._parameters is None:
+            self._parameters = np.zeros((self._positions.shape[0], parameters.shape[1]), dtype=parameters.dtype)
+        self._parameters[roi_indices] = parameters
+        self._computed[roi_indices] = True
+
+
+def get_voxel_ordering(voxel_ordering):
+    """Get the voxel ordering for the given name.
+
+    Args:
+        voxel_ordering (str or VoxelOrdering): the name of the ordering, one of 'roi', 'slices' or 'morton'. If a
+            voxel ordering is given, it is returned as is.
+
+    Returns:
+        VoxelOrdering: the voxel ordering object
+    """
+    if isinstance(voxel_ordering, VoxelOrdering):
+        return voxel_ordering
+
+    orderings = {'roi': ROIOrdering, 'slices': SliceOrdering, 'morton': MortonOrdering}
+    if voxel_ordering not in orderings:
+        raise ValueError('The voxel ordering "{}" is not supported, choose from {}.'.format(
+            voxel_ordering, sorted(orderings)))
+    return orderings[voxel_ordering]()
+
+
+class VoxelOrdering(object):
+    """Determines the order in which the voxels are processed."""
+
+    def order(self, roi_indices, mask):
+        """Order the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels to order
+            mask (ndarray): the three dimensional mask, the ROI indices index the voxels in this mask
+
+        Returns:
+            ndarray: the same ROI indices, in the order in which they should be processed
+        """
+        raise NotImplementedError()
+
+
+class ROIOrdering(VoxelOrdering):
+    """Process the voxels in the order of the ROI, that is, in the C-order of the volume."""
+
+    def order(self, roi_indices, mask):
+        return roi_indices
+
+
+class SliceOrdering(VoxelOrdering):
+    """Process the voxels slice by slice, over the last spatial axis."""
+
+    def order(self, roi_indices, mask):
+        positions = np.argwhere(mask)[roi_indices]
+        return roi_indices[np.lexsort((positions[:, 0], positions[:, 1], positions[:, 2]))]
+
+
+class MortonOrdering(VoxelOrdering):
+    """Process the voxels following a Z-order (Morton) space filling curve.
+
+    This keeps voxels which are close to each other in space also close together in the processing order, in all
+    three dimensions.
+    """
+
+    def order(self, roi_indices, mask):
+        positions = np.argwhere(mask)[roi_indices].astype(np.uint64)
+        nmr_bits = int(np.max(mask.shape[:3]) - 1).bit_length()
+
+        codes = np.zeros(len(roi_indices), dtype=np.uint64)
+        for bit in range(nmr_bits):
+            for axis in range(3):
+                codes |= ((positions[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + axis)
+
+        return roi_indices[np.argsort(codes, kind='mergesort')]
+
+
 def get_full_tmp_results_path(output_dir, tmp_dir):
     """Get a temporary results path for processing.
 
@@ -731,14 +1078,21 @@ def get_full_tmp_results_path(output_dir, tmp_dir):
     return os.path.join(tmp_dir, hashlib.md5(output_dir.encode('utf-8')).hexdigest())
 
 
-def _combine_volumes_write_out(info_pair):
-    """Write out the given information to a nifti volume.
+def _select_rows(results, roi_indices):
+    """Select the given voxels from the (nested) dictionary of ROI results.
 
-    Needs to be used by ModelProcessor._combine_volumes
-    """
-    map_name, info_list = info_pair
-    chunks_dir, output_dir, nifti_header, write_gzipped = info_list
+    Args:
+        results (dict): the ROI results, possibly nested
+        roi_indices (ndarray): the ROI indices of the voxels to select
 
-    data = np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r')
-    write_all_as_nifti({map_name: data}, output_dir, nifti_header=nifti_header, gzip=write_gzipped)
+    Returns:
+        dict: the same (nested) dictionary with only the rows of the given voxels
+    """
+    selected = {}
+    for key, value in results.items():
+        if isinstance(value, collections.Mapping):
+            selected[key] = _select_rows(value, roi_indices)
+        else:
+            selected[key] = np.asarray(value)[roi_indices]
+    return selected
 
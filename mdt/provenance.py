@@ -0,0 +1,418 @@
+"""Provenance tracking of model fitting results.
+
+Every model fit stores a provenance file next to its output maps. This file holds digests of everything that
+determines the results of that fit: the input data (DWI, mask, protocol, protocol maps, gradient deviations and noise
+std), the model definition and its current parameter initialization, fixation and bounds, the optimizer configuration,
+the floating point precision and the MDT version.
+
+When results are requested again without explicit recalculation, the stored provenance is compared to the provenance of
+the new request. If nothing changed the existing results are reused, else the model is recomputed. Since the
+initialization of a model in a cascade depends on the results of the previous models, a change in one cascade stage
+automatically invalidates all the stages after it, while the stages before it are reused.
+
+Next to the provenance we store a fingerprint per voxel of all the voxel dependent inputs of the fit (signal, protocol
+maps, gradient deviations, noise std and the parameter initialization, fixation and bounds). When only these voxel
+dependent inputs or the mask changed, an incremental fit can reuse the results of all voxels with an unchanged
+fingerprint and only refit the new or changed voxels.
+"""
+import hashlib
+import json
+import logging
+import numbers
+import os
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import six
+
+from mdt.__version__ import __version__
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-16'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+PROVENANCE_FILENAME = 'provenance.json'
+VOXEL_FINGERPRINTS_FILENAME = 'voxel_fingerprints.npz'
+
+#: the provenance components that need to be equal for results to be reusable in an incremental fit, all other
+#: components are voxel dependent and are covered by the voxel fingerprints.
+INCREMENTAL_COMPONENTS = ('mdt_version', 'protocol', 'model_definition', 'optimizer', 'double_precision',
+                          'refinement', 'precision_refinement', 'voxel_triage', 'bootstrap')
+
+_FINGERPRINT_MULTIPLIER = np.uint64(0x100000001B3)
+_FINGERPRINT_NONE = np.uint64(0x9E3779B97F4A7C15)
+
+_input_data_digests = weakref.WeakKeyDictionary()
+
+
+def get_fit_provenance(model, input_data, optimizer, double_precision=False, refinement=None,
+                       precision_refinement=None, voxel_triage=None, bootstrap=None):
+    """Get the provenance of fitting the given model with the given input data and optimizer.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model, with its initialization
+            and fixations applied.
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data used for the fit
+        optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): the optimization routine
+        double_precision (boolean): if the computations are done in double precision
+        refinement (:class:`~mdt.refinement.VoxelRefinement`): the refinement of poorly converged voxels, if enabled
+        precision_refinement (:class:`~mdt.refinement.VoxelRefinement`): the refinement in double precision of mixed
+            precision fitting, if enabled
+        voxel_triage (:class:`~mdt.voxel_triage.VoxelTriage`): the triage of degenerate voxels, if enabled
+        bootstrap (:class:`~mdt.bootstrap.ResidualBootstrap`): the residual bootstrap, if enabled
+
+    Returns:
+        dict: with the element ``hash``, the combined digest, and ``components``, the digests of the separate parts.
+    """
+    components = OrderedDict()
+    components['mdt_version'] = __version__
+    components.update(get_input_data_digests(input_data))
+    components.update(get_model_digests(model))
+    components['optimizer'] = get_optimizer_digest(optimizer)
+    components['double_precision'] = bool(double_precision)
+    if refinement is not None:
+        components['refinement'] = _digest_value({'criteria': refinement.get_criteria(),
+                                                  'optimizer': _optimizer_description(refinement.optimizer)})
+    if precision_refinement is not None:
+        components['precision_refinement'] = _digest_value(
+            {'criteria': precision_refinement.get_criteria(),
+             'optimizer': _optimizer_description(precision_refinement.optimizer)})
+    if voxel_triage is not None:
+        components['voxel_triage'] = _digest_value(voxel_triage.get_criteria())
+    if bootstrap is not None:
+        components['bootstrap'] = _digest_value(bootstrap.get_settings())
+
+    return {'hash': _digest(json.dumps(components, sort_keys=True).encode('utf-8')),
+            'components': components}
+
+
+def get_input_data_digests(input_data):
+    """Get the digests of the separate parts of the given input data.
+
+    The digests are cached per input data object, such that the (potentially large) DWI volume is only read once when
+    fitting multiple models on the same data. The DWI digest covers the signal of the voxels in the mask, the signal
+    outside of the mask does not influence the fit.
+
+    Args:
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data to digest
+
+    Returns:
+        dict: digests for the elements ``dwi``, ``mask``, ``protocol``, ``protocol_maps``, ``gradient_deviations``
+            and ``noise_std``.
+    """
+    if input_data in _input_data_digests:
+        return dict(_input_data_digests[input_data])
+
+    digests = {
+        'dwi': _digest_value(input_data.observations),
+        'mask': _digest_value(input_data.mask),
+        'protocol': get_protocol_digest(input_data.protocol),
+        'protocol_maps': _digest_value(input_data.protocol_maps),
+        'gradient_deviations': _digest_value(input_data.gradient_deviations),
+        'noise_std': _digest_value(input_data.noise_std)
+    }
+
+    _input_data_digests[input_data] = digests
+    return dict(digests)
+
+
+def get_protocol_digest(protocol):
+    """Get a digest of the columns of the given protocol.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol to digest
+
+    Returns:
+        str: the digest of the protocol
+    """
+    return _digest_value({name: protocol.get_column(name) for name in protocol.column_names})
+
+
+def get_model_digests(model):
+    """Get the digests of the definition and of the current parameter state of the given model.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model to digest
+
+    Returns:
+        dict: with the digests ``model_definition`` and ``model_parameters``
+    """
+    provenance_data = model.get_provenance_data()
+    return {'model_definition': _digest_value([provenance_data['definition'], provenance_data['post_processing'],
+                                               provenance_data['post_processing_settings']]),
+            'model_parameters': _digest_value(provenance_data['parameters'])}
+
+
+def get_optimizer_digest(optimizer):
+    """Get a digest of the type and the settings of the given optimizer.
+
+    Args:
+        optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): the optimizer to digest
+
+    Returns:
+        str: the digest of the optimizer
+    """
+    return _digest_value(_optimizer_description(optimizer))
+
+
+def write_provenance(output_path, provenance):
+    """Write the provenance information to the given model output directory.
+
+    Args:
+        output_path (str): the directory with the model output maps
+        provenance (dict): the provenance as returned by :func:`get_fit_provenance`
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    with open(os.path.join(output_path, PROVENANCE_FILENAME), 'w') as f:
+        json.dump(provenance, f, sort_keys=True, indent=4)
+
+
+def load_provenance(output_path):
+    """Load the provenance information from the given model output directory.
+
+    Args:
+        output_path (str): the directory with the model output maps
+
+    Returns:
+        dict or None: the stored provenance, or None if no (valid) provenance is stored.
+    """
+    path = os.path.join(output_path, PROVENANCE_FILENAME)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logging.getLogger(__name__).warning('Could not read the provenance file {}.'.format(path))
+        return None
+
+
+def get_provenance_changes(output_path, provenance):
+    """Compare the stored provenance of a model output with a new provenance.
+
+    Args:
+        output_path (str): the directory with the model output maps
+        provenance (dict): the new provenance, as returned by :func:`get_fit_provenance`
+
+    Returns:
+        list or None: the names of the components that changed (empty if nothing changed), or None if there is no
+            provenance stored with the output.
+    """
+    stored = load_provenance(output_path)
+    if stored is None:
+        return None
+
+    if stored.get('hash') == provenance['hash']:
+        return []
+
+    stored_components = stored.get('components', {})
+    return sorted(key for key, value in provenance['components'].items() if stored_components.get(key) != value)
+
+
+def get_voxel_fingerprints(model, input_data):
+    """Get a fingerprint per voxel of all the voxel dependent inputs of fitting the given model.
+
+    The fingerprints cover the signal, the protocol maps, the gradient deviations, the noise std and the
+    initialization, fixation and bounds of every free parameter. Inputs that are the same for all voxels are
+    included as well, such that changing those changes the fingerprint of every voxel.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model, with its initialization
+            and fixations applied.
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data used for the fit
+
+    Returns:
+        ndarray: an uint64 array with one fingerprint per voxel in the mask
+    """
+    nmr_voxels = np.count_nonzero(input_data.mask)
+
+    values = [input_data.observations]
+    protocol_maps = input_data.protocol_maps or {}
+    values.extend(protocol_maps[key] for key in sorted(protocol_maps))
+    values.append(input_data.gradient_deviations)
+    values.append(input_data.noise_std)
+
+    parameters = model.get_provenance_data()['parameters']
+    for param_name in sorted(parameters):
+        values.extend(parameters[param_name][key] for key in ('fixed', 'value', 'lower_bound', 'upper_bound'))
+
+    fingerprints = np.zeros(nmr_voxels, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for value in values:
+            words = _fingerprint_words(value, input_data.mask, nmr_voxels)
+            for ind in range(words.shape[1]):
+                fingerprints = fingerprints * _FINGERPRINT_MULTIPLIER + words[:, ind]
+            fingerprints = fingerprints * _FINGERPRINT_MULTIPLIER + np.uint64(words.shape[1])
+    return fingerprints
+
+
+def write_voxel_fingerprints(output_path, fingerprints, mask):
+    """Write the voxel fingerprints to the given model output directory.
+
+    Args:
+        output_path (str): the directory with the model output maps
+        fingerprints (ndarray): the fingerprint per voxel in the mask, as returned by :func:`get_voxel_fingerprints`
+        mask (ndarray): the mask used during fitting
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    np.savez(os.path.join(output_path, VOXEL_FINGERPRINTS_FILENAME),
+             mask=np.asarray(mask, dtype=np.bool), fingerprints=fingerprints)
+
+
+def load_voxel_fingerprints(output_path):
+    """Load the voxel fingerprints from the given model output directory.
+
+    Args:
+        output_path (str): the directory with the model output maps
+
+    Returns:
+        tuple or None: the mask and the fingerprints per voxel in that mask, or None if nothing is stored.
+    """
+    path = os.path.join(output_path, VOXEL_FINGERPRINTS_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        return data['mask'], data['fingerprints']
+
+
+def get_reusable_voxels(output_path, provenance, fingerprints, mask):
+    """Get the voxels for which the existing results in the given output directory can be reused.
+
+    This requires the stored provenance to match the new provenance in all of the :data:`INCREMENTAL_COMPONENTS`.
+    Of the voxels in the new mask, we can then reuse the results of all the voxels that were in the previous mask
+    and whose fingerprint did not change.
+
+    Args:
+        output_path (str): the directory with the model output maps
+        provenance (dict): the new provenance, as returned by :func:`get_fit_provenance`
+        fingerprints (ndarray): the new voxel fingerprints, as returned by :func:`get_voxel_fingerprints`
+        mask (ndarray): the new mask
+
+    Returns:
+        ndarray or None: a boolean array with, for every voxel in the new mask, if its results can be reused.
+            None if the existing results can not be used for an incremental fit.
+    """
+    stored = load_provenance(output_path)
+    stored_fingerprints = load_voxel_fingerprints(output_path)
+    if stored is None or stored_fingerprints is None:
+        return None
+
+    stored_components = stored.get('components', {})
+    if any(stored_components.get(key) != provenance['components'].get(key) for key in INCREMENTAL_COMPONENTS):
+        return None
+
+    previous_mask, previous_fingerprints = stored_fingerprints
+    if previous_mask.shape != mask.shape[:3]:
+        return None
+
+    previous_volume = np.zeros(previous_mask.shape, dtype=np.uint64)
+    previous_volume[previous_mask] = previous_fingerprints
+
+    mask = np.asarray(mask, dtype=np.bool)
+    return previous_mask[mask] & (previous_volume[mask] == fingerprints)
+
+
+def _fingerprint_words(value, mask, nmr_voxels):
+    """Get a two dimensional matrix of uint64 words (one row per voxel) representing the given value.
+
+    Arrays with a value per voxel in the ROI or in the volume are converted per voxel, all other values are
+    digested and broadcasted to all voxels.
+    """
+    if value is None:
+        return np.full((nmr_voxels, 1), _FINGERPRINT_NONE, dtype=np.uint64)
+
+    if isinstance(value, np.ndarray) and value.ndim:
+        if value.ndim >= 3 and value.shape[:3] == mask.shape[:3]:
+            value = value[np.asarray(mask, dtype=np.bool)]
+        if value.shape[0] == nmr_voxels:
+            value = np.ascontiguousarray(np.reshape(value, (nmr_voxels, -1)), dtype=np.float64)
+            return value.view(np.uint64)
+
+    word = np.uint64(int(_digest_value(value)[:16], 16))
+    return np.full((nmr_voxels, 1), word, dtype=np.uint64)
+
+
+def _optimizer_description(optimizer):
+    """Get a JSON serializable description of the given optimizer.
+
+    Nested optimizers (of for example the ``MultiStepOptimizer`` and ``RandomRestart``) are described recursively.
+    """
+    settings = getattr(optimizer, 'optimizer_settings', None) or {}
+
+    def describe(value):
+        if hasattr(value, 'minimize'):
+            return _optimizer_description(value)
+        if isinstance(value, (list, tuple)):
+            return [describe(el) for el in value]
+        if isinstance(value, dict):
+            return {str(k): describe(v) for k, v in value.items()}
+        if value is None or isinstance(value, (bool, numbers.Number, six.string_types)):
+            return value
+        return '{}.{}'.format(type(value).__module__, type(value).__name__)
+
+    description = {'type': '{}.{}'.format(type(optimizer).__module__, type(optimizer).__name__),
+                   'settings': describe(settings)}
+
+    for attribute in ('optimizers', '_optimizer'):
+        if getattr(optimizer, attribute, None) is not None:
+            description[attribute.lstrip('_')] = describe(getattr(optimizer, attribute))
+
+    generator = getattr(optimizer, '_starting_point_generator', None)
+    if generator is not None:
+        description['starting_point_generator'] = {
+            'type': '{}.{}'.format(type(generator).__module__, type(generator).__name__),
+            'settings': describe({k: v for k, v in vars(generator).items() if not k.startswith('_')})}
+    return description
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _digest_value(value):
+    """Compute a digest of the given value.
+
+    This supports (nested) dictionaries, lists and tuples of numbers, strings and arrays. Arrays are hashed on their
+    content, shape and dtype. Objects with an ``assignment_code`` (parameter dependencies) are hashed on that code,
+    other objects only on their type.
+    """
+    hasher = hashlib.sha1()
+    _update_hasher(hasher, value)
+    return hasher.hexdigest()
+
+
+def _update_hasher(hasher, value):
+    if value is None:
+        hasher.update(b'None')
+    elif isinstance(value, np.ndarray):
+        hasher.update('ndarray{}{}'.format(value.shape, value.dtype.str).encode('utf-8'))
+        if value.ndim:
+            for ind in range(value.shape[0]):
+                hasher.update(np.ascontiguousarray(value[ind]).tobytes())
+        else:
+            hasher.update(value.tobytes())
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for key in sorted(value.keys(), key=str):
+            _update_hasher(hasher, str(key))
+            _update_hasher(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update('sequence{}'.format(len(value)).encode('utf-8'))
+        for el in value:
+            _update_hasher(hasher, el)
+    elif isinstance(value, six.string_types):
+        hasher.update(b'str' + value.encode('utf-8'))
+    elif isinstance(value, (bool, numbers.Number, np.generic)):
+        hasher.update('{}{!r}'.format(type(value).__name__, value).encode('utf-8'))
+    elif hasattr(value, 'assignment_code'):
+        hasher.update(b'assignment' + value.assignment_code.encode('utf-8'))
+    else:
+        hasher.update('{}.{}'.format(type(value).__module__, type(value).__name__).encode('utf-8'))
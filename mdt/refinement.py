@@ -0,0 +1,251 @@
+"""Adaptive refinement of poorly converged voxels.
+
+A single optimizer configuration is applied uniformly to all voxels, while most voxels converge fine with a cheap
+optimizer and only a small fraction needs a more expensive routine (for example more patience or random restarts).
+With refinement enabled, a model is first fitted with the regular optimizer, after which the poorly converged voxels
+are selected and only those are optimized again with the (more expensive) refinement optimizer, starting from their
+first pass results. The refined results are merged with the first pass results of the other voxels.
+
+Voxels are selected for refinement using one or more of the following criteria:
+
+* ``return_codes``: the optimizer reported a failure, was trapped or exhausted its patience
+  (see :data:`FAILED_RETURN_CODES`)
+* ``max_relative_residual``: the norm of the residual relative to the norm of the signal is larger than this value
+* ``log_likelihood_outliers``: the log-likelihood is lower than the median log-likelihood of the neighbouring voxels
+  by more than this number of (robust) standard deviations
+* ``max_relative_gradient``: the gradient of the log-likelihood at the optimum, relative to the log-likelihood,
+  is larger than this value (see :func:`get_relative_gradients`)
+
+Refinement is configured in the ``optimization`` section of the configuration, under ``refinement``.
+
+The same mechanism is used for mixed precision fitting, configured under ``mixed_precision``. With mixed precision,
+a model is optimized in single precision, after which the voxels with a failed return code or a suspicious gradient
+are optimized again in double precision, starting from their single precision results. Since most voxels converge
+fine in single precision, this gives nearly the accuracy of double precision at nearly the cost of single precision.
+"""
+import numpy as np
+
+from mdt.cl_routines.mapping.calculate_model_estimates import CalculateModelEstimates
+from mdt.model_building.utils import ParameterTransformedModel
+from mdt.utils import BoundingBox, MaskIndex, load_brain_mask
+from mot.cl_runtime_info import CLRuntimeInfo
+from mot.cl_routines.optimizing.base import return_code_labels
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+FAILED_RETURN_CODES = tuple(code for code, (label, _) in sorted(return_code_labels.items())
+                            if label in ('trapped', 'exhausted', 'failed', 'NaN'))
+"""The optimizer return codes indicating a voxel did not converge."""
+
+_NEIGHBOUR_OFFSETS = np.array([[-1, 0, 0], [1, 0, 0], [0, -1, 0], [0, 1, 0], [0, 0, -1], [0, 0, 1]])
+
+
+class VoxelRefinement(object):
+
+    def __init__(self, optimizer, return_codes=True, max_relative_residual=None, log_likelihood_outliers=None,
+                 max_relative_gradient=None, double_precision=False, batch_size=10000):
+        """Selects the poorly converged voxels of a first optimization pass and holds the optimizer to refine them.
+
+        Args:
+            optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): the optimizer for the refinement
+            return_codes (boolean): if we refine the voxels with a failed return code
+            max_relative_residual (float): if set, we refine the voxels whose residual norm relative to the
+                signal norm is larger than this value
+            log_likelihood_outliers (float): if set, we refine the voxels whose log-likelihood is this many robust
+                standard deviations below the median log-likelihood of their neighbours
+            max_relative_gradient (float): if set, we refine the voxels whose relative gradient of the log-likelihood
+                is larger than this value, see :func:`get_relative_gradients`
+            double_precision (boolean): if the refinement optimizer runs in double precision. The gradients are then
+                also computed in double precision.
+            batch_size (int): the number of voxels for which we compute the residuals or gradients at once
+        """
+        self.optimizer = optimizer
+        self.return_codes = return_codes
+        self.max_relative_residual = max_relative_residual
+        self.log_likelihood_outliers = log_likelihood_outliers
+        self.max_relative_gradient = max_relative_gradient
+        self.double_precision = double_precision
+        self.batch_size = batch_size
+
+    def get_criteria(self):
+        """Get the criteria used for selecting the voxels to refine.
+
+        Returns:
+            dict: the criteria settings, used for the provenance of the results
+        """
+        return {'return_codes': self.return_codes,
+                'max_relative_residual': self.max_relative_residual,
+                'log_likelihood_outliers': self.log_likelihood_outliers,
+                'max_relative_gradient': self.max_relative_gradient,
+                'double_precision': self.double_precision}
+
+    def get_voxels_to_refine(self, model, results, skip_voxels=None):
+        """Get the voxels which should be refined.
+
+        Args:
+            model (mdt.models.composite.DMRICompositeModel): the fitted model, with its input data set
+            results (dict): the ROI results of the first pass
+            skip_voxels (ndarray): optional boolean array with the voxels that were not fitted (see
+                :mod:`mdt.voxel_triage`). These are never refined and are not used as neighbours.
+
+        Returns:
+            ndarray: a boolean array with for every voxel in the ROI if we should refine it
+        """
+        input_data = model.get_input_data()
+        refine = np.zeros(input_data.nmr_problems, dtype=np.bool)
+
+        if self.return_codes and 'ReturnCodes' in results:
+            refine |= np.in1d(np.reshape(results['ReturnCodes'], (-1,)), FAILED_RETURN_CODES)
+
+        if self.max_relative_residual is not None:
+            refine |= get_relative_residuals(model, results, batch_size=self.batch_size) > self.max_relative_residual
+
+        if self.log_likelihood_outliers is not None and 'LogLikelihood' in results:
+            log_likelihoods = np.array(np.reshape(results['LogLikelihood'], (-1,)), dtype=np.float64)
+            if skip_voxels is not None:
+                log_likelihoods[skip_voxels] = np.nan
+            refine |= get_neighbourhood_outliers(log_likelihoods, input_data.mask, self.log_likelihood_outliers)
+
+        if self.max_relative_gradient is not None:
+            voxels = np.where(np.logical_not(refine | (skip_voxels if skip_voxels is not None else False)))[0]
+            if len(voxels):
+                gradients = get_relative_gradients(model, results, voxels=voxels, batch_size=self.batch_size,
+                                                   double_precision=self.double_precision)
+                refine[voxels] |= gradients > self.max_relative_gradient
+
+        if skip_voxels is not None:
+            refine &= np.logical_not(skip_voxels)
+        return refine
+
+
+def get_relative_residuals(model, results, batch_size=10000):
+    """Get the norm of the residuals relative to the norm of the observations, per voxel.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the fitted model, with its input data set
+        results (dict): the ROI results of the fit, needs to contain all the free parameters of the model
+        batch_size (int): the number of voxels for which we compute the model estimates at once
+
+    Returns:
+        ndarray: the relative residual norm per voxel in the ROI
+    """
+    observations = model.get_input_data().observations
+    parameters = model.param_dict_to_array(results)
+
+    relative_residuals = np.zeros(observations.shape[0])
+    for start in range(0, observations.shape[0], batch_size):
+        roi_indices = np.arange(start, min(start + batch_size, observations.shape[0]))
+        residuals = CalculateModelEstimates().calculate_residuals(model.build(roi_indices), parameters[roi_indices])
+
+        signal_norm = np.linalg.norm(observations[roi_indices], axis=1)
+        residual_norm = np.linalg.norm(residuals, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative_residuals[roi_indices] = np.where(signal_norm > 0, residual_norm / signal_norm, 0)
+    return relative_residuals
+
+
+def get_relative_gradients(model, results, voxels=None, step=1e-4, batch_size=10000, double_precision=True):
+    """Get the largest gradient of the log-likelihood, relative to the log-likelihood, per voxel.
+
+    The gradients are computed with central differences in the optimization space of the model (after applying the
+    parameter codec), with a step relative to the magnitude of every parameter. Per voxel we return::
+
+        max_i |LL(x + h_i e_i) - LL(x - h_i e_i)| / (2 * step * max(|LL(x)|, 1))
+
+        with h_i = step * max(|x_i|, 1)
+
+    which is the relative change of the log-likelihood for a relative change of the parameters. At a well converged
+    optimum this is close to zero, while voxels stopped early by the limited precision of single precision floats
+    typically have a clearly larger value.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the fitted model, with its input data set
+        results (dict): the ROI results of the fit, needs to contain all the free parameters of the model
+        voxels (ndarray): the ROI indices of the voxels for which we compute the gradients, defaults to all voxels
+        step (float): the relative step size of the central differences
+        batch_size (int): the number of voxels for which we compute the gradients at once
+        double_precision (boolean): if we evaluate the log-likelihoods in double precision
+
+    Returns:
+        ndarray: the relative gradient per given voxel
+    """
+    parameters = model.param_dict_to_array(results)
+    if voxels is None:
+        voxels = np.arange(parameters.shape[0])
+    nmr_params = parameters.shape[1]
+    nmr_evaluations = 2 * nmr_params + 1
+
+    calculator = CalculateModelEstimates(cl_runtime_info=CLRuntimeInfo(double_precision=double_precision))
+
+    relative_gradients = np.zeros(len(voxels))
+    for start in range(0, len(voxels), batch_size):
+        roi_indices = voxels[start:start + batch_size]
+        nmr_voxels = len(roi_indices)
+
+        codec_model = ParameterTransformedModel(model.build(np.tile(roi_indices, nmr_evaluations)),
+                                                model.get_parameter_codec())
+        encoded = np.array(codec_model.encode_parameters(parameters[roi_indices]), dtype=np.float64)
+        steps = step * np.maximum(np.abs(encoded), 1)
+
+        points = np.tile(encoded, (nmr_evaluations, 1))
+        for ind in range(nmr_params):
+            points[2 * ind * nmr_voxels:(2 * ind + 1) * nmr_voxels, ind] += steps[:, ind]
+            points[(2 * ind + 1) * nmr_voxels:(2 * ind + 2) * nmr_voxels, ind] -= steps[:, ind]
+
+        log_likelihoods = np.sum(calculator.calculate_log_likelihoods(codec_model, points), axis=1, dtype=np.float64)
+        log_likelihoods = np.reshape(log_likelihoods, (nmr_evaluations, nmr_voxels))
+
+        differences = np.abs(log_likelihoods[0:-1:2] - log_likelihoods[1:-1:2])
+        with np.errstate(invalid='ignore'):
+            gradients = np.max(differences, axis=0) / (2 * step * np.maximum(np.abs(log_likelihoods[-1]), 1))
+        relative_gradients[start:start + nmr_voxels] = np.where(np.isfinite(gradients), gradients, np.inf)
+    return relative_gradients
+
+
+def get_neighbourhood_outliers(values, mask, nmr_deviations):
+    """Find the voxels whose value is much lower than the median value of their neighbours.
+
+    For every voxel we compute the difference to the median of its six connected neighbours in the mask. Voxels
+    whose difference is lower than ``-nmr_deviations`` times the robust standard deviation (1.4826 times the median
+    absolute deviation) of all these differences are reported as outliers. Voxels without neighbours are never
+    outliers.
+
+    Args:
+        values (ndarray): the value per voxel in the ROI
+        mask (ndarray): the three dimensional mask defining the ROI
+        nmr_deviations (float): the number of robust standard deviations a voxel needs to be below its neighbours
+
+    Returns:
+        ndarray: a boolean array with for every voxel in the ROI if it is an outlier
+    """
+    mask_index = MaskIndex(BoundingBox.from_mask(mask).crop(load_brain_mask(mask)))
+    mask = mask_index.mask
+    positions = mask_index.positions
+    roi_lookup = mask_index.index_matrix
+
+    neighbour_values = np.full((positions.shape[0], len(_NEIGHBOUR_OFFSETS)), np.nan)
+    for ind, offset in enumerate(_NEIGHBOUR_OFFSETS):
+        neighbours = positions + offset
+        inside = np.where(np.all((neighbours >= 0) & (neighbours < mask.shape), axis=1))[0]
+
+        neighbour_indices = roi_lookup[tuple(neighbours[inside].T)]
+        in_mask = neighbour_indices >= 0
+        neighbour_values[inside[in_mask], ind] = values[neighbour_indices[in_mask]]
+
+    outliers = np.zeros(positions.shape[0], dtype=np.bool)
+
+    has_neighbours = np.any(np.isfinite(neighbour_values), axis=1) & np.isfinite(values)
+    if not np.any(has_neighbours):
+        return outliers
+
+    differences = values[has_neighbours] - np.nanmedian(neighbour_values[has_neighbours], axis=1)
+    robust_std = 1.4826 * np.median(np.abs(differences - np.median(differences)))
+    if robust_std > 0:
+        outliers[has_neighbours] = differences < -nmr_deviations * robust_std
+    return outliers
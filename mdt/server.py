@@ -0,0 +1,528 @@
+"""A long running fitting service that keeps MDT and the OpenCL devices loaded between jobs.
+
+Every call to ``mdt-model-fit`` starts a new Python process, which re-imports MDT and its dependencies, loads the
+components and rediscovers the OpenCL devices. For pipelines that submit many small fits (single slices, QC subsets)
+this overhead dominates the total run time. This module offers a daemon, :class:`FittingServer`, that listens on a
+local Unix socket and executes fit and sample jobs inside a single long running process. The imports are done once and
+the CL environments are created once and reused for every job, such that the CL contexts stay alive for the lifetime
+of the server.
+
+Please note that the OpenCL programs are still built per routine call, as in a regular fit, the server only saves the
+start-up costs of the process.
+
+Jobs are queued per client and served round-robin over the clients, such that a single client submitting many jobs
+can not starve the others. During a job the log messages of MDT and MOT are streamed back to the submitting client.
+
+Communication uses newline delimited JSON. Use :class:`ServerClient` to talk to the server from Python, or the
+command line tools ``mdt-serve`` and ``mdt-serve-submit``.
+
+Example usage::
+
+    client = ServerClient()
+    info = client.fit_model('BallStick_r1 (Cascade)', 'dwi.nii.gz', 'dwi.prtcl', 'mask.nii.gz', 'output')
+"""
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+from six.moves import queue, socketserver
+
+from mdt.configuration import get_config_dir
+from mdt.exceptions import ServerJobError
+from mdt.log_handlers import LogDispatchHandler, LogListenerInterface
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-14'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_default_socket_path():
+    """Get the default location of the Unix socket of the fitting server.
+
+    Returns:
+        str: the path to the socket file in the MDT configuration directory
+    """
+    return os.path.join(get_config_dir(), 'mdt-serve.sock')
+
+
+class FittingServer(object):
+
+    def __init__(self, socket_path=None, cl_device_ind=None, double_precision=False):
+        """Daemon that executes fit and sample jobs submitted over a local Unix socket.
+
+        Args:
+            socket_path (str): the path of the Unix socket to listen on, defaults to
+                :func:`get_default_socket_path`.
+            cl_device_ind (int or list): the indices of the CL devices to use by default for all jobs. Jobs may
+                select a subset of devices using their own ``cl_device_ind`` setting.
+            double_precision (boolean): the default precision for the jobs, can be overwritten per job.
+        """
+        self._socket_path = socket_path or get_default_socket_path()
+        self._double_precision = double_precision
+        self._logger = logging.getLogger(__name__)
+
+        self._cl_devices = None
+        self._cl_device_ind = cl_device_ind
+        if self._cl_device_ind is not None and not isinstance(self._cl_device_ind, collections.Iterable):
+            self._cl_device_ind = [self._cl_device_ind]
+
+        self._job_queue = _FairJobQueue()
+        self._current_job = None
+        self._job_counter = 0
+        self._lock = threading.Lock()
+
+        self._server = None
+        self._worker = None
+        self._log_listener = _JobLogListener(lambda: self._current_job)
+
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+    def serve_forever(self):
+        """Start the server and block until the server is shut down."""
+        self._prepare_socket_path()
+
+        self._cl_devices = self._load_cl_devices()
+        self._logger.info('Fitting server using the devices: {}'.format(
+            ', '.join(str(env) for env in self._cl_devices)))
+
+        LogDispatchHandler.add_listener(self._log_listener)
+
+        self._worker = threading.Thread(target=self._process_jobs)
+        self._worker.daemon = True
+        self._worker.start()
+
+        self._server = _ThreadedUnixServer(self._socket_path, _RequestHandler)
+        self._server.fitting_server = self
+        self._logger.info('Fitting server listening on {}'.format(self._socket_path))
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._job_queue.close()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+            self._logger.info('Fitting server stopped.')
+
+    def shutdown(self):
+        """Stop serving, this lets :meth:`serve_forever` return. Queued jobs are discarded."""
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown).start()
+
+    def submit(self, client_id, job_type, spec):
+        """Add a job to the queue.
+
+        Args:
+            client_id (str): the identifier of the submitting client, used for fair queueing
+            job_type (str): either 'fit' or 'sample'
+            spec (dict): the job specification, see :class:`ServerClient` for the supported elements
+
+        Returns:
+            _Job: the queued job
+        """
+        if job_type not in ('fit', 'sample'):
+            raise ValueError('The job type "{}" is not supported.'.format(job_type))
+
+        with self._lock:
+            self._job_counter += 1
+            job = _Job(self._job_counter, client_id, job_type, spec)
+
+        self._job_queue.put(job)
+        return job
+
+    def get_queue_position(self, job):
+        """Get the number of jobs that will be started before the given job."""
+        return self._job_queue.position(job)
+
+    def get_status(self):
+        """Get information about the current state of the server.
+
+        Returns:
+            dict: with the running job id, the number of queued jobs per client and the devices in use.
+        """
+        current_job = self._current_job
+        return {'running': current_job.job_id if current_job else None,
+                'queued': self._job_queue.get_queue_sizes(),
+                'devices': [str(env) for env in self._cl_devices or []]}
+
+    def _prepare_socket_path(self):
+        """Make sure the directory of the socket exists and that there is no stale socket file."""
+        if os.path.exists(self._socket_path):
+            if ServerClient(self._socket_path).is_alive():
+                raise RuntimeError('A fitting server is already listening on {}.'.format(self._socket_path))
+            os.remove(self._socket_path)
+
+        if not os.path.isdir(os.path.dirname(self._socket_path)):
+            os.makedirs(os.path.dirname(self._socket_path))
+
+    def _load_cl_devices(self):
+        """Load the CL environments once, such that they can be shared between all jobs."""
+        from mdt.utils import get_cl_devices
+        all_devices = get_cl_devices()
+        if self._cl_device_ind is None:
+            return all_devices
+        return [all_devices[ind] for ind in self._cl_device_ind]
+
+    def _process_jobs(self):
+        while True:
+            job = self._job_queue.get()
+            if job is None:
+                return
+
+            self._current_job = job
+            job.send_event({'type': 'started', 'job_id': job.job_id})
+            try:
+                result = self._execute(job)
+                job.send_event({'type': 'finished', 'job_id': job.job_id, 'result': result})
+            except Exception as exc:
+                self._logger.error('Job {} failed with: {}'.format(job.job_id, exc))
+                job.send_event({'type': 'failed', 'job_id': job.job_id, 'error': str(exc),
+                                'traceback': traceback.format_exc()})
+            finally:
+                self._current_job = None
+                job.close()
+
+    def _execute(self, job):
+        """Run the given job using the shared CL environments.
+
+        Returns:
+            dict: a serializable summary of the results of the job
+        """
+        import mdt
+        import mot.configuration
+        from mdt.configuration import VoidConfigAction, get_load_balancer
+
+        spec = job.spec
+
+        cl_environments = self._cl_devices
+        if spec.get('cl_device_ind') is not None:
+            indices = spec['cl_device_ind']
+            if not isinstance(indices, collections.Iterable):
+                indices = [indices]
+            cl_environments = [self._cl_devices[ind] for ind in indices]
+
+        double_precision = spec.get('double_precision', self._double_precision)
+
+        runtime_action = mot.configuration.RuntimeConfigurationAction(
+            cl_environments=cl_environments,
+            load_balancer=get_load_balancer(),
+            double_precision=double_precision)
+
+        config_action = VoidConfigAction()
+        if spec.get('config_context'):
+            config_action = spec['config_context']
+
+        # MOT's config context does not restore the runtime configuration if the job raises an exception
+        with mdt.config_context(config_action):
+            runtime_action.apply()
+            try:
+                input_data = mdt.load_input_data(spec['dwi'], spec['protocol'], spec['mask'],
+                                                 gradient_deviations=spec.get('gradient_deviations'),
+                                                 noise_std=spec.get('noise_std'),
+                                                 protocol_maps=spec.get('protocol_maps'))
+
+                if job.job_type == 'fit':
+                    results = mdt.fit_model(spec['model'], input_data, spec['output_folder'],
+                                            recalculate=spec.get('recalculate', False),
+                                            only_recalculate_last=spec.get('only_recalculate_last', False),
+                                            cascade_subdir=spec.get('cascade_subdir', False),
+                                            double_precision=double_precision,
+                                            tmp_results_dir=spec.get('tmp_results_dir', True),
+                                            save_user_script_info=None,
+                                            initialization_data=spec.get('initialization_data'),
+                                            post_processing=spec.get('post_processing'))
+                else:
+                    results = mdt.sample_model(spec['model'], input_data, spec['output_folder'],
+                                               nmr_samples=spec.get('nmr_samples'),
+                                               burnin=spec.get('burnin'),
+                                               thinning=spec.get('thinning'),
+                                               recalculate=spec.get('recalculate', False),
+                                               double_precision=double_precision,
+                                               store_samples=spec.get('store_samples', True),
+                                               tmp_results_dir=spec.get('tmp_results_dir', True),
+                                               save_user_script_info=None,
+                                               post_processing=spec.get('post_processing'))
+            finally:
+                runtime_action.unapply()
+
+        return {'output_folder': os.path.abspath(spec['output_folder']),
+                'maps': sorted(results.keys()) if results else []}
+
+
+class ServerClient(object):
+
+    def __init__(self, socket_path=None, client_id=None):
+        """Client for communicating with a running :class:`FittingServer`.
+
+        Args:
+            socket_path (str): the path to the Unix socket of the server, defaults to
+                :func:`get_default_socket_path`.
+            client_id (str): the identifier used by the server for fair queueing. Defaults to a combination of the
+                user id and the process id.
+        """
+        self._socket_path = socket_path or get_default_socket_path()
+        self._client_id = client_id or '{}-{}'.format(os.getuid(), os.getpid())
+
+    def fit_model(self, model, dwi, protocol, mask, output_folder, progress_callback=None, **options):
+        """Fit a model on the server.
+
+        Args:
+            model (str): the name of the model to fit
+            dwi (str): the path to the diffusion weighted image
+            protocol (str): the path to the protocol file
+            mask (str): the path to the mask
+            output_folder (str): the output folder, see :func:`mdt.fit_model`
+            progress_callback (Callable[[dict], None]): function called with every event the server sends back,
+                for example the log messages. If not given, the log messages are forwarded to the logging module.
+            **options: additional options for the job. Supported are the keyword arguments of
+                :func:`mdt.load_input_data` (``gradient_deviations``, ``noise_std``, ``protocol_maps``), most keyword
+                arguments of :func:`mdt.fit_model`, ``cl_device_ind`` and ``config_context`` (a YAML string).
+
+        Returns:
+            dict: the output folder and the names of the computed maps
+
+        Raises:
+            ServerJobError: if the job failed on the server
+        """
+        return self._run_job('fit', model, dwi, protocol, mask, output_folder, progress_callback, options)
+
+    def sample_model(self, model, dwi, protocol, mask, output_folder, progress_callback=None, **options):
+        """Sample a model on the server.
+
+        This accepts the same arguments as :meth:`fit_model`, with as options the keyword arguments of
+        :func:`mdt.sample_model`.
+
+        Returns:
+            dict: the output folder and the names of the sampled maps
+
+        Raises:
+            ServerJobError: if the job failed on the server
+        """
+        return self._run_job('sample', model, dwi, protocol, mask, output_folder, progress_callback, options)
+
+    def status(self):
+        """Get the status of the server.
+
+        Returns:
+            dict: the status information, see :meth:`FittingServer.get_status`
+        """
+        return next(self._request({'command': 'status'}))['status']
+
+    def shutdown(self):
+        """Request the server to shut down."""
+        for _ in self._request({'command': 'shutdown'}):
+            pass
+
+    def is_alive(self):
+        """Check if there is a server listening on the socket.
+
+        Returns:
+            boolean: True if a server answered, False otherwise
+        """
+        try:
+            self.status()
+            return True
+        except (socket.error, StopIteration, ValueError):
+            return False
+
+    def _run_job(self, job_type, model, dwi, protocol, mask, output_folder, progress_callback, options):
+        spec = dict(options)
+        spec.update({'model': model,
+                     'dwi': os.path.realpath(dwi),
+                     'protocol': os.path.realpath(protocol),
+                     'mask': os.path.realpath(mask),
+                     'output_folder': os.path.realpath(output_folder)})
+
+        for item in ('gradient_deviations', 'noise_std'):
+            if isinstance(spec.get(item), str) and os.path.isfile(spec[item]):
+                spec[item] = os.path.realpath(spec[item])
+
+        progress_callback = progress_callback or _log_server_event
+
+        for event in self._request({'command': job_type, 'client_id': self._client_id, 'job': spec}):
+            progress_callback(event)
+            if event['type'] == 'finished':
+                return event['result']
+            if event['type'] == 'failed':
+                raise ServerJobError('Job {} failed on the server: {}'.format(event['job_id'], event['error']),
+                                     event.get('traceback'))
+
+        raise ServerJobError('The connection to the server was closed before the job finished.')
+
+    def _request(self, message):
+        """Send a message to the server and yield the events it sends back."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+            sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            with sock.makefile('rb') as stream:
+                for line in stream:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            sock.close()
+
+
+def _log_server_event(event):
+    """The default progress callback, forwards the server events to the logging module."""
+    logger = logging.getLogger(__name__)
+    if event['type'] == 'log':
+        logger.info(event['message'])
+    elif event['type'] == 'queued':
+        logger.info('Job {} queued at position {}.'.format(event['job_id'], event['position']))
+    elif event['type'] == 'started':
+        logger.info('Job {} started.'.format(event['job_id']))
+
+
+class _Job(object):
+
+    def __init__(self, job_id, client_id, job_type, spec):
+        """Container for a job in the queue of the server.
+
+        Events for the submitting client are put in the :attr:`events` queue. A ``None`` event signals the end.
+        """
+        self.job_id = job_id
+        self.client_id = client_id
+        self.job_type = job_type
+        self.spec = spec
+        self.events = queue.Queue()
+
+    def send_event(self, event):
+        self.events.put(event)
+
+    def close(self):
+        self.events.put(None)
+
+
+class _FairJobQueue(object):
+
+    def __init__(self):
+        """Job queue that serves the clients round-robin.
+
+        Every client has its own FIFO queue. On every :meth:`get` we take the first job of the next client in line,
+        after which that client moves to the back of the line.
+        """
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, job):
+        with self._condition:
+            self._queues.setdefault(job.client_id, collections.deque()).append(job)
+            self._condition.notify()
+
+    def get(self):
+        """Get the next job, blocks until a job is available.
+
+        Returns:
+            _Job: the next job, or None if the queue was closed.
+        """
+        with self._condition:
+            while not self._queues and not self._closed:
+                self._condition.wait()
+
+            if self._closed:
+                return None
+
+            client_id, client_queue = next(iter(self._queues.items()))
+            job = client_queue.popleft()
+
+            del self._queues[client_id]
+            if client_queue:
+                self._queues[client_id] = client_queue
+            return job
+
+    def position(self, job):
+        """Get the number of queued jobs that will be started before the given job."""
+        with self._condition:
+            if job not in self._queues.get(job.client_id, ()):
+                return 0
+
+            clients = list(self._queues.keys())
+            own_rank = clients.index(job.client_id)
+            own_index = list(self._queues[job.client_id]).index(job)
+
+            position = own_index
+            for rank, client_id in enumerate(clients):
+                if client_id != job.client_id:
+                    position += min(len(self._queues[client_id]), own_index + (1 if rank < own_rank else 0))
+            return position
+
+    def get_queue_sizes(self):
+        with self._condition:
+            return {client_id: len(q) for client_id, q in self._queues.items()}
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class _JobLogListener(LogListenerInterface):
+
+    def __init__(self, current_job_getter):
+        """Forwards the log messages to the client of the job that is currently running."""
+        self._current_job_getter = current_job_getter
+
+    def emit(self, record, formatted_message):
+        job = self._current_job_getter()
+        if job is not None:
+            job.send_event({'type': 'log', 'job_id': job.job_id, 'level': record.levelname,
+                            'message': record.getMessage()})
+
+
+class _ThreadedUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        fitting_server = self.server.fitting_server
+
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            message = json.loads(line.decode('utf-8'))
+            command = message['command']
+
+            if command == 'status':
+                self._send({'type': 'status', 'status': fitting_server.get_status()})
+            elif command == 'shutdown':
+                self._send({'type': 'shutdown'})
+                fitting_server.shutdown()
+            elif command in ('fit', 'sample'):
+                self._handle_job(fitting_server, command, message)
+            else:
+                raise ValueError('Unknown command "{}".'.format(command))
+        except socket.error:
+            pass
+        except Exception as exc:
+            self._send({'type': 'failed', 'job_id': None, 'error': str(exc), 'traceback': traceback.format_exc()})
+
+    def _handle_job(self, fitting_server, command, message):
+        job = fitting_server.submit(message.get('client_id', 'anonymous'), command, message['job'])
+        self._send({'type': 'queued', 'job_id': job.job_id, 'position': fitting_server.get_queue_position(job)})
+
+        client_connected = True
+        while True:
+            event = job.events.get()
+            if event is None:
+                return
+            if client_connected:
+                try:
+                    self._send(event)
+                except socket.error:
+                    client_connected = False
+
+    def _send(self, event):
+        self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+        self.wfile.flush()
@@ -0,0 +1,269 @@
+"""Sharded fitting of a single dataset over multiple processes or computers.
+
+For large datasets, the fitting of a single subject can be split over multiple independent processes, possibly on
+different computers sharing a filesystem. Every process is started with the same arguments and its own shard, for
+example ``mdt-model-fit ... --shard 1/4`` up to ``--shard 4/4``. Every shard fits a disjoint part of the voxels of
+each model and stores its temporary results in its own subdirectory of the temporary results directory, such that an
+interrupted shard resumes from its own processed voxels when started again.
+
+The shard finishing last merges the results of all shards and writes the output maps. The other shards wait until
+these results are written, after which every shard continues with the next model of a cascade. If the merging shard
+was interrupted, the results of the finished shards can be merged with :func:`merge_shards` or with the command
+``mdt-merge-shards``.
+
+Since the shards communicate through the filesystem, the temporary results directory (see ``tmp_results_dir`` in the
+configuration) must be on the shared filesystem. The interval at which waiting shards check for the results is set in
+the ``sharding`` section of the configuration.
+"""
+import errno
+import glob
+import logging
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from mdt.configuration import get_sharding_settings, get_output_dtype_policy
+from mdt.nifti import write_all_as_nifti, get_all_nifti_data
+from mdt.processing_strategies import FittingProcessor
+from mdt.utils import create_roi, BoundingBox, load_brain_mask
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-30'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+#: the name of the file marking a shard as finished, in the temporary results directory of the shard
+SHARD_FINISHED_FILENAME = 'finished'
+
+#: the name of the lock file claimed by the shard merging the results
+MERGE_LOCK_FILENAME = 'merge.lock'
+
+
+class Shard(object):
+
+    def __init__(self, index, nmr_shards):
+        """One of the disjoint parts of the voxels, fitted by an independent process.
+
+        Args:
+            index (int): the index of this shard, from 0 to (but excluding) nmr_shards
+            nmr_shards (int): the total number of shards
+        """
+        if nmr_shards < 1 or not 0 <= index < nmr_shards:
+            raise ValueError('Invalid shard {} of {} shards.'.format(index, nmr_shards))
+        self.index = index
+        self.nmr_shards = nmr_shards
+
+    @classmethod
+    def from_string(cls, value):
+        """Create a shard from a string ``i/N``, with the shard number i counting from 1 to N.
+
+        Args:
+            value (str): the shard specification, for example '1/4' for the first of four shards
+
+        Returns:
+            Shard: the shard
+        """
+        match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            raise ValueError('Invalid shard "{}", use "i/N" with 1 <= i <= N.'.format(value))
+        return cls(int(match.group(1)) - 1, int(match.group(2)))
+
+    def get_directory_name(self):
+        """Get the name of the directory holding the temporary results of this shard."""
+        return 'shard_{}_of_{}'.format(self.index + 1, self.nmr_shards)
+
+    def select(self, roi_indices):
+        """Select the part of the given voxels belonging to this shard.
+
+        The voxels are split in consecutive parts of (nearly) equal size, such that every voxel is in exactly one
+        shard.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of all the voxels to fit
+
+        Returns:
+            ndarray: the ROI indices of the voxels of this shard
+        """
+        return np.array_split(roi_indices, self.nmr_shards)[self.index]
+
+    def __str__(self):
+        return '{}/{}'.format(self.index + 1, self.nmr_shards)
+
+
+class ShardedFittingProcessor(FittingProcessor):
+
+    def __init__(self, shard, sharding_dir, optimizer, model, mask, nifti_header, output_dir, recalculate, **kwargs):
+        """The processing worker for fitting one shard of the voxels.
+
+        This only fits the voxels of the given shard and stores the temporary results in a subdirectory of the
+        sharding directory. On combining, the shard finishing last merges the results of all the shards and writes
+        the output maps, the other shards wait until these are written.
+
+        Args:
+            shard (Shard): the shard to fit
+            sharding_dir (str): the temporary results directory shared by all the shards
+            **kwargs: see :class:`~mdt.processing_strategies.FittingProcessor`
+        """
+        self._shard = shard
+        self._sharding_dir = sharding_dir
+        super(ShardedFittingProcessor, self).__init__(optimizer, model, mask, nifti_header, output_dir,
+                                                      os.path.join(sharding_dir, shard.get_directory_name()),
+                                                      recalculate, **kwargs)
+        self._logger = logging.getLogger(__name__)
+        self.merged = False
+
+    def get_voxels_to_compute(self):
+        voxels = super(ShardedFittingProcessor, self).get_voxels_to_compute()
+        return voxels[np.in1d(voxels, self._get_shard_voxels())]
+
+    def get_total_nmr_voxels(self):
+        return len(self._get_shard_voxels())
+
+    def combine(self):
+        with open(os.path.join(self._tmp_storage_dir, SHARD_FINISHED_FILENAME), 'w'):
+            pass
+
+        if self._claim_merge():
+            self._logger.info('All {} shards finished, merging the results.'.format(self._shard.nmr_shards))
+            merge_shards(self._sharding_dir, self._output_dir, self._mask, self._nifti_header,
+                         gzip=self._write_volumes_gzipped)
+            self.merged = True
+        else:
+            self._logger.info('Finished shard {}, waiting for the other shards.'.format(self._shard))
+            poll_interval = get_sharding_settings().get('poll_interval', 10)
+            while os.path.exists(self._tmp_storage_dir):
+                time.sleep(poll_interval)
+
+        return create_roi(get_all_nifti_data(self._output_dir), self._mask)
+
+    def finalize(self):
+        """The temporary results are removed by the shard merging the results."""
+        del self._volume_indices
+
+    def _get_shard_voxels(self):
+        roi_list = np.arange(0, self._total_nmr_voxels)
+        if self._skip_voxels is not None:
+            roi_list = roi_list[np.logical_not(self._skip_voxels)]
+        return self._shard.select(roi_list)
+
+    def _claim_merge(self):
+        """Claim the merging of the results, if all shards are finished and no other shard claimed it before.
+
+        Returns:
+            boolean: if this shard should merge the results
+        """
+        if get_unfinished_shards(self._sharding_dir, self._shard.nmr_shards):
+            return False
+        try:
+            os.close(os.open(os.path.join(self._sharding_dir, MERGE_LOCK_FILENAME),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            raise
+        return True
+
+
+def get_unfinished_shards(sharding_dir, nmr_shards):
+    """Get the shards in the given directory which are not yet finished.
+
+    Args:
+        sharding_dir (str): the temporary results directory shared by the shards
+        nmr_shards (int): the total number of shards
+
+    Returns:
+        list of Shard: the shards which are not yet started or not yet finished
+    """
+    return [Shard(ind, nmr_shards) for ind in range(nmr_shards)
+            if not os.path.isfile(os.path.join(sharding_dir, Shard(ind, nmr_shards).get_directory_name(),
+                                               SHARD_FINISHED_FILENAME))]
+
+
+def get_sharding_dirs(tmp_results_dir):
+    """Find the directories with shards which are not yet merged.
+
+    Args:
+        tmp_results_dir (str): the temporary results directory of a model, as used during fitting
+
+    Returns:
+        list of str: the sharding directories in the given directory, sorted by name
+    """
+    return sorted(set(os.path.dirname(path) for path in
+                      glob.glob(os.path.join(tmp_results_dir, '*', 'shard_*_of_*'))))
+
+
+def merge_shards(sharding_dir, output_dir, mask, nifti_header, gzip=True):
+    """Merge the temporary results of all the shards and write the resulting maps.
+
+    Every voxel is taken from the shard which processed it. The voxels which were not processed by any shard (like
+    the skipped voxels) are taken from the first shard having the map, since these are the same for all shards.
+    After writing the maps, the sharding directory is removed, which signals the waiting shards to continue.
+
+    Args:
+        sharding_dir (str): the temporary results directory shared by the shards
+        output_dir (str): the directory for the output maps
+        mask (ndarray or str): the mask used for fitting
+        nifti_header (nibabel nifti header): the header for the output maps
+        gzip (boolean): if we want to write the maps gzipped
+    """
+    shard_dirs = glob.glob(os.path.join(sharding_dir, 'shard_*_of_*'))
+    if not shard_dirs:
+        raise ValueError('No shards found in {}.'.format(sharding_dir))
+
+    nmr_shards = int(re.search(r'_of_(\d+)$', shard_dirs[0]).group(1))
+    unfinished = get_unfinished_shards(sharding_dir, nmr_shards)
+    if unfinished:
+        raise ValueError('Can not merge the results, the shards {} are not finished.'.format(
+            ', '.join(map(str, unfinished))))
+
+    shard_dirs = [os.path.join(sharding_dir, Shard(ind, nmr_shards).get_directory_name())
+                  for ind in range(nmr_shards)]
+    bounding_box = BoundingBox.from_mask(load_brain_mask(mask))
+
+    processed = []
+    for shard_dir in shard_dirs:
+        processed_voxels_path = os.path.join(shard_dir, 'processing_tmp', 'processed_voxels.npy')
+        if os.path.isfile(processed_voxels_path):
+            processed.append(np.load(processed_voxels_path)[..., 0].astype(np.bool))
+        else:
+            processed.append(None)
+
+    maps = set()
+    for shard_dir in shard_dirs:
+        for directory, dirnames, filenames in os.walk(shard_dir):
+            dirnames[:] = [d for d in dirnames if d != 'processing_tmp']
+            maps.update((os.path.relpath(directory, shard_dir), os.path.splitext(f)[0])
+                        for f in filenames if f.endswith('.npy'))
+
+    for sub_dir in set(sub_dir for sub_dir, _ in maps):
+        full_output_dir = os.path.normpath(os.path.join(output_dir, sub_dir))
+        if not os.path.exists(full_output_dir):
+            os.makedirs(full_output_dir)
+
+        for fname in os.listdir(full_output_dir):
+            if fname.endswith('.nii.gz'):
+                os.remove(os.path.join(full_output_dir, fname))
+
+    for sub_dir, map_name in sorted(maps):
+        merged = None
+        for shard_dir, shard_processed in zip(shard_dirs, processed):
+            path = os.path.join(shard_dir, sub_dir, map_name + '.npy')
+            if not os.path.isfile(path):
+                continue
+
+            data = np.load(path, mmap_mode='r')
+            if merged is None:
+                merged = np.array(data)
+            elif shard_processed is not None:
+                merged[shard_processed] = data[shard_processed]
+
+        write_all_as_nifti({map_name: merged}, os.path.normpath(os.path.join(output_dir, sub_dir)),
+                           nifti_header=nifti_header, gzip=gzip, bounding_box=bounding_box,
+                           dtype_policy=get_output_dtype_policy())
+
+    shutil.rmtree(sharding_dir)
@@ -1,10 +1,16 @@
+import os
+import tempfile
 import numpy as np
 import collections
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from numpy.lib.format import open_memmap
 from six import string_types
 from mdt.components import get_model
-from mdt.nifti import get_all_nifti_data
-from mdt.utils import create_roi, restore_volumes, MockMRIInputData
+from mdt.nifti import get_all_nifti_data, write_nifti
+from mdt.utils import create_roi, MockMRIInputData, SimpleMRIInputData
 from mdt.cl_routines.mapping.calculate_model_estimates import CalculateModelEstimates
+from mot.cl_runtime_info import CLRuntimeInfo
 
 __author__ = 'Robbert Harms'
 __date__ = '2017-05-29'
@@ -13,7 +19,7 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
-def create_signal_estimates(model, input_data, parameters):
+def create_signal_estimates(model, input_data, parameters, batch_size=10000, out=None, residuals_out=None):
     """Create the signals estimates for your estimated model parameters.
 
     This function is typically used to obtain signal estimates from optimization results.
@@ -21,14 +27,69 @@ def create_signal_estimates(model, input_data, parameters):
     This function evaluates the model as it is in the model fitting and sampling. That is, this method includes
     the gradient deviations (if set in the input data) and loads all static and fixed parameters maps.
 
+    The model is evaluated in batches of voxels (see :func:`iter_signal_estimates`), which are written directly to the
+    output volume. For large datasets, set ``out`` to a filename to avoid keeping the estimates in memory. For a
+    ``.npy`` filename we write to a memory mapped array, for a ``.nii`` or ``.nii.gz`` filename we write a NIfTI file
+    with the header of the input data (using a temporary memory mapped array next to that file).
+
+    If ``residuals_out`` is given, the residuals (the observations minus the estimates) are computed in the same pass
+    and written to that output, which accepts the same values as ``out``.
+
     Args:
         model (str or model): the model or the name of the model to use for estimating the signals
         input_data (mdt.utils.MRIInputData): the input data object, we will set this to the model
         parameters (str or dict): either a directory file name or a dictionary containing optimization results
             Each element is assumed to be a 4d volume with the voxels we are using for the simulations.
+        batch_size (int): the number of voxels we evaluate at once, limits the memory usage
+        out (ndarray or str): optionally, the 4d array to write the estimates to or the filename of a ``.npy`` or
+            NIfTI file to write to
+        residuals_out (ndarray or str): optionally, the 4d array or the filename to write the residuals to
 
     Returns:
-        ndarray: the 4d array with the signal estimates per voxel
+        ndarray: the 4d array with the signal estimates per voxel. If ``out`` is given, this is that output array
+            or, for a filename, the memory mapped array. For NIfTI output this returns None.
+    """
+    if isinstance(model, string_types):
+        model = get_model(model)()
+
+    estimates_iterator = iter_signal_estimates(model, input_data, parameters, batch_size=batch_size)
+    nmr_observations = model.get_nmr_observations()
+    shape = input_data.mask_index.shape + (nmr_observations,)
+
+    outputs = [_SignalVolumeOutput(out, shape, input_data.nifti_header)]
+    if residuals_out is not None:
+        outputs.append(_SignalVolumeOutput(residuals_out, shape, input_data.nifti_header))
+
+    observations = model.get_input_data().observations
+    flat_indices = input_data.mask_index.flat_indices
+
+    try:
+        for roi_indices, estimates in estimates_iterator:
+            outputs[0].write(flat_indices[roi_indices], estimates)
+            if residuals_out is not None:
+                outputs[1].write(flat_indices[roi_indices], np.asarray(observations[roi_indices]) - estimates)
+        return [output.finalize() for output in outputs][0]
+    finally:
+        for output in outputs:
+            output.remove_temporary_files()
+
+
+def iter_signal_estimates(model, input_data, parameters, batch_size=10000):
+    """Create the signal estimates for your estimated model parameters, in batches of voxels.
+
+    This is the streaming version of :func:`create_signal_estimates`, it builds and evaluates the model for
+    ``batch_size`` voxels at a time and yields the estimates of every batch.
+
+    Args:
+        model (str or model): the model or the name of the model to use for estimating the signals
+        input_data (mdt.utils.MRIInputData): the input data object, we will set this to the model
+        parameters (str or dict): either a directory file name or a dictionary containing optimization results
+            Each element is assumed to be a 4d volume with the voxels we are using for the simulations.
+        batch_size (int): the number of voxels we evaluate at once
+
+    Returns:
+        generator: yielding tuples with the ROI indices of a batch of voxels and the (v, n) signal estimates of these
+            voxels
     """
     if isinstance(model, string_types):
         model = get_model(model)()
@@ -38,35 +99,176 @@ def create_signal_estimates(model, input_data, parameters):
     if isinstance(parameters, string_types):
         parameters = get_all_nifti_data(parameters)
 
-    parameters = create_roi(parameters, input_data.mask)
+    parameters = create_roi(parameters, input_data.mask_index)
     parameters = model.param_dict_to_array(parameters)
 
-    build_model = model.build()
-
-    if parameters.shape[0] != build_model.get_nmr_problems():
+    if parameters.shape[0] != input_data.nmr_problems:
         raise ValueError('The number of voxels in the parameters does not match those in the model.')
 
-    calculator = CalculateModelEstimates()
-    results = calculator.calculate(model.build(), parameters)
+    def estimates_generator():
+        calculator = CalculateModelEstimates()
+        for start in range(0, parameters.shape[0], batch_size):
+            roi_indices = np.arange(start, min(start + batch_size, parameters.shape[0]))
+            yield roi_indices, calculator.calculate(model.build(roi_indices), parameters[roi_indices])
+
+    return estimates_generator()
+
+
+class _SignalVolumeOutput(object):
+
+    def __init__(self, out, shape, nifti_header):
+        """The output of a 4d signal volume, to which we can write the signals of batches of voxels.
+
+        Args:
+            out (ndarray, str or None): the output array, the filename of a ``.npy`` or NIfTI file, or None for a new
+                array in memory
+            shape (tuple): the shape of the output volume
+            nifti_header (nibabel header): the header for NIfTI output
+        """
+        self._nifti_filename = None
+        self._tmp_filename = None
+        self._nifti_header = nifti_header
+        dtype = CLRuntimeInfo().mot_float_dtype
 
-    return restore_volumes(results, input_data.mask)
+        if out is None:
+            self._volume = np.zeros(shape, dtype=dtype)
+        elif isinstance(out, string_types):
+            if out.endswith('.npy'):
+                self._volume = open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+            else:
+                self._nifti_filename = out
+                handle, self._tmp_filename = tempfile.mkstemp(suffix='.npy',
+                                                              dir=os.path.dirname(os.path.abspath(out)))
+                os.close(handle)
+                self._volume = open_memmap(self._tmp_filename, mode='w+', dtype=dtype, shape=shape)
+        elif out.shape != shape:
+            raise ValueError('The output array has shape {}, while the estimates need {}.'.format(out.shape, shape))
+        else:
+            self._volume = out
 
+        self._flat_volume = np.reshape(self._volume, (-1, shape[-1]))
+        if not np.may_share_memory(self._flat_volume, self._volume):
+            raise ValueError('The output array needs to be C-contiguous.')
 
-def simulate_signals(model, protocol, parameters):
+    def write(self, flat_indices, signals):
+        """Write the signals of a batch of voxels.
+
+        Args:
+            flat_indices (ndarray): the flat (C-order) indices of the voxels in the volume
+            signals (ndarray): the (v, n) signals of these voxels
+        """
+        self._flat_volume[flat_indices] = signals
+
+    def finalize(self):
+        """Finish writing the output.
+
+        Returns:
+            ndarray: the output volume, or None if we wrote a NIfTI file
+        """
+        if self._nifti_filename is None:
+            return self._volume
+
+        write_nifti(self._volume, self._nifti_filename, header=self._nifti_header)
+        return None
+
+    def remove_temporary_files(self):
+        """Remove the temporary memory mapped array used for writing NIfTI files."""
+        if self._tmp_filename is not None:
+            del self._flat_volume
+            del self._volume
+            os.remove(self._tmp_filename)
+            self._tmp_filename = None
+
+
+def simulate_signals(model, protocol, parameters, noise_level=None, noise_type='rician', nmr_realizations=None,
+                     seed=None, batch_size=10000, out=None):
     """Estimate the signals of a given model for the given combination of protocol and parameters.
 
     In contrast to the function :func:`create_signal_estimates`, this function does not incorporate the gradient
     deviations. Furthermore, this function expects a two dimensional list of parameters and this function will
     simply evaluate the model for each set of parameters.
 
+    The model is evaluated in batches of parameter rows (see :func:`iter_simulate_signals`), which are written to the
+    output array. For large simulations, set ``out`` to a filename to write the results to a memory mapped ``.npy``
+    file instead of keeping them in memory.
+
+    Optionally, noise can be added to the signals, see :func:`add_noise`. With ``nmr_realizations`` set, the model is
+    evaluated once per parameter row and the given number of noise realizations are generated from that signal.
+
+    Args:
+        model (str or model): the model or the name of the model to use for estimating the signals
+        protocol (mdt.protocols.Protocol): the protocol we will use for the signal simulation
+        parameters (dict or ndarray): the parameters for which to simulate the signal. It can either be a matrix with
+            for every row every model parameter, or a dictionary with for every parameter a 1d array.
+        noise_level (float or ndarray): if set, the standard deviation of the noise to add, either a scalar or a
+            value per parameter row
+        noise_type (str): the type of noise to add, either 'rician' or 'gaussian'
+        nmr_realizations (int): if set, the number of noise realizations per parameter row, the output then has an
+            extra dimension for the realizations
+        seed (int): the seed for the noise generation, if not set we use a random seed
+        batch_size (int): the number of parameter rows we evaluate at once, limits the memory usage
+        out (ndarray or str): optionally, the array to write the signals to, or the filename of a ``.npy`` file we
+            will create as a memory mapped array
+
+    Returns:
+        ndarray: a 2d array with for every parameter combination the simulated model signal. With
+            ``nmr_realizations`` set, a 3d array with for every parameter combination the signal of every realization.
+            If ``out`` was given, this is that output array.
+    """
+    build_model, parameters = _prepare_simulation(model, protocol, parameters)
+
+    shape = (parameters.shape[0],)
+    if noise_level is not None and nmr_realizations is not None:
+        shape += (nmr_realizations,)
+    shape += (build_model.get_nmr_observations(),)
+
+    if out is None:
+        out = np.zeros(shape, dtype=CLRuntimeInfo().mot_float_dtype)
+    elif isinstance(out, string_types):
+        out = open_memmap(out, mode='w+', dtype=CLRuntimeInfo().mot_float_dtype,
+                          shape=shape)
+    elif out.shape != shape:
+        raise ValueError('The output array has shape {}, while the simulation needs {}.'.format(out.shape, shape))
+
+    for rows, signals in _iter_signals(build_model, parameters, noise_level, noise_type, nmr_realizations, seed,
+                                       batch_size):
+        out[rows] = signals
+    return out
+
+
+def iter_simulate_signals(model, protocol, parameters, noise_level=None, noise_type='rician', nmr_realizations=None,
+                          seed=None, batch_size=10000):
+    """Simulate the signals of a model in batches of parameter rows.
+
+    This is the streaming version of :func:`simulate_signals`, it evaluates the model for ``batch_size`` parameter rows
+    at a time and yields the signals of every batch. The noise of every parameter row only depends on the seed and
+    the index of that row, such that the results do not depend on the batch size.
+
     Args:
         model (str or model): the model or the name of the model to use for estimating the signals
         protocol (mdt.protocols.Protocol): the protocol we will use for the signal simulation
         parameters (dict or ndarray): the parameters for which to simulate the signal. It can either be a matrix with
             for every row every model parameter, or a dictionary with for every parameter a 1d array.
+        noise_level (float or ndarray): if set, the standard deviation of the noise to add, either a scalar or a
+            value per parameter row
+        noise_type (str): the type of noise to add, either 'rician' or 'gaussian'
+        nmr_realizations (int): if set, the number of noise realizations per parameter row
+        seed (int): the seed for the noise generation, if not set we use a random seed
+        batch_size (int): the number of parameter rows we evaluate at once
 
     Returns:
-        ndarray: a 2d array with for every parameter combination the simulated model signal
+        generator: yielding tuples with the slice with the parameter rows of a batch and the simulated signals of
+            these rows
+    """
+    build_model, parameters = _prepare_simulation(model, protocol, parameters)
+    return _iter_signals(build_model, parameters, noise_level, noise_type, nmr_realizations, seed, batch_size)
+
+
+def _prepare_simulation(model, protocol, parameters):
+    """Build the model for simulating the given protocol and get the parameters as a matrix.
+
+    Returns:
+        tuple: the build model and the (n, p) matrix with the parameters
     """
     if isinstance(model, string_types):
         model = get_model(model)()
@@ -76,11 +278,70 @@ def simulate_signals(model, protocol, parameters):
     if isinstance(parameters, collections.Mapping):
         parameters = model.param_dict_to_array(parameters)
 
+    return model.build(), parameters
+
+
+def _iter_signals(build_model, parameters, noise_level, noise_type, nmr_realizations, seed, batch_size):
+    """Evaluate the build model in batches of parameter rows, see :func:`iter_simulate_signals`."""
+    if noise_level is not None:
+        noise_level = _get_noise_level_per_row(noise_level, parameters.shape[0])
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+
     calculator = CalculateModelEstimates()
-    return calculator.calculate(model.build(), parameters)
+
+    for start in range(0, parameters.shape[0], batch_size):
+        rows = slice(start, min(start + batch_size, parameters.shape[0]))
+        signals = calculator.calculate(build_model, parameters[rows])
+
+        if noise_level is not None:
+            signals = _add_noise(signals, noise_level[rows], noise_type, seed, nmr_realizations, row_offset=start)
+        yield rows, signals
+
+
+def add_noise(signals, noise_level, noise_type='rician', seed=None, nmr_realizations=None):
+    """Add Gaussian or Rician distributed noise to the given signals.
+
+    The noise is generated in blocks of rows (the first dimension of the signals), using an independent random
+    stream per block and realization which only depends on the seed. These blocks are generated in parallel, using
+    one thread per CPU. The results are reproducible given the seed, independent of the number of threads.
+
+    Args:
+        signals (ndarray): the signals to add noise to, with the first dimension being the rows (for example the
+            voxels or the parameter combinations)
+        noise_level (float or ndarray): the standard deviation of the noise, either a scalar or an array
+            broadcastable to the signals
+        noise_type (str): the type of noise to add, either 'rician' or 'gaussian'
+        seed (int): if given, the seed for the random number generation
+        nmr_realizations (int): if set, the number of noise realizations to generate, added as a second dimension
+            to the output
+
+    Returns:
+        ndarray: the noisy signals, with the shape of the signals or, with ``nmr_realizations`` set, with the
+            realizations inserted as the second dimension.
+    """
+    signals = np.asarray(signals)
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    return _add_noise(signals, noise_level, noise_type, seed, nmr_realizations)
 
 
-def add_rician_noise(signals, noise_level, seed=None):
+def add_gaussian_noise(signals, noise_level, seed=None, nmr_realizations=None):
+    """Add Gaussian distributed noise to the given signals.
+
+    Args:
+        signals: the signals to add the noise to
+        noise_level: the standard deviation of the noise, either a scalar or an array broadcastable to the signals
+        seed (int): if given, the seed for the random number generation
+        nmr_realizations (int): if set, the number of noise realizations to generate, see :func:`add_noise`
+
+    Returns:
+        ndarray: the signals with added Gaussian noise
+    """
+    return add_noise(signals, noise_level, noise_type='gaussian', seed=seed, nmr_realizations=nmr_realizations)
+
+
+def add_rician_noise(signals, noise_level, seed=None, nmr_realizations=None):
     """Make the given signal Rician distributed.
 
     To calculate the noise level divide the signal of the unweighted volumes by the SNR you want. For example,
@@ -91,11 +352,253 @@ def add_rician_noise(signals, noise_level, seed=None):
         noise_level: the level of noise to add. The actual Rician stdev depends on the signal. See ricestat in
             the mathworks library. The noise level can be calculated using b0/SNR.
         seed (int): if given, the seed for the random number generation
+        nmr_realizations (int): if set, the number of noise realizations to generate, see :func:`add_noise`
 
     Returns:
         ndarray: Rician distributed signals.
     """
-    random_state = np.random.RandomState(seed)
-    x = noise_level * random_state.normal(size=signals.shape) + signals
-    y = noise_level * random_state.normal(size=signals.shape)
-    return np.sqrt(np.power(x, 2), np.power(y, 2)).astype(signals.dtype)
+    return add_noise(signals, noise_level, noise_type='rician', seed=seed, nmr_realizations=nmr_realizations)
+
+
+def run_recovery_study(model, protocol, parameters, snrs, nmr_repeats=1, noise_type='rician', seed=None,
+                       chunk_size=10000, confidence_level=0.95, results_file=None, optimizer=None,
+                       cl_device_ind=None, double_precision=False, post_processing=None):
+    """Run a parameter recovery study: simulate signals, fit the model to these signals and compare the estimates.
+
+    The parameter combinations are processed per SNR level in chunks of ``chunk_size`` combinations. For every chunk we
+    simulate the noise free signals once and generate ``nmr_repeats`` noise realizations per combination from these
+    signals. All realizations of a chunk are fitted as a single ROI of problems, without writing anything to disk.
+    The fitting uses the regular processing strategy and hence all the selected devices. The noise only depends on the
+    seed, not on the chunk size.
+
+    The noise level of every parameter combination is the mean noise free signal over the unweighted volumes (see
+    :func:`mdt.linear_estimators.get_s0_volume_indices`) divided by the SNR. This noise level is also used as the
+    noise standard deviation for the fit.
+
+    Per SNR level and per free parameter we report the number of finite estimates (``nmr_valid``), the ``bias``
+    (mean of the estimate minus the true value), the root mean squared error (``rmse``), the mean absolute error
+    (``mae``) and, if the fit provides standard deviations (see the ``covariance`` post-processing), the ``coverage``:
+    the fraction of the estimates whose confidence interval contains the true value. The statistics are accumulated
+    over the chunks and the rows of an SNR level are written to the results file as soon as that level is complete.
+
+    Please note that the errors are computed on the raw parameter values. For parameters with symmetries, like the
+    orientation angles, these errors are not meaningful.
+
+    Args:
+        model (str or model): the composite model (or the name of the composite model) to simulate and fit
+        protocol (mdt.protocols.Protocol): the protocol to simulate
+        parameters (dict or ndarray): the true parameters, as samples from the parameter distribution of interest.
+            Either a matrix with for every row every free parameter, or a dictionary with for some of the free
+            parameters a 1d array. Parameters not in the dictionary are kept at their initial value.
+            See for example :func:`mdt.dictionary_matching.get_parameter_grid` for generating parameters.
+        snrs (list of float): the SNR levels to simulate
+        nmr_repeats (int): the number of noise realizations per parameter combination and SNR level
+        noise_type (str): the type of noise to add, either 'rician' or 'gaussian'
+        seed (int): the seed for the noise generation, if not set we use a random seed
+        chunk_size (int): the number of parameter combinations we simulate and fit at once, the number of problems
+            per fit is this times the number of repeats
+        confidence_level (float): the level of the (normal) confidence intervals used for the coverage
+        results_file (str): if given, the path to a CSV file to which we write the results table
+        optimizer (mot.cl_routines.optimizing.base.AbstractOptimizer): the optimizer to use, defaults to the
+            configured optimizer for the model
+        cl_device_ind (int or list): the index of the CL device(s) to use, see :func:`mdt.fit_model`
+        double_precision (boolean): if we do the fitting in double precision
+        post_processing (dict): the post-processing options for the fit, see :func:`mdt.fit_model`
+
+    Returns:
+        list of dict: the rows of the results table, with the keys 'snr', 'parameter', 'nmr_valid', 'bias', 'rmse',
+            'mae' and 'coverage'.
+    """
+    from mdt import fit_model
+    from mdt.linear_estimators import get_s0_volume_indices
+    from scipy.stats import norm
+
+    if isinstance(model, string_types):
+        model = get_model(model)()
+    model.volume_selection = False
+
+    if isinstance(parameters, collections.Mapping):
+        all_parameters = {}
+        nmr_rows = len(next(iter(parameters.values())))
+        for name, value in zip(model.get_free_param_names(), model.get_initial_parameters()):
+            all_parameters[name] = np.full(nmr_rows, value, dtype=np.float64)
+        all_parameters.update(parameters)
+        parameters = all_parameters
+
+    build_model, parameters = _prepare_simulation(model, protocol, parameters)
+    param_names = model.get_free_param_names()
+    s0_indices = get_s0_volume_indices(protocol)
+    critical_value = norm.ppf(0.5 + confidence_level / 2.0)
+
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    snr_seeds = [np.random.RandomState([seed, ind]).randint(2 ** 31) for ind in range(len(snrs))]
+
+    table = []
+    csv_file = None
+    if results_file is not None:
+        csv_file = open(results_file, 'w')
+        csv_file.write('snr,parameter,nmr_valid,bias,rmse,mae,coverage\n')
+
+    try:
+        for snr_ind, snr in enumerate(snrs):
+            statistics = np.zeros((len(param_names), 5))
+            has_stds = False
+
+            for start in range(0, parameters.shape[0], chunk_size):
+                rows = slice(start, min(start + chunk_size, parameters.shape[0]))
+                signals = CalculateModelEstimates().calculate(build_model, parameters[rows])
+                noise_level = np.mean(signals[:, s0_indices], axis=1, dtype=np.float64)[:, None] / snr
+
+                noisy_signals = _add_noise(signals, noise_level, noise_type, snr_seeds[snr_ind], nmr_repeats,
+                                           row_offset=start)
+                noisy_signals = np.reshape(noisy_signals, (-1, signals.shape[1]))
+
+                mask = np.ones((noisy_signals.shape[0], 1, 1), dtype=np.bool)
+                input_data = SimpleMRIInputData(protocol, noisy_signals[:, None, None, :], mask, None,
+                                                noise_std=np.repeat(noise_level, nmr_repeats)[:, None, None])
+                results = create_roi(fit_model(model, input_data, None, optimizer=optimizer,
+                                               cl_device_ind=cl_device_ind, double_precision=double_precision,
+                                               save_user_script_info=False, post_processing=post_processing), mask)
+
+                true_values = np.repeat(parameters[rows], nmr_repeats, axis=0)
+                for param_ind, name in enumerate(param_names):
+                    statistics[param_ind] += _get_recovery_statistics(true_values[:, param_ind], results, name,
+                                                                      critical_value)
+                has_stds = all('{}.std'.format(name) in results for name in param_names)
+
+            for param_ind, name in enumerate(param_names):
+                nmr_valid, error_sum, squared_error_sum, absolute_error_sum, nmr_covered = statistics[param_ind]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    row = collections.OrderedDict([
+                        ('snr', snr), ('parameter', name), ('nmr_valid', int(nmr_valid)),
+                        ('bias', error_sum / nmr_valid), ('rmse', np.sqrt(squared_error_sum / nmr_valid)),
+                        ('mae', absolute_error_sum / nmr_valid),
+                        ('coverage', nmr_covered / nmr_valid if has_stds else np.nan)])
+                table.append(row)
+
+                if csv_file is not None:
+                    csv_file.write(','.join(str(value) for value in row.values()) + '\n')
+                    csv_file.flush()
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    return table
+
+
+def _get_recovery_statistics(true_values, results, param_name, critical_value):
+    """Get the sums needed for the recovery statistics of one parameter in one chunk.
+
+    Args:
+        true_values (ndarray): the true value per problem
+        results (dict): the ROI results of the fit
+        param_name (str): the name of the parameter
+        critical_value (float): the critical value of the normal distribution for the confidence intervals
+
+    Returns:
+        ndarray: the number of finite estimates, the sum of the errors, of the squared errors and of the absolute
+            errors and the number of confidence intervals containing the true value.
+    """
+    estimates = np.reshape(results[param_name], (-1,)).astype(np.float64)
+    errors = estimates - true_values
+    valid = np.isfinite(errors)
+
+    nmr_covered = 0
+    std_name = '{}.std'.format(param_name)
+    if std_name in results:
+        stds = np.reshape(results[std_name], (-1,))
+        with np.errstate(invalid='ignore'):
+            nmr_covered = np.count_nonzero(valid & (np.abs(errors) <= critical_value * stds))
+
+    errors = errors[valid]
+    return np.array([errors.shape[0], np.sum(errors), np.sum(errors ** 2), np.sum(np.abs(errors)), nmr_covered])
+
+
+_NOISE_BLOCK_SIZE = 4096
+"""The number of rows sharing a random stream, fixed such that the noise does not depend on the batching."""
+
+
+def _add_noise(signals, noise_level, noise_type, seed, nmr_realizations, row_offset=0):
+    """Add noise to the given signals, in parallel over blocks of rows.
+
+    Args:
+        signals (ndarray): the signals to add noise to
+        noise_level (float or ndarray): the noise standard deviation, broadcastable to the signals
+        noise_type (str): either 'rician' or 'gaussian'
+        seed (int): the seed for the random streams
+        nmr_realizations (int or None): the number of realizations, if set we add a second dimension to the output
+        row_offset (int): the index of the first row of these signals in the complete set of rows, this positions the
+            signals in the blocks of the random streams.
+
+    Returns:
+        ndarray: the noisy signals
+    """
+    if noise_type not in ('rician', 'gaussian'):
+        raise ValueError('The noise type "{}" is not supported, use "rician" or "gaussian".'.format(noise_type))
+
+    noise_level = np.asarray(noise_level)
+    rows_per_level = noise_level.ndim == signals.ndim and noise_level.shape[0] == signals.shape[0]
+
+    output_shape = signals.shape[:1] + ((nmr_realizations,) if nmr_realizations is not None else ()) + signals.shape[1:]
+    noisy_signals = np.zeros(output_shape, dtype=signals.dtype)
+
+    def add_block_noise(block_index):
+        block_start = block_index * _NOISE_BLOCK_SIZE - row_offset
+        rows = slice(max(block_start, 0), min(block_start + _NOISE_BLOCK_SIZE, signals.shape[0]))
+
+        block_signals = signals[rows].astype(np.float64)
+        block_level = noise_level[rows] if rows_per_level else noise_level
+
+        for realization in range(nmr_realizations or 1):
+            random_state = np.random.RandomState([seed, block_index, realization])
+            target = (rows, realization) if nmr_realizations is not None else rows
+            noisy_signals[target] = _sample_noisy_signals(random_state, block_signals, block_level, noise_type,
+                                                          rows.start - block_start)
+
+    first_block = row_offset // _NOISE_BLOCK_SIZE
+    last_block = (row_offset + signals.shape[0] - 1) // _NOISE_BLOCK_SIZE
+    block_indices = list(range(first_block, last_block + 1))
+
+    if len(block_indices) > 1:
+        pool = ThreadPool(min(cpu_count(), len(block_indices)))
+        try:
+            pool.map(add_block_noise, block_indices)
+        finally:
+            pool.close()
+    else:
+        for block_index in block_indices:
+            add_block_noise(block_index)
+    return noisy_signals
+
+
+def _sample_noisy_signals(random_state, signals, noise_level, noise_type, skip):
+    """Sample the noisy signals of (a part of) a block of rows from the random stream of that block.
+
+    The random values are drawn row by row, such that the values of a row only depend on its position in the block.
+
+    Args:
+        random_state (numpy.random.RandomState): the random stream of the block
+        signals (ndarray): the signals of the rows in the block we are interested in
+        noise_level (float or ndarray): the noise standard deviation, broadcastable to the signals
+        noise_type (str): either 'rician' or 'gaussian'
+        skip (int): the number of rows at the start of the block not present in the signals, the random values of
+            these rows are drawn and discarded
+
+    Returns:
+        ndarray: the noisy signals
+    """
+    nmr_components = 2 if noise_type == 'rician' else 1
+    noise = random_state.normal(size=(skip + signals.shape[0], nmr_components) + signals.shape[1:])[skip:]
+
+    x = signals + noise_level * noise[:, 0]
+    if noise_type == 'gaussian':
+        return x
+    return np.sqrt(x ** 2 + (noise_level * noise[:, 1]) ** 2)
+
+
+def _get_noise_level_per_row(noise_level, nmr_rows):
+    """Get the noise level as a (n, 1) array, with one noise level per parameter row."""
+    noise_level = np.asarray(noise_level, dtype=np.float64)
+    if noise_level.size == 1:
+        return np.full((nmr_rows, 1), noise_level.item())
+    return np.reshape(noise_level, (nmr_rows, 1))
@@ -3,13 +3,19 @@
 For example, in some applications it can be desired to sort volume fractions voxel-wise over an entire volume. This
 module contains functions for creating sort index matrices (determining the sort order), sorting volumes and lists
 and anti-sorting volumes (reversing the sort operation based on the sort index).
+
+All routines work on volumes (3d or 4d arrays with the voxels on the first three dimensions), on ROI arrays (1d or 2d
+arrays with the voxels on the first dimension, see :func:`mdt.utils.create_roi`) and on filenames of nifti files. The
+voxels are processed in batches, volumes in slabs over the third dimension, which bounds the memory usage and allows
+nifti files to be read slab by slab instead of being loaded completely. If a mask is given, only the voxels in the
+mask are sorted.
 """
 import collections
 from copy import copy
-import itertools
 import numpy as np
 from six import string_types
-from mdt.nifti import get_all_nifti_data, load_nifti
+from mdt.nifti import get_all_nifti_data, load_all_niftis, load_nifti
+from mdt.utils import get_mask_index, restore_volumes
 
 
 __author__ = 'Robbert Harms'
@@ -19,10 +25,10 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
-def sort_orientations(data_input, weight_names, extra_sortable_maps):
+def sort_orientations(data_input, weight_names, extra_sortable_maps, mask=None, batch_size=100000):
     """Sort the orientations of multi-direction models voxel-wise.
 
-    This expects as input 3d/4d volumes. Do not use this with 2d arrays.
+    This expects as input 3d/4d volumes or 1d/2d ROI arrays.
 
     This can be used to sort, for example, simulations of the BallStick_r3 model (with three Sticks).
     There is no voxel-wise order over Sticks since for the model they are all equal compartments.
@@ -48,114 +54,95 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
         extra_sortable_maps (iterable of iterable): the list of additional maps to sort. Every element in the given
             list should be another list with the names of the maps. The length of these second layer of lists should
             match the length of the ``weight_names``.
+        mask (str or ndarray or mdt.utils.MaskIndex): if given, we only sort the voxels in this mask.
+            The sorted volumes are zero outside of the mask.
+        batch_size (int): the number of voxels we sort at once
 
     Returns:
         dict: the sorted results in a new dictionary. This returns all input maps with some of them sorted.
     """
+    weight_names = list(weight_names)
+    sortable_maps = [list(names) for names in extra_sortable_maps]
+    sortable_maps.append(weight_names)
+    map_names = set(name for names in sortable_maps for name in names)
+
     if isinstance(data_input, string_types):
-        input_maps = get_all_nifti_data(data_input)
-        result_maps = input_maps
+        result_maps = get_all_nifti_data(data_input)
+        input_maps = {name: nifti.dataobj for name, nifti in load_all_niftis(data_input, map_names=map_names).items()}
     else:
-        input_maps = data_input
-        result_maps = copy(input_maps)
+        result_maps = copy(data_input)
+        input_maps = {name: data_input[name] for name in map_names}
 
-    weight_names = list(weight_names)
-    sortable_maps = copy(extra_sortable_maps)
-    sortable_maps.append(weight_names)
+    mask_index = None if mask is None else get_mask_index(mask)
+    roi_maps = {name: _load_map(value, mask_index) for name, value in input_maps.items()}
 
-    sort_index_matrix = create_sort_matrix([input_maps[k] for k in weight_names], reversed_sort=True)
+    sort_index = _create_sort_index([roi_maps[name] for name in weight_names], True, batch_size)
 
     for sortable_map_names in sortable_maps:
-        sorted = dict(zip(sortable_map_names, sort_volumes_per_voxel([input_maps[k] for k in sortable_map_names],
-                                                                     sort_index_matrix)))
-        result_maps.update(sorted)
+        sorted_maps = _sort_per_voxel([roi_maps[name] for name in sortable_map_names], sort_index, batch_size)
+        result_maps.update((name, _restore_map(sorted_map, input_maps[name], mask_index))
+                           for name, sorted_map in zip(sortable_map_names, sorted_maps))
 
     return result_maps
 
 
-def create_sort_matrix(input_volumes, reversed_sort=False):
-    """Create an index matrix that sorts the given input on the 4th dimension from small to large values (per element).
+def create_sort_matrix(input_volumes, reversed_sort=False, mask=None, batch_size=100000):
+    """Create an index matrix that sorts the given input on the last dimension from small to large values (per element).
 
     Args:
         input_volumes (ndarray or list): either a list with 3d volumes (or 4d with a singleton on the fourth dimension),
-            or a 4d volume to use directly.
+            1d ROI arrays (or 2d with a singleton on the second dimension) or filenames, or a 4d volume or 2d ROI array
+            to use directly.
         reversed_sort (boolean): if True we reverse the sort and we sort from large to small.
+        mask (str or ndarray or mdt.utils.MaskIndex): if given, we only sort the voxels in this mask.
+            The sort index is zero outside of the mask.
+        batch_size (int): the number of voxels we sort at once
 
     Returns:
-        ndarray: a 4d matrix with on the 4th dimension the indices of the elements in sorted order.
+        ndarray: a 4d matrix (for volumes) or 2d matrix (for ROI arrays) with on the last dimension the indices of
+            the elements in sorted order.
     """
-    def load_maps(map_list):
-        tmp = []
-        for data in map_list:
-            if isinstance(data, string_types):
-                data = load_nifti(data).get_data()
-
-            if len(data.shape) < 4:
-                data = data[..., None]
-
-            if data.shape[3] > 1:
-                raise ValueError('Can not sort input volumes where one has more than one items on the 4th dimension.')
-
-            tmp.append(data)
-        return tmp
+    mask_index = None if mask is None else get_mask_index(mask)
 
     if isinstance(input_volumes, collections.Sequence):
-        maps_to_sort_on = load_maps(input_volumes)
-        input_4d_vol = np.concatenate([m for m in maps_to_sort_on], axis=3)
+        maps = [_load_map(data, mask_index) for data in input_volumes]
+        if any(_get_nmr_elements(data) > 1 for data in maps):
+            raise ValueError('Can not sort input volumes where one has more than one items on the last dimension.')
+        original = input_volumes[0]
     else:
-        input_4d_vol = input_volumes
+        maps = [_load_map(input_volumes, mask_index)]
+        original = input_volumes
 
-    sort_index = np.argsort(input_4d_vol, axis=3)
+    return _restore_map(_create_sort_index(maps, reversed_sort, batch_size), original, mask_index)
 
-    if reversed_sort:
-        return sort_index[..., ::-1]
 
-    return sort_index
-
-
-def sort_volumes_per_voxel(input_volumes, sort_matrix):
+def sort_volumes_per_voxel(input_volumes, sort_matrix, mask=None, batch_size=100000):
     """Sort the given volumes per voxel using the sort index in the given matrix.
 
     What this essentially does is to look per voxel from which map we should take the first value. Then we place that
     value in the first volume and we repeat for the next value and finally for the next voxel.
 
-    If the length of the 4th dimension is > 1 we shift the 4th dimension to the 5th dimension and sort
-    the array as if the 4th dimension values where a single value. This is useful for sorting (eigen)vector matrices.
+    If the length of the last dimension is > 1 we sort the array as if the values on the last dimension were a
+    single value. This is useful for sorting (eigen)vector matrices.
 
     Args:
-        input_volumes (:class:`list`): list of 4d ndarray
-        sort_matrix (ndarray): 4d ndarray with for every voxel the sort index
+        input_volumes (:class:`list`): list of 3d/4d volumes, 1d/2d ROI arrays or filenames
+        sort_matrix (ndarray): 4d volume or 2d ROI array with for every voxel the sort index
+        mask (str or ndarray or mdt.utils.MaskIndex): if given, we only sort the voxels in this mask.
+            The sorted volumes are zero outside of the mask.
+        batch_size (int): the number of voxels we sort at once
 
     Returns:
         :class:`list`: the same input volumes but then with every voxel sorted according to the given sort index.
+            Volumes are returned as 4d volumes, ROI arrays keep their shape.
     """
-    def load_maps(map_list):
-        tmp = []
-        for data in map_list:
-            if isinstance(data, string_types):
-                data = load_nifti(data).get_data()
-
-            if len(data.shape) < 4:
-                data = data[..., None]
-
-            tmp.append(data)
-        return tmp
-
-    input_volumes = load_maps(input_volumes)
-
-    if input_volumes[0].shape[3] > 1:
-        volume = np.concatenate([np.reshape(m, m.shape[0:3] + (1,) + (m.shape[3],)) for m in input_volumes], axis=3)
-        grid = np.ogrid[[slice(x) for x in volume.shape]]
-        sorted_volume = volume[list(grid[:-2]) + [np.reshape(sort_matrix, sort_matrix.shape + (1,))] + list(grid[-1])]
-        return [sorted_volume[..., ind, :] for ind in range(len(input_volumes))]
-    else:
-        volume = np.concatenate([m for m in input_volumes], axis=3)
-        sorted_volume = volume[list(np.ogrid[[slice(x) for x in volume.shape]][:-1])+[sort_matrix]]
-        return [np.reshape(sorted_volume[..., ind], sorted_volume.shape[0:3] + (1,))
-                for ind in range(len(input_volumes))]
+    mask_index = None if mask is None else get_mask_index(mask)
+    sorted_maps = _sort_per_voxel([_load_map(data, mask_index) for data in input_volumes],
+                                  _load_map(sort_matrix, mask_index), batch_size)
+    return [_restore_map(sorted_map, data, mask_index) for sorted_map, data in zip(sorted_maps, input_volumes)]
 
 
-def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
+def undo_sort_volumes_per_voxel(input_volumes, sort_matrix, mask=None, batch_size=100000):
     """Undo the voxel-wise sorting of volumes based on the original sort matrix.
 
     This uses the original sort matrix to place the elements back into the original order. For example, suppose we had
@@ -163,19 +150,187 @@ def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
     sort matrix [1, 2, 0] and results [b, c, a] return the original matrix [a, b, c].
 
     Args:
-        input_volumes (:class:`list`): list of 4d ndarray
-        sort_matrix (ndarray): 4d ndarray with for every voxel the sort index
+        input_volumes (:class:`list`): list of 3d/4d volumes, 1d/2d ROI arrays or filenames
+        sort_matrix (ndarray): 4d volume or 2d ROI array with for every voxel the sort index
+        mask (str or ndarray or mdt.utils.MaskIndex): if given, we only anti-sort the voxels in this mask.
+            The resulting volumes are zero outside of the mask.
+        batch_size (int): the number of voxels we anti-sort at once
 
     Returns:
         :class:`list`: the same input volumes but then with every voxel anti-sorted according to the given sort index.
+            Volumes are returned as 4d volumes, ROI arrays keep their shape.
     """
-    results = [np.zeros_like(vol) for vol in input_volumes]
+    mask_index = None if mask is None else get_mask_index(mask)
+    sorted_maps = _sort_per_voxel([_load_map(data, mask_index) for data in input_volumes],
+                                  _load_map(sort_matrix, mask_index), batch_size, undo=True)
+    return [_restore_map(sorted_map, data, mask_index) for sorted_map, data in zip(sorted_maps, input_volumes)]
 
-    shape = input_volumes[0].shape
 
-    for x, y, z in itertools.product(range(shape[0]), range(shape[1]), range(shape[2])):
-        for ind, sort_ind in enumerate(list(sort_matrix[x, y, z])):
-            results[sort_ind][x, y, z] = input_volumes[ind][x, y, z]
+def _create_sort_index(maps, reversed_sort, batch_size):
+    """Create the sort index over the given maps, batch by batch.
 
+    Args:
+        maps (list): the volumes or ROI arrays to sort on, all should have the same voxels
+        reversed_sort (boolean): if we sort from large to small instead of small to large
+        batch_size (int): the number of voxels we sort at once
+
+    Returns:
+        ndarray: the sort index with the voxels on the first dimension(s) and the indices on the last dimension
+    """
+    nmr_spatial_dims = _get_nmr_spatial_dims(maps[0])
+    _check_voxel_shapes(maps, maps[0].shape[:nmr_spatial_dims])
+
+    sort_index = None
+    for batch in _get_batches(maps[0].shape[:nmr_spatial_dims], batch_size):
+        index = np.argsort(np.concatenate([_get_rows(data, batch) for data in maps], axis=1), axis=1)
+        if reversed_sort:
+            index = index[:, ::-1]
+
+        if sort_index is None:
+            sort_index = np.zeros(maps[0].shape[:nmr_spatial_dims] + (index.shape[1],), dtype=index.dtype)
+        sort_index[batch] = np.reshape(index, sort_index[batch].shape)
+    return sort_index
+
+
+def _sort_per_voxel(maps, sort_index, batch_size, undo=False):
+    """Sort, or anti-sort, the given maps per voxel, batch by batch.
+
+    Per batch, the values of all maps are stacked in a (voxels, maps, elements) array which is then gathered (for
+    sorting) or scattered (for undoing the sort) over the second dimension using the sort index. This is done with
+    flat indices over the first two dimensions, which is faster than the equivalent two dimensional fancy indexing.
+
+    Args:
+        maps (list): the volumes or ROI arrays to sort, all should have the same voxels as the sort index
+        sort_index (ndarray): the sort index, with the voxels on the first dimension(s)
+        batch_size (int): the number of voxels we sort at once
+        undo (boolean): if we undo the sorting instead of sorting
+
+    Returns:
+        list: the sorted maps, volumes are returned as 4d volumes and ROI arrays keep their shape
+    """
+    nmr_spatial_dims = len(sort_index.shape) - 1
+    if len(maps) != sort_index.shape[-1]:
+        raise ValueError('The number of maps ({}) does not match the size of the sort index ({}).'.format(
+            len(maps), sort_index.shape[-1]))
+    _check_voxel_shapes(maps, sort_index.shape[:nmr_spatial_dims])
+
+    results = None
+    for batch in _get_batches(sort_index.shape[:nmr_spatial_dims], batch_size):
+        index = _get_rows(sort_index, batch)
+        if not np.issubdtype(index.dtype, np.integer):
+            index = np.round(index).astype(np.int64)
+
+        values = np.concatenate([_get_rows(data, batch)[:, None, :] for data in maps], axis=1)
+        flat_index = np.reshape(np.arange(index.shape[0])[:, None] * len(maps) + index, (-1,))
+        flat_values = np.reshape(values, (-1, values.shape[2]))
+
+        if undo:
+            permuted = np.zeros_like(flat_values)
+            permuted[flat_index] = flat_values
+        else:
+            permuted = np.take(flat_values, flat_index, axis=0)
+        permuted = np.reshape(permuted, values.shape)
+
+        if results is None:
+            results = [np.zeros(_get_output_shape(data), dtype=permuted.dtype) for data in maps]
+        for ind, result in enumerate(results):
+            result[batch] = np.reshape(permuted[:, ind], result[batch].shape)
     return results
 
+
+def _load_map(data, mask_index=None):
+    """Prepare a map for sorting.
+
+    Filenames are opened as nibabel array proxies, such that we can read the data slab by slab. If a mask is given,
+    volumes are converted to ROI arrays.
+
+    Args:
+        data (str or ndarray): the filename, volume or ROI array
+        mask_index (mdt.utils.MaskIndex): the mask index to use for converting volumes to ROI arrays
+
+    Returns:
+        ndarray or nibabel proxy: the data to sort
+    """
+    if isinstance(data, string_types):
+        data = load_nifti(data).dataobj
+    if mask_index is not None and len(data.shape) >= 3:
+        return mask_index.gather(np.asarray(data))
+    return data
+
+
+def _restore_map(data, original, mask_index=None):
+    """Convert a map in ROI space back to a volume if the original map was a volume and a mask was used.
+
+    Args:
+        data (ndarray): the map as computed
+        original (str or ndarray): the original input map
+        mask_index (mdt.utils.MaskIndex): the mask index used for converting volumes to ROI arrays
+
+    Returns:
+        ndarray: the map as a volume or ROI array, depending on the original input
+    """
+    if mask_index is not None and (isinstance(original, string_types) or len(original.shape) >= 3):
+        return restore_volumes(data, mask_index)
+    return data
+
+
+def _get_nmr_spatial_dims(data):
+    """Get the number of dimensions indexing the voxels, three for volumes and one for ROI arrays."""
+    return 3 if len(data.shape) >= 3 else 1
+
+
+def _get_nmr_elements(data):
+    """Get the number of elements per voxel of the given volume or ROI array."""
+    return int(np.prod(data.shape[_get_nmr_spatial_dims(data):]))
+
+
+def _get_output_shape(data):
+    """Get the shape of a sorted map, volumes are always 4d while ROI arrays keep their shape."""
+    if len(data.shape) == 3:
+        return tuple(data.shape) + (1,)
+    return tuple(data.shape)
+
+
+def _check_voxel_shapes(maps, voxel_shape):
+    """Check if all the given maps have the given voxel shape, raises a ValueError if not."""
+    for data in maps:
+        if tuple(data.shape[:len(voxel_shape)]) != tuple(voxel_shape) \
+                or _get_nmr_spatial_dims(data) != len(voxel_shape):
+            raise ValueError('The map with shape {} does not match the voxels of shape {}.'.format(
+                tuple(data.shape), tuple(voxel_shape)))
+
+
+def _get_batches(voxel_shape, batch_size):
+    """Get the indices for processing the voxels in batches.
+
+    Volumes are divided in slabs over the third dimension, matching the (Fortran) ordering of nifti files on disk.
+
+    Args:
+        voxel_shape (tuple): the shape of the voxel dimensions, three dimensional for volumes or one dimensional for
+            ROI arrays
+        batch_size (int): the maximum number of voxels per batch, volumes use at least one slice per batch
+
+    Returns:
+        generator: yields tuples of slices, one per voxel dimension
+    """
+    if len(voxel_shape) == 3:
+        step = max(batch_size // max(voxel_shape[0] * voxel_shape[1], 1), 1)
+        for start in range(0, voxel_shape[2], step):
+            yield (slice(None), slice(None), slice(start, min(start + step, voxel_shape[2])))
+    else:
+        for start in range(0, voxel_shape[0], batch_size):
+            yield (slice(start, min(start + batch_size, voxel_shape[0])),)
+
+
+def _get_rows(data, batch):
+    """Get the data of a batch of voxels as a two dimensional (voxels, elements) array.
+
+    Args:
+        data (ndarray or nibabel proxy): the volume or ROI array
+        batch (tuple): the batch indices, as generated by :func:`_get_batches`
+
+    Returns:
+        ndarray: the (voxels, elements) array with the data of the batch
+    """
+    chunk = np.asarray(data[batch])
+    return np.reshape(chunk, (int(np.prod(chunk.shape[:len(batch)])), _get_nmr_elements(data)))
@@ -105,6 +105,15 @@ class MRIInputData(object):
         """
         raise NotImplementedError()
 
+    @property
+    def has_noise_std(self):
+        """If the noise standard deviation was given or estimated, instead of a fallback value.
+
+        Returns:
+            boolean: False if the noise std is a fallback value without relation to the data, True otherwise
+        """
+        return True
+
     @property
     def protocol(self):
         """Return the protocol data stored in this input data container.
@@ -141,6 +150,15 @@ class MRIInputData(object):
         """
         raise NotImplementedError()
 
+    @property
+    def mask_index(self):
+        """Return the index of the mask in use, for fast conversions between volumes and ROI arrays.
+
+        Returns:
+            MaskIndex: the index of the mask
+        """
+        return get_mask_index(self.mask)
+
     @property
     def gradient_deviations(self):
         """Get the gradient deviations matrix to use in model fitting.
@@ -201,15 +219,32 @@ class SimpleMRIInputData(MRIInputData):
                 Q1_Release_Appendix_II.pdf``).
             noise_std (number or ndarray): either None for automatic detection,
                 or a scalar, or an 3d matrix with one value per voxel.
+
+        The mask can also be given as a :class:`MaskIndex`, which is then used for all conversions between volumes
+        and ROI arrays.
+
+        The signal can be given for the full field of view of the mask or already cropped to the bounding box of
+        the mask (see :class:`BoundingBox`). All processing is done on the signal within the bounding box, the
+        full field of view signal is only reconstructed when requested with :attr:`signal4d`.
         """
         self._logger = logging.getLogger(__name__)
         self._signal4d = signal4d
         self._nifti_header = nifti_header
+        self._mask_index = None
+        if isinstance(mask, MaskIndex):
+            self._mask_index = mask
+            mask = mask.mask
         self._mask = mask
+        self._bounding_box = None
+        self._cropped_signal4d = signal4d
+        if signal4d is not None and mask is not None:
+            self._bounding_box = BoundingBox.from_mask(mask)
+            self._cropped_signal4d = self._bounding_box.crop(signal4d)
         self._protocol = protocol
         self._observation_list = None
         self._protocol_maps = protocol_maps or {}
         self._noise_std = noise_std
+        self._noise_std_is_fallback = False
         self._gradient_deviations = gradient_deviations
 
         if protocol.length != 0:
@@ -250,6 +285,9 @@ class SimpleMRIInputData(MRIInputData):
         for key, value in kwargs.items():
             new_kwargs[key] = value
 
+        if new_args[2] is not self._mask and new_args[1] is self._cropped_signal4d:
+            new_args[1] = self.signal4d
+
         return self.__class__(*new_args, **new_kwargs)
 
     def _get_constructor_args(self):
@@ -258,9 +296,9 @@ class SimpleMRIInputData(MRIInputData):
         Returns:
             tuple: args and kwargs tuple
         """
-        args = [self._protocol, self.signal4d, self._mask, self.nifti_header]
+        args = [self._protocol, self._cropped_signal4d, self._mask, self.nifti_header]
         kwargs = dict(protocol_maps=self._protocol_maps, gradient_deviations=self.gradient_deviations,
-                      noise_std=self._noise_std)
+                      noise_std=None if self._noise_std_is_fallback else self._noise_std)
         return args, kwargs
 
     def get_subset(self, volumes_to_keep=None, volumes_to_remove=None):
@@ -283,9 +321,9 @@ class SimpleMRIInputData(MRIInputData):
         if self.protocol is not None:
             new_protocol = self.protocol.get_new_protocol_with_indices(volumes_to_keep)
 
-        new_dwi_volume = self.signal4d
-        if self.signal4d is not None:
-            new_dwi_volume = self.signal4d[..., volumes_to_keep]
+        new_dwi_volume = self._cropped_signal4d
+        if self._cropped_signal4d is not None:
+            new_dwi_volume = self._cropped_signal4d[..., volumes_to_keep]
 
         return self.copy_with_updates(new_protocol, new_dwi_volume)
 
@@ -299,6 +337,13 @@ class SimpleMRIInputData(MRIInputData):
 
     @property
     def signal4d(self):
+        """The signal of the full field of view.
+
+        If the signal was given cropped to the bounding box of the mask, this pads the signal to the full field of
+        view with zeros. Please note that in that case this allocates a new volume on every call.
+        """
+        if self._bounding_box is not None and self._signal4d.shape[:3] != self._bounding_box.full_shape:
+            return self._bounding_box.pad(self._signal4d)
         return self._signal4d
 
     @property
@@ -316,7 +361,11 @@ class SimpleMRIInputData(MRIInputData):
     @property
     def observations(self):
         if self._observation_list is None:
-            self._observation_list = create_roi(self.signal4d, self._mask)
+            if self._bounding_box is None:
+                self._observation_list = create_roi(self._signal4d, self.mask_index)
+            else:
+                self._observation_list = create_roi(self._cropped_signal4d,
+                                                    self._bounding_box.crop(load_brain_mask(self._mask)))
         return self._observation_list
 
     @property
@@ -328,6 +377,12 @@ class SimpleMRIInputData(MRIInputData):
         """
         return self._mask
 
+    @property
+    def mask_index(self):
+        if self._mask_index is None:
+            self._mask_index = MaskIndex(self._mask)
+        return self._mask_index
+
     @property
     def protocol_maps(self):
         if self._protocol_maps is not None:
@@ -338,9 +393,9 @@ class SimpleMRIInputData(MRIInputData):
                 loaded_val = None
 
                 if isinstance(val, six.string_types):
-                    loaded_val = create_roi(load_nifti(val).get_data(), self.mask)
+                    loaded_val = create_roi(load_nifti(val).get_data(), self.mask_index)
                 elif isinstance(val, np.ndarray):
-                    loaded_val = create_roi(val, self.mask)
+                    loaded_val = create_roi(val, self.mask_index)
                 elif is_scalar(val):
                     loaded_val = val
 
@@ -359,6 +414,7 @@ class SimpleMRIInputData(MRIInputData):
                 except NoiseStdEstimationNotPossible:
                     self._logger.warning('Failed to obtain a noise std for this subject. '
                                          'We will continue with an std of 1.')
+                    self._noise_std_is_fallback = True
                     return 1
 
             if isinstance(self._noise_std, (numbers.Number, np.ndarray)):
@@ -372,6 +428,7 @@ class SimpleMRIInputData(MRIInputData):
                 return load_nifti(filename).get_data()
 
             self._logger.warning('Failed to obtain a noise std for this subject. We will continue with an std of 1.')
+            self._noise_std_is_fallback = True
             return 1
 
         self._noise_std = _compute_noise_std()
@@ -379,7 +436,12 @@ class SimpleMRIInputData(MRIInputData):
         if is_scalar(self._noise_std):
             return self._noise_std
         else:
-            return create_roi(self._noise_std, self.mask)
+            return create_roi(self._noise_std, self.mask_index)
+
+    @property
+    def has_noise_std(self):
+        self.noise_std
+        return not self._noise_std_is_fallback
 
 
 class MockMRIInputData(SimpleMRIInputData):
@@ -396,7 +458,7 @@ class MockMRIInputData(SimpleMRIInputData):
         Returns:
             tuple: args and kwargs tuple
         """
-        args = [self._protocol, self.signal4d, self._mask, self.nifti_header]
+        args = [self._protocol, self._cropped_signal4d, self._mask, self.nifti_header]
         kwargs = {}
         return args, kwargs
 
@@ -446,6 +508,8 @@ def load_input_data(volume_info, protocol, mask, protocol_maps=None, gradient_de
     if isinstance(gradient_deviations, six.string_types):
         gradient_deviations = load_nifti(gradient_deviations).get_data()
 
+    signal4d = BoundingBox.from_mask(mask).crop(signal4d, copy=True)
+
     return SimpleMRIInputData(protocol, signal4d, mask, img_header, protocol_maps=protocol_maps, noise_std=noise_std,
                               gradient_deviations=gradient_deviations)
 
@@ -541,7 +605,7 @@ class SimpleInitializationData(InitializationData):
             if isinstance(v, AbstractParameterDependency):
                 return v
 
-            return create_roi(v, input_data.mask)
+            return create_roi(v, input_data.mask_index)
 
         if len(self._inits):
             model.set_initial_parameters(DeferredActionDict(prepare_value, self.get_inits()))
@@ -820,21 +884,18 @@ def create_roi(data, brain_mask):
         data (string, ndarray or dict): a brain volume with four dimensions (x, y, z, w)
             where w is the length of the protocol, or a list, tuple or dictionary with volumes or a string
             with a filename of a dataset to use or a directory with the containing maps to load.
-        brain_mask (ndarray or str): the mask indicating the region of interest with dimensions: (x, y, z) or the string
-            to the brain mask to use
+        brain_mask (ndarray, str or MaskIndex): the mask indicating the region of interest with dimensions: (x, y, z),
+            the string to the brain mask to use or a :class:`MaskIndex`.
 
     Returns:
         ndarray, tuple, dict: If a single ndarray is given we will return the ROI for that array. If
             an iterable is given we will return a tuple. If a dict is given we return a dict.
             For each result the axis are: (voxels, protocol)
     """
-    brain_mask = load_brain_mask(brain_mask)
+    brain_mask = get_mask_index(brain_mask)
 
     def creator(v):
-        return_val = v[brain_mask]
-        if len(return_val.shape) == 1:
-            return_val = np.expand_dims(return_val, axis=1)
-        return return_val
+        return brain_mask.gather(v)
 
     if isinstance(data, (dict, collections.Mapping)):
         return DeferredActionDict(lambda _, item: create_roi(item, brain_mask), data)
@@ -847,6 +908,222 @@ def create_roi(data, brain_mask):
     return creator(data)
 
 
+class BoundingBox(object):
+
+    def __init__(self, slices, full_shape):
+        """The bounding box of a mask, used to do all voxel wise processing on the smallest possible grid.
+
+        Volumes are cropped to the bounding box for processing and only padded back to the full field of view for
+        the final output. Since the padded volumes have the same shape as the original volumes, they can be written
+        with the original nifti header, preserving the voxel to world mapping.
+
+        Args:
+            slices (tuple): the three slices (one per spatial dimension) of the bounding box in the full volume
+            full_shape (tuple): the spatial shape of the full volume
+        """
+        self.slices = tuple(slices)
+        self.full_shape = tuple(full_shape)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Get the bounding box of the non-zero voxels of the given mask.
+
+        Args:
+            mask (ndarray or str): the mask, or the path to the mask, see :func:`load_brain_mask`
+
+        Returns:
+            BoundingBox: the smallest box containing all voxels in the mask. If the mask is empty, the box covers
+                the whole volume.
+        """
+        mask = load_brain_mask(mask)
+
+        slices = []
+        for axis in range(3):
+            nonzero = np.where(np.any(mask, axis=tuple(ind for ind in range(3) if ind != axis)))[0]
+            if not len(nonzero):
+                return cls([slice(0, length) for length in mask.shape[:3]], mask.shape[:3])
+            slices.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+        return cls(slices, mask.shape[:3])
+
+    @property
+    def shape(self):
+        """The spatial shape of the bounding box."""
+        return tuple(s.stop - s.start for s in self.slices)
+
+    @property
+    def offset(self):
+        """The position of the first voxel of the bounding box in the full volume, as an (1, 3) array."""
+        return np.array([[s.start for s in self.slices]])
+
+    def crop(self, volume, copy=False):
+        """Crop the given volume to this bounding box.
+
+        Volumes which are already of the shape of this bounding box are returned as is.
+
+        Args:
+            volume (ndarray): the volume with at least three dimensions
+            copy (boolean): if we return a copy of the cropped data instead of a view on the given volume. Use this
+                to be able to release the memory of the full volume.
+
+        Returns:
+            ndarray: the cropped volume
+        """
+        if volume.shape[:3] != self.full_shape or self.shape == self.full_shape:
+            return volume
+        if copy:
+            return np.array(volume[self.slices])
+        return volume[self.slices]
+
+    def pad(self, volume):
+        """Pad the given cropped volume with zeros to the full field of view.
+
+        Args:
+            volume (ndarray): a volume with the shape of this bounding box in the first three dimensions
+
+        Returns:
+            ndarray: a volume of the full field of view with the given volume at the position of this bounding box
+        """
+        if self.shape == self.full_shape:
+            return volume
+        padded = np.zeros(self.full_shape + volume.shape[3:], dtype=volume.dtype)
+        padded[self.slices] = volume
+        return padded
+
+
+class MaskIndex(object):
+
+    def __init__(self, mask):
+        """Precomputed indices of the voxels in a mask, for fast conversions between volumes and ROI arrays.
+
+        Computing the positions of the voxels in a mask requires a pass over the whole volume. This object does that
+        once and can then be used to gather the ROI of many volumes (:meth:`gather`) or to restore many ROI arrays
+        to volumes (:meth:`scatter`). It can be used everywhere a mask is accepted, for example in
+        :func:`create_roi` and :func:`restore_volumes`.
+
+        The ROI order is the C-order of the voxels in the mask, the same order as boolean indexing with the mask.
+
+        Args:
+            mask (ndarray or str): the mask or the path to the mask, see :func:`load_brain_mask`
+        """
+        self.mask = np.array(load_brain_mask(mask), dtype=np.bool)
+        self.mask.flags.writeable = False
+        self.flat_indices = np.flatnonzero(self.mask)
+        self._coordinates = None
+        self._index_matrix = None
+
+    @property
+    def shape(self):
+        """The three dimensional shape of the mask."""
+        return self.mask.shape
+
+    @property
+    def nmr_voxels(self):
+        """The number of voxels in the mask."""
+        return len(self.flat_indices)
+
+    @property
+    def coordinates(self):
+        """The tuple with per axis the coordinates of the voxels in the mask, as returned by ``np.nonzero``."""
+        if self._coordinates is None:
+            self._coordinates = np.unravel_index(self.flat_indices, self.mask.shape)
+        return self._coordinates
+
+    @property
+    def positions(self):
+        """The (n, 3) array with the 3d position of every voxel in the mask, as returned by ``np.argwhere``."""
+        return np.column_stack(self.coordinates)
+
+    @property
+    def index_matrix(self):
+        """A volume with for every voxel in the mask its index in the ROI and -1 for all other voxels."""
+        if self._index_matrix is None:
+            self._index_matrix = np.full(self.mask.shape, -1, dtype=np.int64)
+            self._index_matrix.flat[self.flat_indices] = np.arange(self.nmr_voxels)
+            self._index_matrix.flags.writeable = False
+        return self._index_matrix
+
+    def gather(self, volume):
+        """Get the values of the voxels in the mask from the given volume.
+
+        Args:
+            volume (ndarray): a volume with at least three dimensions, the first three matching the mask
+
+        Returns:
+            ndarray: the ROI array with on the first axis the voxels, always at least two dimensional
+
+        Raises:
+            ValueError: if the first three dimensions of the volume do not match the mask
+        """
+        if tuple(volume.shape[:3]) != self.shape:
+            raise ValueError('The shape of the volume {} does not match the shape of the mask {}.'.format(
+                tuple(volume.shape), self.shape))
+
+        if isinstance(volume, np.ndarray) and volume.flags.c_contiguous:
+            roi = np.take(np.reshape(volume, (-1,) + volume.shape[3:]), self.flat_indices, axis=0)
+        else:
+            roi = np.asarray(volume[self.coordinates])
+
+        if len(roi.shape) == 1:
+            return np.expand_dims(roi, axis=1)
+        return roi
+
+    def scatter(self, roi, with_volume_dim=True):
+        """Restore the given ROI array to a volume, with zeros outside of the mask.
+
+        Args:
+            roi (ndarray): the ROI array with on the first axis the voxels
+            with_volume_dim (boolean): If true we always return values with at least 4 dimensions.
+                If false we return at least 3 dimensions.
+
+        Returns:
+            ndarray: the restored volume
+        """
+        roi = np.asarray(roi)
+        volume = np.zeros((self.mask.size,) + roi.shape[1:], dtype=roi.dtype, order='C')
+        volume[self.flat_indices] = roi
+        volume = np.reshape(volume, self.mask.shape + roi.shape[1:])
+
+        if with_volume_dim and len(roi.shape) < 2:
+            return np.expand_dims(volume, axis=3)
+        return volume
+
+
+_mask_index_cache = collections.OrderedDict()
+_MASK_INDEX_CACHE_SIZE = 8
+
+
+def get_mask_index(mask):
+    """Get the :class:`MaskIndex` for the given mask.
+
+    Masks given as filename are cached, keyed by their path, modification time and size, such that the same mask file
+    is loaded and indexed only once. Masks given as array are indexed on every call, to reuse the index for arrays
+    create a :class:`MaskIndex` once and pass that instead of the array.
+
+    Args:
+        mask (ndarray, str or MaskIndex): the mask, the path to the mask or an existing mask index
+
+    Returns:
+        MaskIndex: the index for the given mask
+    """
+    if isinstance(mask, MaskIndex):
+        return mask
+
+    if isinstance(mask, six.string_types):
+        path = os.path.realpath(mask)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+
+        if key in _mask_index_cache:
+            _mask_index_cache[key] = _mask_index_cache.pop(key)
+        else:
+            _mask_index_cache[key] = MaskIndex(load_nifti(path).get_data())
+            while len(_mask_index_cache) > _MASK_INDEX_CACHE_SIZE:
+                _mask_index_cache.popitem(last=False)
+        return _mask_index_cache[key]
+
+    return MaskIndex(mask)
+
+
 def restore_volumes(data, brain_mask, with_volume_dim=True):
     """Restore the given data to a whole brain volume
 
@@ -854,7 +1131,7 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
 
     Args:
         data (ndarray): the data as a x dimensional list of voxels, or, a list, tuple, or dict of those voxel lists
-        brain_mask (ndarray): the brain_mask which was used to generate the data list
+        brain_mask (ndarray, str or MaskIndex): the brain_mask which was used to generate the data list
         with_volume_dim (boolean): If true we always return values with at least 4 dimensions.
             The extra dimension is for the volume index. If false we return at least 3 dimensions.
 
@@ -863,21 +1140,10 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
         If with_volume_ind_dim is set we return values with 4 dimensions. (x, y, z, 1). If not set we return only
         three dimensions.
     """
-    brain_mask = load_brain_mask(brain_mask)
-
-    shape3d = brain_mask.shape[:3]
-    indices = np.ravel_multi_index(np.nonzero(brain_mask)[:3], shape3d, order='C')
+    mask_index = get_mask_index(brain_mask)
 
     def restorer(voxel_list):
-        s = voxel_list.shape
-
-        return_volume = np.zeros((brain_mask.size,) + s[1:], dtype=voxel_list.dtype, order='C')
-        return_volume[indices] = voxel_list
-        vol = np.reshape(return_volume, shape3d + s[1:])
-
-        if with_volume_dim and len(s) < 2:
-            return np.expand_dims(vol, axis=3)
-        return vol
+        return mask_index.scatter(voxel_list, with_volume_dim=with_volume_dim)
 
     if isinstance(data, collections.Mapping):
         return {key: restorer(value) for key, value in data.items()}
@@ -1239,15 +1505,19 @@ def load_brain_mask(data_source):
     """Load a brain mask from the given data.
 
     Args:
-        data_source (string, ndarray, tuple, nifti): Either a filename, a ndarray, a tuple as (ndarray, nifti header) or
-            finally a nifti object having the method 'get_data()'.
+        data_source (string, ndarray, tuple, nifti or MaskIndex): Either a filename, a ndarray, a tuple as
+            (ndarray, nifti header), a nifti object having the method 'get_data()' or a :class:`MaskIndex`.
 
     Returns:
         ndarray: boolean array with every voxel with a value higher than 0 set to 1 and all other values set to 0.
     """
+    if isinstance(data_source, MaskIndex):
+        return data_source.mask
+
+    if isinstance(data_source, six.string_types):
+        return np.array(get_mask_index(data_source).mask)
+
     def _load_data():
-        if isinstance(data_source, six.string_types):
-            return load_nifti(data_source).get_data()
         if isinstance(data_source, np.ndarray):
             return data_source
         if isinstance(data_source, (list, tuple)):
@@ -1498,12 +1768,11 @@ def estimate_noise_std(input_data):
 
     def all_unweighted_volumes(input_data):
         unweighted_indices = input_data.protocol.get_unweighted_indices()
-        unweighted_volumes = input_data.signal4d[..., unweighted_indices]
 
         if len(unweighted_indices) < 2:
             raise NoiseStdEstimationNotPossible('Not enough unweighted volumes for this estimator.')
 
-        voxel_list = create_roi(unweighted_volumes, input_data.mask)
+        voxel_list = input_data.observations[:, unweighted_indices]
         return np.mean(np.std(voxel_list, axis=1))
 
     noise_std = all_unweighted_volumes(input_data)
@@ -1565,13 +1834,13 @@ def roi_index_to_volume_index(roi_indices, brain_mask):
 
     Args:
         roi_indices (int or ndarray): the index in the ROI created by that brain mask
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         ndarray: the 3d voxel location(s) of the indicated voxel(s)
     """
-    mask = load_brain_mask(brain_mask)
-    return np.argwhere(mask)[roi_indices, :]
+    mask_index = get_mask_index(brain_mask)
+    return mask_index.positions[roi_indices, :]
 
 
 def volume_index_to_roi_index(volume_index, brain_mask):
@@ -1583,14 +1852,15 @@ def volume_index_to_roi_index(volume_index, brain_mask):
 
     Args:
         volume_index (tuple): the volume index, a tuple or list of length 3
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         int: the index of the given voxel in the ROI created by the given mask
     """
+    index_matrix = get_mask_index(brain_mask).index_matrix
     if isinstance(volume_index, np.ndarray) and len(volume_index.shape) >= 2:
-        return create_index_matrix(brain_mask)[volume_index[:, 0], volume_index[:, 1], volume_index[:, 2]]
-    return create_index_matrix(brain_mask)[volume_index[0], volume_index[1], volume_index[2]]
+        return np.maximum(index_matrix[volume_index[:, 0], volume_index[:, 1], volume_index[:, 2]], 0)
+    return np.maximum(index_matrix[volume_index[0], volume_index[1], volume_index[2]], 0)
 
 
 def create_index_matrix(brain_mask):
@@ -1599,15 +1869,13 @@ def create_index_matrix(brain_mask):
     This function is useful if you want to locate a voxel in the ROI given the position in the volume.
 
     Args:
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         3d ndarray: a 3d volume of the same size as the given mask and with as every non-zero element the position
             of that voxel in the linear ROI list.
     """
-    mask = load_brain_mask(brain_mask)
-    roi = np.arange(0, np.count_nonzero(mask))
-    return restore_volumes(roi, mask, with_volume_dim=False)
+    return np.maximum(get_mask_index(brain_mask).index_matrix, 0)
 
 
 def get_temporary_results_dir(user_value):
@@ -0,0 +1,102 @@
+"""Triage of degenerate voxels before model fitting and sampling.
+
+Brain masks routinely include voxels without usable signal, for example voxels whose signal is all zeros, contains
+NaNs or infinities, or whose unweighted intensity is below the noise level (edges of the brain, dropout slices).
+Fitting these voxels costs as much as fitting any other voxel, while the results are meaningless.
+
+With triage enabled, these voxels are selected before processing and are excluded from optimization, refinement and
+sampling. They keep a value of zero in all output maps (and hence a ``ReturnCodes`` of zero, "no return code
+specified"), have a value of zero in the ``UsedMask`` and are marked in an additional ``SkippedVoxels`` map.
+
+Voxels are skipped if they match any of the following criteria:
+
+* ``non_finite``: the signal contains a NaN or an infinite value
+* ``all_zeros``: the signal is zero in all volumes
+* ``min_unweighted_snr``: the mean of the unweighted signal (see :func:`mdt.linear_estimators.get_s0_volume_indices`)
+  is lower than this value times the noise standard deviation. This criterion is not applied if no noise standard
+  deviation was given and none could be estimated from the data.
+
+Triage is configured in the ``voxel_triage`` section of the configuration.
+"""
+import logging
+import numpy as np
+
+from mdt.linear_estimators import get_s0_volume_indices
+from mdt.utils import is_scalar
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-05-23'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+#: the name of the output map marking the skipped voxels
+SKIPPED_VOXELS_MAP_NAME = 'SkippedVoxels'
+
+
+class VoxelTriage(object):
+
+    def __init__(self, non_finite=True, all_zeros=True, min_unweighted_snr=None, batch_size=100000):
+        """Selects the voxels in the mask which should not be processed.
+
+        Args:
+            non_finite (boolean): if we skip the voxels with a NaN or infinite value in their signal
+            all_zeros (boolean): if we skip the voxels whose signal is zero in all volumes
+            min_unweighted_snr (float): if set, we skip the voxels whose mean unweighted signal is lower than this
+                value times the noise standard deviation. Ignored if the input data has no noise std.
+            batch_size (int): the number of voxels we inspect at once, limits the memory usage
+        """
+        self.non_finite = non_finite
+        self.all_zeros = all_zeros
+        self.min_unweighted_snr = min_unweighted_snr
+        self.batch_size = batch_size
+        self._logger = logging.getLogger(__name__)
+
+    def get_criteria(self):
+        """Get the criteria used for selecting the voxels to skip.
+
+        Returns:
+            dict: the criteria settings, used for the provenance of the results
+        """
+        return {'non_finite': self.non_finite,
+                'all_zeros': self.all_zeros,
+                'min_unweighted_snr': self.min_unweighted_snr}
+
+    def get_voxels_to_skip(self, input_data):
+        """Get the voxels in the mask which should not be processed.
+
+        Args:
+            input_data (mdt.utils.MRIInputData): the input data to inspect
+
+        Returns:
+            ndarray: a boolean array with for every voxel in the ROI if we should skip it
+        """
+        observations = input_data.observations
+        skip = np.zeros(observations.shape[0], dtype=np.bool)
+
+        s0_indices = None
+        noise_std = None
+        if self.min_unweighted_snr is not None and input_data.protocol.has_column('b'):
+            if input_data.has_noise_std:
+                s0_indices = get_s0_volume_indices(input_data.protocol)
+                noise_std = input_data.noise_std
+            else:
+                self._logger.warning('No noise std available, the voxels are not triaged on their unweighted SNR.')
+
+        for start in range(0, observations.shape[0], self.batch_size):
+            batch = slice(start, min(start + self.batch_size, observations.shape[0]))
+            signal = np.asarray(observations[batch])
+
+            if self.non_finite:
+                skip[batch] |= ~np.all(np.isfinite(signal), axis=1)
+
+            if self.all_zeros:
+                skip[batch] |= np.all(signal == 0, axis=1)
+
+            if s0_indices is not None:
+                threshold = self.min_unweighted_snr * (noise_std if is_scalar(noise_std)
+                                                       else np.reshape(noise_std, (-1,))[batch])
+                with np.errstate(invalid='ignore'):
+                    skip[batch] |= np.mean(signal[:, s0_indices], axis=1) < threshold
+        return skip
@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.bootstrap import ResidualBootstrap, BOOTSTRAP_MAPS_DIR
+from mdt.configuration import YamlStringAction, get_residual_bootstrap
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData, create_roi
+from mot.cl_routines.optimizing.powell import Powell
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-26"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ResidualBootstrapTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_volumes = 31
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        self._protocol = Protocol(columns={'b': np.array([0] + [1e9] * 15 + [2e9] * 15),
+                                           'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        nmr_voxels = 12
+        self._parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_voxels),
+                            'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_voxels),
+                            'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels),
+                            'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels)}
+        self._parameters['w_ball.w'] = 1 - self._parameters['w_stick0.w']
+
+        self._noise_free = mdt.simulate_signals('BallStick_r1', self._protocol, self._parameters)
+        self._noise = random_state.normal(size=self._noise_free.shape)
+        self._roi_indices = np.arange(nmr_voxels)
+
+    def _get_model(self, noise_std):
+        signals = self._noise_free + noise_std * self._noise
+        model = mdt.get_model('BallStick_r1')()
+        model.set_input_data(SimpleMRIInputData(self._protocol, signals[:, None, None, :],
+                                                np.ones((len(signals), 1, 1), dtype=bool), None, noise_std=noise_std))
+        return model
+
+    def _compute(self, noise_std, **kwargs):
+        model = self._get_model(noise_std)
+        parameters = model.param_dict_to_array(self._parameters)
+        return ResidualBootstrap(**dict(dict(nmr_replicates=20, seed=0), **kwargs)).compute(
+            model, Powell(patience=5), self._roi_indices, parameters)
+
+    def test_maps(self):
+        results = self._compute(20)
+        for name in ['S0.s0', 'w_stick0.w', 'Stick0.theta', 'Stick0.phi']:
+            for suffix in ['std', 'percentile_2.5', 'percentile_97.5']:
+                self.assertEqual(results['{}.{}'.format(name, suffix)].shape, self._roi_indices.shape)
+            self.assertTrue(np.all(results[name + '.std'] > 0), name)
+            self.assertTrue(np.all(results[name + '.percentile_2.5'] <= results[name + '.percentile_97.5']), name)
+
+        self.assertTrue(np.all(results['S0.s0.percentile_2.5'] < self._parameters['S0.s0'] + 20))
+        self.assertTrue(np.all(results['S0.s0.percentile_97.5'] > self._parameters['S0.s0'] - 20))
+
+    def test_uncertainty_scales_with_noise(self):
+        low_noise, high_noise = self._compute(5), self._compute(50)
+        for name in ['S0.s0', 'w_stick0.w']:
+            self.assertGreater(np.median(high_noise[name + '.std'] / low_noise[name + '.std']), 5, name)
+
+    def test_reproducible(self):
+        results = self._compute(20)
+        for name, value in self._compute(20).items():
+            np.testing.assert_allclose(value, results[name], rtol=1e-5, err_msg=name)
+
+        # the resampling does not depend on the batches, only the optimization of the replicates may differ slightly
+        for name, value in self._compute(20, max_batch_problems=50).items():
+            np.testing.assert_allclose(value, results[name], rtol=1e-2, err_msg=name)
+        self.assertFalse(np.allclose(self._compute(20, seed=1)['S0.s0.std'], results['S0.s0.std']))
+
+    def test_configuration(self):
+        config = 'optimization: {bootstrap: {nmr_replicates: 10, percentiles: [50], seed: 1}}'
+        with mdt.config_context(YamlStringAction(config)):
+            self.assertEqual(get_residual_bootstrap().get_settings(),
+                             {'nmr_replicates': 10, 'percentiles': [50], 'seed': 1})
+
+    def test_fit(self):
+        config = '''
+            active_post_processing:
+                optimization:
+                    covariance: False
+                    bootstrap: True
+            optimization:
+                bootstrap:
+                    nmr_replicates: 10
+                    percentiles: [50]
+                    seed: 0
+        '''
+        model = self._get_model(20)
+        with mdt.config_context(YamlStringAction(config)):
+            results = mdt.fit_model('BallStick_r1', model.get_input_data(), None, cl_device_ind=0)
+
+        bootstrap = create_roi(results[BOOTSTRAP_MAPS_DIR], model.get_input_data().mask)
+        self.assertEqual(sorted(bootstrap), sorted('{}.{}'.format(name, suffix)
+                                                   for name in model.get_free_param_names()
+                                                   for suffix in ['std', 'percentile_50']))
+        self.assertTrue(np.all(bootstrap['S0.s0.std'] > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
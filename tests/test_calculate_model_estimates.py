@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.cl_routines.mapping.calculate_model_estimates import CalculateModelEstimates, \
+    MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION
+from mdt.configuration import YamlStringAction
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData
+from mot.cl_runtime_info import CLRuntimeInfo
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-27"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class CalculateModelEstimatesTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._cl_runtime_info = CLRuntimeInfo(double_precision=False)
+
+        nmr_volumes = 37
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        protocol = Protocol(columns={'b': np.array([0] + [1e9] * 18 + [2e9] * 18),
+                                     'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        nmr_voxels = 101
+        parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_voxels),
+                      'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_voxels),
+                      'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels),
+                      'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels)}
+        parameters['w_ball.w'] = 1 - parameters['w_stick0.w']
+
+        self._noise_free = mdt.simulate_signals('BallStick_r1', protocol, parameters)
+        self._observations = self._noise_free + random_state.normal(0, 10, self._noise_free.shape)
+
+        model = mdt.get_model('BallStick_r1')()
+        model.set_input_data(SimpleMRIInputData(protocol, self._observations[:, None, None, :],
+                                                np.ones((nmr_voxels, 1, 1), dtype=bool), None, noise_std=10))
+        self._model = model.build()
+        self._parameters = model.param_dict_to_array(parameters)
+
+    def _calculate(self, evaluation, parallelization):
+        routine = CalculateModelEstimates(parallelization=parallelization, cl_runtime_info=self._cl_runtime_info)
+        return getattr(routine, evaluation)(self._model, self._parameters)
+
+    def test_estimates(self):
+        for parallelization in ['voxels', 'observations', None]:
+            np.testing.assert_allclose(self._calculate('calculate', parallelization), self._noise_free, rtol=1e-5,
+                                       err_msg=str(parallelization))
+
+    def test_residuals(self):
+        for parallelization in ['voxels', 'observations']:
+            np.testing.assert_allclose(self._calculate('calculate_residuals', parallelization),
+                                       self._observations - self._noise_free, rtol=1e-3, atol=1e-2,
+                                       err_msg=parallelization)
+
+    def test_log_likelihoods(self):
+        voxels = self._calculate('calculate_log_likelihoods', 'voxels')
+        observations = self._calculate('calculate_log_likelihoods', 'observations')
+
+        self.assertEqual(voxels.shape, self._observations.shape)
+        self.assertTrue(np.all(np.isfinite(voxels)))
+        np.testing.assert_allclose(observations, voxels, rtol=1e-5)
+
+    def test_launch_settings(self):
+        routine = CalculateModelEstimates(cl_runtime_info=self._cl_runtime_info)
+        cl_environment = self._cl_runtime_info.cl_environments[0]
+
+        with mdt.config_context(YamlStringAction('autotuning: {enabled: False}')):
+            for nmr_voxels, parallelization in [(10, 'observations'),
+                                                (MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION, 'observations'),
+                                                (MAX_VOXELS_PER_OBSERVATION_PARALLELIZATION + 1, 'voxels')]:
+                settings = routine._get_launch_settings(cl_environment, self._model, np.zeros((nmr_voxels, 4)),
+                                                        'estimates', None)
+                self.assertEqual(settings, {'parallelization': parallelization, 'local_size': None})
+
+        self.assertEqual(CalculateModelEstimates(parallelization='voxels')._get_launch_settings(
+            cl_environment, self._model, self._parameters, 'estimates', None),
+            {'parallelization': 'voxels', 'local_size': None})
+
+        with self.assertRaises(ValueError):
+            CalculateModelEstimates(parallelization='observation')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.dictionary_matching import get_parameter_grid, create_dictionary, match_dictionary, get_dictionary_matcher, \
+    clear_dictionary_cache
+from mdt.models.estimators import DMRIEstimator
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-22"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class DictionaryMatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._random_state = np.random.RandomState(0)
+        self._protocol = _get_protocol(self._random_state)
+        clear_dictionary_cache()
+
+    def tearDown(self):
+        clear_dictionary_cache()
+
+    def test_parameter_grid(self):
+        model = mdt.get_model('NODDI')()
+        parameters = get_parameter_grid(model, max_size=1000, grid={'NODDI_IC.kappa': [1, 2, 3]})
+
+        np.testing.assert_array_equal(np.unique(parameters['NODDI_IC.kappa']), [1, 2, 3])
+        self.assertNotIn('S0.s0', parameters)
+        self.assertLessEqual(len(parameters['NODDI_IC.kappa']), 1000)
+        self.assertTrue(np.all(np.sum([parameters[weight] for weight in model.get_free_weight_names()], axis=0) <= 1))
+
+    def test_match_dictionary(self):
+        dictionary = self._random_state.rand(50, 20)
+        indices = self._random_state.randint(0, 50, 30)
+        np.testing.assert_array_equal(match_dictionary(dictionary[indices], dictionary, max_chunk_elements=100),
+                                      indices)
+
+    def test_noiseless_recovery(self):
+        class Matcher(get_dictionary_matcher('NODDI')):
+            max_dictionary_size = 2000
+
+        model = mdt.get_model('NODDI')()
+        parameters, dictionary = create_dictionary(model, self._protocol,
+                                                   get_parameter_grid(model, max_size=Matcher.max_dictionary_size))
+        indices = self._random_state.choice(len(dictionary), 25, replace=False)
+
+        s0 = self._random_state.uniform(500, 1500, len(indices))
+        signals = s0[:, None] * dictionary[indices]
+        estimates = Matcher().estimate(self._get_input_data(signals))
+        np.testing.assert_allclose(estimates['S0.s0'], s0, rtol=1e-5)
+        for name, values in parameters.items():
+            np.testing.assert_allclose(estimates[name], values[indices], rtol=1e-5, err_msg=name)
+
+    def _get_input_data(self, signals):
+        return SimpleMRIInputData(self._protocol, signals[:, None, None, :], np.ones((len(signals), 1, 1)), None)
+
+
+class EstimatorCascadesTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._input_data = SimpleMRIInputData(_get_protocol(random_state), random_state.rand(3, 1, 1, 61) * 100 + 10,
+                                              np.ones((3, 1, 1)), None)
+
+    def test_cascades(self):
+        for model_name, estimator_name in [('Tensor', 'Tensor (Linear)'), ('Kurtosis', 'Kurtosis (Linear)'),
+                                           ('NODDI', 'NODDI (Dictionary)'), ('ActiveAx', 'ActiveAx (Dictionary)')]:
+            cascade_name = '{} (Cascade|{})'.format(model_name, estimator_name.split('(')[1][:-1])
+            cascade = mdt.get_model(cascade_name)()
+            self.assertEqual(cascade.get_model_names(), [estimator_name, model_name])
+            self.assertTrue(cascade.is_input_data_sufficient(self._input_data), cascade_name)
+
+            cascade.set_input_data(self._input_data)
+            estimator = cascade.get_next([])
+            self.assertIsInstance(estimator, DMRIEstimator)
+            self.assertEqual(estimator.target_model, model_name)
+
+            estimates = estimator.estimate(self._input_data)
+            self.assertEqual(sorted(estimates), sorted(estimator.get_free_param_names()))
+
+            model = cascade.get_next([estimates])
+            self.assertEqual(model.name, model_name)
+            self.assertFalse(cascade.has_next())
+
+
+def _get_protocol(random_state):
+    """Get a two shell protocol with the sequence timings, suitable for all the models tested here."""
+    directions = random_state.normal(size=(60, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    g = np.vstack([[1, 0, 0], directions])
+    return Protocol(columns={'b': np.array([0] + [1e9] * 30 + [3e9] * 30, dtype=np.float64),
+                             'gx': g[:, 0], 'gy': g[:, 1], 'gz': g[:, 2],
+                             'Delta': np.full(61, 0.0218), 'delta': np.full(61, 0.0129), 'TE': np.full(61, 0.057)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import itertools
+import unittest
+import numpy as np
+
+from mdt.cl_routines.mapping.dki_measures import DKIMeasures, get_spherical_directions
+from mdt.linear_estimators import KURTOSIS_INDICES
+from mdt.utils import tensor_spherical_to_cartesian
+from mot.cl_runtime_info import CLRuntimeInfo
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-22"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class DKIMeasuresTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._cl_runtime_info = CLRuntimeInfo(double_precision=False)
+
+        nmr_voxels = 20
+        self._parameters = {'d': random_state.uniform(1.5e-9, 2.5e-9, nmr_voxels),
+                            'dperp0': random_state.uniform(0.8e-9, 1.2e-9, nmr_voxels),
+                            'dperp1': random_state.uniform(0.2e-9, 0.5e-9, nmr_voxels),
+                            'theta': random_state.uniform(0, np.pi, nmr_voxels),
+                            'phi': random_state.uniform(0, np.pi, nmr_voxels),
+                            'psi': random_state.uniform(0, np.pi, nmr_voxels)}
+
+        isotropic_kurtosis = random_state.uniform(0.5, 1.5, nmr_voxels)
+        for index in KURTOSIS_INDICES:
+            nmr_unique = len(set(index))
+            if nmr_unique == 1:
+                value = isotropic_kurtosis
+            elif nmr_unique == 2 and index.count(index[0]) == 2:
+                value = isotropic_kurtosis / 3.
+            else:
+                value = np.zeros(nmr_voxels)
+            self._parameters['W_{}{}{}{}'.format(*index)] = value + random_state.uniform(-0.05, 0.05, nmr_voxels)
+
+    def test_axial_kurtosis(self):
+        for method in ['numerical', 'analytic']:
+            measures = DKIMeasures(method=method, cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+            np.testing.assert_allclose(measures['AK'][:, 0], self._get_axial_kurtosis(self._parameters), rtol=1e-3)
+
+    def test_axial_kurtosis_uses_principal_eigenvector(self):
+        """The principal eigenvector is the one with the largest eigenvalue, not the one of a fixed parameter."""
+        largest, middle, smallest = self._parameters['d'], self._parameters['dperp0'], self._parameters['dperp1']
+
+        for eigenvalues in [(largest, middle, smallest), (middle, largest, smallest), (smallest, middle, largest)]:
+            parameters = dict(self._parameters)
+            parameters['d'], parameters['dperp0'], parameters['dperp1'] = eigenvalues
+
+            measures = DKIMeasures(cl_runtime_info=self._cl_runtime_info).calculate(parameters)
+            axial_kurtosis = self._get_axial_kurtosis(parameters)
+            np.testing.assert_allclose(measures['AK'][:, 0], axial_kurtosis, rtol=1e-3)
+
+            if eigenvalues[2] is not largest:
+                self.assertTrue(np.all(np.abs(measures['AK'][:, 0] - self._get_apparent_kurtosis(
+                    parameters, self._get_eigenvectors(parameters)[:, :, 2])) > 1e-2))
+
+    def test_mean_kurtosis(self):
+        directions = get_spherical_directions(4000)
+        reference = np.mean([self._get_apparent_kurtosis(self._parameters, np.tile(direction, (20, 1)))
+                             for direction in directions], axis=0)
+
+        for method in ['numerical', 'analytic']:
+            measures = DKIMeasures(method=method, nmr_directions=4000,
+                                   cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+            np.testing.assert_allclose(measures['MK'][:, 0], reference, rtol=1e-2)
+
+    def test_analytic_and_numerical_agree(self):
+        numerical = DKIMeasures(method='numerical', nmr_directions=4000, nmr_radial_directions=360,
+                                cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+        analytic = DKIMeasures(method='analytic', cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+
+        for measure in ['MK', 'AK', 'RK']:
+            np.testing.assert_allclose(analytic[measure], numerical[measure], rtol=1e-2)
+
+    def test_default_directions_approximate_analytic(self):
+        numerical = DKIMeasures(method='numerical', nmr_directions=256, nmr_radial_directions=256,
+                                cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+        analytic = DKIMeasures(method='analytic', cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+
+        for measure in ['MK', 'RK']:
+            np.testing.assert_allclose(numerical[measure], analytic[measure], rtol=5e-2)
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            DKIMeasures(method='other', cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+        with self.assertRaises(ValueError):
+            DKIMeasures(method='numerical', nmr_directions=10 ** 6,
+                        cl_runtime_info=self._cl_runtime_info).calculate(self._parameters)
+
+    def _get_eigenvectors(self, parameters):
+        """Get the (v, 3, 3) eigenvectors, with the vectors of d, dperp0 and dperp1 in the columns."""
+        return np.stack(tensor_spherical_to_cartesian(parameters['theta'], parameters['phi'], parameters['psi']),
+                        axis=-1)
+
+    def _get_axial_kurtosis(self, parameters):
+        eigenvalues = np.column_stack([parameters['d'], parameters['dperp0'], parameters['dperp1']])
+        vectors = self._get_eigenvectors(parameters)
+        principal = vectors[np.arange(len(eigenvalues)), :, np.argmax(eigenvalues, axis=1)]
+        return self._get_apparent_kurtosis(parameters, principal)
+
+    def _get_apparent_kurtosis(self, parameters, directions):
+        """Get the apparent kurtosis of every voxel in the given (v, 3) directions."""
+        eigenvalues = np.column_stack([parameters['d'], parameters['dperp0'], parameters['dperp1']])
+        vectors = self._get_eigenvectors(parameters)
+
+        adc = np.sum(eigenvalues * np.einsum('vik,vi->vk', vectors, directions) ** 2, axis=1)
+        mean_diffusivity = np.mean(eigenvalues, axis=1)
+
+        kurtosis_product = np.zeros(len(directions))
+        for index in itertools.product(range(3), repeat=4):
+            kurtosis_product += (parameters['W_{}{}{}{}'.format(*sorted(index, reverse=True))]
+                                 * np.prod(directions[:, index], axis=1))
+        return (mean_diffusivity / adc) ** 2 * kurtosis_product
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.cl_routines.mapping.goodness_of_fit import GoodnessOfFit
+from mdt.configuration import YamlStringAction
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData, create_roi
+from mot.cl_runtime_info import CLRuntimeInfo
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-27"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class GoodnessOfFitTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_volumes = 25
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        b_values = np.array([0, 5e6] + [0.99e9, 1.01e9] * 6 + [2.04e9] * 11)
+        self._protocol = Protocol(columns={'b': b_values,
+                                           'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        self._mask = np.ones((5, 4, 3), dtype=bool)
+        nmr_voxels = np.count_nonzero(self._mask)
+        self._parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_voxels),
+                            'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_voxels),
+                            'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels),
+                            'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels)}
+        self._parameters['w_ball.w'] = 1 - self._parameters['w_stick0.w']
+
+        signals = mdt.simulate_signals('BallStick_r1', self._protocol, self._parameters)
+        self._signals = signals + random_state.normal(0, 20, signals.shape)
+        self._signals[0, 3] += 500
+
+        self._model = mdt.get_model('BallStick_r1')()
+        self._model.set_input_data(SimpleMRIInputData(
+            self._protocol, np.reshape(self._signals, self._mask.shape + (-1,)), self._mask, None, noise_std=20))
+
+    def test_shells(self):
+        shells = dict(self._model._get_goodness_of_fit_shells())
+        self.assertEqual(sorted(shells), ['b0', 'b1000', 'b2000'])
+        np.testing.assert_array_equal(shells['b0'], [0, 1])
+        np.testing.assert_array_equal(shells['b1000'], np.arange(2, 14))
+        np.testing.assert_array_equal(shells['b2000'], np.arange(14, 25))
+
+        self._model.set_input_data(SimpleMRIInputData(
+            Protocol(columns={'gx': np.ones(25), 'gy': np.zeros(25), 'gz': np.zeros(25)}),
+            np.reshape(self._signals, self._mask.shape + (-1,)), self._mask, None))
+        self.assertEqual(self._model._get_goodness_of_fit_shells(), [])
+
+    def test_measures(self):
+        shells = self._model._get_goodness_of_fit_shells()
+        measures = GoodnessOfFit(cl_runtime_info=CLRuntimeInfo(double_precision=False)).calculate(
+            self._model.build(), self._model.param_dict_to_array(self._parameters), shells)
+
+        residuals = self._signals - mdt.simulate_signals('BallStick_r1', self._protocol, self._parameters)
+        sse = np.sum(residuals ** 2, axis=1)
+        total_sum_squares = np.sum((self._signals - np.mean(self._signals, axis=1)[:, None]) ** 2, axis=1)
+        rmse = np.sqrt(np.mean(residuals ** 2, axis=1))
+
+        np.testing.assert_allclose(measures['GoodnessOfFit.SSE'], sse, rtol=1e-3)
+        np.testing.assert_allclose(measures['GoodnessOfFit.R2'], 1 - sse / total_sum_squares, rtol=1e-3)
+        np.testing.assert_allclose(measures['GoodnessOfFit.NRMSE'], rmse / np.mean(self._signals, axis=1), rtol=1e-3)
+        np.testing.assert_array_equal(measures['GoodnessOfFit.OutlierVolumes'],
+                                      np.sum(np.abs(residuals) > 3 * rmse[:, None], axis=1))
+        self.assertGreater(measures['GoodnessOfFit.OutlierVolumes'][0], 0)
+
+        for name, indices in shells:
+            np.testing.assert_allclose(measures['GoodnessOfFit.ResidualMean.' + name],
+                                       np.mean(residuals[:, indices], axis=1), rtol=1e-3, atol=1e-2)
+            np.testing.assert_allclose(measures['GoodnessOfFit.ResidualStd.' + name],
+                                       np.std(residuals[:, indices], axis=1), rtol=1e-3, atol=1e-2)
+
+    def test_outlier_threshold(self):
+        parameters = self._model.param_dict_to_array(self._parameters)
+        outliers = [GoodnessOfFit(outlier_threshold=threshold).calculate(self._model.build(), parameters, [])
+                    ['GoodnessOfFit.OutlierVolumes'] for threshold in [1, 3]]
+        self.assertTrue(np.all(outliers[0] >= outliers[1]))
+        self.assertTrue(np.any(outliers[0] > outliers[1]))
+
+        with mdt.config_context(YamlStringAction('optimization: {goodness_of_fit: {outlier_threshold: 1}}')):
+            self.assertEqual(GoodnessOfFit().get_settings(), {'outlier_threshold': 1.0})
+
+    def test_fit(self):
+        config = '''
+            active_post_processing:
+                optimization:
+                    covariance: False
+                    goodness_of_fit: True
+        '''
+        with mdt.config_context(YamlStringAction(config)):
+            results = create_roi(mdt.fit_model('BallStick_r1', self._model.get_input_data(), None, cl_device_ind=0),
+                                 self._mask)
+
+        for name in ['SSE', 'R2', 'NRMSE', 'OutlierVolumes', 'ResidualMean.b0', 'ResidualStd.b1000',
+                     'ResidualStd.b2000']:
+            self.assertIn('GoodnessOfFit.' + name, results)
+        self.assertTrue(np.all(results['GoodnessOfFit.R2'] > 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
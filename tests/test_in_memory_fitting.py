@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import mdt
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-22"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class InMemoryFittingTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+
+        nmr_volumes = 13
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        protocol = Protocol(columns={'b': np.array([0] + [1e9] * 6 + [2e9] * 6),
+                                     'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        mask = random_state.rand(3, 3, 2) > 0.3
+        signal = 1000 * np.exp(-protocol.get_column('b')[:, 0] * 1e-9)[None, None, None, :] \
+            * random_state.uniform(0.8, 1.2, mask.shape + (nmr_volumes,))
+        self._input_data = SimpleMRIInputData(protocol, signal, mask, None)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _fit(self, model, output_folder):
+        return mdt.fit_model(model, self._input_data, output_folder, cl_device_ind=0, tmp_results_dir=self._tmp_dir,
+                             save_user_script_info=None, post_processing={'covariance': False})
+
+    def test_matches_fit_on_disk(self):
+        in_memory = self._fit('BallStick_r1', None)
+        on_disk = self._fit('BallStick_r1', os.path.join(self._tmp_dir, 'output'))
+
+        self.assertEqual(sorted(in_memory), sorted(on_disk))
+        for name in on_disk:
+            np.testing.assert_allclose(np.squeeze(in_memory[name]), np.squeeze(on_disk[name]), rtol=1e-6,
+                                       err_msg=name)
+
+    def test_maps_are_volumes(self):
+        results = self._fit('BallStick_r1', None)
+        for name, volume in results.items():
+            self.assertEqual(volume.shape[:3], self._input_data.mask.shape, name)
+            np.testing.assert_array_equal(volume[np.logical_not(self._input_data.mask)], 0)
+
+    def test_nothing_written(self):
+        self._fit('BallStick_r1 (Cascade)', None)
+        self.assertEqual(os.listdir(self._tmp_dir), [])
+
+    def test_cascade(self):
+        results = self._fit('BallStick_r1 (Cascade)', None)
+        self.assertIn('Stick0.theta', results)
+        self.assertTrue(np.all(np.isfinite(results['LogLikelihood'][self._input_data.mask])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import itertools
+import unittest
+import numpy as np
+
+from mdt.linear_estimators import estimate_s0, estimate_tensor, estimate_kurtosis, KURTOSIS_INDICES
+from mdt.protocols import Protocol
+from mdt.utils import tensor_spherical_to_cartesian
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-18"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class LinearEstimatorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._random_state = np.random.RandomState(0)
+        self._protocol = self._get_protocol([0, 1e9, 2e9], 30)
+
+        nmr_voxels = 200
+        self._s0 = self._random_state.uniform(500, 1500, nmr_voxels)
+        self._eigenvalues = np.sort(self._random_state.uniform(0.2e-9, 2.5e-9, (nmr_voxels, 3)), axis=1)[:, ::-1]
+        self._angles = self._random_state.uniform(0, np.pi, (nmr_voxels, 3))
+        self._tensors = self._get_tensors(self._eigenvalues, self._angles)
+
+    def test_s0(self):
+        observations = np.tile(self._s0[:, None], (1, len(self._protocol)))
+        observations[:, self._protocol.get_weighted_indices()] = 0
+        np.testing.assert_allclose(estimate_s0(self._protocol, observations), self._s0)
+
+    def test_tensor_recovery(self):
+        observations = self._get_tensor_signal(self._protocol, self._s0, self._tensors)
+
+        for weighted in [True, False]:
+            estimates = estimate_tensor(self._protocol, observations, weighted=weighted, batch_size=64)
+            self._assert_tensor_estimates(estimates)
+
+    def test_kurtosis_recovery(self):
+        kurtosis = {index: self._random_state.uniform(0.3, 0.8, len(self._s0)) if len(set(index)) == 1
+                    else self._random_state.uniform(-0.05, 0.05, len(self._s0)) for index in KURTOSIS_INDICES}
+
+        mean_diffusivity = np.mean(self._eigenvalues, axis=1)
+        g = self._protocol.get_column('g')
+        b = np.squeeze(self._protocol.get_column('b'))
+
+        kurtosis_term = np.zeros((len(self._s0), len(self._protocol)))
+        for index in itertools.product(range(3), repeat=4):
+            kurtosis_term += (kurtosis[tuple(sorted(index, reverse=True))][:, None]
+                              * np.prod(g[:, index], axis=1)[None, :])
+        observations = self._get_tensor_signal(self._protocol, self._s0, self._tensors) * np.exp(
+            b[None, :] ** 2 / 6.0 * mean_diffusivity[:, None] ** 2 * kurtosis_term)
+
+        estimates = estimate_kurtosis(self._protocol, observations, batch_size=64)
+        self._assert_tensor_estimates(estimates)
+        for index in KURTOSIS_INDICES:
+            np.testing.assert_allclose(estimates['W_{}{}{}{}'.format(*index)], kurtosis[index], atol=1e-6)
+
+    def test_batch_size_independence(self):
+        observations = self._get_tensor_signal(self._protocol, self._s0, self._tensors)
+        observations *= self._random_state.normal(1, 0.02, observations.shape)
+
+        reference = estimate_tensor(self._protocol, observations, batch_size=len(self._s0))
+        for batch_size in [1, 17]:
+            estimates = estimate_tensor(self._protocol, observations, batch_size=batch_size)
+            np.testing.assert_allclose(estimates['s0'], reference['s0'], rtol=1e-10)
+            np.testing.assert_allclose(self._get_estimated_tensors(estimates),
+                                       self._get_estimated_tensors(reference), rtol=1e-8, atol=1e-20)
+
+    def test_rank_deficient_protocol(self):
+        protocol = Protocol(columns={'b': np.array([0, 1e9, 1e9, 1e9]),
+                                     'gx': np.array([1., 1, 0, 0]),
+                                     'gy': np.array([0., 0, 1, 0]),
+                                     'gz': np.array([0., 0, 0, 1])})
+        observations = self._get_tensor_signal(protocol, self._s0[:10], self._tensors[:10])
+
+        for weighted in [True, False]:
+            estimates = estimate_tensor(protocol, observations, weighted=weighted)
+            for value in estimates.values():
+                self.assertTrue(np.all(np.isfinite(value)))
+
+    def _assert_tensor_estimates(self, estimates):
+        np.testing.assert_allclose(estimates['s0'], self._s0, rtol=1e-6)
+        np.testing.assert_allclose(
+            np.column_stack([estimates['d'], estimates['dperp0'], estimates['dperp1']]),
+            self._eigenvalues, rtol=1e-6)
+
+        np.testing.assert_allclose(self._get_estimated_tensors(estimates), self._tensors, atol=1e-15)
+
+    def _get_estimated_tensors(self, estimates):
+        return self._get_tensors(np.column_stack([estimates['d'], estimates['dperp0'], estimates['dperp1']]),
+                                 np.column_stack([estimates['theta'], estimates['phi'], estimates['psi']]))
+
+    def _get_protocol(self, b_values, nmr_directions):
+        """Get a protocol with one unweighted volume and the given number of random directions per shell."""
+        b = [0]
+        g = [[1, 0, 0]]
+        for b_value in b_values[1:]:
+            directions = self._random_state.normal(size=(nmr_directions, 3))
+            g.extend(directions / np.linalg.norm(directions, axis=1)[:, None])
+            b.extend([b_value] * nmr_directions)
+        g = np.array(g)
+        return Protocol(columns={'b': np.array(b, dtype=np.float64), 'gx': g[:, 0], 'gy': g[:, 1], 'gz': g[:, 2]})
+
+    def _get_tensors(self, eigenvalues, angles):
+        """Get the (v, 3, 3) tensors from the eigenvalues and the angles theta, phi and psi."""
+        vectors = np.stack(tensor_spherical_to_cartesian(angles[:, 0], angles[:, 1], angles[:, 2]), axis=-1)
+        return np.einsum('vik,vk,vjk->vij', vectors, eigenvalues, vectors)
+
+    def _get_tensor_signal(self, protocol, s0, tensors):
+        g = protocol.get_column('g')
+        b = np.squeeze(protocol.get_column('b'))
+        return s0[:, None] * np.exp(-b[None, :] * np.einsum('ni,vij,nj->vn', g, tensors, g))
+
+
+if __name__ == '__main__':
+    unittest.main()
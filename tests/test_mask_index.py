@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from mdt.nifti import write_nifti
+from mdt.utils import MaskIndex, get_mask_index, create_roi, restore_volumes, create_index_matrix, \
+    roi_index_to_volume_index, volume_index_to_roi_index
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-19"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class MaskIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._mask = random_state.rand(7, 6, 5) > 0.4
+        self._volume = random_state.rand(7, 6, 5, 4)
+        self._mask_index = MaskIndex(self._mask)
+
+    def test_properties(self):
+        self.assertEqual(self._mask_index.shape, self._mask.shape)
+        self.assertEqual(self._mask_index.nmr_voxels, np.count_nonzero(self._mask))
+        np.testing.assert_array_equal(self._mask_index.positions, np.argwhere(self._mask))
+        for coordinates, expected in zip(self._mask_index.coordinates, np.nonzero(self._mask)):
+            np.testing.assert_array_equal(coordinates, expected)
+
+    def test_gather(self):
+        np.testing.assert_array_equal(self._mask_index.gather(self._volume), self._volume[self._mask])
+
+    def test_gather_3d_volume(self):
+        roi = self._mask_index.gather(self._volume[..., 0])
+        self.assertEqual(roi.shape, (self._mask_index.nmr_voxels, 1))
+        np.testing.assert_array_equal(roi[:, 0], self._volume[..., 0][self._mask])
+
+    def test_gather_non_contiguous_volume(self):
+        volume = np.asfortranarray(self._volume)
+        np.testing.assert_array_equal(self._mask_index.gather(volume), self._volume[self._mask])
+
+    def test_gather_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            self._mask_index.gather(np.zeros((7, 6, 4, 4)))
+        with self.assertRaises(ValueError):
+            self._mask_index.gather(np.zeros((7, 6)))
+
+    def test_round_trip(self):
+        roi = self._mask_index.gather(self._volume)
+        volume = self._mask_index.scatter(roi)
+
+        np.testing.assert_array_equal(volume[self._mask], self._volume[self._mask])
+        np.testing.assert_array_equal(volume[~self._mask], 0)
+        np.testing.assert_array_equal(self._mask_index.gather(volume), roi)
+
+    def test_scatter_volume_dim(self):
+        roi = self._volume[..., 0][self._mask]
+        self.assertEqual(self._mask_index.scatter(roi).shape, self._mask.shape + (1,))
+        self.assertEqual(self._mask_index.scatter(roi, with_volume_dim=False).shape, self._mask.shape)
+
+    def test_create_roi_and_restore_volumes(self):
+        rois = create_roi({'a': self._volume, 'b': self._volume[..., 0]}, self._mask)
+        np.testing.assert_array_equal(rois['a'], self._volume[self._mask])
+
+        volumes = restore_volumes(dict(rois), self._mask_index)
+        np.testing.assert_array_equal(volumes['a'][self._mask], self._volume[self._mask])
+        np.testing.assert_array_equal(volumes['b'][..., 0][self._mask], self._volume[..., 0][self._mask])
+
+    def test_index_matrix(self):
+        index_matrix = create_index_matrix(self._mask)
+        np.testing.assert_array_equal(index_matrix[self._mask], np.arange(self._mask_index.nmr_voxels))
+        np.testing.assert_array_equal(index_matrix[~self._mask], 0)
+        np.testing.assert_array_equal(self._mask_index.index_matrix[~self._mask], -1)
+
+    def test_index_conversions(self):
+        roi_indices = np.arange(self._mask_index.nmr_voxels)
+        positions = roi_index_to_volume_index(roi_indices, self._mask_index)
+        np.testing.assert_array_equal(volume_index_to_roi_index(positions, self._mask_index), roi_indices)
+
+        outside = tuple(np.argwhere(~self._mask)[0])
+        self.assertEqual(volume_index_to_roi_index(outside, self._mask_index), 0)
+
+    def test_get_mask_index(self):
+        self.assertIs(get_mask_index(self._mask_index), self._mask_index)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'mask.nii.gz')
+            write_nifti(self._mask.astype(np.uint8), path)
+
+            mask_index = get_mask_index(path)
+            self.assertIs(get_mask_index(path), mask_index)
+            np.testing.assert_array_equal(mask_index.mask, self._mask)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import numpy as np
+
+import mdt
+import mdt.model_fitting
+from mdt.configuration import YamlStringAction, use_mixed_precision, get_mixed_precision_refinement
+from mdt.protocols import Protocol
+from mdt.refinement import VoxelRefinement, get_relative_gradients
+from mdt.utils import SimpleMRIInputData, create_roi
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-29"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class MixedPrecisionTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_volumes = 31
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        protocol = Protocol(columns={'b': np.array([0] + [1e9] * 15 + [2e9] * 15),
+                                     'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        self._mask = np.ones((4, 4, 2), dtype=bool)
+        nmr_voxels = np.count_nonzero(self._mask)
+        parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_voxels),
+                      'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_voxels),
+                      'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels),
+                      'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels)}
+        parameters['w_ball.w'] = 1 - parameters['w_stick0.w']
+
+        signals = mdt.simulate_signals('BallStick_r1', protocol, parameters)
+        signals += random_state.normal(0, 10, signals.shape)
+        self._input_data = SimpleMRIInputData(protocol, np.reshape(signals, self._mask.shape + (-1,)), self._mask,
+                                              None, noise_std=10)
+
+        self._model = mdt.get_model('BallStick_r1')()
+        self._model.set_input_data(self._input_data)
+
+        self._config = mdt.config_context(YamlStringAction('''
+            active_post_processing:
+                optimization:
+                    covariance: False
+            optimization:
+                general:
+                    name: Powell
+                    settings:
+                        patience: 1
+                mixed_precision:
+                    return_codes: False
+                    max_relative_gradient: 0.05
+        '''))
+        self._config.__enter__()
+
+    def tearDown(self):
+        self._config.__exit__(None, None, None)
+
+    def test_configuration(self):
+        self.assertFalse(use_mixed_precision())
+        with mdt.config_context(YamlStringAction('optimization: {mixed_precision: {enabled: True}}')):
+            self.assertTrue(use_mixed_precision())
+
+        refinement = get_mixed_precision_refinement(['BallStick_r1'])
+        self.assertEqual(refinement.get_criteria(), {'return_codes': False, 'max_relative_residual': None,
+                                                     'log_likelihood_outliers': None, 'max_relative_gradient': 0.05,
+                                                     'double_precision': True})
+        self.assertEqual(refinement.optimizer.patience, 1)
+
+    def test_refinement_only_for_single_precision(self):
+        refinement = self._get_precision_refinement(mixed_precision=True)
+        self.assertIsInstance(refinement, VoxelRefinement)
+        self.assertTrue(refinement.double_precision)
+        self.assertTrue(refinement.optimizer._cl_runtime_info.double_precision)
+
+        self.assertIsNone(self._get_precision_refinement(mixed_precision=False))
+        self.assertIsNone(self._get_precision_refinement(mixed_precision=True, double_precision=True))
+
+        with mdt.config_context(YamlStringAction('optimization: {mixed_precision: {enabled: True}}')):
+            self.assertIsNotNone(self._get_precision_refinement())
+
+    def test_selects_poorly_converged_voxels(self):
+        results = create_roi(mdt.fit_model('BallStick_r1', self._input_data, None, cl_device_ind=0), self._mask)
+        gradients = get_relative_gradients(self._model, results, double_precision=False)
+
+        refinement = get_mixed_precision_refinement(['BallStick_r1'])
+        refinement.double_precision = False
+        refinement.max_relative_gradient = float(np.median(gradients))
+
+        refine = refinement.get_voxels_to_refine(self._model, results)
+        np.testing.assert_array_equal(refine, gradients > refinement.max_relative_gradient)
+        self.assertTrue(np.any(refine))
+        self.assertFalse(np.all(refine))
+
+        skip_voxels = np.zeros_like(refine)
+        skip_voxels[np.flatnonzero(refine)[0]] = True
+        np.testing.assert_array_equal(refinement.get_voxels_to_refine(self._model, results, skip_voxels=skip_voxels),
+                                      refine & ~skip_voxels)
+
+    def _get_precision_refinement(self, **kwargs):
+        """Get the precision refinement the model fitting passes on to the single model fit, without fitting."""
+        captured = {}
+
+        class StopFitting(Exception):
+            pass
+
+        def single_model_fit(*args, **fit_kwargs):
+            captured.update(fit_kwargs)
+            raise StopFitting()
+
+        original = mdt.model_fitting.SingleModelFit
+        mdt.model_fitting.SingleModelFit = single_model_fit
+        try:
+            with self.assertRaises(StopFitting):
+                mdt.fit_model('BallStick_r1', self._input_data, None, cl_device_ind=0, **kwargs)
+        finally:
+            mdt.model_fitting.SingleModelFit = original
+        return captured['precision_refinement']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import mdt
+from mdt.protocols import Protocol
+from mdt.provenance import get_fit_provenance, get_provenance_changes, get_reusable_voxels, get_voxel_fingerprints, \
+    write_provenance, write_voxel_fingerprints
+from mdt.utils import SimpleMRIInputData
+from mot.cl_routines.optimizing.nmsimplex import NMSimplex
+from mot.cl_routines.optimizing.powell import Powell
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-16"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ProvenanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self._random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+
+        nmr_volumes = 10
+        directions = self._random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        self._protocol = Protocol(columns={'b': np.array([0] + [1e9] * (nmr_volumes - 1)),
+                                           'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        self._mask = self._random_state.rand(4, 4, 3) > 0.3
+        self._signal = self._random_state.rand(4, 4, 3, nmr_volumes) * 100 + 10
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_input_data(self, signal=None, mask=None, noise_std=5):
+        return SimpleMRIInputData(self._protocol, self._signal if signal is None else signal,
+                                  self._mask if mask is None else mask, None, noise_std=noise_std)
+
+    def _get_model(self):
+        return mdt.get_model('BallStick_r1')()
+
+    def _store(self, model, input_data, optimizer=None, **kwargs):
+        provenance = get_fit_provenance(model, input_data, optimizer or Powell(), **kwargs)
+        write_provenance(self._tmp_dir, provenance)
+        write_voxel_fingerprints(self._tmp_dir, get_voxel_fingerprints(model, input_data), input_data.mask)
+        return provenance
+
+    def _get_reusable_voxels(self, model, input_data, optimizer=None, **kwargs):
+        provenance = get_fit_provenance(model, input_data, optimizer or Powell(), **kwargs)
+        return get_reusable_voxels(self._tmp_dir, provenance, get_voxel_fingerprints(model, input_data),
+                                   input_data.mask)
+
+    def test_provenance_is_deterministic(self):
+        input_data = self._get_input_data()
+        provenance = get_fit_provenance(self._get_model(), input_data, Powell())
+        self.assertEqual(get_fit_provenance(self._get_model(), self._get_input_data(), Powell()), provenance)
+
+    def test_provenance_components(self):
+        provenance = get_fit_provenance(self._get_model(), self._get_input_data(), Powell())
+
+        model = self._get_model()
+        model.fix('Stick0.theta', 1)
+        signal = np.copy(self._signal)
+        signal[tuple(np.argwhere(self._mask)[0])][0] += 1
+        changed = get_fit_provenance(model, self._get_input_data(signal=signal), Powell())
+
+        self.assertNotEqual(changed['hash'], provenance['hash'])
+        self.assertEqual(sorted(key for key, value in changed['components'].items()
+                                if provenance['components'][key] != value), ['dwi', 'model_parameters'])
+
+    def test_provenance_changes(self):
+        self.assertIsNone(get_provenance_changes(self._tmp_dir, {'hash': '', 'components': {}}))
+
+        input_data = self._get_input_data()
+        provenance = self._store(self._get_model(), input_data)
+        self.assertEqual(get_provenance_changes(self._tmp_dir, provenance), [])
+
+        changed = get_fit_provenance(self._get_model(), input_data, NMSimplex(), double_precision=True)
+        self.assertEqual(get_provenance_changes(self._tmp_dir, changed), ['double_precision', 'optimizer'])
+
+    def test_fingerprints_per_voxel(self):
+        model = self._get_model()
+        fingerprints = get_voxel_fingerprints(model, self._get_input_data())
+        self.assertEqual(fingerprints.shape, (np.count_nonzero(self._mask),))
+        self.assertEqual(len(np.unique(fingerprints)), len(fingerprints))
+
+        signal = np.copy(self._signal)
+        position = tuple(np.argwhere(self._mask)[2])
+        signal[position][0] += 1
+        changed = get_voxel_fingerprints(model, self._get_input_data(signal=signal))
+        np.testing.assert_array_equal(np.flatnonzero(changed != fingerprints), [2])
+
+    def test_fingerprints_global_inputs(self):
+        model = self._get_model()
+        fingerprints = get_voxel_fingerprints(model, self._get_input_data())
+        changed = get_voxel_fingerprints(model, self._get_input_data(noise_std=6))
+        self.assertTrue(np.all(changed != fingerprints))
+
+    def test_fingerprints_parameter_maps(self):
+        model = self._get_model()
+        fingerprints = get_voxel_fingerprints(model, self._get_input_data())
+
+        theta = np.full(np.count_nonzero(self._mask), 0.5)
+        model.init('Stick0.theta', theta)
+        initialized = get_voxel_fingerprints(model, self._get_input_data())
+
+        theta[3] = 1
+        model.init('Stick0.theta', theta)
+        changed = get_voxel_fingerprints(model, self._get_input_data())
+
+        self.assertTrue(np.all(initialized != fingerprints))
+        np.testing.assert_array_equal(np.flatnonzero(changed != initialized), [3])
+
+    def test_reuse_without_stored_results(self):
+        self.assertIsNone(self._get_reusable_voxels(self._get_model(), self._get_input_data()))
+
+    def test_reuse_unchanged(self):
+        self._store(self._get_model(), self._get_input_data())
+        reusable = self._get_reusable_voxels(self._get_model(), self._get_input_data())
+        self.assertTrue(np.all(reusable))
+
+    def test_reuse_changed_voxels(self):
+        self._store(self._get_model(), self._get_input_data())
+
+        signal = np.copy(self._signal)
+        signal[tuple(np.argwhere(self._mask)[4])][1] += 1
+        reusable = self._get_reusable_voxels(self._get_model(), self._get_input_data(signal=signal))
+        np.testing.assert_array_equal(np.flatnonzero(~reusable), [4])
+
+    def test_reuse_changed_mask(self):
+        self._store(self._get_model(), self._get_input_data())
+
+        mask = np.copy(self._mask)
+        added = tuple(np.argwhere(~self._mask)[0])
+        removed = tuple(np.argwhere(self._mask)[0])
+        mask[added] = True
+        mask[removed] = False
+
+        reusable = self._get_reusable_voxels(self._get_model(), self._get_input_data(mask=mask))
+        self.assertEqual(reusable.shape, (np.count_nonzero(mask),))
+
+        index_matrix = np.cumsum(mask).reshape(mask.shape) - 1
+        np.testing.assert_array_equal(np.flatnonzero(~reusable), [index_matrix[added]])
+
+    def test_no_reuse_with_other_settings(self):
+        self._store(self._get_model(), self._get_input_data())
+
+        self.assertIsNone(self._get_reusable_voxels(self._get_model(), self._get_input_data(), NMSimplex()))
+        self.assertIsNone(self._get_reusable_voxels(self._get_model(), self._get_input_data(),
+                                                    double_precision=True))
+        self.assertIsNone(self._get_reusable_voxels(mdt.get_model('BallStick_r2')(), self._get_input_data()))
+
+    def test_no_reuse_with_other_bootstrap(self):
+        self._store(self._get_model(), self._get_input_data())
+        self.assertIsNone(self._get_reusable_voxels(self._get_model(), self._get_input_data(),
+                                                    bootstrap=mdt.configuration.get_residual_bootstrap()))
+
+
+if __name__ == '__main__':
+    unittest.main()
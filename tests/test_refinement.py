@@ -0,0 +1,144 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.configuration import YamlStringAction
+from mdt.protocols import Protocol
+from mdt.refinement import VoxelRefinement, FAILED_RETURN_CODES, get_neighbourhood_outliers, \
+    get_relative_residuals, get_relative_gradients
+from mdt.utils import SimpleMRIInputData, create_roi
+from mot.cl_routines.optimizing.powell import Powell
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-22"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class RefinementTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_volumes = 31
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        self._protocol = Protocol(columns={'b': np.array([0] + [1e9] * 15 + [2e9] * 15),
+                                           'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        self._mask = np.ones((4, 4, 3), dtype=bool)
+        nmr_voxels = np.count_nonzero(self._mask)
+        self._parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_voxels),
+                            'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_voxels),
+                            'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels),
+                            'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_voxels)}
+        self._parameters['w_ball.w'] = 1 - self._parameters['w_stick0.w']
+
+        signals = mdt.simulate_signals('BallStick_r1', self._protocol, self._parameters)
+        self._signals = signals + random_state.normal(0, 10, signals.shape)
+
+        self._input_data = SimpleMRIInputData(self._protocol, np.reshape(self._signals, self._mask.shape + (-1,)),
+                                              self._mask, None, noise_std=10)
+        self._model = mdt.get_model('BallStick_r1')()
+        self._model.set_input_data(self._input_data)
+
+    def test_neighbourhood_outliers(self):
+        mask = np.zeros((5, 5, 5), dtype=bool)
+        mask[1:4, 1:4, 1:4] = True
+        mask[0, 0, 0] = True
+        values = np.random.RandomState(0).normal(0, 0.1, np.count_nonzero(mask))
+
+        positions = np.argwhere(mask)
+        center = int(np.where(np.all(positions == [2, 2, 2], axis=1))[0][0])
+        isolated = int(np.where(np.all(positions == [0, 0, 0], axis=1))[0][0])
+        values[center] = -10
+        values[isolated] = -10
+
+        np.testing.assert_array_equal(np.flatnonzero(get_neighbourhood_outliers(values, mask, 3)), [center])
+
+        values[center] = np.nan
+        self.assertFalse(np.any(get_neighbourhood_outliers(values, mask, 3)))
+
+    def test_relative_residuals(self):
+        exact = get_relative_residuals(self._model, self._parameters)
+        expected = (np.linalg.norm(self._signals - mdt.simulate_signals('BallStick_r1', self._protocol,
+                                                                       self._parameters), axis=1)
+                    / np.linalg.norm(self._signals, axis=1))
+        np.testing.assert_allclose(exact, expected, rtol=1e-3)
+
+        scaled = dict(self._parameters)
+        scaled['S0.s0'] = self._parameters['S0.s0'] * 0.5
+        self.assertTrue(np.all(get_relative_residuals(self._model, scaled, batch_size=7) > exact))
+
+    def test_relative_gradients(self):
+        results = create_roi(self._fit('', patience=10), self._mask)
+        converged = get_relative_gradients(self._model, results, double_precision=False)
+
+        perturbed = dict(results)
+        perturbed['Stick0.theta'] = results['Stick0.theta'] + 0.2
+        voxels = np.arange(0, np.count_nonzero(self._mask), 2)
+        gradients = get_relative_gradients(self._model, perturbed, voxels=voxels, batch_size=5,
+                                           double_precision=False)
+
+        self.assertEqual(gradients.shape, voxels.shape)
+        self.assertLess(np.median(converged), 0.1)
+        self.assertTrue(np.all(gradients > 1))
+
+    def test_voxels_to_refine(self):
+        return_codes = np.zeros(np.count_nonzero(self._mask))
+        return_codes[[1, 4]] = FAILED_RETURN_CODES[0]
+        skip_voxels = np.zeros(np.count_nonzero(self._mask), dtype=bool)
+        skip_voxels[4] = True
+
+        refinement = VoxelRefinement(Powell(), log_likelihood_outliers=None)
+        refine = refinement.get_voxels_to_refine(self._model, dict(self._parameters, ReturnCodes=return_codes),
+                                                 skip_voxels=skip_voxels)
+        np.testing.assert_array_equal(np.flatnonzero(refine), [1])
+
+        refinement.return_codes = False
+        self.assertFalse(np.any(refinement.get_voxels_to_refine(self._model, dict(self._parameters,
+                                                                                  ReturnCodes=return_codes))))
+
+    def test_refined_fit(self):
+        first_pass = create_roi(self._fit(''), self._mask)
+
+        relative_residuals = get_relative_residuals(self._model, first_pass)
+        threshold = float(np.median(relative_residuals))
+        refined_voxels = relative_residuals > threshold
+
+        refined = create_roi(self._fit('''
+            refinement:
+                enabled: True
+                return_codes: False
+                log_likelihood_outliers: !!null
+                max_relative_residual: {}
+                optimizer:
+                    name: Powell
+                    settings:
+                        patience: 10
+        '''.format(threshold)), self._mask)
+
+        for name in self._model.get_free_param_names():
+            np.testing.assert_array_equal(refined[name][~refined_voxels], first_pass[name][~refined_voxels])
+        self.assertTrue(np.all(refined['LogLikelihood'][refined_voxels]
+                               >= first_pass['LogLikelihood'][refined_voxels] - 1e-3))
+        self.assertTrue(np.any(refined['LogLikelihood'][refined_voxels] > first_pass['LogLikelihood'][refined_voxels]))
+
+    def _fit(self, optimization_config, patience=1):
+        config = '''
+            active_post_processing:
+                optimization:
+                    covariance: False
+            optimization:
+                general:
+                    name: Powell
+                    settings:
+                        patience: {}
+        '''.format(patience) + optimization_config.replace('\n            ', '\n                ')
+        with mdt.config_context(YamlStringAction(config)):
+            return mdt.fit_model('BallStick_r1', self._input_data, None, cl_device_ind=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
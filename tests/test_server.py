@@ -0,0 +1,106 @@
+import unittest
+
+import mot.configuration
+import mdt
+from mdt.server import FittingServer, _FairJobQueue, _Job
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-14"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class FairJobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self._queue = _FairJobQueue()
+        self._counter = 0
+
+    def _put(self, client_id):
+        self._counter += 1
+        job = _Job(self._counter, client_id, 'fit', {})
+        self._queue.put(job)
+        return job
+
+    def _get_all(self):
+        jobs = []
+        while self._queue.get_queue_sizes():
+            jobs.append(self._queue.get())
+        return jobs
+
+    def test_round_robin_over_clients(self):
+        for client_id in ['a', 'a', 'a', 'b', 'c', 'c']:
+            self._put(client_id)
+
+        order = [job.client_id for job in self._get_all()]
+        self.assertEqual(order, ['a', 'b', 'c', 'a', 'c', 'a'])
+
+    def test_fifo_per_client(self):
+        jobs = [self._put('a') for _ in range(3)]
+        self.assertEqual(self._get_all(), jobs)
+
+    def test_served_client_moves_to_back(self):
+        self._put('a')
+        self._put('a')
+        self._put('b')
+        self.assertEqual(self._queue.get().client_id, 'a')
+
+        self._put('c')
+        order = [job.client_id for job in self._get_all()]
+        self.assertEqual(order, ['b', 'a', 'c'])
+
+    def test_drained_client_rejoins_at_back(self):
+        self._put('a')
+        self._put('b')
+        self.assertEqual(self._queue.get().client_id, 'a')
+
+        self._put('a')
+        order = [job.client_id for job in self._get_all()]
+        self.assertEqual(order, ['b', 'a'])
+
+    def test_positions_match_serving_order(self):
+        jobs = [self._put(client_id) for client_id in ['a', 'a', 'a', 'b', 'c', 'c', 'b']]
+        positions = {job.job_id: self._queue.position(job) for job in jobs}
+
+        served = self._get_all()
+        self.assertEqual(sorted(positions.values()), list(range(len(jobs))))
+        for index, job in enumerate(served):
+            self.assertEqual(positions[job.job_id], index)
+
+    def test_position_of_unknown_job(self):
+        self._put('a')
+        self.assertEqual(self._queue.position(_Job(100, 'a', 'fit', {})), 0)
+        self.assertEqual(self._queue.position(_Job(101, 'b', 'fit', {})), 0)
+
+    def test_closed_queue_returns_none(self):
+        self._put('a')
+        self._queue.close()
+        self.assertIsNone(self._queue.get())
+
+
+class FittingServerTest(unittest.TestCase):
+
+    def test_failing_job_restores_configuration(self):
+        server = FittingServer()
+        server._cl_devices = mot.configuration.get_cl_environments()
+
+        gzip_optimization_results = mdt.configuration.gzip_optimization_results()
+        cl_environments = mot.configuration.get_cl_environments()
+        double_precision = mot.configuration.use_double_precision()
+
+        spec = {'dwi': '/non/existing/dwi.nii', 'protocol': '/non/existing/dwi.prtcl',
+                'mask': '/non/existing/mask.nii', 'model': 'BallStick_r1', 'output_folder': '/non/existing',
+                'cl_device_ind': 0, 'double_precision': not double_precision,
+                'config_context': 'output_format: {optimization: {gzip: %s}}' % (not gzip_optimization_results)}
+
+        with self.assertRaises(Exception):
+            server._execute(_Job(1, 'a', 'fit', spec))
+
+        self.assertEqual(mdt.configuration.gzip_optimization_results(), gzip_optimization_results)
+        self.assertEqual(mot.configuration.get_cl_environments(), cl_environments)
+        self.assertEqual(mot.configuration.use_double_precision(), double_precision)
+
+
+if __name__ == '__main__':
+    unittest.main()
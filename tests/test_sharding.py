@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+
+import mdt
+from mdt.cli_scripts.mdt_merge_shards import MergeShards
+from mdt.configuration import YamlStringAction
+from mdt.nifti import get_all_nifti_data, write_nifti
+from mdt.processing_strategies import get_full_tmp_results_path
+from mdt.protocols import Protocol
+from mdt.sharding import Shard, get_sharding_dirs, get_unfinished_shards, merge_shards, MERGE_LOCK_FILENAME
+from mdt.utils import SimpleMRIInputData, create_roi
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-30"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_from_string(self):
+        shard = Shard.from_string(' 2 / 3 ')
+        self.assertEqual((shard.index, shard.nmr_shards), (1, 3))
+        self.assertEqual(str(shard), '2/3')
+        self.assertEqual(shard.get_directory_name(), 'shard_2_of_3')
+
+        for value in ['0/3', '4/3', '1', 'a/b', '1/0']:
+            with self.assertRaises(ValueError):
+                Shard.from_string(value)
+        with self.assertRaises(ValueError):
+            Shard(3, 3)
+
+    def test_select(self):
+        roi_indices = np.arange(3, 13)
+        selections = [Shard(ind, 3).select(roi_indices) for ind in range(3)]
+        self.assertEqual([len(selection) for selection in selections], [4, 3, 3])
+        np.testing.assert_array_equal(np.concatenate(selections), roi_indices)
+
+
+class ShardedFittingTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+        self._output_folder = os.path.join(self._tmp_dir, 'output')
+        self._tmp_results_dir = os.path.join(self._tmp_dir, 'tmp_results')
+
+        nmr_volumes = 13
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        protocol = Protocol(columns={'b': np.array([0] + [1e9] * 6 + [2e9] * 6),
+                                     'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        mask = random_state.rand(4, 3, 3) > 0.2
+        signal = 1000 * np.exp(-protocol.get_column('b')[:, 0] * 1e-9)[None, None, None, :] \
+            * random_state.uniform(0.8, 1.2, mask.shape + (nmr_volumes,))
+        self._input_data = SimpleMRIInputData(protocol, signal, mask, None)
+
+        self._config = mdt.config_context(YamlStringAction('''
+            active_post_processing:
+                optimization:
+                    covariance: False
+            sharding:
+                poll_interval: 0.1
+        '''))
+        self._config.__enter__()
+
+    def tearDown(self):
+        self._config.__exit__(None, None, None)
+        shutil.rmtree(self._tmp_dir)
+
+    def _fit(self, output_folder, shard=None):
+        return mdt.fit_model('BallStick_r1', self._input_data, output_folder, cl_device_ind=0, shard=shard,
+                             tmp_results_dir=self._tmp_results_dir, save_user_script_info=None)
+
+    def _fit_shards(self, nmr_shards):
+        """Fit all the shards in parallel threads and return the results of every shard."""
+        results = [None] * nmr_shards
+        errors = []
+
+        def fit_shard(ind):
+            try:
+                results[ind] = self._fit(self._output_folder, shard=Shard(ind, nmr_shards))
+            except Exception as exc:
+                errors.append(exc)
+                raise
+
+        threads = [threading.Thread(target=fit_shard, args=(ind,)) for ind in range(nmr_shards)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        self.assertEqual(errors, [])
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        return results
+
+    def _get_sharding_dir(self):
+        return os.path.join(get_full_tmp_results_path(os.path.join(self._output_folder, 'BallStick_r1'),
+                                                      self._tmp_results_dir), 'optimization')
+
+    def test_matches_unsharded_fit(self):
+        reference = self._fit(None)
+        for shard_results in self._fit_shards(3):
+            self.assertEqual(sorted(shard_results), sorted(reference))
+            for name in ['S0.s0', 'w_stick0.w', 'LogLikelihood']:
+                np.testing.assert_allclose(shard_results[name], reference[name], rtol=1e-5, err_msg=name)
+
+        self.assertFalse(os.path.exists(self._get_sharding_dir()))
+
+    def test_merge_interrupted_shards(self):
+        sharding_dir = self._get_sharding_dir()
+        os.makedirs(sharding_dir)
+        with open(os.path.join(sharding_dir, MERGE_LOCK_FILENAME), 'w'):
+            pass
+
+        shard_threads = threading.Thread(target=self._fit_shards, args=(2,))
+        shard_threads.daemon = True
+        shard_threads.start()
+        for _ in range(600):
+            if not get_unfinished_shards(sharding_dir, 2):
+                break
+            time.sleep(0.1)
+        self.assertEqual(get_unfinished_shards(sharding_dir, 2), [])
+
+        tmp_dir = get_full_tmp_results_path(os.path.join(self._output_folder, 'BallStick_r1'), self._tmp_results_dir)
+        self.assertEqual(get_sharding_dirs(tmp_dir), [sharding_dir])
+
+        MergeShards().run(MergeShards()._get_arg_parser().parse_args([
+            self._write_mask(), os.path.join(self._output_folder, 'BallStick_r1'),
+            '--tmp-results-dir', self._tmp_results_dir]), [])
+        shard_threads.join(60)
+        self.assertFalse(shard_threads.is_alive())
+
+        merged = create_roi(get_all_nifti_data(os.path.join(self._output_folder, 'BallStick_r1')),
+                            self._input_data.mask)
+        reference = create_roi(self._fit(None), self._input_data.mask)
+        for name in ['S0.s0', 'w_stick0.w', 'LogLikelihood']:
+            np.testing.assert_allclose(merged[name], reference[name], rtol=1e-5, err_msg=name)
+
+    def test_merge_unfinished(self):
+        sharding_dir = os.path.join(self._tmp_dir, 'sharding')
+        os.makedirs(os.path.join(sharding_dir, Shard(0, 2).get_directory_name()))
+        with self.assertRaises(ValueError):
+            merge_shards(sharding_dir, self._output_folder, self._input_data.mask, None)
+        with self.assertRaises(ValueError):
+            merge_shards(self._tmp_dir, self._output_folder, self._input_data.mask, None)
+
+    def test_requires_output_folder(self):
+        with self.assertRaises(ValueError):
+            self._fit(None, shard='1/2')
+
+    def _write_mask(self):
+        filename = os.path.join(self._tmp_dir, 'mask.nii.gz')
+        write_nifti(self._input_data.mask.astype(np.int8), filename)
+        return filename
+
+
+if __name__ == '__main__':
+    unittest.main()
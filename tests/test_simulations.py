@@ -0,0 +1,245 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import mdt
+from mdt.protocols import Protocol
+from mdt.nifti import load_nifti
+from mdt.simulations import simulate_signals, iter_simulate_signals, add_noise, run_recovery_study, \
+    _get_recovery_statistics, create_signal_estimates, iter_signal_estimates
+from mdt.utils import SimpleMRIInputData, restore_volumes
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-26"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class SimulateSignalsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+
+        self._protocol = _get_protocol(random_state)
+        self._parameters = _get_parameters(random_state, 5000)
+        self._s0 = self._parameters['S0.s0']
+        self._noise_free = simulate_signals('BallStick_r1', self._protocol, self._parameters)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_batches(self):
+        batches = list(iter_simulate_signals('BallStick_r1', self._protocol, self._parameters, batch_size=1500))
+        self.assertEqual([rows for rows, _ in batches],
+                         [slice(0, 1500), slice(1500, 3000), slice(3000, 4500), slice(4500, 5000)])
+        np.testing.assert_array_equal(np.concatenate([signals for _, signals in batches]), self._noise_free)
+
+        np.testing.assert_allclose(self._noise_free[:, 0], self._s0, rtol=1e-5)
+        self.assertTrue(np.all(self._noise_free[:, 1:] < self._s0[:, None]))
+
+        matrix = mdt.get_model('BallStick_r1')().param_dict_to_array(self._parameters)
+        np.testing.assert_array_equal(simulate_signals('BallStick_r1', self._protocol, matrix), self._noise_free)
+
+    def test_noise_is_reproducible(self):
+        noisy = [simulate_signals('BallStick_r1', self._protocol, self._parameters, noise_level=20, seed=1,
+                                  batch_size=batch_size) for batch_size in [10000, 999]]
+        np.testing.assert_array_equal(noisy[0], noisy[1])
+
+        other_seed = simulate_signals('BallStick_r1', self._protocol, self._parameters, noise_level=20, seed=2)
+        self.assertFalse(np.allclose(noisy[0], other_seed))
+
+    def test_noise_distribution(self):
+        gaussian, rician = [simulate_signals('BallStick_r1', self._protocol, self._parameters, noise_level=20,
+                                             noise_type=noise_type, seed=0).astype(np.float64) - self._noise_free
+                            for noise_type in ['gaussian', 'rician']]
+        self.assertAlmostEqual(np.std(gaussian), 20, delta=0.5)
+        self.assertAlmostEqual(np.mean(gaussian), 0, delta=0.5)
+        self.assertAlmostEqual(np.std(rician), 20, delta=0.5)
+        self.assertGreater(np.mean(rician), np.mean(gaussian))
+
+        zeros = np.zeros((10000, 4))
+        self.assertAlmostEqual(np.mean(add_noise(zeros, 1, noise_type='rician', seed=0)), np.sqrt(np.pi / 2),
+                               delta=0.02)
+        np.testing.assert_array_equal(add_noise(zeros, 1, seed=0), add_noise(zeros, 1, seed=0))
+
+        with self.assertRaises(ValueError):
+            add_noise(zeros, 1, noise_type='uniform')
+
+    def test_noise_level_per_row(self):
+        noise_level = np.where(np.arange(5000) < 2500, 0, 50)
+        noisy = simulate_signals('BallStick_r1', self._protocol, self._parameters, noise_level=noise_level,
+                                 noise_type='gaussian', seed=0)
+        np.testing.assert_array_equal(noisy[:2500], self._noise_free[:2500])
+        self.assertAlmostEqual(np.std(noisy[2500:].astype(np.float64) - self._noise_free[2500:]), 50, delta=1)
+
+    def test_realizations(self):
+        parameters = {name: values[:100] for name, values in self._parameters.items()}
+        noisy = simulate_signals('BallStick_r1', self._protocol, parameters, noise_level=20,
+                                 noise_type='gaussian', nmr_realizations=200, seed=0)
+
+        self.assertEqual(noisy.shape, (100, 200, self._noise_free.shape[1]))
+        self.assertFalse(np.allclose(noisy[:, 0], noisy[:, 1]))
+        np.testing.assert_allclose(np.mean(noisy, axis=1), self._noise_free[:100], atol=6)
+
+        first_realization = simulate_signals('BallStick_r1', self._protocol, parameters, noise_level=20,
+                                             noise_type='gaussian', nmr_realizations=1, seed=0)
+        np.testing.assert_array_equal(first_realization[:, 0], noisy[:, 0])
+
+    def test_output(self):
+        filename = os.path.join(self._tmp_dir, 'signals.npy')
+        simulate_signals('BallStick_r1', self._protocol, self._parameters, batch_size=1000, out=filename)
+        np.testing.assert_array_equal(np.load(filename), self._noise_free)
+
+        out = np.zeros_like(self._noise_free)
+        self.assertIs(simulate_signals('BallStick_r1', self._protocol, self._parameters, out=out), out)
+        np.testing.assert_array_equal(out, self._noise_free)
+
+        with self.assertRaises(ValueError):
+            simulate_signals('BallStick_r1', self._protocol, self._parameters, out=out[:10])
+
+
+class RecoveryStudyTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+
+        self._protocol = _get_protocol(random_state)
+        self._parameters = _get_parameters(random_state, 20)
+        del self._parameters['w_ball.w']
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _run(self, **kwargs):
+        return run_recovery_study('BallStick_r1', self._protocol, self._parameters, [10, 200], nmr_repeats=3, seed=0,
+                                  cl_device_ind=0, post_processing={'covariance': False}, **kwargs)
+
+    def test_table(self):
+        results_file = os.path.join(self._tmp_dir, 'recovery.csv')
+        table = self._run(chunk_size=7, results_file=results_file)
+
+        param_names = ['S0.s0', 'w_stick0.w', 'Stick0.theta', 'Stick0.phi']
+        self.assertEqual([(row['snr'], row['parameter']) for row in table],
+                         [(snr, name) for snr in [10, 200] for name in param_names])
+        for row in table:
+            self.assertEqual(row['nmr_valid'], 60)
+            self.assertLessEqual(abs(row['bias']), row['mae'])
+            self.assertLessEqual(row['mae'], row['rmse'])
+            self.assertTrue(np.isnan(row['coverage']))
+
+        rows = {(row['snr'], row['parameter']): row for row in table}
+        for name in ['S0.s0', 'w_stick0.w']:
+            self.assertLess(rows[(200, name)]['rmse'], rows[(10, name)]['rmse'])
+        self.assertLess(rows[(200, 'S0.s0')]['mae'], 0.05 * np.mean(self._parameters['S0.s0']))
+
+        with open(results_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'snr,parameter,nmr_valid,bias,rmse,mae,coverage')
+        self.assertEqual(len(lines), len(table) + 1)
+        self.assertEqual(lines[1].split(',')[:3], ['10', 'S0.s0', '60'])
+
+    def test_chunk_size(self):
+        single_chunk = self._run()
+        for row, other in zip(single_chunk, self._run(chunk_size=6)):
+            for key in ['bias', 'rmse', 'mae']:
+                self.assertAlmostEqual(row[key], other[key], places=4)
+
+    def test_statistics(self):
+        true_values = np.array([1., 2., 3., 4.])
+        results = {'x': np.array([[1.5], [1.], [np.nan], [4.]]), 'x.std': np.array([[1.], [0.1], [1.], [0.1]])}
+        nmr_valid, error_sum, squared_error_sum, absolute_error_sum, nmr_covered = _get_recovery_statistics(
+            true_values, results, 'x', 1.)
+        self.assertEqual((nmr_valid, error_sum, squared_error_sum, absolute_error_sum, nmr_covered),
+                         (3, -0.5, 1.25, 1.5, 2))
+
+
+class SignalEstimatesTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._tmp_dir = tempfile.mkdtemp()
+
+        self._protocol = _get_protocol(random_state)
+        self._mask = random_state.rand(5, 4, 3) > 0.3
+        nmr_voxels = np.count_nonzero(self._mask)
+
+        parameters = _get_parameters(random_state, nmr_voxels)
+        self._noise_free = simulate_signals('BallStick_r1', self._protocol, parameters)
+        self._observations = self._noise_free + random_state.normal(0, 10, self._noise_free.shape)
+        self._input_data = SimpleMRIInputData(self._protocol, restore_volumes(self._observations, self._mask),
+                                              self._mask, None)
+        self._parameters = restore_volumes(parameters, self._mask)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_estimates(self):
+        estimates = create_signal_estimates('BallStick_r1', self._input_data, self._parameters, batch_size=7)
+
+        self.assertEqual(estimates.shape, self._mask.shape + (self._noise_free.shape[1],))
+        np.testing.assert_allclose(estimates[self._mask], self._noise_free, rtol=1e-5)
+        np.testing.assert_array_equal(estimates[~self._mask], 0)
+
+    def test_batches(self):
+        batches = list(iter_signal_estimates('BallStick_r1', self._input_data, self._parameters, batch_size=10))
+        np.testing.assert_array_equal(np.concatenate([roi_indices for roi_indices, _ in batches]),
+                                      np.arange(np.count_nonzero(self._mask)))
+        self.assertTrue(all(len(roi_indices) <= 10 for roi_indices, _ in batches))
+        np.testing.assert_allclose(np.concatenate([estimates for _, estimates in batches]), self._noise_free,
+                                   rtol=1e-5)
+
+        with self.assertRaises(ValueError):
+            list(iter_signal_estimates('BallStick_r1', self._input_data,
+                                       {k: v[:2] for k, v in self._parameters.items()}))
+
+    def test_residuals(self):
+        residuals = np.zeros(self._mask.shape + (self._noise_free.shape[1],), dtype=np.float32)
+        estimates = create_signal_estimates('BallStick_r1', self._input_data, self._parameters, batch_size=7,
+                                            residuals_out=residuals)
+
+        np.testing.assert_allclose(residuals[self._mask], self._observations - self._noise_free, rtol=1e-3,
+                                   atol=1e-2)
+        np.testing.assert_allclose(estimates + residuals, self._input_data.signal4d, rtol=1e-5, atol=1e-3)
+
+    def test_file_output(self):
+        npy_file = os.path.join(self._tmp_dir, 'estimates.npy')
+        nifti_file = os.path.join(self._tmp_dir, 'residuals.nii.gz')
+        estimates = create_signal_estimates('BallStick_r1', self._input_data, self._parameters, batch_size=7,
+                                            out=npy_file)
+        self.assertIsInstance(estimates, np.memmap)
+        np.testing.assert_allclose(np.load(npy_file)[self._mask], self._noise_free, rtol=1e-5)
+
+        self.assertIsNone(create_signal_estimates('BallStick_r1', self._input_data, self._parameters,
+                                                  out=nifti_file))
+        np.testing.assert_allclose(load_nifti(nifti_file).get_data()[self._mask], self._noise_free, rtol=1e-5)
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ['estimates.npy', 'residuals.nii.gz'])
+
+        with self.assertRaises(ValueError):
+            create_signal_estimates('BallStick_r1', self._input_data, self._parameters, out=np.zeros((2, 2)))
+
+
+def _get_protocol(random_state):
+    nmr_volumes = 16
+    directions = random_state.normal(size=(nmr_volumes, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    return Protocol(columns={'b': np.array([0] + [1e9] * 8 + [2e9] * 7),
+                             'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+
+def _get_parameters(random_state, nmr_rows):
+    """Get random parameters of the BallStick_r1 model, as a dictionary with a 1d array per parameter."""
+    parameters = {'S0.s0': random_state.uniform(800, 1200, nmr_rows),
+                  'w_stick0.w': random_state.uniform(0.3, 0.7, nmr_rows),
+                  'Stick0.theta': random_state.uniform(0.2, np.pi - 0.2, nmr_rows),
+                  'Stick0.phi': random_state.uniform(0.2, np.pi - 0.2, nmr_rows)}
+    parameters['w_ball.w'] = 1 - parameters['w_stick0.w']
+    return parameters
+
+
+if __name__ == '__main__':
+    unittest.main()
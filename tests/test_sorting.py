@@ -0,0 +1,100 @@
+import unittest
+import numpy as np
+
+from mdt.sorting import create_sort_matrix, sort_volumes_per_voxel, undo_sort_volumes_per_voxel, sort_orientations
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-20"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class SortingTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._volumes = [random_state.rand(6, 5, 4) for _ in range(3)]
+        self._vectors = [random_state.rand(6, 5, 4, 3) for _ in range(3)]
+        self._mask = random_state.rand(6, 5, 4) > 0.3
+
+        self._stacked = np.stack(self._volumes, axis=-1)
+        self._sort_index = np.argsort(self._stacked, axis=-1)
+
+    def test_create_sort_matrix(self):
+        for batch_size in [1, 7, 100000]:
+            sort_matrix = create_sort_matrix(self._volumes, batch_size=batch_size)
+            np.testing.assert_array_equal(sort_matrix, self._sort_index)
+
+    def test_create_sort_matrix_reversed(self):
+        sort_matrix = create_sort_matrix(self._volumes, reversed_sort=True, batch_size=7)
+        np.testing.assert_array_equal(sort_matrix, self._sort_index[..., ::-1])
+
+    def test_sort_volumes(self):
+        expected = np.take_along_axis(self._stacked, self._sort_index, axis=-1)
+
+        for batch_size in [1, 7, 100000]:
+            sorted_volumes = sort_volumes_per_voxel(self._volumes, self._sort_index, batch_size=batch_size)
+            for ind, volume in enumerate(sorted_volumes):
+                self.assertEqual(volume.shape, (6, 5, 4, 1))
+                np.testing.assert_array_equal(volume[..., 0], expected[..., ind])
+
+    def test_sort_vector_volumes(self):
+        stacked = np.stack(self._vectors, axis=3)
+        expected = np.take_along_axis(stacked, self._sort_index[..., None], axis=3)
+
+        sorted_volumes = sort_volumes_per_voxel(self._vectors, self._sort_index, batch_size=7)
+        for ind, volume in enumerate(sorted_volumes):
+            np.testing.assert_array_equal(volume, expected[:, :, :, ind])
+
+    def test_sort_roi_arrays(self):
+        rois = [np.reshape(volume, (-1,)) for volume in self._volumes]
+        sort_index = np.reshape(self._sort_index, (-1, 3))
+        expected = np.take_along_axis(np.stack(rois, axis=-1), sort_index, axis=-1)
+
+        sorted_rois = sort_volumes_per_voxel(rois, sort_index, batch_size=7)
+        for ind, roi in enumerate(sorted_rois):
+            self.assertEqual(roi.shape, rois[ind].shape)
+            np.testing.assert_array_equal(roi, expected[:, ind])
+
+    def test_undo_sort(self):
+        sorted_volumes = sort_volumes_per_voxel(self._volumes, self._sort_index, batch_size=7)
+        restored = undo_sort_volumes_per_voxel(sorted_volumes, self._sort_index, batch_size=7)
+        for volume, original in zip(restored, self._volumes):
+            np.testing.assert_array_equal(volume[..., 0], original)
+
+    def test_sort_with_mask(self):
+        expected = np.take_along_axis(self._stacked, self._sort_index, axis=-1)
+
+        sort_matrix = create_sort_matrix(self._volumes, mask=self._mask, batch_size=7)
+        np.testing.assert_array_equal(sort_matrix[self._mask], self._sort_index[self._mask])
+        np.testing.assert_array_equal(sort_matrix[~self._mask], 0)
+
+        sorted_volumes = sort_volumes_per_voxel(self._volumes, sort_matrix, mask=self._mask, batch_size=7)
+        for ind, volume in enumerate(sorted_volumes):
+            np.testing.assert_array_equal(volume[self._mask][:, 0], expected[self._mask][:, ind])
+            np.testing.assert_array_equal(volume[~self._mask], 0)
+
+    def test_sort_orientations(self):
+        weights = {'w{}'.format(ind): volume for ind, volume in enumerate(self._volumes)}
+        thetas = {'theta{}'.format(ind): volume for ind, volume in enumerate(self._vectors)}
+        maps = dict(weights, **thetas)
+        maps['other'] = self._volumes[0]
+
+        results = sort_orientations(maps, sorted(weights), [sorted(thetas)], batch_size=7)
+
+        reversed_index = self._sort_index[..., ::-1]
+        expected_weights = np.take_along_axis(self._stacked, reversed_index, axis=-1)
+        expected_thetas = np.take_along_axis(np.stack(self._vectors, axis=3), reversed_index[..., None], axis=3)
+        for ind in range(3):
+            np.testing.assert_array_equal(results['w{}'.format(ind)][..., 0], expected_weights[..., ind])
+            np.testing.assert_array_equal(results['theta{}'.format(ind)], expected_thetas[:, :, :, ind])
+        self.assertIs(results['other'], self._volumes[0])
+
+    def test_mismatching_number_of_maps(self):
+        with self.assertRaises(ValueError):
+            sort_volumes_per_voxel(self._volumes[:2], self._sort_index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+
+from mdt.cl_routines.mapping.tensor_measures import TensorMeasures
+from mdt.post_processing import DTIMeasures
+from mdt.utils import tensor_spherical_to_cartesian
+from mot.cl_runtime_info import CLRuntimeInfo
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-25"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class TensorMeasuresTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_voxels = 100
+        self._parameters = {'d': random_state.uniform(0.1e-9, 3e-9, nmr_voxels),
+                            'dperp0': random_state.uniform(0.1e-9, 3e-9, nmr_voxels),
+                            'dperp1': random_state.uniform(0.1e-9, 3e-9, nmr_voxels),
+                            'theta': random_state.uniform(0, np.pi, nmr_voxels),
+                            'phi': random_state.uniform(0, np.pi, nmr_voxels),
+                            'psi': random_state.uniform(0, np.pi, nmr_voxels),
+                            'd.std': random_state.uniform(0.01e-9, 0.1e-9, nmr_voxels),
+                            'dperp0.std': random_state.uniform(0.01e-9, 0.1e-9, nmr_voxels),
+                            'dperp1.std': random_state.uniform(0.01e-9, 0.1e-9, nmr_voxels)}
+        self._measures = TensorMeasures(cl_runtime_info=CLRuntimeInfo(double_precision=False)).calculate(
+            self._parameters)
+
+    def test_sorted_eigenvalues(self):
+        sorted_eigenvalues = DTIMeasures.sort_eigensystem(self._parameters)[0]
+        for ind, name in enumerate(['d', 'dperp0', 'dperp1']):
+            np.testing.assert_allclose(self._measures[name], sorted_eigenvalues[:, ind], rtol=1e-5, err_msg=name)
+
+    def test_eigenvectors(self):
+        sorted_eigenvectors = DTIMeasures.sort_eigensystem(self._parameters)[1]
+        for ind in range(3):
+            vec = self._measures['vec{}'.format(ind)]
+            np.testing.assert_allclose(np.abs(np.sum(vec * sorted_eigenvectors[ind], axis=1)), 1, rtol=1e-4)
+
+        angle_vectors = tensor_spherical_to_cartesian(self._measures['theta'], self._measures['phi'],
+                                                      self._measures['psi'])
+        for ind in range(3):
+            np.testing.assert_allclose(angle_vectors[ind], self._measures['vec{}'.format(ind)], atol=1e-4)
+
+    def test_angles_describe_the_same_tensor(self):
+        np.testing.assert_allclose(self._get_tensor(self._measures), self._get_tensor(self._parameters),
+                                   rtol=1e-4, atol=1e-14)
+        self.assertTrue(np.all((0 <= self._measures['theta']) & (self._measures['theta'] <= np.pi)))
+        self.assertTrue(np.all((0 <= self._measures['phi']) & (self._measures['phi'] <= np.pi)))
+
+    def test_scalar_measures(self):
+        d, dperp0, dperp1 = (self._measures[name] for name in ['d', 'dperp0', 'dperp1'])
+        np.testing.assert_allclose(self._measures['FA'], DTIMeasures.fractional_anisotropy(d, dperp0, dperp1),
+                                   rtol=1e-4)
+        np.testing.assert_allclose(self._measures['MD'], (d + dperp0 + dperp1) / 3., rtol=1e-5)
+        np.testing.assert_allclose(self._measures['AD'], d, rtol=1e-5)
+        np.testing.assert_allclose(self._measures['RD'], (dperp0 + dperp1) / 2., rtol=1e-5)
+
+    def test_standard_deviations(self):
+        ranking = DTIMeasures.sort_eigensystem(self._parameters)[2]
+        stds = np.column_stack([self._parameters[name] for name in ['d.std', 'dperp0.std', 'dperp1.std']])
+        d_std, dperp0_std, dperp1_std = (stds[np.arange(len(stds)), ranking[:, ind]] for ind in range(3))
+
+        np.testing.assert_allclose(self._measures['FA.std'], DTIMeasures.fractional_anisotropy_std(
+            self._measures['d'], self._measures['dperp0'], self._measures['dperp1'],
+            d_std, dperp0_std, dperp1_std), rtol=1e-3)
+        np.testing.assert_allclose(self._measures['AD.std'], d_std, rtol=1e-5)
+        np.testing.assert_allclose(self._measures['RD.std'], (dperp0_std + dperp1_std) / 2., rtol=1e-5)
+
+        without_stds = {k: v for k, v in self._parameters.items() if not k.endswith('.std')}
+        self.assertNotIn('FA.std', TensorMeasures().calculate(without_stds))
+
+    def test_optimization_maps(self):
+        maps = DTIMeasures.extra_optimization_maps(self._parameters)
+        for name in ['FA', 'MD', 'AD', 'RD', 'vec0', 'FA.std']:
+            np.testing.assert_allclose(maps[name], self._measures[name], rtol=1e-5, err_msg=name)
+
+        modified = DTIMeasures.post_optimization_modifier(self._parameters)
+        self.assertEqual(sorted(modified), sorted(DTIMeasures.cl_required_maps))
+        self.assertTrue(np.all(modified['d'] >= modified['dperp0']))
+        self.assertTrue(np.all(modified['dperp0'] >= modified['dperp1']))
+
+    def _get_tensor(self, parameters):
+        """Get the (v, 3, 3) diffusion Tensor matrices."""
+        vectors = np.stack(tensor_spherical_to_cartesian(parameters['theta'], parameters['phi'], parameters['psi']),
+                           axis=-1)
+        eigenvalues = np.column_stack([parameters['d'], parameters['dperp0'], parameters['dperp1']])
+        return np.einsum('vik,vk,vjk->vij', vectors, eigenvalues, vectors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import numpy as np
+
+from mdt.processing_strategies import get_voxel_ordering, ROIOrdering, SliceOrdering, MortonOrdering, \
+    VoxelRange, ModelProcessor, NeighbourWarmStart
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-21"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class VoxelOrderingTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._mask = random_state.rand(9, 7, 5) > 0.3
+        self._positions = np.argwhere(self._mask)
+        self._roi_indices = np.arange(len(self._positions))
+
+    def test_get_voxel_ordering(self):
+        self.assertIsInstance(get_voxel_ordering('roi'), ROIOrdering)
+        self.assertIsInstance(get_voxel_ordering('slices'), SliceOrdering)
+        self.assertIsInstance(get_voxel_ordering('morton'), MortonOrdering)
+
+        ordering = MortonOrdering()
+        self.assertIs(get_voxel_ordering(ordering), ordering)
+
+        with self.assertRaises(ValueError):
+            get_voxel_ordering('hilbert')
+
+    def test_orderings_are_permutations(self):
+        subset = self._roi_indices[::3]
+        for name in ['roi', 'slices', 'morton']:
+            ordered = get_voxel_ordering(name).order(subset, self._mask)
+            np.testing.assert_array_equal(np.sort(ordered), subset)
+
+    def test_roi_ordering(self):
+        np.testing.assert_array_equal(ROIOrdering().order(self._roi_indices, self._mask), self._roi_indices)
+
+    def test_slice_ordering(self):
+        ordered = SliceOrdering().order(self._roi_indices, self._mask)
+        positions = self._positions[ordered]
+
+        keys = [tuple(position[::-1]) for position in positions]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_morton_ordering(self):
+        mask = np.ones((4, 4, 4), dtype=bool)
+        positions = np.argwhere(mask)
+        ordered = MortonOrdering().order(np.arange(len(positions)), mask)
+
+        def morton_code(position):
+            return sum(((int(position[axis]) >> bit) & 1) << (3 * bit + axis) for bit in range(2) for axis in range(3))
+
+        codes = [morton_code(positions[ind]) for ind in ordered]
+        self.assertEqual(codes, list(range(64)))
+
+        for block_start in range(0, 64, 8):
+            block = positions[ordered[block_start:block_start + 8]]
+            self.assertEqual(len(set(map(tuple, block // 2))), 1)
+
+    def test_chunks_follow_ordering(self):
+        processor = _RecordingProcessor(self._mask)
+        VoxelRange(max_nmr_voxels=10, voxel_ordering='slices').process(processor)
+
+        self.assertTrue(all(len(chunk) <= 10 for chunk in processor.chunks))
+        np.testing.assert_array_equal(np.concatenate(processor.chunks),
+                                      SliceOrdering().order(self._roi_indices, self._mask))
+        for next_chunk, chunk in zip(processor.next_chunks[:-1], processor.chunks[1:]):
+            np.testing.assert_array_equal(next_chunk, chunk)
+        self.assertIsNone(processor.next_chunks[-1])
+        self.assertFalse(processor.warm_start)
+
+    def test_warm_start_is_enabled(self):
+        processor = _RecordingProcessor(self._mask)
+        VoxelRange(max_nmr_voxels=10, warm_start=True).process(processor)
+        self.assertTrue(processor.warm_start)
+
+
+class NeighbourWarmStartTest(unittest.TestCase):
+
+    def setUp(self):
+        self._mask = np.zeros((5, 5, 3), dtype=bool)
+        self._mask[1:4, 1:4, 1] = True
+        self._mask[0, 0, 0] = True
+        self._positions = np.argwhere(self._mask)
+
+    def _roi_index(self, position):
+        return int(np.where(np.all(self._positions == position, axis=1))[0][0])
+
+    def test_without_results(self):
+        warm_start = NeighbourWarmStart(self._mask)
+        initial = np.ones((3, 2))
+        np.testing.assert_array_equal(warm_start.get_starting_points(np.arange(3), initial), initial)
+
+    def test_neighbours(self):
+        warm_start = NeighbourWarmStart(self._mask)
+        center = self._roi_index([2, 2, 1])
+        warm_start.add_results(np.array([center]), np.array([[5., 6.]]))
+
+        neighbour = self._roi_index([1, 2, 1])
+        diagonal = self._roi_index([1, 1, 1])
+        isolated = self._roi_index([0, 0, 0])
+
+        starting_points = warm_start.get_starting_points(np.array([neighbour, diagonal, isolated]), np.zeros((3, 2)))
+        np.testing.assert_array_equal(starting_points, [[5, 6], [0, 0], [0, 0]])
+
+    def test_initial_parameters_are_not_altered(self):
+        warm_start = NeighbourWarmStart(self._mask)
+        warm_start.add_results(np.array([self._roi_index([2, 2, 1])]), np.array([[5., 6.]]))
+
+        initial = np.zeros((1, 2))
+        warm_start.get_starting_points(np.array([self._roi_index([2, 1, 1])]), initial)
+        np.testing.assert_array_equal(initial, 0)
+
+
+class _RecordingProcessor(ModelProcessor):
+
+    def __init__(self, mask):
+        self._mask = mask
+        self.chunks = []
+        self.next_chunks = []
+        self.warm_start = False
+
+    def process(self, roi_indices, next_indices=None):
+        self.chunks.append(np.array(roi_indices))
+        self.next_chunks.append(next_indices)
+
+    def get_voxels_to_compute(self):
+        return np.arange(np.count_nonzero(self._mask))
+
+    def get_total_nmr_voxels(self):
+        return np.count_nonzero(self._mask)
+
+    def get_mask(self):
+        return self._mask
+
+    def enable_warm_start(self):
+        self.warm_start = True
+
+    def combine(self):
+        return {}
+
+    def finalize(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
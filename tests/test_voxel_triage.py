@@ -0,0 +1,93 @@
+import unittest
+import numpy as np
+
+import mdt
+from mdt.configuration import YamlStringAction, get_voxel_triage
+from mdt.protocols import Protocol
+from mdt.utils import SimpleMRIInputData, create_roi
+from mdt.voxel_triage import VoxelTriage, SKIPPED_VOXELS_MAP_NAME
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-05-23"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class VoxelTriageTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        nmr_volumes = 13
+        directions = random_state.normal(size=(nmr_volumes, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        self._protocol = Protocol(columns={'b': np.array([0, 0] + [1e9] * 11),
+                                           'gx': directions[:, 0], 'gy': directions[:, 1], 'gz': directions[:, 2]})
+
+        self._mask = np.ones((4, 3, 2), dtype=bool)
+        self._signal = random_state.uniform(100, 200, self._mask.shape + (nmr_volumes,))
+
+        self._signal[0, 0, 0, 3] = np.nan
+        self._signal[1, 0, 0, 0] = np.inf
+        self._signal[2, 0, 0] = 0
+        self._signal[3, 0, 0, :2] = 5
+        self._expected = [0, 6, 12, 18]
+
+    def _get_input_data(self, noise_std=10):
+        return SimpleMRIInputData(self._protocol, self._signal, self._mask, None, noise_std=noise_std)
+
+    def test_criteria(self):
+        skip = VoxelTriage(min_unweighted_snr=1).get_voxels_to_skip(self._get_input_data())
+        np.testing.assert_array_equal(np.flatnonzero(skip), self._expected)
+
+        skip = VoxelTriage(non_finite=False, all_zeros=False, min_unweighted_snr=1).get_voxels_to_skip(
+            self._get_input_data())
+        np.testing.assert_array_equal(np.flatnonzero(skip), [12, 18])
+
+        skip = VoxelTriage(all_zeros=False).get_voxels_to_skip(self._get_input_data())
+        np.testing.assert_array_equal(np.flatnonzero(skip), [0, 6])
+
+    def test_batches(self):
+        skip = VoxelTriage(min_unweighted_snr=1, batch_size=4).get_voxels_to_skip(self._get_input_data())
+        np.testing.assert_array_equal(np.flatnonzero(skip), self._expected)
+
+    def test_noise_std_per_voxel(self):
+        noise_std = np.full(self._mask.shape, 1.)
+        noise_std[0, 1, 0] = 1000
+        skip = VoxelTriage(min_unweighted_snr=1).get_voxels_to_skip(self._get_input_data(noise_std=noise_std))
+        np.testing.assert_array_equal(np.flatnonzero(skip), [0, 2, 6, 12])
+
+    def test_configuration(self):
+        with mdt.config_context(YamlStringAction('voxel_triage: {enabled: False}')):
+            self.assertIsNone(get_voxel_triage())
+
+        with mdt.config_context(YamlStringAction('voxel_triage: {enabled: True, min_unweighted_snr: 2}')):
+            triage = get_voxel_triage()
+            self.assertEqual(triage.get_criteria(), {'non_finite': True, 'all_zeros': True, 'min_unweighted_snr': 2})
+
+    def test_fit_skips_voxels(self):
+        config = '''
+            active_post_processing:
+                optimization:
+                    covariance: False
+            voxel_triage:
+                enabled: True
+                min_unweighted_snr: 1
+        '''
+        with mdt.config_context(YamlStringAction(config)):
+            results = create_roi(mdt.fit_model('BallStick_r1', self._get_input_data(), None, cl_device_ind=0),
+                                 self._mask)
+
+        skipped = np.zeros(np.count_nonzero(self._mask), dtype=bool)
+        skipped[self._expected] = True
+
+        np.testing.assert_array_equal(np.squeeze(results[SKIPPED_VOXELS_MAP_NAME]), skipped)
+        np.testing.assert_array_equal(np.squeeze(results['UsedMask']), ~skipped)
+        for name in ['S0.s0', 'w_stick0.w', 'Stick0.theta', 'LogLikelihood', 'ReturnCodes']:
+            np.testing.assert_array_equal(results[name][skipped], 0, err_msg=name)
+        self.assertTrue(np.all(results['S0.s0'][~skipped] > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()